@@ -136,7 +136,8 @@ class Launcher(object):
                     region='us-east-1', log=None, scratch=None,
                     ipython_profile=None, ipcontroller_json=None, common=None,
                     direct_write=False, json=False, sort=None,
-                    profile=None):
+                    profile=None, shuffle=None, reuse_outputs=False,
+                    intermediate_format=None, framed_compression=None):
         self.force = force
         self.num_processes = num_processes
         self.keep_intermediates = keep_intermediates
@@ -154,6 +155,10 @@ class Launcher(object):
         self.json = json
         self.sort = sort
         self.profile = profile
+        self.shuffle = shuffle
+        self.reuse_outputs = reuse_outputs
+        self.intermediate_format = intermediate_format
+        self.framed_compression = framed_compression
 
     def run(self, mode, payload):
         """ Replaces current process, using PyPy if it's available.
@@ -191,6 +196,16 @@ class Launcher(object):
                                 '--max-attempts', str(self.max_task_attempts)]
                 if self.sort:
                     runner_args.extend(['--sort', self.sort])
+                if self.shuffle:
+                    runner_args.extend(['--shuffle', self.shuffle])
+                if self.intermediate_format:
+                    runner_args.extend(['--intermediate-format',
+                                            self.intermediate_format])
+                if self.framed_compression:
+                    runner_args.extend(['--framed-compression',
+                                            self.framed_compression])
+                if self.reuse_outputs:
+                    runner_args.append('--reuse-outputs')
                 if self.force:
                     runner_args.append('-f')
                 if self.keep_intermediates:
@@ -220,6 +235,16 @@ class Launcher(object):
                                 '--max-attempts', str(self.max_task_attempts)]
                 if self.sort:
                     runner_args.extend(['--sort', self.sort])
+                if self.shuffle:
+                    runner_args.extend(['--shuffle', self.shuffle])
+                if self.intermediate_format:
+                    runner_args.extend(['--intermediate-format',
+                                            self.intermediate_format])
+                if self.framed_compression:
+                    runner_args.extend(['--framed-compression',
+                                            self.framed_compression])
+                if self.reuse_outputs:
+                    runner_args.append('--reuse-outputs')
                 if self.force:
                     runner_args.append('-f')
                 if self.keep_intermediates:
@@ -606,6 +631,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 bowtie_idx=args.bowtie_idx,
                 bowtie1_exe=args.bowtie1, bowtie2_exe=args.bowtie2,
                 bowtie1_build_exe=args.bowtie1_build,
@@ -634,6 +661,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -646,6 +674,7 @@ if __name__ == '__main__':
                 bam_basename=args.bam_basename,
                 tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename,
+                index_outputs=args.index_outputs,
                 num_processes=args.num_processes,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
@@ -694,6 +723,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -706,6 +736,7 @@ if __name__ == '__main__':
                 bam_basename=args.bam_basename,
                 tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename,
+                index_outputs=args.index_outputs,
                 num_processes=args.num_processes,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
@@ -728,6 +759,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 num_processes=args.num_processes,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
@@ -754,6 +787,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 bowtie_idx=args.bowtie_idx,
                 bowtie1_exe=args.bowtie1, bowtie2_exe=args.bowtie2,
                 bowtie1_build_exe=args.bowtie1_build,
@@ -782,6 +817,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -794,6 +830,7 @@ if __name__ == '__main__':
                 bam_basename=args.bam_basename,
                 tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename,
+                index_outputs=args.index_outputs,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
                 sort_memory_cap=args.sort_memory_cap,
@@ -845,6 +882,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -857,6 +895,7 @@ if __name__ == '__main__':
                 bam_basename=args.bam_basename,
                 tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename,
+                index_outputs=args.index_outputs,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
                 sort_memory_cap=args.sort_memory_cap,
@@ -882,6 +921,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 gzip_intermediates=args.gzip_intermediates,
                 gzip_level=args.gzip_level,
                 sort_memory_cap=args.sort_memory_cap,
@@ -905,6 +946,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 isofrag_idx=args.isofrag_idx,
                 intermediate_dir=args.intermediate,
                 force=args.force, aws_exe=args.aws, profile=args.profile,
@@ -934,6 +977,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -946,6 +990,7 @@ if __name__ == '__main__':
                 bam_basename=args.bam_basename,
                 tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename, log_uri=args.log_uri,
+                index_outputs=args.index_outputs,
                 ami_version=args.ami_version,
                 visible_to_all_users=args.visible_to_all_users,
                 tags='', name=args.name,
@@ -1009,6 +1054,7 @@ if __name__ == '__main__':
                 experimental=args.experimental,
                 count_multiplier=args.count_multiplier,
                 max_refs_per_strand=args.max_refs_per_strand,
+                max_paths_per_strand=args.max_paths_per_strand,
                 tie_margin=args.tie_margin,
                 normalize_percentile=args.normalize_percentile,
                 transcriptome_indexes_per_sample=\
@@ -1020,6 +1066,7 @@ if __name__ == '__main__':
                 deliverables=args.deliverables,
                 bam_basename=args.bam_basename, tsv_basename=args.tsv_basename,
                 bed_basename=args.bed_basename, log_uri=args.log_uri,
+                index_outputs=args.index_outputs,
                 ami_version=args.ami_version,
                 visible_to_all_users=args.visible_to_all_users,
                 tags='', name=args.name,
@@ -1054,6 +1101,8 @@ if __name__ == '__main__':
                 short_read_names=args.short_read_names,
                 skip_bad_records=args.skip_bad_records,
                 ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+                stream_downloads=args.stream_downloads,
+                preprocess_workers=args.preprocess_workers,
                 intermediate_dir=args.intermediate,
                 force=args.force, aws_exe=args.aws, profile=args.profile,
                 region=args.region,
@@ -1170,6 +1219,26 @@ if __name__ == '__main__':
                                         if mode in ['local', 'parallel']
                                         else None
                                     ),
+                                    shuffle=(
+                                        args.shuffle
+                                        if mode in ['local', 'parallel']
+                                        else None
+                                    ),
+                                    reuse_outputs=(
+                                        args.reuse_outputs
+                                        if mode in ['local', 'parallel']
+                                        else False
+                                    ),
+                                    intermediate_format=(
+                                        args.intermediate_format
+                                        if mode in ['local', 'parallel']
+                                        else None
+                                    ),
+                                    framed_compression=(
+                                        args.framed_compression
+                                        if mode in ['local', 'parallel']
+                                        else None
+                                    ),
                                     json=args.json,
                                     profile=(
                                         args.profile
@@ -56,7 +56,16 @@ import tempfile
 import shutil
 import os
 import contextlib
+import heapq
+import errno
+import threading
+import re
+import random
 from tools import make_temp_dir, make_temp_dir_and_register_cleanup
+from tools import wait_for_asyncresults, notify_when_done
+from tools import FramedWriter, framed_records, framed_lines, is_framed, \
+    framed_codec_functions, varint, _framed_magic, _framed_codecs, \
+    _framed_max_digits, _framed_codec_variable
 from ansibles import Url
 import site
 import string
@@ -71,7 +80,7 @@ def add_args(parser):
     parser.add_argument(
             '-m', '--memcap', type=int, required=False, default=(1024*300),
             help=('Maximum amount of memory (in bytes) to use per UNIX sort '
-                  'instance.')
+                  'instance or per in-process shuffle.')
         )
     parser.add_argument(
             '-p', '--num-processes', type=int, required=False, default=1,
@@ -149,6 +158,63 @@ def add_args(parser):
             help=('Path to sort executable. Add arguments as necessary, '
                   'e.g. for specifying a directory for storing sort\'s '
                   'temporary files.'))
+    parser.add_argument('--shuffle', type=str, required=False,
+            default='memory', choices=['memory', 'sort'],
+            help=('Shuffle engine. "memory" partitions and sorts map output '
+                  'in process, spilling sorted runs to disk when --memcap '
+                  'is reached, and streams a k-way merge of the runs into '
+                  'each reducer; "sort" presorts and merges with UNIX sort. '
+                  'Sort options that the in-process engine cannot emulate '
+                  'fall back to "sort".'))
+    parser.add_argument('--no-pipeline', action='store_const',
+            const=True, default=False,
+            help=('Run steps one after another, each map, partition, and '
+                  'reduce phase finishing before the next starts, rather '
+                  'than as a DAG of steps; always true in --ipy mode.'))
+    parser.add_argument('--reuse-outputs', action='store_const',
+            const=True, default=False,
+            help=('Skip steps whose outputs are stamped with a hash of the '
+                  'same args, input files, and stamps of the steps they '
+                  'depend on, and whose outputs have not changed since. '
+                  'Implies --keep-intermediates.'))
+    parser.add_argument('--stamp-content-limit', type=int, required=False,
+            default=1048576,
+            help=('Max size in bytes of a file read by a step that is '
+                  'hashed by content for --reuse-outputs. Larger files are '
+                  'stamped by size and modification time only, so merely '
+                  'touching one reruns the steps that read it, while '
+                  'rewriting it with the same size and modification time '
+                  'goes unnoticed. Use -1 to hash every file.'))
+    parser.add_argument('--intermediate-format', type=str, required=False,
+            default='text', choices=['text', 'framed'],
+            help=('Format of intermediate files. "framed" asks streaming '
+                  'commands to write blocks of length-prefixed records with '
+                  'numeric fields stored as varints (see '
+                  'dooplicity.tools.framed_output()), and shuffles map '
+                  'output as framed sorted runs; streaming commands must '
+                  'read input with dooplicity.tools.xstream or xlines. '
+                  'Outputs that no later step reads as input are always '
+                  'text. Overrides --gzip-outputs for framed files.'))
+    parser.add_argument('--framed-compression', type=str, required=False,
+            default='zlib', choices=_framed_codecs,
+            help=('Block compression to use for framed intermediates; "lz4" '
+                  'and "zstd" require the corresponding Python modules.'))
+
+def set_service_dir(service_dir):
+    """ Sets directory where streaming commands place node-local services.
+
+        Services like pools of aligners are started by the first task that
+        needs them and shared by later tasks on the same node. They find the
+        directory in the environment variable DOOPLICITY_SERVICE_DIR and exit
+        when it is removed.
+
+        service_dir: path to directory; may contain environment variables
+
+        No return value.
+    """
+    os.environ['DOOPLICITY_SERVICE_DIR'] = os.path.expanduser(
+            os.path.expandvars(service_dir)
+        )
 
 def init_worker():
     """ Prevents KeyboardInterrupt from reaching a pool's workers.
@@ -222,17 +288,228 @@ def parsed_keys(partition_options, key_fields):
         )
         return partitioned_key
 
+_numeric_prefix = re.compile(r'\s*(-?[0-9]*(?:\.[0-9]*)?)')
+
+def numeric_sort_field(field):
+    """ Interprets a field the way UNIX sort -n does in the C locale.
+
+        Leading blanks are skipped, and the longest numeric prefix is
+        used; fields without one compare as zero.
+
+        field: string containing field
+
+        Return value: int or float
+    """
+    prefix = _numeric_prefix.match(field).group(1)
+    try:
+        if '.' in prefix:
+            return float(prefix)
+        return int(prefix)
+    except ValueError:
+        # Empty prefix, "-", ".", or "-."
+        return 0
+
+def parsed_sort_key(sort_options, separator):
+    """ Parses UNIX sort options into a Python key function.
+
+        The key function mimics LC_ALL=C sort -t<separator> <sort_options>,
+        including sort's last-resort comparison of whole lines when all keys
+        compare equal. Only -k options whose fields have no character
+        positions are supported, each optionally with the modifiers n and r;
+        r is permitted only alongside n.
+
+        sort_options: UNIX sort options like -k1,1 -k2,3 -k4,4n
+        separator: separator between successive fields of a line
+
+        Return value: function that takes a line as input and returns a
+            tuple to sort on OR False if sort_options cannot be emulated
+    """
+    keys = []
+    for arg in sort_options.split('-k'):
+        arg = arg.strip()
+        if not arg:
+            continue
+        modifiers = set()
+        bounds = []
+        for el in arg.split(','):
+            stripped = el.rstrip('nr')
+            modifiers.update(el[len(stripped):])
+            if not stripped.isdigit() or int(stripped) < 1:
+                return False
+            bounds.append(int(stripped))
+        if len(bounds) > 2 or modifiers == set(['r']):
+            return False
+        field = 'separator.join(fields[{}:{}])'.format(
+                    bounds[0] - 1, bounds[1] if len(bounds) == 2 else ''
+                )
+        if 'n' in modifiers:
+            field = '{}numeric_sort_field({})'.format(
+                        '-' if 'r' in modifiers else '', field
+                    )
+        keys.append(field)
+    exec (
+"""def sort_key(line, separator={separator!r}):
+    if line[-1:] == '\\n':
+        line = line[:-1]
+    fields = line.split(separator)
+    return ({keys}line,)
+""".format(separator=separator,
+            keys=''.join([key + ', ' for key in keys]))
+    )
+    return sort_key
+
+def write_sorted_run(lines, run_file, sort_key, gzip=False, gzip_level=3,
+                        framed_codec=None):
+    """ Sorts lines in place and writes them to a run file.
+
+        lines: list of lines, each ending in a newline
+        run_file: path to run file
+        sort_key: key function from parsed_sort_key()
+        gzip: True iff run file should be gzipped
+        gzip_level: level of gzip compression to use, if applicable
+        framed_codec: block codec of framed run file, or None if run file
+            should be text; overrides gzip
+
+        No return value.
+    """
+    lines.sort(key=sort_key)
+    if framed_codec is not None:
+        gzip = False
+        run_stream = FramedWriter(open(run_file, 'wb'), codec=framed_codec)
+    elif gzip:
+        run_process = subprocess.Popen(
+                'gzip -%d >%s' % (gzip_level, run_file),
+                shell=True, bufsize=-1,
+                executable='/bin/bash',
+                stdin=subprocess.PIPE
+            )
+        run_stream = run_process.stdin
+    else:
+        run_stream = open(run_file, 'w')
+    try:
+        run_stream.writelines(lines)
+    finally:
+        run_stream.close()
+        if gzip:
+            run_process.wait()
+
+def sorted_run_lines(run_file, sort_key):
+    """ Iterates through a sorted run, framed, gzip'd, or neither.
+
+        run_file: path to run file written by write_sorted_run()
+        sort_key: key function from parsed_sort_key()
+
+        Yield value: tuple (sort key, line)
+    """
+    with open(run_file, 'rb') as binary_input_stream:
+        magic = binary_input_stream.read(len(_framed_magic))
+        if is_framed(magic):
+            for line in framed_lines(binary_input_stream, prefix=magic):
+                yield sort_key(line), line
+            return
+    gzipped = (magic[:2] == '\x1f\x8b')
+    if gzipped:
+        run_process = subprocess.Popen(['gzip', '-cd', run_file],
+                                        bufsize=-1,
+                                        stdout=subprocess.PIPE)
+        run_stream = run_process.stdout
+    else:
+        run_stream = open(run_file)
+    try:
+        for line in run_stream:
+            if line[-1:] != '\n':
+                line += '\n'
+            yield sort_key(line), line
+    finally:
+        run_stream.close()
+        if gzipped:
+            run_process.wait()
+
+def input_lines(input_file):
+    """ Iterates through lines of a file that is framed, gzip'd, or neither.
+
+        input_file: path to input file
+
+        Yield value: line
+    """
+    with open(input_file, 'rb') as binary_input_stream:
+        magic = binary_input_stream.read(len(_framed_magic))
+        if is_framed(magic):
+            for line in framed_lines(binary_input_stream, prefix=magic):
+                yield line
+            return
+    with yopen(None, input_file) as input_stream:
+        for line in input_stream:
+            yield line
+
+def feed_lines(lines, output_stream, description):
+    """ Writes lines to a stream, then closes it.
+
+        lines: iterable of lines
+        output_stream: where to write lines; typically a streaming command's
+            stdin
+        description: what is being fed, for error messages
+
+        Return value: None if no errors encountered; otherwise error string.
+    """
+    try:
+        for line in lines:
+            output_stream.write(line)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            from traceback import format_exc
+            return ('Error\n\n%s\nencountered %s.'
+                        % (format_exc(), description))
+        # Streaming command closed its input; its exit level is reported
+    except Exception:
+        from traceback import format_exc
+        return ('Error\n\n%s\nencountered %s.'
+                        % (format_exc(), description))
+    finally:
+        try:
+            output_stream.close()
+        except IOError:
+            pass
+    return None
+
+def feed_merged_runs(run_files, sort_key, output_stream):
+    """ Streams a k-way merge of sorted runs into a stream, then closes it.
+
+        If the runs are framed, so is the merge, but its blocks are not
+        compressed because it goes through a pipe.
+
+        run_files: paths to run files, each sorted according to sort_key
+        sort_key: key function from parsed_sort_key()
+        output_stream: where to write merged lines; typically a reducer's
+            stdin
+
+        Return value: None if no errors encountered; otherwise error string.
+    """
+    with open(run_files[0], 'rb') as binary_input_stream:
+        if is_framed(binary_input_stream.read(len(_framed_magic))):
+            output_stream = FramedWriter(output_stream, codec='none')
+    return feed_lines(
+            (line for _, line in heapq.merge(
+                    *[sorted_run_lines(run_file, sort_key)
+                        for run_file in run_files]
+                )),
+            output_stream,
+            'merging runs [%s]' % ', '.join(run_files)
+        )
+
 def presorted_tasks(input_files, process_id, sort_options, output_dir,
                     key_fields, separator, partition_options, task_count,
                     memcap, gzip=False, gzip_level=3, scratch=None,
                     direct_write=False, sort='sort', mod_partition=False,
-                    max_attempts=4):
+                    shuffle='sort', framed_codec=None, max_attempts=4):
     """ Partitions input data into tasks and presorts them.
 
         Files in output directory are in the format x.y, where x is a task
         number on the interval [0, number of tasks - 1], and y is a process
         ID that identifies which process created the file. y is unimportant;
-        the glob x.* should be catted to the reducer.
+        the glob x.* should be catted to the reducer. The in-process shuffle
+        instead writes sorted runs in the format x.y.z, where z numbers the
+        spills made by process y.
 
         Formula for computing task assignment: 
             int(hashlib.md5(key).hexdigest(), 16) % (task_count)
@@ -257,6 +534,11 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         sort: path to sort executable
         mod_partition: if True, task is assigned according to formula
             (product of fields) % task_count
+        shuffle: "sort" to presort with UNIX sort; "memory" to write sorted
+            runs from Python instead, falling back to UNIX sort if
+            sort_options cannot be emulated
+        framed_codec: block codec of framed sorted runs written by the
+            in-process shuffle, or None if they should be text
         max_attempts: maximum number of times to attempt partitioning input.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
@@ -304,46 +586,83 @@ def presorted_tasks(input_files, process_id, sort_options, output_dir,
         if not partitioned_key:
             # Invalid partition options
             return ('Partition options "%s" are invalid.' % partition_options)
+        def assigned_task(line):
+            """ Computes task to which line is assigned. """
+            key = partitioned_key(line, separator)
+            if mod_partition and len(key) <= 1:
+                try:
+                    return abs(int(key[0])) % task_count
+                except (IndexError, ValueError):
+                    # Null key or some field doesn't work with this
+                    pass
+            return int(
+                    hashlib.md5(separator.join(key)).hexdigest(), 16
+                ) % task_count
+        sort_key = (parsed_sort_key(sort_options, separator)
+                        if shuffle == 'memory' else False)
+        if sort_key:
+            '''Shuffle in process: buffer lines by task, and write each
+            task's buffer as a sorted run only when memcap is reached or
+            input is exhausted. Like sort -S, memcap is in kilobytes; count
+            some overhead per line for the string object and its sort key.'''
+            task_buffers = defaultdict(list)
+            buffered_bytes, run_number = 0, 0
+            run_extension = ('.gz' if gzip and framed_codec is None
+                                else '')
+            for input_file in input_files:
+                for line in input_lines(input_file):
+                    if line[-1:] != '\n':
+                        line += '\n'
+                    task_buffers[assigned_task(line)].append(line)
+                    buffered_bytes += len(line) + 100
+                    if buffered_bytes < memcap * 1024:
+                        continue
+                    for task in task_buffers:
+                        write_sorted_run(
+                                task_buffers[task],
+                                os.path.join(output_dir, '%d.%s.%d%s'
+                                        % (task, process_id, run_number,
+                                            run_extension)),
+                                sort_key, gzip, gzip_level, framed_codec
+                            )
+                    task_buffers = defaultdict(list)
+                    buffered_bytes = 0
+                    run_number += 1
+            for task in task_buffers:
+                write_sorted_run(
+                        task_buffers[task],
+                        os.path.join(output_dir, '%d.%s.%d%s'
+                                % (task, process_id, run_number,
+                                    run_extension)),
+                        sort_key, gzip, gzip_level, framed_codec
+                    )
+            return None
         for input_file in input_files:
-            with yopen(None, input_file) as input_stream:
-                for line in input_stream:
-                    key = partitioned_key(line, separator)
-                    if mod_partition and len(key) <= 1:
-                        try:
-                            task = abs(int(key[0])) % task_count
-                        except (IndexError, ValueError):
-                            # Null key or some field doesn't work with this
-                            task = int(
-                                hashlib.md5(separator.join(key)).hexdigest(),
-                                16
-                            ) % task_count
+            for line in input_lines(input_file):
+                task = assigned_task(line)
+                try:
+                    task_streams[task].write(line)
+                except KeyError:
+                    # Task file doesn't exist yet; create it
+                    if gzip:
+                        task_file = os.path.join(output_dir, str(task) +
+                                                    '.' + str(process_id)
+                                                    + '.unsorted.gz')
+                        task_stream_processes[task] = subprocess.Popen(
+                                'gzip -%d >%s' % 
+                                (gzip_level, task_file),
+                                shell=True, bufsize=-1,
+                                executable='/bin/bash',
+                                stdin=subprocess.PIPE
+                            )
+                        task_streams[task] \
+                            = task_stream_processes[task].stdin
                     else:
-                        task = int(
-                            hashlib.md5(separator.join(key)).hexdigest(), 16
-                        ) % task_count
-                    try:
-                        task_streams[task].write(line)
-                    except KeyError:
-                        # Task file doesn't exist yet; create it
-                        if gzip:
-                            task_file = os.path.join(output_dir, str(task) +
-                                                        '.' + str(process_id)
-                                                        + '.unsorted.gz')
-                            task_stream_processes[task] = subprocess.Popen(
-                                    'gzip -%d >%s' % 
-                                    (gzip_level, task_file),
-                                    shell=True, bufsize=-1,
-                                    executable='/bin/bash',
-                                    stdin=subprocess.PIPE
-                                )
-                            task_streams[task] \
-                                = task_stream_processes[task].stdin
-                        else:
-                            task_file = os.path.join(output_dir, str(task) +
-                                                        '.' + str(process_id)
-                                                        + '.unsorted')
-                            task_streams[task] = open(task_file, 'w')
-                        task_streams[task].write(line)
+                        task_file = os.path.join(output_dir, str(task) +
+                                                    '.' + str(process_id)
+                                                    + '.unsorted')
+                        task_streams[task] = open(task_file, 'w')
+                    task_streams[task].write(line)
         for task in task_streams:
             task_streams[task].close()
         if gzip:
@@ -442,7 +761,9 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                   separator, sort_options, memcap,
                                   gzip=False, gzip_level=3, scratch=None,
                                   direct_write=False, sort='sort',
-                                  dir_to_path=None, attempt_number=None):
+                                  dir_to_path=None, shuffle='sort',
+                                  framed_codec=None, framed_keys=None,
+                                  attempt_number=None):
     """ Runs a streaming command on a task, segregating multiple outputs. 
 
         streaming_command: streaming command to run.
@@ -474,6 +795,15 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
             no matter what scratch is.
         sort: path to sort executable.
         dir_to_path: path to add to PATH.
+        shuffle: "sort" to merge presorted input with UNIX sort -m; "memory"
+            to stream a k-way merge of sorted runs into the streaming
+            command from Python instead, falling back to UNIX sort if
+            sort_options cannot be emulated
+        framed_codec: block codec the streaming command should use for
+            framed output, or None if it should write text; framed output
+            overrides gzip
+        framed_keys: if multiple_outputs, keys of outputs to keep framed, or
+            None for all keys; records under other keys are written as text
         attempt_number: attempt number of current task or None if no retries.
             MUST BE FINAL ARG to be compatible with 
             execute_balanced_job_with_retries().
@@ -519,13 +849,38 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
             # No input!
             return None
         if sort_options is None:
-            # Mapper. Check if first input file is gzip'd
-            with open(input_files[0], 'rb') as binary_input_stream:
-                if binary_input_stream.read(2) == '\x1f\x8b':
-                    # Magic number of gzip'd file found
-                    prefix = 'gzip -cd %s' % input_glob
-                else:
-                    prefix = 'cat %s' % input_glob
+            # Mapper. Check if input files are framed or gzip'd
+            magics = []
+            for input_file in input_files:
+                with open(input_file, 'rb') as binary_input_stream:
+                    magics.append(
+                            binary_input_stream.read(len(_framed_magic))
+                        )
+            framed = [is_framed(magic) for magic in magics]
+            if any(framed) and not all(framed):
+                '''Framed streams can be concatenated, but not with text;
+                Python decodes input for the streaming command.'''
+                feed = lambda output_stream: feed_lines(
+                        itertools.chain.from_iterable(
+                                input_lines(input_file)
+                                for input_file in input_files
+                            ),
+                        output_stream,
+                        'reading input files [%s]' % ', '.join(input_files)
+                    )
+                prefix = None
+            elif magics[0][:2] == '\x1f\x8b':
+                # Magic number of gzip'd file found
+                prefix = 'gzip -cd %s' % input_glob
+            else:
+                prefix = 'cat %s' % input_glob
+        elif shuffle == 'memory' and parsed_sort_key(sort_options, separator):
+            # Reducer. Python feeds merged runs to the streaming command.
+            sort_key = parsed_sort_key(sort_options, separator)
+            feed = lambda output_stream: feed_merged_runs(
+                    input_files, sort_key, output_stream
+                )
+            prefix = None
         else:
             # Reducer. Merge sort the input glob.
             if gzip:
@@ -554,10 +909,17 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
         new_env = os.environ.copy()
         new_env['mapreduce_task_partition'] \
             = new_env['mapred_task_partition'] = str(task_id)
+        if framed_codec is not None:
+            new_env[_framed_codec_variable] = framed_codec
+            gzip = False
+        else:
+            new_env.pop(_framed_codec_variable, None)
         if multiple_outputs:
             # Must grab each line of output and separate by directory
-            command_to_run \
-                = prefix + ' | ' + streaming_command + (' 2>%s' % err_file)
+            command_to_run = ' | '.join(
+                    ([prefix] if prefix is not None else [])
+                    + [streaming_command]
+                ) + (' 2>%s' % err_file)
             # Need bash or zsh for process substitution
             multiple_output_process = subprocess.Popen(
                     ' '.join([('set -eo pipefail; cd %s;' % dir_to_path)
@@ -565,48 +927,104 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                                 else 'set -eo pipefail;',
                               command_to_run]),
                     shell=True,
+                    stdin=(subprocess.PIPE if prefix is None else None),
                     stdout=subprocess.PIPE,
                     stderr=open(os.devnull, 'w'),
                     env=new_env,
                     bufsize=-1,
                     executable='/bin/bash'
                 )
+            if prefix is None:
+                '''Feed command from another thread so its output can be
+                read here at the same time.'''
+                feed_errors = []
+                feeder = threading.Thread(
+                        target=lambda: feed_errors.append(
+                                feed(multiple_output_process.stdin)
+                            )
+                    )
+                feeder.daemon = True
+                feeder.start()
             task_file_streams = {}
             if gzip:
                 task_file_stream_processes = {}
-            for line in multiple_output_process.stdout:
-                key, _, line_to_write = line.partition(separator)
+            def open_task_file(key):
+                """ Opens output file for key; None if that fails. """
+                '''Must create new file, but another process could have
+                created the output directory.'''
+                key_dir = os.path.join(output_dir, key)
                 try:
-                    task_file_streams[key].write(line_to_write)
-                except KeyError:
-                    '''Must create new file, but another process could have
-                    created the output directory.'''
-                    key_dir = os.path.join(output_dir, key)
+                    os.makedirs(key_dir)
+                except OSError:
+                    if not os.path.exists(key_dir):
+                        return None
+                if framed_stdout and (framed_keys is None
+                                        or key in framed_keys):
+                    return FramedWriter(
+                            open(os.path.join(key_dir, str(task_id)), 'wb'),
+                            codec=framed_codec
+                        )
+                if gzip:
+                    task_file_stream_processes[key] = subprocess.Popen(
+                            'gzip -%d >%s' % 
+                            (gzip_level,
+                             os.path.join(key_dir, str(task_id) + '.gz')),
+                            shell=True, bufsize=-1,
+                            executable='/bin/bash',
+                            stdin=subprocess.PIPE
+                        )
+                    return task_file_stream_processes[key].stdin
+                return open(os.path.join(key_dir, str(task_id)), 'w')
+            head = multiple_output_process.stdout.read(len(_framed_magic))
+            framed_stdout = framed_codec is not None and is_framed(head)
+            if framed_stdout:
+                # Route records by key without turning them into text
+                for record in framed_records(multiple_output_process.stdout,
+                                                prefix=head):
+                    key = record[0]
                     try:
-                        os.makedirs(key_dir)
-                    except OSError:
-                        if not os.path.exists(key_dir):
+                        task_file_stream = task_file_streams[key]
+                    except KeyError:
+                        task_file_stream = open_task_file(key)
+                        if task_file_stream is None:
                             return (('Streaming command "%s" failed: problem '
                                      'encountered creating output '
-                                     'directory %s.') % (command_to_run,
-                                                          key_dir))
-                    if gzip:
-                        task_file_stream_processes[key] = subprocess.Popen(
-                                'gzip -%d >%s' % 
-                                (gzip_level,
-                                 os.path.join(key_dir, str(task_id) + '.gz')),
-                                shell=True, bufsize=-1,
-                                executable='/bin/bash',
-                                stdin=subprocess.PIPE
-                            )
-                        task_file_streams[key] \
-                            = task_file_stream_processes[key].stdin
+                                     'directory %s.') % (
+                                            command_to_run,
+                                            os.path.join(output_dir, key)
+                                        ))
+                        task_file_streams[key] = task_file_stream
+                    if isinstance(task_file_stream, FramedWriter):
+                        task_file_stream.write_record(record[1:])
                     else:
-                        task_file_streams[key] = open(
-                                os.path.join(key_dir, str(task_id)), 'w'
+                        task_file_stream.write(
+                                separator.join(record[1:]) + '\n'
                             )
-                    task_file_streams[key].write(line_to_write)
+            else:
+                for line in itertools.chain(
+                        (head + multiple_output_process.stdout.readline()
+                            ).splitlines(True),
+                        multiple_output_process.stdout
+                    ):
+                    key, _, line_to_write = line.partition(separator)
+                    try:
+                        task_file_streams[key].write(line_to_write)
+                    except KeyError:
+                        task_file_stream = open_task_file(key)
+                        if task_file_stream is None:
+                            return (('Streaming command "%s" failed: problem '
+                                     'encountered creating output '
+                                     'directory %s.') % (
+                                            command_to_run,
+                                            os.path.join(output_dir, key)
+                                        ))
+                        task_file_streams[key] = task_file_stream
+                        task_file_stream.write(line_to_write)
             multiple_output_process_return = multiple_output_process.wait()
+            if prefix is None:
+                feeder.join()
+                if feed_errors[0] is not None:
+                    return feed_errors[0]
             if multiple_output_process_return != 0:
                 return (('Streaming command "%s" failed; exit level was %d.')
                          % (command_to_run, multiple_output_process_return))
@@ -617,8 +1035,10 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                 out_file = os.path.abspath(
                                 os.path.join(output_dir, str(task_id) + '.gz')
                             )
-                command_to_run \
-                    = prefix + ' | ' + streaming_command + (
+                command_to_run = ' | '.join(
+                        ([prefix] if prefix is not None else [])
+                        + [streaming_command]
+                    ) + (
                             ' 2>%s | gzip -%d >%s'
                                 % (err_file,
                                     gzip_level,
@@ -628,10 +1048,35 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                 out_file = os.path.abspath(
                                 os.path.join(output_dir, str(task_id))
                             )
-                command_to_run \
-                    = prefix + ' | ' + streaming_command + (' >%s 2>%s'
-                                                             % (out_file,
-                                                                err_file))
+                command_to_run = ' | '.join(
+                        ([prefix] if prefix is not None else [])
+                        + [streaming_command]
+                    ) + (' >%s 2>%s' % (out_file, err_file))
+            if prefix is None:
+                # All output is redirected, so feed command from here
+                reduce_process = subprocess.Popen(
+                        ' '.join([('set -eo pipefail; cd %s;'
+                                    % dir_to_path)
+                                    if dir_to_path is not None
+                                    else 'set -eo pipefail;',
+                                  command_to_run]),
+                        shell=True,
+                        stdin=subprocess.PIPE,
+                        stdout=open(os.devnull, 'w'),
+                        stderr=subprocess.STDOUT,
+                        env=new_env,
+                        bufsize=-1,
+                        executable='/bin/bash'
+                    )
+                feed_error = feed(reduce_process.stdin)
+                reduce_process_return = reduce_process.wait()
+                if feed_error is not None:
+                    return feed_error
+                if reduce_process_return != 0:
+                    return (('Streaming command "%s" failed; exit level '
+                             'was %d.')
+                             % (command_to_run, reduce_process_return))
+                return None
             try:
                 # Need bash or zsh for process substitution
                 subprocess.check_output(' '.join([('set -eo pipefail; cd %s;'
@@ -679,12 +1124,474 @@ def step_runner_with_error_return(streaming_command, input_glob, output_dir,
                         )
             shutil.rmtree(output_dir)
 
+def file_key(path):
+    """ Identifies a file whether or not it's gzipped.
+
+        path: path to file
+
+        Return value: absolute path with any .gz extension removed
+    """
+    path = os.path.abspath(path)
+    if path.endswith('.gz'):
+        return path[:-3]
+    return path
+
+def execute_balanced_ipython_job(pool, iface, task_function,
+    task_function_args, host_map, engine_map, file_hosts,
+    status_message='Tasks completed', finish_message='Completed tasks.',
+    max_attempts=4, task_inputs=None, task_outputs=None, steps=None):
+    """ Executes parallel job over IPython engines with retries.
+
+        Waits until some task completes, then immediately assigns queued
+        tasks to the engines freed. A task is assigned preferentially to an
+        engine on the node that wrote most of its input files so it reads
+        them from that node's cache. If a task fails on one engine, it is
+        retried on another engine. If a task has been tried on all engines
+        but fails before max_attempts is exceeded, the step is failed.
+
+        pool: IPython Client object; all engines it spans are used
+        iface: DooplicityInterface object for spewing log messages
+            to console
+        task_function: name if function to execute
+        task_function_args: iterable of lists, each of whose items are
+            task_function's arguments, WITH THE EXCEPTION OF A SINGLE
+            KEYWORD ARGUMENT "attempt_count". This argument must be the
+            final keyword argument of the function but _excluded_ from the
+            arguments in any item of task_function_args.
+        host_map: dictionary mapping engine IDs to hostnames
+        engine_map: dictionary mapping hostnames to lists of engine IDs
+        file_hosts: dictionary mapping file_key() of each file written by
+            a completed task to the hostname of the engine that wrote it;
+            updated with task_outputs
+        status_message: status message about tasks completed
+        finish_message: message to output when all tasks are completed
+        max_attempts: max number of times to attempt any given task
+        task_inputs: list whose ith item is a list of files read by the
+            task with the ith item of task_function_args as arguments, or
+            None if unknown
+        task_outputs: list whose ith item is a list of files written by
+            the task with the ith item of task_function_args as arguments,
+            or None if unknown
+        steps: steps to list as not completed if the job fails, or None
+
+        No return value.
+    """
+    global failed
+    random.seed(pool.ids[-1])
+    all_engines = set(pool.ids)
+    free_engines = set(pool.ids)
+    completed_tasks = 0
+    tasks_to_assign = deque([
+            [task_function_arg, i, []] for i, task_function_arg
+            in enumerate(task_function_args)
+        ])
+    task_count = len(tasks_to_assign)
+    # Ordered so results are checked in the order tasks were submitted
+    assigned_tasks = OrderedDict()
+    # Set by done callbacks registered on tasks as they're submitted
+    done_event = threading.Event()
+    max_task_fails = 0
+    iface.status(('    %s: '
+                  '%d/%d | \\max_i (task_i fails): %d/%d')
+                    % (status_message, completed_tasks,
+                        task_count, max_task_fails,
+                        max_attempts - 1))
+    while completed_tasks < task_count:
+        for _ in xrange(len(tasks_to_assign)):
+            if not free_engines:
+                break
+            task_to_assign = tasks_to_assign.popleft()
+            forbidden_engines = set(task_to_assign[2])
+            if len(forbidden_engines) >= 2:
+                # After two fails, do not allow reused nodes
+                for forbidden_engine in task_to_assign[2]:
+                    forbidden_engines.update(
+                        engine_map[host_map[forbidden_engine]]
+                    )
+            if all_engines <= forbidden_engines:
+                iface.fail(('No more running IPython engines '
+                            'and/or nodes on which function-arg '
+                            'combo (%s, %s) has not failed '
+                            'attempt to execute. Check the '
+                            'IPython cluster\'s integrity and '
+                            'resource availability.')
+                             % (task_function, task_to_assign[0]),
+                             steps=steps)
+                failed = True
+                raise RuntimeError
+            candidate_engines = free_engines - forbidden_engines
+            if not candidate_engines:
+                # No engine to assign yet; add back to queue
+                tasks_to_assign.append(task_to_assign)
+                continue
+            if task_inputs is not None:
+                input_counts = defaultdict(int)
+                for input_file in task_inputs[task_to_assign[1]]:
+                    input_counts[
+                            file_hosts.get(file_key(input_file))
+                        ] += 1
+                most_inputs = max(
+                        input_counts[host_map[engine]]
+                        for engine in candidate_engines
+                    )
+                candidate_engines = [
+                        engine for engine in candidate_engines
+                        if input_counts[host_map[engine]]
+                        == most_inputs
+                    ]
+            assigned_engine = random.choice(
+                    sorted(candidate_engines)
+                )
+            asyncresult = pool[assigned_engine].apply_async(
+                    task_function,
+                    *(task_to_assign[0] + [len(task_to_assign[2])])
+                )
+            if done_event is not None and not notify_when_done(
+                    asyncresult, done_event
+                ):
+                # Legacy AsyncResults must be polled
+                done_event = None
+            assigned_tasks[asyncresult] = [
+                    task_to_assign[0], task_to_assign[1],
+                    task_to_assign[2] + [assigned_engine]
+                ]
+            free_engines.remove(assigned_engine)
+        for asyncresult in wait_for_asyncresults(
+                    pool, assigned_tasks, first_completed=True,
+                    done_event=done_event
+                ):
+            task = assigned_tasks.pop(asyncresult)
+            assert task[-1][-1] == asyncresult.engine_id
+            # Free engine
+            free_engines.add(task[-1][-1])
+            return_value = asyncresult.get()
+            if return_value is not None:
+                if max_attempts > len(task[2]):
+                    # Add to queue for reattempt
+                    tasks_to_assign.append(task)
+                    max_task_fails = max(
+                            len(task[2]), max_task_fails
+                        )
+                else:
+                    # Bail if max_attempts is saturated
+                    iface.fail(return_value, steps=steps)
+                    failed = True
+                    raise RuntimeError
+            else:
+                # Success
+                completed_tasks += 1
+                if task_outputs is not None:
+                    for output_file in task_outputs[task[1]]:
+                        file_hosts[file_key(output_file)] \
+                            = host_map[task[-1][-1]]
+            iface.status(('    %s: '
+                          '%d/%d | '
+                          '\\max_i (task_i fails): '
+                          '%d/%d')
+                % (status_message, completed_tasks,
+                    task_count, max_task_fails,
+                    max_attempts - 1))
+    assert not assigned_tasks
+    iface.step(finish_message)
+
+_path_pattern = re.compile(r'''(?:^|[\s='",])(/[^\s'",#;|<>()]+)''')
+
+def read_only_path(path):
+    """ Decides whether a path mentioned by a step is presumably only read.
+
+        path: absolute path
+
+        Return value: True iff path is an existing file that is not a
+            directory or is the basename of existing files (e.g., a Bowtie
+            index)
+    """
+    if os.path.exists(path):
+        return not os.path.isdir(path)
+    return bool(glob.glob(path + '.*'))
+
+def step_paths(step_data):
+    """ Gets paths a step may read or write.
+
+        Paths in a step's mapper, reducer, archives, and files args are
+        writable unless read_only_path() says otherwise.
+
+        step_data: dictionary with Hadoop Streaming args of step
+
+        Return value: set of tuples (absolute path, True iff path may be
+            written)
+    """
+    paths = set([(os.path.abspath(step_data['output']), True)])
+    paths.update([(os.path.abspath(step_input), False)
+                    for step_input in step_data['input'].split(',')])
+    for arg in ['mapper', 'reducer', 'archives', 'cacheArchive', 'files',
+                'cacheFile']:
+        if arg in step_data:
+            paths.update([(os.path.normpath(path),
+                            not read_only_path(os.path.normpath(path)))
+                            for path in _path_pattern.findall(step_data[arg])])
+    return paths
+
+def paths_overlap(first_path, second_path):
+    """ Checks whether one path is the same as or inside another.
+
+        first_path, second_path: absolute paths
+
+        Return value: True iff paths overlap
+    """
+    return (first_path == second_path
+            or first_path.startswith(second_path.rstrip(os.sep) + os.sep)
+            or second_path.startswith(first_path.rstrip(os.sep) + os.sep))
+
+def step_dependencies(steps, ignored_paths=[]):
+    """ Builds DAG of steps from paths they read and write.
+
+        A step depends on an earlier step if a path either step writes
+        overlaps a path the other step reads or writes. So a step waits for
+        the steps whose outputs are its inputs, but steps that only read the
+        same inputs can run at the same time.
+
+        steps: OrderedDict mapping step names to dictionaries with Hadoop
+            Streaming args of steps, in job flow order
+        ignored_paths: paths to ignore, like temporary directories, where
+            steps write only to files with unique names
+
+        Return value: dictionary mapping each step name to set of names of
+            steps on which it depends
+    """
+    ignored_paths = set([os.path.normpath(path) for path in ignored_paths])
+    paths = dict(
+            (step, [(path, writable) for path, writable
+                        in step_paths(steps[step])
+                        if path not in ignored_paths])
+            for step in steps
+        )
+    dependencies = {}
+    for i, step in enumerate(steps):
+        dependencies[step] = set(
+                earlier_step for earlier_step in steps.keys()[:i]
+                if any((writable or earlier_writable)
+                        and paths_overlap(path, earlier_path)
+                        for path, writable in paths[step]
+                        for earlier_path, earlier_writable
+                        in paths[earlier_step])
+            )
+    return dependencies
+
+def framed_outputs(steps):
+    """ Decides which outputs of steps may be framed.
+
+        Only streaming commands' input is read with xstream or xlines, so an
+        output may be framed only if later steps read it as input and no
+        step opens it or a path inside it by name, as from its mapper,
+        reducer, archives, or files args or as NLineInputFormat input. Any
+        output that remains when the job flow is done is then text.
+
+        steps: OrderedDict mapping step names to dictionaries with Hadoop
+            Streaming args of steps, in job flow order
+
+        Return value: dictionary mapping the name of each step whose output
+            may be framed to None if all of its output may be framed or to
+            the set of keys of its multiple outputs that may be framed
+    """
+    opened_paths = set()
+    for step_data in steps.values():
+        for arg in ['mapper', 'reducer', 'archives', 'cacheArchive', 'files',
+                    'cacheFile']:
+            if arg in step_data:
+                opened_paths.update(
+                        [os.path.normpath(path) for path
+                            in _path_pattern.findall(step_data[arg])]
+                    )
+        if step_data.get('inputformat') \
+            == 'org.apache.hadoop.mapred.lib.NLineInputFormat':
+            opened_paths.add(os.path.abspath(step_data['input']))
+    framed = {}
+    later_inputs = set()
+    for step in reversed(steps.keys()):
+        step_output = os.path.abspath(steps[step]['output'])
+        inside = lambda path: path.startswith(step_output + os.sep)
+        opened_keys = set(
+                os.path.relpath(path, step_output).split(os.sep)[0]
+                for path in opened_paths if inside(path)
+            )
+        if step_output in opened_paths:
+            # Some command opens the whole output
+            pass
+        elif step_output in later_inputs:
+            if not opened_keys:
+                framed[step] = None
+        else:
+            keys = set(
+                    os.path.relpath(path, step_output).split(os.sep)[0]
+                    for path in later_inputs if inside(path)
+                ) - opened_keys
+            if keys:
+                framed[step] = keys
+        later_inputs.update([os.path.abspath(step_input) for step_input
+                                in steps[step]['input'].split(',')])
+    return framed
+
+_stamp_filename = '.dp.stamp'
+
+def file_listing(path, since=None):
+    """ Lists regular files at a path with sizes and modification times.
+
+        path: file, directory to search recursively, or basename of files
+            (e.g., a Bowtie index)
+        since: if not None, list only files modified at or after this time
+
+        Return value: sorted list of lists [path, size, modification time]
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(root, filename)
+                    for root, _, filenames in os.walk(path)
+                    for filename in filenames]
+    else:
+        paths = [path] + glob.glob(path + '.*')
+    listing = []
+    for file_path in paths:
+        if not os.path.isfile(file_path):
+            continue
+        file_stat = os.stat(file_path)
+        if since is None or file_stat.st_mtime >= since:
+            listing.append([file_path, file_stat.st_size, file_stat.st_mtime])
+    return sorted(listing)
+
+def output_listing(output_dir):
+    """ Lists files in a step's output directory, excluding temporary files.
+
+        output_dir: output directory of step
+
+        Return value: sorted list of lists [path relative to output_dir,
+            size, modification time]
+    """
+    listing = []
+    for root, dirnames, filenames in os.walk(output_dir):
+        dirnames[:] = [dirname for dirname in dirnames
+                        if dirname not in ['dp.map', 'dp.tasks']
+                        and not dirname.endswith('.log')]
+        for filename in filenames:
+            if filename == _stamp_filename or filename.endswith('.log'):
+                continue
+            file_path = os.path.join(root, filename)
+            file_stat = os.stat(file_path)
+            listing.append([os.path.relpath(file_path, output_dir),
+                            file_stat.st_size, file_stat.st_mtime])
+    return sorted(listing)
+
+def step_stamps(steps, dependencies, ignored_paths=[],
+                    content_limit=1048576):
+    """ Computes stamps identifying what each step's outputs derive from.
+
+        A step's stamp is an MD5 hash of its Hadoop Streaming args, the
+        stamps of the steps on which it depends, and listings of files it
+        reads that no step writes, such as input files, indexes, and the
+        scripts in its mapper and reducer. Files of at most content_limit
+        bytes are hashed by content so that, e.g., a manifest downloaded
+        anew for each run doesn't change stamps. Larger files are listed by
+        size and modification time only, which avoids reading whole indexes
+        for every run: touching one changes stamps, but rewriting one
+        without changing its size or modification time does not.
+
+        steps: OrderedDict mapping step names to dictionaries with Hadoop
+            Streaming args of steps, in job flow order
+        dependencies: dictionary from step_dependencies()
+        ignored_paths: paths to ignore, like temporary directories
+        content_limit: max size in bytes of a file hashed by content; if
+            negative, every file is hashed by content
+
+        Return value: tuple (dictionary mapping step names to stamps,
+            dictionary mapping step names to lists of paths outside step
+            outputs that steps may write)
+    """
+    ignored_paths = set([os.path.normpath(path) for path in ignored_paths])
+    outputs = [os.path.abspath(steps[step]['output']) for step in steps]
+    stamps, side_paths = {}, {}
+    for step in steps:
+        stamp = hashlib.md5(json.dumps(steps[step], sort_keys=True))
+        for dependency in steps:
+            if dependency in dependencies[step]:
+                stamp.update(stamps[dependency])
+        side_paths[step] = []
+        for path, writable in sorted(step_paths(steps[step])):
+            if path in ignored_paths or any(
+                    path == output or path.startswith(output + os.sep)
+                    for output in outputs
+                ):
+                continue
+            if writable:
+                side_paths[step].append(path)
+            else:
+                for file_path, size, mtime in file_listing(path):
+                    if content_limit < 0 or size <= content_limit:
+                        content_hash = hashlib.md5()
+                        with open(file_path, 'rb') as file_stream:
+                            for block in iter(
+                                    lambda: file_stream.read(1048576), ''
+                                ):
+                                content_hash.update(block)
+                        mtime = content_hash.hexdigest()
+                    stamp.update(json.dumps([file_path, size, mtime]))
+        stamps[step] = stamp.hexdigest()
+    return stamps, side_paths
+
+def write_stamp(output_dir, stamp, side_paths=[], since=None):
+    """ Stamps a step's output directory once the step is done.
+
+        The stamp file also records the step's outputs and the files it
+        wrote to side_paths so stamp_is_current() can tell if they changed.
+
+        output_dir: output directory of step
+        stamp: step's stamp from step_stamps()
+        side_paths: paths outside step outputs that the step may write
+        since: time step started
+
+        No return value.
+    """
+    with open(os.path.join(output_dir, _stamp_filename), 'w') as stamp_stream:
+        json.dump({
+                'stamp' : stamp,
+                'outputs' : output_listing(output_dir),
+                'side_outputs' : [listing for side_path in side_paths
+                                    for listing
+                                    in file_listing(side_path, since)]
+            }, stamp_stream)
+
+def stamp_is_current(output_dir, stamp):
+    """ Checks whether a step's outputs are up to date.
+
+        output_dir: output directory of step
+        stamp: step's stamp from step_stamps()
+
+        Return value: True iff output_dir is stamped with stamp, and neither
+            its files nor files the step wrote elsewhere have changed
+    """
+    try:
+        with open(os.path.join(output_dir, _stamp_filename)) as stamp_stream:
+            record = json.load(stamp_stream)
+    except (IOError, ValueError):
+        return False
+    if (record.get('stamp') != stamp
+            or record.get('outputs') != output_listing(output_dir)):
+        return False
+    for path, size, mtime in record.get('side_outputs', []):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return False
+        if file_stat.st_size != size or file_stat.st_mtime != mtime:
+            return False
+    return True
+
 def run_simulation(branding, json_config, force, memcap, num_processes,
                     separator, keep_intermediates, keep_last_output,
                     log, gzip=False, gzip_level=3, ipy=False,
                     ipcontroller_json=None, ipy_profile=None, scratch=None,
                     common=None, sort='sort', max_attempts=4,
-                    direct_write=False):
+                    direct_write=False, shuffle='memory',
+                    pipeline=True, reuse_outputs=False,
+                    intermediate_format='text', framed_compression='zlib',
+                    stamp_content_limit=1048576):
     """ Runs Hadoop Streaming simulation.
 
         FUNCTIONALITY IS IDIOSYNCRATIC; it is currently confined to those
@@ -724,6 +1631,25 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
         max_attempts: maximum number of times to attempt a task in ipy mode.
         direct_write: always writes intermediate files directly to final
             destination, even when scratch is specified
+        shuffle: shuffle engine; "memory" sorts runs in process and streams
+            their merge into reducers, while "sort" uses UNIX sort
+        pipeline: True iff steps should be run as a DAG built from their
+            inputs and outputs so independent steps run at the same time and
+            partitioning overlaps map tasks; applies only when not in ipy
+            mode
+        reuse_outputs: True iff steps whose outputs are up to date according
+            to their stamps (see step_stamps()) should be skipped; implies
+            keep_intermediates and permits overwriting the outputs of steps
+            that are rerun, as force does
+        intermediate_format: "text" or "framed"; in framed mode, streaming
+            commands may write framed output (see framed_outputs()) and map
+            output is shuffled as framed sorted runs
+        framed_compression: block codec of framed intermediates; one of
+            "none", "zlib", "lz4", or "zstd"
+        stamp_content_limit: max size in bytes of a file read by a step
+            that is hashed by content when stamping; larger files are
+            stamped by size and modification time. If negative, every file
+            is hashed.
 
         No return value.
     """
@@ -747,6 +1673,16 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                          log_stream=log_stream)
     failed = False
     try:
+        if intermediate_format == 'framed':
+            framed_codec = framed_compression
+            try:
+                framed_codec_functions(framed_codec)
+            except RuntimeError as e:
+                iface.fail(str(e))
+                failed = True
+                raise
+        else:
+            framed_codec = None
         # Using IPython?
         if ipy:
             try:
@@ -827,14 +1763,52 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                 import tempfile
                 import shutil
                 import os
+                import heapq
+                import threading
+                import errno
+                import re
+                import itertools
             direct_view.push(dict(
                     yopen=yopen,
                     step_runner_with_error_return=\
                         step_runner_with_error_return,
                     presorted_tasks=presorted_tasks,
-                    parsed_keys=parsed_keys
+                    parsed_keys=parsed_keys,
+                    _numeric_prefix=_numeric_prefix,
+                    numeric_sort_field=numeric_sort_field,
+                    parsed_sort_key=parsed_sort_key,
+                    write_sorted_run=write_sorted_run,
+                    sorted_run_lines=sorted_run_lines,
+                    feed_merged_runs=feed_merged_runs,
+                    input_lines=input_lines,
+                    feed_lines=feed_lines,
+                    FramedWriter=FramedWriter,
+                    framed_records=framed_records,
+                    framed_lines=framed_lines,
+                    is_framed=is_framed,
+                    framed_codec_functions=framed_codec_functions,
+                    varint=varint,
+                    _framed_magic=_framed_magic,
+                    _framed_codecs=_framed_codecs,
+                    _framed_max_digits=_framed_max_digits,
+                    _framed_codec_variable=_framed_codec_variable
                 ))
             iface.step('Loaded dependencies on IPython engines.')
+            # Engines on the same node share services
+            import random
+            service_dir = os.path.join(
+                    tempfile.gettempdir() if scratch in [None, '-']
+                    else scratch,
+                    'dooplicity-services-%s' % ''.join(
+                            random.choice(string.ascii_uppercase
+                                            + string.digits)
+                            for _ in xrange(12)
+                        )
+                )
+            apply_async_with_errors(pool, all_engines, set_service_dir,
+                service_dir,
+                message=('Error(s) encountered setting directory for '
+                         'node-local services on IPython engines.'))
             # Get host-to-engine and engine pids relations
             current_hostname = socket.gethostname()
             host_map = apply_async_with_errors(
@@ -882,141 +1856,25 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         #    ), bufsize=-1, shell=True
                         #)
                         pass
-            import random
+            # Hostname of engine that wrote each file; see file_key()
+            file_hosts = {}
             def execute_balanced_job_with_retries(pool, iface,
-                task_function, task_function_args,
-                status_message='Tasks completed',
-                finish_message='Completed tasks.', max_attempts=4):
+                task_function, task_function_args, **kwargs):
                 """ Executes parallel job over IPython engines with retries.
 
-                    Tasks are assigned to free engines as they become
-                    available. If a task fails on one engine, it is retried on
-                    another engine. If a task has been tried on all engines but
-                    fails before max_attempts is exceeded, the step is failed.
-
-                    pool: IPython Client object; all engines it spans are used
-                    iface: DooplicityInterface object for spewing log messages
-                        to console
-                    task_function: name if function to execute
-                    task_function_args: iterable of lists, each of whose
-                        items are task_function's arguments, WITH THE EXCEPTION
-                        OF A SINGLE KEYWORD ARGUMENT "attempt_count". This
-                        argument must be the final keyword argument of the
-                        function but _excluded_ from the arguments in any item
-                        of task_function_args.
-                    status_message: status message about tasks completed
-                    finish_message: message to output when all tasks are
-                        completed
-                    max_attempts: max number of times to attempt any given
-                        task
+                    See execute_balanced_ipython_job() for arguments other
+                    than the cluster's engine and file locations, which
+                    are filled in here.
 
                     No return value.
                 """
-                global failed
-                random.seed(pool.ids[-1])
-                used_engines, free_engines = set(), set(pool.ids)
-                completed_tasks = 0
-                tasks_to_assign = deque([
-                        [task_function_arg, i, []] for i, task_function_arg
-                        in enumerate(task_function_args)
-                    ])
-                task_count = len(tasks_to_assign)
-                assigned_tasks, asyncresults = {}, {}
-                max_task_fails = 0
-                iface.status(('    %s: '
-                              '%d/%d | \\max_i (task_i fails): %d/%d')
-                                % (status_message, completed_tasks,
-                                    task_count, max_task_fails,
-                                    max_attempts - 1))
-                while completed_tasks < task_count:
-                    if tasks_to_assign:
-                        task_to_assign = tasks_to_assign.popleft()
-                        forbidden_engines = set(task_to_assign[2])
-                        if len(forbidden_engines) >= 2:
-                            # After two fails, do not allow reused nodes
-                            for forbidden_engine in task_to_assign[2]:
-                                forbidden_engines.update(
-                                    engine_map[host_map[forbidden_engine]]
-                                )
-                        if all_engines <= forbidden_engines:
-                            iface.fail(('No more running IPython engines '
-                                        'and/or nodes on which function-arg '
-                                        'combo (%s, %s) has not failed '
-                                        'attempt to execute. Check the '
-                                        'IPython cluster\'s integrity and '
-                                        'resource availability.')
-                                         % (task_function, task_to_assign[0]),
-                                         steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
-                            failed = True
-                            raise RuntimeError
-                        try:
-                            assigned_engine = random.choice(
-                                    list(free_engines - forbidden_engines)
-                                )
-                        except IndexError:
-                            # No engine to assign yet; add back to queue
-                            tasks_to_assign.append(task_to_assign)
-                        else:
-                            asyncresults[task_to_assign[1]] = (
-                                pool[assigned_engine].apply_async(
-                                    task_function,
-                                    *(task_to_assign[0] +
-                                      [len(task_to_assign[2])])
-                                )
-                            )
-                            assigned_tasks[task_to_assign[1]] = [
-                                    task_to_assign[0], task_to_assign[1],
-                                    task_to_assign[2] + [assigned_engine]
-                                ]
-                            used_engines.add(assigned_engine)
-                            free_engines.remove(assigned_engine)
-                    asyncresults_to_remove = []
-                    for task in asyncresults:
-                        if asyncresults[task].ready():
-                            return_value = asyncresults[task].get()
-                            if return_value is not None:
-                                if max_attempts > len(assigned_tasks[task][2]):
-                                    # Add to queue for reattempt
-                                    tasks_to_assign.append(
-                                            assigned_tasks[task]
-                                        )
-                                    max_task_fails = max(
-                                            len(assigned_tasks[task][2]),
-                                            max_task_fails
-                                        )
-                                    asyncresults_to_remove.append(task)
-                                else:
-                                    # Bail if max_attempts is saturated
-                                    iface.fail(return_value,
-                                    steps=(job_flow[step_number:]
-                                            if step_number != 0 else None))
-                                    failed = True
-                                    raise RuntimeError
-                            else:
-                                # Success
-                                completed_tasks += 1
-                                asyncresults_to_remove.append(task)
-                            iface.status(('    %s: '
-                                          '%d/%d | '
-                                          '\\max_i (task_i fails): '
-                                          '%d/%d')
-                                % (status_message, completed_tasks,
-                                    task_count, max_task_fails,
-                                    max_attempts - 1))
-                            assert assigned_tasks[task][-1][-1] == \
-                                asyncresults[task].engine_id
-                            # Free engine
-                            used_engines.remove(
-                                    assigned_tasks[task][-1][-1]
-                                )
-                            free_engines.add(assigned_tasks[task][-1][-1])
-                    for task in asyncresults_to_remove:
-                        del asyncresults[task]
-                        del assigned_tasks[task]
-                    time.sleep(0.1)
-                assert not used_engines
-                iface.step(finish_message)
+                execute_balanced_ipython_job(
+                        pool, iface, task_function, task_function_args,
+                        host_map, engine_map, file_hosts,
+                        steps=(job_flow[step_number:]
+                                if step_number != 0 else None),
+                        **kwargs
+                    )
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
                 """ Places X.[tar.gz/tgz]#Y in dir Y, unpacked if archive
@@ -1281,10 +2139,26 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         )
         else:
             import multiprocessing
+            import threading
+            '''Set by pool's result handler thread whenever a task succeeds,
+            so the scheduler blocks until there's something to do instead of
+            polling. A task whose function raises doesn't trigger the
+            callback, so waits time out now and then; this also lets
+            KeyboardInterrupt through.'''
+            done_event = threading.Event()
+            def notify_done(_):
+                """ Wakes scheduler when a task is done.
+
+                    _: return value of task; ignored
+
+                    No return value.
+                """
+                done_event.set()
             def execute_balanced_job_with_retries(pool, iface,
                 task_function, task_function_args,
                 status_message='Tasks completed',
-                finish_message='Completed tasks.', max_attempts=4):
+                finish_message='Completed tasks.', max_attempts=4,
+                task_inputs=None, task_outputs=None):
                 """ Executes parallel job locally with multiprocessing module.
 
                     Tasks are added to queue if they fail, and max_attempts-1
@@ -1305,6 +2179,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                         completed
                     max_attempts: max number of times to attempt any given
                         task
+                    task_inputs: ignored; all processes share a node
+                    task_outputs: ignored; all processes share a node
 
                     No return value.
                 """
@@ -1324,13 +2200,17 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                             max_attempts - 1)
                                        if max_attempts > 1 else '')))
                 while completed_tasks < task_count:
-                    if tasks_to_assign:
+                    # Clear before checking so no completion is missed
+                    done_event.clear()
+                    # Pool queues tasks until processes are free
+                    while tasks_to_assign:
                         task_to_assign = tasks_to_assign.popleft()
                         asyncresults[task_to_assign[1]] = (
                                 pool.apply_async(
                                     task_function,
                                     args=(task_to_assign[0] +
-                                            [task_to_assign[2]])
+                                            [task_to_assign[2]]),
+                                    callback=notify_done
                                 )
                             )
                         assigned_tasks[task_to_assign[1]] = [
@@ -1373,7 +2253,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     for task in asyncresults_to_remove:
                         del asyncresults[task]
                         del assigned_tasks[task]
-                    time.sleep(0.1)
+                    if not asyncresults_to_remove:
+                        done_event.wait(1)
                 iface.step(finish_message)
             @contextlib.contextmanager
             def cache(pool=None, file_or_archive=None, archive=True):
@@ -1570,7 +2451,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             for required_parameter in required_data:
                 if required_parameter not in step_data:
                     missing_data[step].append('-' + required_parameter)
-                elif not force and required_parameter == 'output' \
+                elif not force and not reuse_outputs \
+                    and required_parameter == 'output' \
                     and os.path.exists(step_data['output']):
                     bad_output_data.append(step)
             try:
@@ -1601,6 +2483,35 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                     for i, error in enumerate(errors)]))
             failed = True
             raise RuntimeError
+        ignored_paths = [tempfile.gettempdir()]
+        if scratch not in [None, '-']:
+            ignored_paths.append(
+                    os.path.expanduser(os.path.expandvars(scratch))
+                )
+        if reuse_outputs or (pipeline and not ipy):
+            dependencies = step_dependencies(steps, ignored_paths)
+        skipped_steps = set()
+        if reuse_outputs:
+            # Stamped outputs are reused only if intermediates are kept
+            keep_intermediates = True
+            stamps, side_paths = step_stamps(steps, dependencies,
+                                                ignored_paths,
+                                                stamp_content_limit)
+            dependents = defaultdict(set)
+            for step in steps:
+                for dependency in dependencies[step]:
+                    dependents[dependency].add(step)
+            '''Like make, rerun a step whose outputs are not up to date
+            only if it's a final step or some step that depends on it is
+            rerun.'''
+            rerun_steps = set()
+            for step in reversed(steps.keys()):
+                if not stamp_is_current(steps[step]['output'],
+                                        stamps[step]) and (
+                        not dependents[step] or dependents[step] & rerun_steps
+                    ):
+                    rerun_steps.add(step)
+            skipped_steps = set(steps) - rerun_steps
         if not keep_intermediates:
             # Create schedule for deleting intermediates
             marked_intermediates = set()
@@ -1620,8 +2531,32 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 step_input
                             )
                         marked_intermediates.add(step_input)
+        if framed_codec is not None:
+            framed_steps = framed_outputs(steps)
+        else:
+            framed_steps = {}
+        def map_framing(step):
+            """ Gets framed codec and keys for map tasks of a step.
+
+                Map output that is shuffled is always framed in framed mode.
+
+                step: name of step
+
+                Return value: tuple (framed codec or None, framed keys or
+                    None); see step_runner_with_error_return()
+            """
+            if framed_codec is None:
+                return None, None
+            if steps[step]['reducer'] not in identity_reducers:
+                return framed_codec, None
+            if step in framed_steps:
+                return framed_codec, framed_steps[step]
+            return None, None
         # Create intermediate directories
         for step in steps:
+            if step in skipped_steps:
+                # Keep up-to-date outputs
+                continue
             try:
                 shutil.rmtree(steps[step]['output'])
             except OSError:
@@ -1655,10 +2590,80 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                             'directory %s.') % reduce_err_dir)
                 failed = True
                 raise
+        def delete_temporary_files(step_data, to_remove_list,
+                                    split_input_dir=None):
+            """ Deletes temporary files after a step is done.
+
+                step_data: dictionary with Hadoop Streaming args of step
+                to_remove_list: step inputs that are no longer needed; only
+                    those that are outputs of steps are removed
+                split_input_dir: directory with NLineInput files or None
+
+                No return value.
+            """
+            iface.status('    Deleting temporary files...')
+            # Kill NLineInput files if they're there
+            if split_input_dir is not None:
+                try:
+                    shutil.rmtree(split_input_dir)
+                except OSError:
+                    pass
+            try:
+                # Intermediate map output should be deleted if it exists
+                shutil.rmtree(
+                            os.path.join(
+                                    step_data['output'], 'dp.map'
+                                )
+                        )
+            except OSError:
+                pass
+            try:
+                # Remove dp.tasks directory
+                shutil.rmtree(
+                        os.path.join(step_data['output'], 'dp.tasks')
+                    )
+            except OSError:
+                pass
+            for to_remove in to_remove_list:
+                if to_remove not in all_outputs:
+                    '''Remove directory only if it's an -output of some
+                    step and an -input of another step.'''
+                    continue
+                if os.path.isfile(to_remove):
+                    try:
+                        os.remove(to_remove)
+                    except OSError:
+                        pass
+                elif os.path.isdir(to_remove):
+                    for detritus in glob.iglob(
+                                        os.path.join(to_remove, '*')
+                                    ):
+                        if detritus[-4:] != '.log':
+                            try:
+                                os.remove(detritus)
+                            except OSError:
+                                try:
+                                    shutil.rmtree(detritus)
+                                except OSError:
+                                    pass
+                    if not os.listdir(to_remove):
+                        try:
+                            os.rmdir(to_remove)
+                        except OSError:
+                            pass
+            iface.step('    Deleted temporary files.')
         # Run steps
         step_number = 0
         total_steps = len(steps)
+        for i, step in enumerate(steps):
+            if step in skipped_steps:
+                iface.step('Step %d/%d: %s | Skipped; outputs are up to date.'
+                            % (i + 1, total_steps, step))
         if not ipy:
+            set_service_dir(make_temp_dir_and_register_cleanup(
+                    None if scratch in [None, '-']
+                    else os.path.expanduser(os.path.expandvars(scratch))
+                ))
             # Pool's only for if we're in local mode
             try:
                 pool = multiprocessing.Pool(num_processes, init_worker,
@@ -1666,8 +2671,357 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
             except Exception:
                 # maxtasksperchild doesn't work, somehow? Supported only in 2.7
                 pool = multiprocessing.Pool(num_processes, init_worker)
-        for step in steps:
+        if pipeline and not ipy:
+            '''Run steps as a DAG rather than one after another. A step starts
+            as soon as the steps it depends on are done; its output is
+            partitioned in batches as mappers finish, and its reducers start
+            as soon as partitioning is done.'''
+            step_indexes = dict((step, i) for i, step in enumerate(steps))
+            input_consumers = defaultdict(set)
+            for step in steps:
+                for step_input in steps[step]['input'].split(','):
+                    input_consumers[os.path.abspath(step_input)].add(step)
+            multiple_output_formats = ['edu.jhu.cs.MultipleOutputFormat',
+                                       'edu.jhu.cs.'
+                                       'MultipleIndexedLzoTextOutputFormat']
+            running_steps, done_steps = OrderedDict(), set(skipped_steps)
+            asyncresults = {}
+            task_counts = {'assigned' : 0, 'completed' : 0, 'max_fails' : 0}
+            def submit_task(step, phase, index, task_function,
+                                task_function_args, attempts=0):
+                """ Submits task of a running step to pool.
+
+                    step: name of step
+                    phase: one of "map", "partition", and "reduce"
+                    index: index of task in phase
+                    task_function: function to execute
+                    task_function_args: task_function's arguments, excluding
+                        final attempt_number argument
+                    attempts: number of times task was attempted already
+
+                    No return value.
+                """
+                asyncresults[(step, phase, index)] = [
+                        pool.apply_async(
+                                task_function,
+                                args=(task_function_args + [attempts]),
+                                callback=notify_done
+                            ),
+                        task_function, task_function_args, attempts + 1
+                    ]
+                if not attempts:
+                    running_steps[step]['tasks'][phase] += 1
+                    task_counts['assigned'] += 1
+            def submit_partition(step):
+                """ Partitions map outputs of step awaiting partitioning.
+
+                    step: name of step
+
+                    No return value.
+                """
+                step_state = running_steps[step]
+                step_data = steps[step]
+                if not step_state['unpartitioned']:
+                    return
+                submit_task(step, 'partition',
+                            step_state['tasks']['partition'],
+                            presorted_tasks,
+                            [step_state['unpartitioned'],
+                                step_state['tasks']['partition'],
+                                step_data['sort_options'],
+                                os.path.join(step_data['output'], 'dp.tasks'),
+                                step_data['key_fields'], separator,
+                                step_data['partition_options'],
+                                step_data['task_count'], memcap, gzip,
+                                gzip_level, scratch, direct_write,
+                                sort, step_state['mod_partition'], shuffle,
+                                framed_codec])
+                step_state['unpartitioned'] = []
+            def start_step(step):
+                """ Starts map or partition tasks of a step.
+
+                    step: name of step
+
+                    No return value.
+                """
+                step_data = steps[step]
+                step_state = running_steps[step] = {
+                        'start_time' : time.time(),
+                        'tasks' : defaultdict(int),
+                        'completed' : defaultdict(int),
+                        'unpartitioned' : [],
+                        'split_input_dir' : None,
+                        'mapper' : (step_data['mapper']
+                                        not in identity_mappers),
+                        'reducer' : (step_data['reducer']
+                                        not in identity_reducers)
+                    }
+                iface.step('Step %d/%d: %s'
+                            % (step_indexes[step] + 1, total_steps, step))
+                step_inputs = []
+                # Handle multiple input files/directories
+                for input_file_or_dir in step_data['input'].split(','):
+                    if os.path.isfile(input_file_or_dir):
+                        step_inputs.append(input_file_or_dir)
+                    elif os.path.isdir(input_file_or_dir):
+                        step_inputs.extend(
+                                glob.glob(os.path.join(input_file_or_dir, '*'))
+                            )
+                if 'archives' in step_data or 'cacheArchive' in step_data:
+                    # Prefer archives to cacheArchives
+                    try:
+                        to_cache = step_data['archives']
+                    except KeyError:
+                        to_cache = step_data['cacheArchive']
+                elif 'files' in step_data or 'cacheFile' in step_data:
+                    try:
+                        to_cache = step_data['files']
+                    except KeyError:
+                        to_cache = step_data['cacheFile']
+                else:
+                    to_cache = None
+                step_state['cache'] = cache(pool if to_cache else None,
+                                            to_cache,
+                                            'archives' in step_data)
+                step_state['dir_to_path'] = dir_to_path \
+                    = step_state['cache'].__enter__()
+                try:
+                    step_state['multiple_outputs'] = (
+                            ('multiple_outputs' in step_data) or
+                            step_data['outputformat']
+                            in multiple_output_formats
+                        )
+                except KeyError:
+                    step_state['multiple_outputs'] = False
+                try:
+                    step_state['mod_partition'] = (
+                            step_data['partitioner']
+                            == 'edu.jhu.cs.ModPartitioner'
+                        )
+                except KeyError:
+                    step_state['mod_partition'] = False
+                if step_state['reducer']:
+                    try:
+                        os.makedirs(
+                                os.path.join(step_data['output'], 'dp.tasks')
+                            )
+                    except OSError:
+                        pass
+                if step_state['mapper']:
+                    if step_data.get('inputformat') \
+                        == 'org.apache.hadoop.mapred.lib.NLineInputFormat':
+                        # Create temporary input files
+                        step_state['split_input_dir'] = split_input_dir \
+                            = make_temp_dir(common)
+                        input_files = []
+                        try:
+                            with open(step_inputs[0]) as nline_stream:
+                                for i, line in enumerate(nline_stream):
+                                    offset = str(i)
+                                    input_files.append(os.path.join(
+                                                            split_input_dir,
+                                                            offset
+                                                        ))
+                                    with open(input_files[-1], 'w') \
+                                        as output_stream:
+                                        print >>output_stream, separator.join([
+                                                                offset, line
+                                                            ])
+                        except IndexError:
+                            raise RuntimeError('No NLineInputFormat input to '
+                                               'step "%s".' % step)
+                    else:
+                        input_files = [input_file for input_file in step_inputs
+                                        if os.path.isfile(input_file)]
+                    if step_state['reducer']:
+                        '''There's a reducer, so input to reducer is output
+                        of mapper, and multiple outputs apply after reduce
+                        step.'''
+                        output_dir = os.path.join(step_data['output'],
+                                                    'dp.map')
+                        try:
+                            os.makedirs(output_dir)
+                        except OSError:
+                            pass
+                        multiple_outputs = False
+                        # Partition in batches of about num_processes
+                        step_state['partition_batch'] = max(
+                                -(-len(input_files) // num_processes), 1
+                            )
+                    else:
+                        output_dir = step_data['output']
+                        multiple_outputs = step_state['multiple_outputs']
+                    step_state['map_output_dir'] = output_dir
+                    if not input_files:
+                        iface.step('No input found; skipping step.')
+                    err_dir = os.path.join(step_data['output'], 'dp.map.log')
+                    map_framed_codec, map_framed_keys = map_framing(step)
+                    for i, input_file in enumerate(input_files):
+                        submit_task(step, 'map', i,
+                                    step_runner_with_error_return,
+                                    [step_data['mapper'], input_file,
+                                        output_dir, err_dir, i,
+                                        multiple_outputs, separator, None,
+                                        None, gzip, gzip_level, scratch,
+                                        direct_write, sort, dir_to_path,
+                                        shuffle, map_framed_codec,
+                                        map_framed_keys])
+                elif step_state['reducer']:
+                    input_files = [input_file for input_file in step_inputs
+                                    if os.path.isfile(input_file)]
+                    batch_size = max(-(-len(input_files) // num_processes), 1)
+                    for i in xrange(0, len(input_files), batch_size):
+                        step_state['unpartitioned'] \
+                            = input_files[i:i+batch_size]
+                        submit_partition(step)
+                advance_step(step)
+            def advance_step(step):
+                """ Starts reduce tasks or finishes step if its phase is done.
+
+                    step: name of step
+
+                    No return value.
+                """
+                step_state = running_steps[step]
+                step_data = steps[step]
+                tasks, completed = step_state['tasks'], step_state['completed']
+                if (tasks['map'] != completed['map']
+                        or tasks['partition'] != completed['partition']):
+                    return
+                if step_state['reducer'] and not tasks['reduce']:
+                    input_files = [os.path.join(step_data['output'],
+                                                'dp.tasks', '%d.*' % i)
+                                   for i in xrange(step_data['task_count'])]
+                    # Filter out bad globs
+                    input_files = [input_file for input_file in input_files
+                                    if glob.glob(input_file)]
+                    err_dir = os.path.join(step_data['output'],
+                                            'dp.reduce.log')
+                    for i, input_file in enumerate(input_files):
+                        submit_task(step, 'reduce', i,
+                                    step_runner_with_error_return,
+                                    [step_data['reducer'], input_file,
+                                        step_data['output'], err_dir, i,
+                                        step_state['multiple_outputs'],
+                                        separator, step_data['sort_options'],
+                                        memcap, gzip, gzip_level, scratch,
+                                        direct_write, sort,
+                                        step_state['dir_to_path'], shuffle,
+                                        framed_codec if step in framed_steps
+                                        else None,
+                                        framed_steps.get(step)])
+                if tasks['reduce'] != completed['reduce']:
+                    return
+                # Step is done
+                del running_steps[step]
+                step_state['cache'].__exit__(None, None, None)
+                done_steps.add(step)
+                iface.step('    Completed step %d/%d: %s (%s).'
+                            % (step_indexes[step] + 1, total_steps, step,
+                                dp_iface.inflected(
+                                        sum(tasks.values()), 'task'
+                                    )))
+                # Really close open file handles in PyPy
+                gc.collect()
+                if reuse_outputs:
+                    write_stamp(step_data['output'], stamps[step],
+                                side_paths[step], step_state['start_time'])
+                if not keep_intermediates:
+                    '''Remove an intermediate only once every step that
+                    reads it is done.'''
+                    delete_temporary_files(
+                            step_data,
+                            [step_input for step_input in
+                                set(os.path.abspath(step_input)
+                                    for step_input
+                                    in step_data['input'].split(','))
+                                if input_consumers[step_input]
+                                <= done_steps],
+                            step_state['split_input_dir']
+                        )
+            def task_done(step, phase, index):
+                """ Records completion of task and starts what depends on it.
+
+                    step: name of step
+                    phase: one of "map", "partition", and "reduce"
+                    index: index of task in phase
+
+                    No return value.
+                """
+                step_state = running_steps[step]
+                step_state['completed'][phase] += 1
+                task_counts['completed'] += 1
+                if phase == 'map' and step_state['reducer']:
+                    map_output = os.path.join(step_state['map_output_dir'],
+                                                str(index))
+                    step_state['unpartitioned'].extend(
+                            [output_file for output_file
+                                in [map_output, map_output + '.gz']
+                                if os.path.isfile(output_file)]
+                        )
+                    if (len(step_state['unpartitioned'])
+                            >= step_state['partition_batch']
+                        or step_state['completed']['map']
+                            == step_state['tasks']['map']):
+                        submit_partition(step)
+                advance_step(step)
+            while len(done_steps) < total_steps:
+                step_number = min(step_indexes[step] for step in steps
+                                    if step not in done_steps)
+                ready_steps = True
+                while ready_steps:
+                    ready_steps = [step for step in steps
+                                    if step not in done_steps
+                                    and step not in running_steps
+                                    and dependencies[step] <= done_steps]
+                    for step in ready_steps:
+                        start_step(step)
+                # Clear before checking so no completion is missed
+                done_event.clear()
+                finished_tasks = [task for task in asyncresults
+                                    if asyncresults[task][0].ready()]
+                for task in finished_tasks:
+                    (asyncresult, task_function, task_function_args,
+                        attempts) = asyncresults.pop(task)
+                    return_value = asyncresult.get()
+                    if return_value is not None:
+                        if max_attempts > attempts:
+                            # Add to queue for reattempt
+                            task_counts['max_fails'] = max(
+                                    attempts, task_counts['max_fails']
+                                )
+                            submit_task(*(list(task) + [task_function,
+                                            task_function_args, attempts]))
+                            continue
+                        # Bail if max_attempts is saturated
+                        iface.fail(return_value,
+                                    steps=(job_flow[step_number:]
+                                            if step_number != 0 else None))
+                        failed = True
+                        raise RuntimeError
+                    task_done(*task)
+                if len(done_steps) < total_steps:
+                    iface.status(('    Tasks completed: %d/%d%s | '
+                                  'Running: %s')
+                                    % (task_counts['completed'],
+                                        task_counts['assigned'],
+                                        (' | \\max_i (task_i fails): %d/%d'
+                                           % (task_counts['max_fails'],
+                                                max_attempts - 1)
+                                           if max_attempts > 1 else ''),
+                                        ', '.join(running_steps)))
+                if not finished_tasks:
+                    done_event.wait(1)
+            step_data = steps[steps.keys()[-1]]
+            serial_steps = []
+        else:
+            serial_steps = steps
+        for step in serial_steps:
             step_data = steps[step]
+            if step in skipped_steps:
+                step_number += 1
+                continue
+            step_start_time = time.time()
             step_inputs = []
             # Handle multiple input files/directories
             for input_file_or_dir in step_data['input'].split(','):
@@ -1775,6 +3129,7 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                     if not input_file_count:
                         iface.step('No input found; skipping step.')
                     err_dir = os.path.join(steps[step]['output'], 'dp.map.log')
+                    map_framed_codec, map_framed_keys = map_framing(step)
                     iface.step('Step %d/%d: %s' % 
                                 (step_number + 1, total_steps, step))
                     iface.status('    Starting step runner...')
@@ -1785,7 +3140,8 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                          i, multiple_outputs,
                                          separator, None, None, gzip,
                                          gzip_level, scratch, direct_write,
-                                         sort, dir_to_path]
+                                         sort, dir_to_path, shuffle,
+                                         map_framed_codec, map_framed_keys]
                                          for i, input_file
                                          in enumerate(input_files)
                                          if os.path.isfile(input_file)],
@@ -1794,11 +3150,18 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 '    Completed %s.'
                                 % dp_iface.inflected(input_file_count, 'task')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            task_inputs=[[input_file]
+                                         for input_file in input_files
+                                         if os.path.isfile(input_file)],
+                            task_outputs=[[os.path.join(output_dir, str(i))]
+                                          for i, input_file
+                                          in enumerate(input_files)
+                                          if os.path.isfile(input_file)]
                         )
                     # Adjust step inputs in case a reducer follows
                     step_inputs = [input_file for input_file 
-                                    in glob.glob(output_dir)
+                                    in glob.glob(os.path.join(output_dir, '*'))
                                     if os.path.isfile(input_file)]
                 if step_data['reducer'] not in identity_reducers:
                     '''Determine whether to use "mod" partitioner that uses
@@ -1851,7 +3214,7 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 step_data['partition_options'],
                                 step_data['task_count'], memcap, gzip,
                                 gzip_level, scratch, direct_write,
-                                sort, mod_partition]
+                                sort, mod_partition, shuffle, framed_codec]
                                     for i, input_file_group
                                     in enumerate(input_file_groups)],
                             status_message='Inputs partitioned',
@@ -1860,7 +3223,17 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 % dp_iface.inflected(input_file_group_count,
                                                      'input')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            task_inputs=input_file_groups,
+                            # Task files are named task.process[.run][.gz]
+                            task_outputs=[[os.path.join(output_dir,
+                                                        '%d.%d' % (task, i))
+                                           for task in xrange(
+                                                step_data['task_count']
+                                            )]
+                                          for i in xrange(
+                                                input_file_group_count
+                                            )]
                         )
                     iface.status('    Starting step runner...')
                     input_files = [os.path.join(output_dir, '%d.*' % i) 
@@ -1891,7 +3264,10 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 err_dir, i, multiple_outputs, separator,
                                 step_data['sort_options'], memcap, gzip,
                                 gzip_level, scratch, direct_write,
-                                sort, dir_to_path]
+                                sort, dir_to_path, shuffle,
+                                framed_codec if step in framed_steps
+                                else None,
+                                framed_steps.get(step)]
                                     for i, input_file
                                     in enumerate(input_files)],
                             status_message='Tasks completed',
@@ -1899,64 +3275,38 @@ def run_simulation(branding, json_config, force, memcap, num_processes,
                                 '    Completed %s.'
                                 % dp_iface.inflected(input_file_count, 'task')
                             ),
-                            max_attempts=max_attempts
+                            max_attempts=max_attempts,
+                            task_inputs=[[os.path.join(
+                                                os.path.dirname(task_file),
+                                                '.'.join(os.path.basename(
+                                                        task_file
+                                                    ).split('.')[:2])
+                                            ) for task_file
+                                            in glob.glob(input_file)]
+                                         for input_file in input_files],
+                            task_outputs=[[os.path.join(output_dir, str(i))]
+                                          for i in xrange(input_file_count)]
                         )
             # Really close open file handles in PyPy
             gc.collect()
+            if reuse_outputs:
+                write_stamp(step_data['output'], stamps[step],
+                            side_paths[step], step_start_time)
             if not keep_intermediates:
-                iface.status('    Deleting temporary files...')
-                # Kill NLineInput files if they're there
-                try:
-                    shutil.rmtree(split_input_dir)
-                except (NameError, OSError):
-                    pass
-                try:
-                    # Intermediate map output should be deleted if it exists
-                    shutil.rmtree(
-                                os.path.join(
-                                        step_data['output'], 'dp.map'
-                                    )
-                            )
-                except OSError:
-                    pass
-                try:
-                    # Remove dp.tasks directory
-                    shutil.rmtree(
-                            os.path.join(step_data['output'], 'dp.tasks')
-                        )
-                except OSError:
-                    pass
-                for to_remove in post_step_cleanups[step_number]:
-                    if to_remove not in all_outputs:
-                        '''Remove directory only if it's an -output of some
-                        step and an -input of another step.'''
-                        continue
-                    if os.path.isfile(to_remove):
-                        try:
-                            os.remove(to_remove)
-                        except OSError:
-                            pass
-                    elif os.path.isdir(to_remove):
-                        for detritus in glob.iglob(
-                                            os.path.join(to_remove, '*')
-                                        ):
-                            if detritus[-4:] != '.log':
-                                try:
-                                    os.remove(detritus)
-                                except OSError:
-                                    try:
-                                        shutil.rmtree(detritus)
-                                    except OSError:
-                                        pass
-                        if not os.listdir(to_remove):
-                            try:
-                                os.rmdir(to_remove)
-                            except OSError:
-                                pass
-                iface.step('    Deleted temporary files.')
+                delete_temporary_files(
+                        step_data, post_step_cleanups[step_number],
+                        split_input_dir if 'split_input_dir' in locals()
+                        else None
+                    )
             step_number += 1
         if not ipy:
             pool.close()
+        else:
+            # Services exit once their directory is gone
+            apply_async_with_errors(pool, all_engines, shutil.rmtree,
+                service_dir, ignore_errors=True,
+                message=('Error(s) encountered removing directory for '
+                         'node-local services on IPython engines.'))
         if not keep_last_output and not keep_intermediates:
             try:
                 os.remove(step_data['output'])
@@ -2036,11 +3386,546 @@ if __name__ == '__main__':
                     formatter_class=argparse.RawDescriptionHelpFormatter)
     add_args(parser)
     dp_iface.add_args(parser)
+    parser.add_argument('--test', action='store_const', const=True,
+        default=False, help='Run unit tests')
     args = parser.parse_args(sys.argv[1:])
+
+if __name__ == '__main__' and not args.test:
     run_simulation(args.branding, args.json_config, args.force,
                     args.memcap, args.num_processes, args.separator,
                     args.keep_intermediates, args.keep_last_output,
                     args.log, args.gzip_outputs, args.gzip_level,
                     args.ipy, args.ipcontroller_json, args.ipy_profile,
                     args.scratch, args.common, args.sort, args.max_attempts,
-                    args.direct_write)
+                    args.direct_write, args.shuffle,
+                    not args.no_pipeline, args.reuse_outputs,
+                    args.intermediate_format, args.framed_compression,
+                    args.stamp_content_limit)
+elif __name__ == '__main__':
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    import random
+
+    class TestParsedSortKey(unittest.TestCase):
+        """ Tests parsed_sort_key() against UNIX sort. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.input_file = os.path.join(self.temp_dir_path, 'input')
+            random.seed(2)
+            fields = ['', '0', '-0', '00', '7', '007', '10', '-10', '2',
+                        '-2.5', '2.50', '.5', '-.5', '3a', 'a3', '1e3',
+                        ' 4', '-', '.', 'chr1', 'chr10', 'chr2', 'chrX',
+                        'Chr1', 'b', 'B', 'ab', 'a', '12345678901234567890']
+            with open(self.input_file, 'w') as input_stream:
+                for _ in xrange(2000):
+                    print >>input_stream, '\t'.join(
+                            [random.choice(fields)
+                                for _ in xrange(random.randint(1, 4))]
+                        )
+
+        def test_against_sort(self):
+            """ Fails if any ordering differs from LC_ALL=C sort's. """
+            for sort_options in ['-k1,1', '-k1,1n', '-k1,1nr', '-k2,2n',
+                                 '-k1,1 -k2,2n', '-k2,2nr -k1,1',
+                                 '-k1,2', '-k2', '-k3,3n -k1,1 -k2,2nr',
+                                 '-k1,1 -k4,4', '-k 2,2n -k 1,1']:
+                sort_key = parsed_sort_key(sort_options, '\t')
+                self.assertTrue(sort_key)
+                with open(self.input_file) as input_stream:
+                    lines = input_stream.readlines()
+                expected = subprocess.check_output(
+                        'LC_ALL=C sort -t$\'\\t\' %s %s'
+                            % (sort_options, self.input_file),
+                        shell=True, executable='/bin/bash'
+                    ).splitlines(True)
+                self.assertEqual(sorted(lines, key=sort_key), expected,
+                                    'Ordering differs for "%s".'
+                                    % sort_options)
+
+        def test_presorted_tasks(self):
+            """ Fails if merged runs differ from presorted task files. """
+            sort_options = '-k1,1 -k2,2n'
+            merged = {}
+            for shuffle in ['memory', 'sort']:
+                output_dir = os.path.join(self.temp_dir_path, shuffle)
+                os.makedirs(output_dir)
+                self.assertEqual(
+                        presorted_tasks([self.input_file], 0, sort_options,
+                                        output_dir, 1, '\t', '-k1,1', 3,
+                                        20, shuffle=shuffle),
+                        None
+                    )
+                for task in xrange(3):
+                    task_files = sorted(glob.glob(
+                            os.path.join(output_dir, '%d.*' % task)
+                        ))
+                    if shuffle == 'memory':
+                        # Small memcap forces multiple runs
+                        self.assertTrue(len(task_files) > 1)
+                        merged_file = os.path.join(output_dir,
+                                                    'merged.%d' % task)
+                        self.assertEqual(feed_merged_runs(
+                                task_files, parsed_sort_key(sort_options,
+                                                                '\t'),
+                                open(merged_file, 'w')
+                            ), None)
+                        with open(merged_file) as merged_stream:
+                            merged[shuffle, task] = merged_stream.read()
+                    else:
+                        merged[shuffle, task] = subprocess.check_output(
+                                'LC_ALL=C sort -m -t$\'\\t\' %s %s'
+                                    % (sort_options, ' '.join(task_files)),
+                                shell=True, executable='/bin/bash'
+                            )
+            for task in xrange(3):
+                self.assertEqual(merged['memory', task],
+                                    merged['sort', task])
+
+        def test_unsupported_options(self):
+            """ Fails if options that can't be emulated are accepted. """
+            for sort_options in ['-k1.2,1', '-k1,1r', '-k0,1', '-k1,2,3',
+                                 '-k1,1g']:
+                self.assertFalse(parsed_sort_key(sort_options, '\t'))
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    def job_flow_step(name, input_path, output_path, mapper, reducer,
+                        key_fields=1, task_count=2):
+        """ Returns JSON-compatible step for a test job flow. """
+        return {
+                'Name' : name,
+                'ActionOnFailure' : 'TERMINATE_JOB_FLOW',
+                'HadoopJarStep' : {
+                    'Jar' : 'hadoop-streaming.jar',
+                    'Args' : ['-D', 'mapreduce.job.reduces=%d' % task_count,
+                              '-D', 'stream.num.map.output.key.fields=%d'
+                                        % key_fields,
+                              '-input', input_path, '-output', output_path,
+                              '-mapper', mapper, '-reducer', reducer]
+                }
+            }
+
+    def run_job_flow(job_flow, json_config, *args):
+        """ Runs job flow with emr_simulator.py as a script.
+
+            job_flow: list of steps from job_flow_step()
+            json_config: where to write job flow
+            *args: extra command-line parameters
+
+            Return value: tuple (exit level, stdout and stderr)
+        """
+        with open(json_config, 'w') as json_stream:
+            json.dump({'Steps' : job_flow}, json_stream)
+        run_process = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                    '-j', json_config] + list(args),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+        output = run_process.communicate()[0]
+        return run_process.returncode, output
+
+    def output_contents(output_dir):
+        """ Reads files listed by output_listing().
+
+            Return value: dictionary mapping paths relative to output_dir to
+                contents
+        """
+        return dict(
+                (file_path, open(os.path.join(output_dir, file_path)).read())
+                for file_path, _, _ in output_listing(output_dir)
+            )
+
+    class FakeAsyncResult(object):
+        """ Stands in for an IPython AsyncResult. """
+        def __init__(self, client, engine_id, value, number):
+            self.client = client
+            self.engine_id = engine_id
+            self.value = value
+            self.number = number
+            self.done = False
+
+        def ready(self):
+            if not self.done:
+                # Like IPython's, polls the client's result socket
+                self.client.spin()
+            return self.done
+
+        def get(self):
+            assert self.done
+            return self.value
+
+    class FakeClient(object):
+        """ Stands in for an IPython Client.
+
+            Tasks run as soon as they're applied, but each spin() finishes
+            only the earliest of the results still pending.
+        """
+        def __init__(self, engine_count):
+            self.ids = range(engine_count)
+            self.calls = []
+            self.results = []
+
+        def __getitem__(self, engine_id):
+            client = self
+            class View(object):
+                def apply_async(self, function, *args):
+                    client.calls.append((engine_id, args))
+                    client.results.append(
+                            FakeAsyncResult(client, engine_id,
+                                            function(*args),
+                                            len(client.calls))
+                        )
+                    return client.results[-1]
+            return View()
+
+        def spin(self):
+            pending = [job for job in self.results if not job.done]
+            if pending:
+                min(pending, key=lambda job: job.number).done = True
+
+    class FakeInterface(object):
+        """ Stands in for DooplicityInterface; records failures. """
+        def __init__(self):
+            self.failures = []
+
+        def status(self, message):
+            pass
+
+        def step(self, message):
+            pass
+
+        def fail(self, message, steps=None):
+            self.failures.append(message)
+
+    def flaky_task(task, attempt_count=0):
+        """ Fails the first attempt at task 1. """
+        if task == 1 and attempt_count == 0:
+            return 'Task 1 failed.'
+        return None
+
+    def failing_task(task, attempt_count=0):
+        """ Always fails. """
+        return 'Task %d failed.' % task
+
+    class TestBalancedIpythonJob(unittest.TestCase):
+        """ Tests scheduling loop of execute_balanced_ipython_job(). """
+        def setUp(self):
+            self.pool = FakeClient(4)
+            self.iface = FakeInterface()
+            self.host_map = {0 : 'a', 1 : 'a', 2 : 'b', 3 : 'b'}
+            self.engine_map = {'a' : [0, 1], 'b' : [2, 3]}
+
+        def test_retries(self):
+            """ Fails if a failed task isn't retried on another engine. """
+            execute_balanced_ipython_job(
+                    self.pool, self.iface, flaky_task,
+                    [[task] for task in xrange(10)],
+                    self.host_map, self.engine_map, {}
+                )
+            self.assertEqual(self.iface.failures, [])
+            self.assertEqual(
+                    sorted(args for _, args in self.pool.calls),
+                    sorted([(task, 0) for task in xrange(10)] + [(1, 1)])
+                )
+            task_1_engines = [engine_id for engine_id, args
+                                in self.pool.calls if args[0] == 1]
+            self.assertEqual(len(task_1_engines), 2)
+            self.assertNotEqual(task_1_engines[0], task_1_engines[1])
+
+        def test_locality(self):
+            """ Fails if tasks don't follow their inputs to their host. """
+            file_hosts = {file_key('/in/0') : 'b', file_key('/in/1') : 'b',
+                          file_key('/in/2') : 'a'}
+            execute_balanced_ipython_job(
+                    self.pool, self.iface, flaky_task,
+                    [[task] for task in [0, 2, 3]],
+                    self.host_map, self.engine_map, file_hosts,
+                    task_inputs=[['/in/0', '/in/1'], ['/in/1'], ['/in/2']],
+                    task_outputs=[['/out/0.gz'], ['/out/1'], ['/out/2']]
+                )
+            self.assertEqual(
+                    [self.host_map[engine_id]
+                        for engine_id, _ in self.pool.calls],
+                    ['b', 'b', 'a']
+                )
+            for i, (engine_id, _) in enumerate(self.pool.calls):
+                self.assertEqual(file_hosts[file_key('/out/%d' % i)],
+                                 self.host_map[engine_id])
+
+        def test_max_attempts(self):
+            """ Fails if a task failing max_attempts times passes. """
+            with self.assertRaises(RuntimeError):
+                execute_balanced_ipython_job(
+                        self.pool, self.iface, failing_task, [[0], [1]],
+                        self.host_map, self.engine_map, {}, max_attempts=2
+                    )
+            self.assertEqual(len(self.iface.failures), 1)
+            self.assertEqual(len(self.pool.calls), 4)
+
+    class TestStepStamps(unittest.TestCase):
+        """ Tests how step_stamps() stamps files steps read. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.input_file = os.path.join(self.temp_dir_path, 'input')
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write('chr1\t1\tA\n')
+            self.steps = OrderedDict([('Read', {
+                    'input' : self.input_file,
+                    'output' : os.path.join(self.temp_dir_path, 'output'),
+                    'mapper' : 'cat', 'reducer' : 'cat'
+                })])
+            self.dependencies = {'Read' : set()}
+
+        def stamp(self, content_limit):
+            """ Computes stamp of step with given content_limit. """
+            return step_stamps(self.steps, self.dependencies,
+                               content_limit=content_limit)[0]['Read']
+
+        def test_content_limit(self):
+            """ Fails if files aren't stamped by content up to the limit. """
+            # Whole seconds so modification time can be restored exactly
+            os.utime(self.input_file, (1000000000, 1000000000))
+            stamps = [self.stamp(limit) for limit in [0, 1048576, -1]]
+            os.utime(self.input_file, (1000000010, 1000000010))
+            # Touching a file past the limit changes the stamp
+            self.assertNotEqual(self.stamp(0), stamps[0])
+            self.assertEqual(self.stamp(1048576), stamps[1])
+            self.assertEqual(self.stamp(-1), stamps[2])
+            # Same size and modification time but different content
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write('chr1\t1\tC\n')
+            os.utime(self.input_file, (1000000000, 1000000000))
+            self.assertEqual(self.stamp(0), stamps[0])
+            self.assertNotEqual(self.stamp(-1), stamps[2])
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestJobFlow(unittest.TestCase):
+        """ Tests running job flows. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.json_config = os.path.join(self.temp_dir_path, 'job.json')
+            input_dir = os.path.join(self.temp_dir_path, 'input')
+            os.makedirs(input_dir)
+            random.seed(3)
+            for i in xrange(3):
+                with open(os.path.join(input_dir, str(i)), 'w') \
+                        as input_stream:
+                    for _ in xrange(500):
+                        print >>input_stream, 'chr%d\t%d\t%s' % (
+                                random.randint(1, 5),
+                                random.randint(1, 50),
+                                random.choice('ACGT')
+                            )
+            self.input_dir = input_dir
+
+        def two_step_flow(self, output_root):
+            """ Returns job flow that counts bases and then sums counts. """
+            first_output = os.path.join(output_root, 'counts')
+            second_output = os.path.join(output_root, 'sums')
+            return [
+                    job_flow_step('Count', self.input_dir, first_output,
+                                    'cut -f1,3', 'uniq -c', key_fields=2,
+                                    task_count=3),
+                    job_flow_step('Sum', first_output, second_output,
+                                    "awk '{print $3 \"\\t\" $1}'",
+                                    "awk -F'\\t' '$1 != k "
+                                    "{if (k != \"\") print k \"\\t\" s; "
+                                    "k = $1; s = 0} {s += $2} "
+                                    "END {if (k != \"\") "
+                                    "print k \"\\t\" s}'")
+                ], first_output, second_output
+
+        def test_pipeline(self):
+            """ Fails if pipelined and sequential outputs differ. """
+            outputs = {}
+            for pipeline_args in [[], ['--no-pipeline']]:
+                output_root = os.path.join(
+                        self.temp_dir_path, 'pipeline' if not pipeline_args
+                                            else 'sequential'
+                    )
+                job_flow, first_output, second_output = self.two_step_flow(
+                                                                output_root
+                                                            )
+                exit_level, output = run_job_flow(
+                        job_flow, self.json_config, '-p', '3',
+                        '--keep-intermediates', *pipeline_args
+                    )
+                self.assertEqual(exit_level, 0, output)
+                outputs[tuple(pipeline_args)] = (
+                        output_contents(first_output),
+                        output_contents(second_output)
+                    )
+            self.assertEqual(outputs[()], outputs[('--no-pipeline',)])
+            first_contents, second_contents = outputs[()]
+            self.assertTrue(any(first_contents.values()))
+            # Every input base is counted once
+            self.assertEqual(
+                    sum(int(line.split('\t')[1])
+                        for contents in second_contents.values()
+                        for line in contents.splitlines()), 1500
+                )
+
+        def test_reuse_outputs(self):
+            """ Fails if stamped steps aren't skipped or rerun correctly. """
+            output_root = os.path.join(self.temp_dir_path, 'reuse')
+            job_flow, first_output, second_output = self.two_step_flow(
+                                                            output_root
+                                                        )
+            def run_and_check(skipped):
+                """ Runs job flow and checks which steps were skipped. """
+                exit_level, output = run_job_flow(
+                        job_flow, self.json_config, '--reuse-outputs'
+                    )
+                self.assertEqual(exit_level, 0, output)
+                for i, step in enumerate(['Count', 'Sum']):
+                    self.assertEqual(
+                            'Step %d/2: %s | Skipped' % (i + 1, step)
+                                in output,
+                            step in skipped, output
+                        )
+                return (output_listing(first_output),
+                        output_contents(second_output))
+            first_listing, second_contents = run_and_check([])
+            # Nothing changed, so both steps are skipped and outputs kept
+            self.assertEqual(run_and_check(['Count', 'Sum']),
+                                (first_listing, second_contents))
+            # A changed command reruns its step but not the step before it
+            job_flow[1]['HadoopJarStep']['Args'][-1] \
+                = job_flow[1]['HadoopJarStep']['Args'][-1].replace(
+                        's += $2', 's = s + $2'
+                    )
+            self.assertEqual(run_and_check(['Count']),
+                                (first_listing, second_contents))
+            self.assertEqual(run_and_check(['Count', 'Sum']),
+                                (first_listing, second_contents))
+            # A changed input reruns the step that reads it and its dependent
+            with open(os.path.join(self.input_dir, '0'), 'a') \
+                    as input_stream:
+                print >>input_stream, 'chr1\t1\tA'
+            rerun_listing, rerun_contents = run_and_check([])
+            self.assertNotEqual(rerun_listing, first_listing)
+            self.assertEqual(
+                    sum(int(line.split('\t')[1])
+                        for contents in rerun_contents.values()
+                        for line in contents.splitlines()), 1501
+                )
+            # A changed output reruns its step
+            with open(os.path.join(second_output,
+                                    rerun_contents.keys()[0]), 'a') \
+                    as output_stream:
+                print >>output_stream, 'junk'
+            self.assertEqual(run_and_check(['Count'])[1], rerun_contents)
+
+        def test_framed(self):
+            """ Fails if framed intermediates change outputs. """
+            tools_dir = os.path.dirname(os.path.abspath(__file__))
+            scripts = {
+                    'count' : [
+                        'for (rname, base), xpartition in xstream(',
+                        '        sys.stdin, 2):',
+                        '    print >>output_stream, "%s\\t%s\\t%012d" % (',
+                        '            rname, base, len(list(xpartition)))'
+                    ],
+                    'drop' : [
+                        'for line in xlines(sys.stdin):',
+                        '    output_stream.write(line.partition("\\t")[2])'
+                    ],
+                    'sum' : [
+                        'for (base,), xpartition in xstream(sys.stdin, 1):',
+                        '    print >>output_stream, "%s\\t%d" % (',
+                        '            base, sum(int(count) for (count,)',
+                        '                        in xpartition))'
+                    ]
+                }
+            for name in scripts:
+                with open(os.path.join(self.temp_dir_path, name + '.py'),
+                            'w') as script_stream:
+                    print >>script_stream, '\n'.join(
+                            ['import sys',
+                             'sys.path.insert(0, %r)' % tools_dir,
+                             'from tools import xstream, xlines, '
+                             'framed_output',
+                             'output_stream = framed_output(sys.stdout)']
+                            + scripts[name] + ['output_stream.close()']
+                        )
+            command = lambda name: '%s %s' % (
+                    sys.executable,
+                    os.path.join(self.temp_dir_path, name + '.py')
+                )
+            outputs = {}
+            for format_args in [['--intermediate-format', 'text'],
+                                ['--intermediate-format', 'framed'],
+                                ['--intermediate-format', 'framed',
+                                    '--shuffle', 'sort', '--no-pipeline']]:
+                output_root = os.path.join(self.temp_dir_path,
+                                            '_'.join(format_args))
+                first_output = os.path.join(output_root, 'counts')
+                second_output = os.path.join(output_root, 'sums')
+                job_flow = [
+                        job_flow_step('Count', self.input_dir, first_output,
+                                        'cut -f1,3', command('count'),
+                                        key_fields=2, task_count=3),
+                        job_flow_step('Sum', first_output, second_output,
+                                        command('drop'), command('sum'))
+                    ]
+                exit_level, output = run_job_flow(
+                        job_flow, self.json_config, '-p', '3',
+                        '--keep-intermediates', *format_args
+                    )
+                self.assertEqual(exit_level, 0, output)
+                for file_path in output_contents(first_output):
+                    with open(os.path.join(first_output, file_path)) \
+                            as intermediate_stream:
+                        self.assertEqual(
+                                is_framed(intermediate_stream.read(
+                                        len(_framed_magic)
+                                    )),
+                                format_args[1] == 'framed'
+                            )
+                for file_path in output_contents(second_output):
+                    with open(os.path.join(second_output, file_path)) \
+                            as output_stream:
+                        self.assertFalse(is_framed(output_stream.read(
+                                        len(_framed_magic)
+                                    )))
+                outputs[tuple(format_args)] = sorted(
+                        line for contents
+                        in output_contents(second_output).values()
+                        for line in contents.splitlines()
+                    )
+            self.assertEqual(len(set(map(tuple, outputs.values()))), 1)
+            self.assertEqual(
+                    sum(int(line.split('\t')[1])
+                        for line in outputs.values()[0]), 1500
+                )
+
+        def test_framed_outputs(self):
+            """ Fails if outputs opened by name or never read are framed. """
+            def step(output_path, input_path, reducer='cat'):
+                return {'input' : input_path, 'output' : output_path,
+                        'mapper' : 'cat', 'reducer' : reducer}
+            steps = OrderedDict([
+                    ('first', step('/a', '/input')),
+                    ('second', step('/b', '/a/x,/a/y')),
+                    ('third', step('/c', '/a,/b/x', 'tool --index /b/x')),
+                    ('fourth', step('/d', '/b/y,/c')),
+                    ('fifth', step('/e', '/d', 'tool --index /d/index'))
+                ])
+            self.assertEqual(framed_outputs(steps),
+                                {'first' : None, 'second' : set(['y']),
+                                 'third' : None})
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
@@ -32,7 +32,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-from itertools import groupby
+from itertools import groupby, chain, imap
 import os
 import threading
 import signal
@@ -188,6 +188,228 @@ def path_join(unix, *args):
     else:
         return os.path.join(*args)
 
+'''BGZF blocks hold at most this many bytes of uncompressed data, as in htslib,
+so a compressed block can't exceed the 64 KB limit set by its BSIZE field.'''
+_bgzf_block_size = 65280
+_bgzf_eof = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+             '\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+def bgzf_block(data, compresslevel=6):
+    """ Compresses data as one BGZF block: a gzip member with a BC field.
+
+        data: string with at most _bgzf_block_size bytes
+        compresslevel: level of compression
+
+        Return value: string with BGZF block
+    """
+    import zlib
+    import struct
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    return ''.join([
+            '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00',
+            struct.pack('<H', len(deflated) + 25),
+            deflated,
+            struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+        ])
+
+def coordinate_index_key(line):
+    """ Gets the coordinate of a line whose first two fields are RNAME, POS.
+
+        Suitable as a BgzfWriter index_key for BED lines, for example.
+
+        line: line of text without its newline
+
+        Return value: tuple (RNAME, POS) or None if line has no coordinate,
+            like a header
+    """
+    fields = line.split('\t', 2)
+    try:
+        return fields[0], int(fields[1])
+    except (IndexError, ValueError):
+        return None
+
+class BgzfWriter(object):
+    """ File-like object that writes BGZF with a pool of compression threads.
+
+        BGZF files are concatenations of gzip members, each holding at most
+        _bgzf_block_size bytes, so they can be read by gzip. Blocks are
+        compressed by zlib, which releases the GIL, in a thread pool and
+        written in order. Blocks begin at fixed offsets of the uncompressed
+        data, so the virtual offset of any line (compressed offset of its
+        block << 16 | its offset within the block) is known once the block
+        is written.
+
+        virtual_offset() converts an uncompressed offset into a virtual offset
+        once the block holding it is written, as for a BAM index.
+
+        If index_key is provided, a coordinate index is written to the
+        output filename + '.idx' on close(). It has a tab-separated line
+        (RNAME, coordinate, virtual offset) for the first line starting in
+        each block and for the first line of each RNAME, so a reader can
+        seek to the last entry before a coordinate of interest in a file
+        sorted by coordinate.
+    """
+    def __init__(self, filename, mode='w', compresslevel=6, threads=1,
+                    index_key=None):
+        """
+            filename: path to output file
+            mode: 'w' to write or 'a' to append
+            compresslevel: level of compression
+            threads: number of compression threads
+            index_key: function that takes a line without its newline and
+                returns a tuple (RNAME, coordinate) or None if line shouldn't
+                be indexed, or None if no index should be written
+        """
+        from collections import deque
+        self.filename = filename
+        self.output_stream = open(filename, 'ab' if 'a' in mode else 'wb')
+        self.output_stream.seek(0, os.SEEK_END)
+        self.offset = self.output_stream.tell()
+        self.compresslevel = compresslevel
+        if threads > 1:
+            from multiprocessing.pool import ThreadPool
+            self._pool = ThreadPool(threads)
+        else:
+            self._pool = None
+        self._max_pending = 4 * threads
+        self._pending = deque()
+        self._buffer, self._buffered = [], 0
+        self.index_key = index_key
+        # Compressed offset of each block written
+        self._block_offsets = []
+        self._index_entries = []
+        self._uncompressed_offset = 0
+        self._line_start, self._partial = 0, []
+        self._last_rname, self._last_block = None, None
+
+    def _index(self, data):
+        """ Finds starts of lines in data, adding index entries as needed.
+
+            data: string with text
+
+            No return value.
+        """
+        position = 0
+        while position < len(data):
+            if not self._partial:
+                self._line_start = self._uncompressed_offset + position
+            newline = data.find('\n', position)
+            if newline == -1:
+                self._partial.append(data[position:])
+                break
+            self._partial.append(data[position:newline])
+            key = self.index_key(''.join(self._partial))
+            self._partial = []
+            position = newline + 1
+            if key is None: continue
+            block = self._line_start // _bgzf_block_size
+            if key[0] != self._last_rname or block != self._last_block:
+                self._index_entries.append(key + (self._line_start,))
+                self._last_rname, self._last_block = key[0], block
+
+    def _write_block(self, block):
+        """ Writes a compressed block, recording its offset.
+
+            block: string with BGZF block
+
+            No return value.
+        """
+        self._block_offsets.append(self.offset)
+        self.output_stream.write(block)
+        self.offset += len(block)
+
+    def _submit(self, data):
+        """ Compresses data in the pool, writing blocks that are done.
+
+            data: string with at most _bgzf_block_size bytes
+
+            No return value.
+        """
+        if self._pool is None:
+            self._write_block(bgzf_block(data, self.compresslevel))
+            return
+        self._pending.append(self._pool.apply_async(
+                bgzf_block, (data, self.compresslevel)
+            ))
+        while len(self._pending) > self._max_pending:
+            self._write_block(self._pending.popleft().get())
+
+    def _flush_blocks(self, final=False):
+        """ Submits buffered data in full blocks (and a last partial one).
+
+            final: True iff a partial block should be submitted too
+
+            No return value.
+        """
+        data = ''.join(self._buffer)
+        blocks_end = len(data) if final else (
+                len(data) - len(data) % _bgzf_block_size
+            )
+        for start in xrange(0, blocks_end, _bgzf_block_size):
+            self._submit(data[start:start + _bgzf_block_size])
+        remainder = data[blocks_end:]
+        self._buffer = [remainder] if remainder else []
+        self._buffered = len(remainder)
+
+    def write(self, data):
+        """ Writes text.
+
+            data: string with text
+
+            No return value.
+        """
+        if self.index_key is not None:
+            self._index(data)
+        self._uncompressed_offset += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= _bgzf_block_size:
+            self._flush_blocks()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        """ Return value: uncompressed offset of next byte written """
+        return self._uncompressed_offset
+
+    def virtual_offset(self, offset):
+        """ Converts an uncompressed offset into a virtual offset.
+
+            offset: uncompressed offset whose block has been written; after
+                close(), this may be the offset of the end of the data
+
+            Return value: compressed offset of block << 16 | offset within
+                block
+        """
+        return (self._block_offsets[offset // _bgzf_block_size] << 16
+                    | offset % _bgzf_block_size)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Writes remaining blocks, the EOF block, and any index. """
+        self._flush_blocks(final=True)
+        while self._pending:
+            self._write_block(self._pending.popleft().get())
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        # The end of the data is the start of the EOF block
+        self._block_offsets.append(self.offset)
+        self.output_stream.write(_bgzf_eof)
+        self.output_stream.close()
+        if self.index_key is not None:
+            with open(self.filename + '.idx', 'w') as index_stream:
+                for rname, coordinate, line_start in self._index_entries:
+                    print >>index_stream, '%s\t%d\t%d' % (
+                            rname, coordinate,
+                            self.virtual_offset(line_start)
+                        )
+
 @contextlib.contextmanager
 def xopen(gzipped, *args):
     """ Passes args on to the appropriate opener, gzip or regular.
@@ -200,7 +422,9 @@ def xopen(gzipped, *args):
 
         gzipped: True iff gzip.open() should be used to open rather than
             open(); False iff open() should be used; None if input should be
-            read and guessed; '-' if writing to stdout
+            read and guessed; '-' if writing to stdout; 'bgzf' if writing
+            with a BgzfWriter, in which case args after the compression
+            level are its threads and index_key
         *args: unnamed arguments to pass
 
         Yield value: file object
@@ -208,6 +432,10 @@ def xopen(gzipped, *args):
     import sys
     if gzipped == '-':
         fh = sys.stdout
+    elif gzipped == 'bgzf':
+        if not args:
+            raise IOError, 'Must provide filename'
+        fh = BgzfWriter(*args)
     else:
         if not args:
             raise IOError, 'Must provide filename'
@@ -260,6 +488,45 @@ def xopen(gzipped, *args):
         if 'old_read_eof' in locals():
             gzip.GzipFile._read_eof = old_read_eof
 
+@contextlib.contextmanager
+def decompressed_input(filename):
+    """ Opens a file for reading, decompressing gzipped input in a subprocess.
+
+        Decompression is offloaded to pigz -dc (or gzip -dc if pigz is not
+        installed) so it proceeds concurrently with whatever consumes the
+        stream. Like xopen(), it is forgiving of gzips that end unexpectedly:
+        a nonzero exit status is reported to stderr rather than raised.
+        Falls back on xopen() for uncompressed files or if neither
+        executable is found.
+
+        filename: path to file
+
+        Yield value: file object
+    """
+    with open(filename, 'rb') as binary_input_stream:
+        gzipped = (binary_input_stream.read(2) == '\x1f\x8b')
+    decompressor = (which('pigz') or which('gzip')) if gzipped else None
+    if decompressor is None:
+        with xopen(None, filename) as input_stream:
+            yield input_stream
+        return
+    decompress_process = subprocess.Popen(
+            [decompressor, '-dc', filename], bufsize=-1,
+            stdout=subprocess.PIPE,
+            preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        )
+    try:
+        yield decompress_process.stdout
+    finally:
+        decompress_process.stdout.close()
+        if decompress_process.wait() > 0:
+            '''Negative return codes are from the signals a decompressor
+            gets when the stream is closed before it's exhausted.'''
+            print >>sys.stderr, (
+                    'Warning: "%s -dc %s" exited with code %d; input may be '
+                    'truncated.'
+                ) % (decompressor, filename, decompress_process.returncode)
+
 def make_temp_dir(scratch=None):
     """ Creates temporary directory in some scratch directory.
 
@@ -327,6 +594,67 @@ def engine_string_from_list(id_list):
         to_print[-1] = ' '.join(['and', to_print[-1]])
     return ', '.join(to_print)
 
+def wait_for_asyncresults(rc, asyncresults, first_completed=False,
+                            done_event=None, interval=0.01):
+    """ Waits for IPython AsyncResults to be done using public Client API.
+
+        For IPython parallel mode.
+
+        Waiting for all results blocks in Client.wait(). Waiting for the
+        first result blocks on done_event if it is provided; it should be
+        set by a done callback that the caller registered on each
+        AsyncResult when the AsyncResult was submitted (see
+        notify_when_done()). Otherwise, results are checked with ready(),
+        which polls the Client's result socket, every interval seconds.
+
+        rc: IPython parallel Client object
+        asyncresults: iterable of AsyncResults
+        first_completed: if True, returns as soon as any of asyncresults is
+            done; otherwise, returns when all of them are done
+        done_event: threading.Event set whenever any of asyncresults is
+            done, or None if AsyncResults don't support done callbacks
+        interval: time in seconds to sleep between checks of which
+            results are done when first_completed is True and done_event
+            is None
+
+        Return value: list of AsyncResults from asyncresults that are done
+    """
+    asyncresults = list(asyncresults)
+    if not first_completed:
+        rc.wait(asyncresults)
+        return asyncresults
+    while True:
+        if done_event is not None:
+            # Clear before checking so no completion is missed
+            done_event.clear()
+        done_asyncresults = [asyncresult for asyncresult in asyncresults
+                                if asyncresult.ready()]
+        if done_asyncresults or not asyncresults:
+            return done_asyncresults
+        if done_event is not None:
+            # Time out now and then so KeyboardInterrupt is handled
+            done_event.wait(1)
+        else:
+            time.sleep(interval)
+
+def notify_when_done(asyncresult, done_event):
+    """ Registers a done callback on an AsyncResult that sets an event.
+
+        For IPython parallel mode. Only ipyparallel AsyncResults support
+        done callbacks.
+
+        asyncresult: AsyncResult
+        done_event: threading.Event to set when asyncresult is done
+
+        Return value: True iff the callback was registered
+    """
+    try:
+        add_done_callback = asyncresult.add_done_callback
+    except AttributeError:
+        return False
+    add_done_callback(lambda _: done_event.set())
+    return True
+
 def apply_async_with_errors(rc, ids, function_to_apply, *args, **kwargs):
     """ apply_async() that cleanly outputs engines responsible for exceptions.
 
@@ -411,8 +739,7 @@ def apply_async_with_errors(rc, ids, function_to_apply, *args, **kwargs):
                     function_to_apply[i],*new_args[i],**new_kwargs[i]
                 )
             )
-    while any([not asyncresult.ready() for asyncresult in asyncresults]):
-        time.sleep(1e-1)
+    wait_for_asyncresults(rc, asyncresults)
     asyncexceptions = defaultdict(set)
     for asyncresult in asyncresults:
         try:
@@ -520,7 +847,370 @@ class dlist(object):
 
     def __exit__(self, type, value, traceback):
         self.tear_down()
- 
+
+'''Framed intermediate format: a stream starts with _framed_magic and a byte
+identifying the block codec, followed by blocks. Each block is
+<varint size of records> <varint size of stored block> <stored block>, where
+the stored block is the codec's compression of a run of records that never
+straddle blocks. A record is <varint field count> followed by its fields.
+A field is <varint 2 * byte count> <bytes> unless it is a run of decimal
+digits, in which case it is <varint 2 * width + 1> <varint value>, and width
+is the number of digits if the field is zero-padded and 0 otherwise. Leading
+NUL never begins a line of text, so the formats can be told apart, and no
+block has size 0, so framed streams can be concatenated: a header may appear
+wherever a block may.'''
+_framed_magic = '\x00DPF1'
+_framed_codecs = ['none', 'zlib', 'lz4', 'zstd']
+_framed_max_digits = 18
+# Steps write framed output with this codec if it's in their environment
+_framed_codec_variable = 'dooplicity_framed_codec'
+
+def framed_codec_functions(codec):
+    """ Gets compress/decompress functions for a framed block codec.
+
+        codec: one of _framed_codecs
+
+        Return value: tuple (compress, decompress), each a function that
+            takes a string and returns a string; decompress also takes the
+            size of the decompressed string
+    """
+    if codec == 'none':
+        return (lambda data: data), (lambda data, size: data)
+    if codec == 'zlib':
+        import zlib
+        return ((lambda data: zlib.compress(data, 1)),
+                (lambda data, size: zlib.decompress(data)))
+    if codec == 'lz4':
+        try:
+            import lz4.block
+        except ImportError:
+            raise RuntimeError('The lz4 module must be installed to use '
+                               'LZ4 compression of framed intermediates.')
+        return ((lambda data: lz4.block.compress(data, store_size=False)),
+                (lambda data, size: lz4.block.decompress(
+                                            data, uncompressed_size=size
+                                        )))
+    if codec == 'zstd':
+        try:
+            import zstd
+        except ImportError:
+            raise RuntimeError('The zstd module must be installed to use '
+                               'Zstandard compression of framed '
+                               'intermediates.')
+        return ((lambda data: zstd.compress(data, 1)),
+                (lambda data, size: zstd.decompress(data)))
+    raise RuntimeError('Framed codec "%s" is not one of {%s}.'
+                        % (codec, ', '.join(_framed_codecs)))
+
+def varint(number, chars=[chr(i) for i in xrange(256)]):
+    """ Encodes a nonnegative integer as an LEB128 varint.
+
+        number: nonnegative integer
+        chars: lookup table of characters; not to be passed
+
+        Return value: string with varint
+    """
+    if number < 128:
+        return chars[number]
+    encoded = []
+    while number >= 128:
+        encoded.append(chars[(number & 127) | 128])
+        number >>= 7
+    encoded.append(chars[number])
+    return ''.join(encoded)
+
+class FramedWriter(object):
+    """ File-like object that writes framed records.
+
+        Records are buffered into blocks of about block_size bytes, which
+        are compressed with the chosen codec. A step can write a record's
+        fields with write_record(), or write lines of text, which are split
+        into fields at separator; only write(), writelines(), flush(), and
+        close() are supported for text, so an instance can stand in for a
+        text output stream (e.g., with print >>).
+    """
+    def __init__(self, output_stream, separator='\t', codec='zlib',
+                    block_size=262144):
+        """
+            output_stream: where to write framed records
+            separator: separator between successive fields of a line
+            codec: block codec, one of _framed_codecs
+            block_size: approximate size of uncompressed block in bytes
+        """
+        self.output_stream = output_stream
+        self.separator = separator
+        self.block_size = block_size
+        self._compress, _ = framed_codec_functions(codec)
+        self._records = []
+        self._buffered = 0
+        self._partial = []
+        self.output_stream.write(
+                _framed_magic + chr(_framed_codecs.index(codec))
+            )
+
+    def write_record(self, fields):
+        """ Writes a record.
+
+            fields: sequence of strings
+
+            No return value.
+        """
+        encoded = [varint(len(fields))]
+        for field in fields:
+            if field.isdigit() and len(field) <= _framed_max_digits:
+                encoded.append(varint(
+                        ((len(field) if field[0] == '0' and len(field) > 1
+                            else 0) << 1) | 1
+                    ))
+                encoded.append(varint(int(field)))
+            else:
+                encoded.append(varint(len(field) << 1))
+                encoded.append(field)
+        record = ''.join(encoded)
+        self._records.append(record)
+        self._buffered += len(record)
+        if self._buffered >= self.block_size:
+            self._write_block()
+
+    def write(self, data):
+        """ Writes text; records are written only for complete lines.
+
+            data: string with text
+
+            No return value.
+        """
+        if '\n' not in data:
+            # Pieces of a line are joined only when it's complete
+            self._partial.append(data)
+            return
+        if self._partial:
+            self._partial.append(data)
+            data = ''.join(self._partial)
+        lines = data.split('\n')
+        last_line = lines.pop()
+        self._partial = [last_line] if last_line else []
+        separator = self.separator
+        for line in lines:
+            self.write_record(line.split(separator))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _write_block(self):
+        """ Compresses and writes buffered records as a block. """
+        if not self._records:
+            return
+        block = ''.join(self._records)
+        stored = self._compress(block)
+        self.output_stream.write(
+                varint(len(block)) + varint(len(stored)) + stored
+            )
+        self._records = []
+        self._buffered = 0
+
+    def flush(self):
+        self._write_block()
+        self.output_stream.flush()
+
+    def close(self):
+        """ Writes any final line lacking a newline and remaining records. """
+        if self._partial:
+            self.write('\n')
+        self._write_block()
+        self.output_stream.close()
+
+def framed_output(output_stream=sys.stdout):
+    """ Gets stream to which a step should write intermediate output.
+
+        A step that writes intermediate output only through the returned
+        stream, and closes it when it's done, writes framed records if the
+        job flow runner put a framed codec in its environment (see
+        emr_simulator's --intermediate-format) and text otherwise.
+
+        output_stream: where to write output
+
+        Return value: FramedWriter that writes to output_stream, or
+            output_stream itself
+    """
+    codec = os.environ.get(_framed_codec_variable)
+    if not codec:
+        return output_stream
+    return FramedWriter(output_stream, codec=codec)
+
+def is_framed(prefix):
+    """ Checks whether the start of a stream is that of a framed stream.
+
+        prefix: first bytes of stream
+
+        Return value: True iff stream is framed
+    """
+    return prefix[:len(_framed_magic)] == _framed_magic
+
+def framed_records(input_stream, prefix=''):
+    """ Iterates through records of a framed stream.
+
+        input_stream: framed stream, or concatenation of framed streams
+        prefix: bytes already read from the beginning of input_stream
+
+        Yield value: tuple of fields of record
+    """
+    buffered = [prefix]
+    def read(size):
+        """ Reads size bytes, first from what's left of prefix. """
+        data = buffered[0][:size]
+        buffered[0] = buffered[0][size:]
+        if len(data) < size:
+            data += input_stream.read(size - len(data))
+        return data
+    def read_varint():
+        """ Reads varint from stream; returns None at end of stream. """
+        number, shift = 0, 0
+        while True:
+            char = read(1)
+            if not char:
+                if shift:
+                    raise RuntimeError('Framed stream is truncated.')
+                return None
+            byte = ord(char)
+            number |= (byte & 127) << shift
+            if byte < 128:
+                return number
+            shift += 7
+    def read_codec(header):
+        """ Gets decompress function from header of framed stream. """
+        if not is_framed(header) or len(header) <= len(_framed_magic):
+            raise RuntimeError('Stream is not framed.')
+        try:
+            return framed_codec_functions(_framed_codecs[ord(header[-1])])[1]
+        except IndexError:
+            raise RuntimeError('Framed stream has an unknown codec.')
+    decompress = read_codec(read(len(_framed_magic) + 1))
+    while True:
+        block_size = read_varint()
+        if block_size is None:
+            return
+        if block_size == 0:
+            # Header of a concatenated framed stream
+            decompress = read_codec('\x00' + read(len(_framed_magic)))
+            continue
+        stored_size = read_varint()
+        if stored_size is None:
+            raise RuntimeError('Framed stream is truncated.')
+        stored = read(stored_size)
+        if len(stored) < stored_size:
+            raise RuntimeError('Framed stream is truncated.')
+        block = decompress(stored, block_size)
+        data = bytearray(block)
+        position, end = 0, len(data)
+        while position < end:
+            '''Varints are decoded inline because function calls per field
+            would dominate decoding time.'''
+            field_count = data[position]
+            position += 1
+            if field_count >= 128:
+                field_count &= 127
+                shift = 7
+                while True:
+                    byte = data[position]
+                    position += 1
+                    field_count |= (byte & 127) << shift
+                    if byte < 128: break
+                    shift += 7
+            fields = []
+            for _ in xrange(field_count):
+                field_header = data[position]
+                position += 1
+                if field_header >= 128:
+                    field_header &= 127
+                    shift = 7
+                    while True:
+                        byte = data[position]
+                        position += 1
+                        field_header |= (byte & 127) << shift
+                        if byte < 128: break
+                        shift += 7
+                if field_header & 1:
+                    number = data[position]
+                    position += 1
+                    if number >= 128:
+                        number &= 127
+                        shift = 7
+                        while True:
+                            byte = data[position]
+                            position += 1
+                            number |= (byte & 127) << shift
+                            if byte < 128: break
+                            shift += 7
+                    fields.append(str(number).zfill(field_header >> 1))
+                else:
+                    field_end = position + (field_header >> 1)
+                    fields.append(block[position:field_end])
+                    position = field_end
+            yield tuple(fields)
+
+def framed_lines(input_stream, prefix='', separator='\t'):
+    """ Iterates through records of a framed stream as lines of text.
+
+        input_stream: framed stream
+        prefix: bytes already read from the beginning of input_stream
+        separator: separator to place between successive fields
+
+        Yield value: line of text ending in a newline
+    """
+    for fields in framed_records(input_stream, prefix=prefix):
+        yield separator.join(fields) + '\n'
+
+def xlines(input_stream, separator='\t'):
+    """ Iterates through lines of a stream that is text or framed.
+
+        For steps that read their input line by line rather than with
+        xstream. Framed records are turned back into lines of text.
+
+        input_stream: input stream
+        separator: separator to place between successive fields of framed
+            records
+
+        Yield value: line of text
+    """
+    head = input_stream.read(len(_framed_magic))
+    if is_framed(head):
+        for line in framed_lines(input_stream, prefix=head,
+                                    separator=separator):
+            yield line
+        return
+    if head:
+        for line in (head + input_stream.readline()).splitlines(True):
+            yield line
+    for line in input_stream:
+        yield line
+
+def text_lines(input_stream, block_size=1048576, prefix=''):
+    """ Iterates through stripped lines of a text stream read in blocks.
+
+        Reading large blocks and splitting them into lines avoids a call
+        per line to readline(), which is slow for, e.g., gzip.GzipFile
+        objects.
+
+        input_stream: text stream
+        block_size: number of bytes to read at a time
+        prefix: text already read from the beginning of input_stream
+
+        Return value: iterator over lines, each stripped of whitespace on
+            both ends
+    """
+    def blocks():
+        """ Yields lists of stripped lines, one per block read. """
+        partial, block = '', prefix + input_stream.read(block_size)
+        while block:
+            lines = (partial + block).split('\n')
+            partial = lines.pop()
+            yield map(str.strip, lines)
+            block = input_stream.read(block_size)
+        if partial:
+            yield [partial.strip()]
+    return chain.from_iterable(blocks())
+
 class xstream(object):
     """ Permits Pythonic iteration through partitioned/sorted input streams.
 
@@ -536,12 +1226,15 @@ class xstream(object):
 
         Each of key and value above is a tuple of strings.
 
-        Properties
-        -------------
-        key: key tuple that denotes current partition; this is an attribute
-            of both an xstream. None when no lines have been read yet.
-        value: tuple that denotes current value. None when no lines have been
-            read yet.
+        Partitions are delimited by checking whether each line begins with
+        the part of the partition's first line up to the separator that
+        follows its last key field, so the rest of a line is split into
+        value fields only when the value is requested. Lines of a partition
+        that is skipped, or not fully iterated through, are thus never split.
+
+        Framed input (see FramedWriter) is detected automatically. Its
+        records already hold fields, so partitions are delimited by
+        comparing key fields, and no text is split at all.
 
         Init vars
         -------------
@@ -550,50 +1243,174 @@ class xstream(object):
             considered the key denoting a partition
         separator: delimiter separating fields from each input line
         skip_duplicates: skip any duplicate lines that may follow a line
+        block_size: number of bytes to read from input_stream at a time if
+            it is not a built-in file, which reads ahead on its own
     """
-    @staticmethod
-    def stream_iterator(
-            input_stream,
-            separator='\t',
-            skip_duplicates=False
-        ):
-        if skip_duplicates:
-            for line, _ in groupby(input_stream):
-                yield tuple(line.strip().split(separator))
-        else:
-            for line in input_stream:
-                yield tuple(line.strip().split(separator))
-
     def __init__(
             self, 
             input_stream,
             key_fields=1,
             separator='\t',
-            skip_duplicates=False
+            skip_duplicates=False,
+            block_size=1048576
         ):
         self._key_fields = key_fields
-        self.it = self.stream_iterator(
-                        input_stream,
-                        separator=separator,
-                        skip_duplicates=skip_duplicates
+        self._separator = separator
+        # Key prefixes of line last read and of current partition; no line
+        # matches the initial one because lines are stripped
+        self._prefix = self._target = ('\n', '\n', None)
+        # Line last read
+        self._line = None
+        # For framed input: next() of record iterator and record last read
+        self._next_record = self._record = None
+        head = ''
+        if hasattr(input_stream, 'read'):
+            head = input_stream.read(len(_framed_magic))
+            if is_framed(head):
+                records = imap(self._stripped_record,
+                               framed_records(input_stream, prefix=head))
+                if skip_duplicates:
+                    records = (record for record, _ in groupby(records))
+                self._next_record = records.next
+                # Keys of record last read and of current partition
+                self._key = self._target_key = None
+                return
+        if (hasattr(input_stream, 'read')
+                and not isinstance(input_stream, file)):
+            lines = text_lines(input_stream, block_size=block_size,
+                               prefix=head)
+        else:
+            # Built-in files already read ahead in blocks
+            if head:
+                input_stream = chain(
+                        (head + input_stream.readline()).splitlines(True),
+                        input_stream
                     )
-        self.tgtkey = self.currkey = self.currvalue = object()
+            lines = imap(str.strip, input_stream)
+        if skip_duplicates:
+            lines = (line for line, _ in groupby(lines))
+        self._next_line = lines.next
 
     def __iter__(self):
         return self
 
+    def _key_prefix(self, line):
+        """ Finds part of line up to separator following its last key field.
+
+            line: line from input stream
+
+            Return value: tuple (key prefix, key line, key). The key prefix
+                is a string that begins every line with the same key and
+                value fields. The key line is the string of key fields
+                alone, which is also how a line with the same key and no
+                value fields reads. The key is the tuple of key fields.
+        """
+        separator, key_fields = self._separator, self._key_fields
+        if key_fields == 1:
+            end = line.find(separator)
+            if end < 0:
+                return line + separator, line, (line,)
+            key_line = line[:end]
+            return key_line + separator, key_line, (key_line,)
+        fields = line.split(separator, key_fields)
+        field_count = len(fields)
+        if field_count > key_fields:
+            key_line = line[:len(line) - len(fields.pop()) - len(separator)]
+            return key_line + separator, key_line, tuple(fields)
+        if field_count == key_fields:
+            # Line has no value fields
+            return line + separator, line, tuple(fields)
+        # Line has too few key fields to be followed by values
+        return line + '\n', line, tuple(fields)
+
+    def _stripped_record(self, record):
+        """ Strips a framed record the way a line of text would be stripped.
+
+            record: tuple of fields
+
+            Return value: tuple of fields of record after the line it
+                represents is stripped of whitespace on both ends
+        """
+        if (record and record[0] and record[-1]
+                and not record[0][0].isspace()
+                and not record[-1][-1].isspace()):
+            return record
+        return tuple(
+                self._separator.join(record).strip().split(self._separator)
+            )
+
     def next(self):
-        while self.currkey == self.tgtkey:
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
-        self.tgtkey = self.currkey
-        return self.currkey, self._grouper(self.tgtkey)
-
-    def _grouper(self, tgtkey):
-        while self.currkey == tgtkey:
-            yield self.currvalue[self._key_fields:]
-            self.currvalue = next(self.it)    # Exit on StopIteration
-            self.currkey = self.currvalue[:self._key_fields]
+        if self._next_record is not None:
+            return self._framed_next()
+        if self._prefix == self._target:
+            # Skip rest of current partition without finding keys
+            prefix, key_line, _ = self._target
+            line = self._next_line()    # Exit on StopIteration
+            while line.startswith(prefix) or line == key_line:
+                line = self._next_line()
+            self._line, self._prefix = line, self._key_prefix(line)
+        self._target = self._prefix
+        return self._prefix[2], self._grouper(self._prefix)
+
+    def _grouper(self, target):
+        """ Yields values of a partition.
+
+            target: (key prefix, key line, key) of partition; see
+                _key_prefix()
+
+            Yield value: tuple of value fields
+        """
+        separator, next_line = self._separator, self._next_line
+        prefix, key_line, _ = target
+        start = len(prefix)
+        line = self._line
+        while True:
+            yield (tuple(line[start:].split(separator))
+                    if len(line) >= start else ())
+            try:
+                line = next_line()
+            except StopIteration:
+                # next() reads again and so stops iteration
+                self._prefix = target
+                return
+            if not (line.startswith(prefix) or line == key_line):
+                self._line, self._prefix = line, self._key_prefix(line)
+                return
+
+    def _framed_next(self):
+        """ next() for framed input. """
+        key_fields, next_record = self._key_fields, self._next_record
+        if self._key == self._target_key:
+            # Skip rest of current partition
+            target_key = self._target_key
+            record = next_record()    # Exit on StopIteration
+            while record[:key_fields] == target_key:
+                record = next_record()
+            self._record, self._key = record, record[:key_fields]
+        self._target_key = self._key
+        return self._key, self._framed_grouper(self._key)
+
+    def _framed_grouper(self, target_key):
+        """ Yields values of a partition of framed input.
+
+            target_key: key of partition
+
+            Yield value: tuple of value fields
+        """
+        key_fields, next_record = self._key_fields, self._next_record
+        record = self._record
+        while True:
+            yield record[key_fields:]
+            try:
+                record = next_record()
+            except StopIteration:
+                # next() reads again and so stops iteration
+                self._key = target_key
+                return
+            key = record[:key_fields]
+            if key != target_key:
+                self._record, self._key = record, key
+                return
 
 if __name__ == '__main__':
     # Run unit tests
@@ -716,10 +1533,376 @@ if __name__ == '__main__':
                     for value in xpartition:
                         pass
 
+        def test_block_boundaries(self):
+            """ Fails if lines split across blocks aren't reassembled. """
+            lines = (' chr1\t1\ta\t20\t90\n'
+                     'chr1\t1\n'
+                     'chr1\t1\ti\t10\t50 \n'
+                     'chr1\n'
+                     'chr1\t10\ti\n'
+                     'chr1\t10\ti')
+            with gzip.open(self.input_file, 'wb') as input_stream:
+                input_stream.write(lines)
+            for block_size in [1, 2, 3, 7, 1048576]:
+                with gzip.open(self.input_file) as input_stream:
+                    output = [(key, list(xpartition)) for key, xpartition
+                                in xstream(input_stream, 2,
+                                            block_size=block_size)]
+                self.assertEqual(output,
+                        [(('chr1', '1'), [('a', '20', '90'), (),
+                                          ('i', '10', '50')]),
+                         (('chr1',), [()]),
+                         (('chr1', '10'), [('i',), ('i',)])]
+                    )
+
+        def test_framed_input(self):
+            """ Fails if framed input isn't partitioned like text input. """
+            lines = ('chr1\t1\ta\t20\t90\n'
+                     'chr1\t1\ta\t20\t90\n'
+                     'chr1\t1\ti\t10\t050\n'
+                     'chr1\t1\n'
+                     ' chr1\t2\ti\t91\t\n'
+                     'chr2\n'
+                     '\n')
+            for skip_duplicates in [False, True]:
+                with open(self.input_file, 'w') as input_stream:
+                    input_stream.write(lines)
+                with open(self.input_file) as input_stream:
+                    text_output = [(key, value) for key, xpartition
+                                    in xstream(input_stream, 2,
+                                        skip_duplicates=skip_duplicates)
+                                    for value in xpartition]
+                with open(self.input_file, 'w') as input_stream:
+                    framed_stream = FramedWriter(input_stream, block_size=20)
+                    framed_stream.write(lines)
+                    framed_stream.close()
+                with open(self.input_file) as input_stream:
+                    framed_output = [(key, value) for key, xpartition
+                                        in xstream(input_stream, 2,
+                                            skip_duplicates=skip_duplicates)
+                                        for value in xpartition]
+                self.assertEqual(text_output, framed_output)
+
+        def test_partially_read_partitions(self):
+            """ Fails if partitions that aren't read through are misplaced.
+            """
+            with open(self.input_file, 'w') as input_stream:
+                input_stream.write(
+                        'read1\tA\n'
+                        'read1\tB\n'
+                        'read10\tC\n'
+                        'read2\tD\n'
+                        'read2\tE\n'
+                        'read2\n'
+                        'read3\tF\n'
+                    )
+            with open(self.input_file) as input_stream:
+                output = []
+                for i, (key, xpartition) in enumerate(xstream(input_stream)):
+                    if i % 2:
+                        output.append((key, xpartition.next()))
+                    else:
+                        output.append(key)
+            self.assertEqual(output,
+                    [('read1',), (('read10',), ('C',)),
+                     ('read2',), (('read3',), ('F',))]
+                )
+
+        def test_framed_partially_read_partitions(self):
+            """ Fails if framed and text partitions are grouped differently.
+            """
+            lines = ('read1\tA\n'
+                     'read1\tA\n'
+                     'read1\tB\n'
+                     'read10\tC\n'
+                     'read2\tD\n'
+                     'read2\tD\n'
+                     'read2\n'
+                     'read3\tF\n'
+                     'read3\tF\n'
+                     'read4\t0012\n')
+            for skip_duplicates in [False, True]:
+                outputs = []
+                for framed in [False, True]:
+                    with open(self.input_file, 'w') as input_stream:
+                        if framed:
+                            framed_stream = FramedWriter(input_stream,
+                                                            block_size=10)
+                            framed_stream.write(lines)
+                            framed_stream.close()
+                        else:
+                            input_stream.write(lines)
+                    with open(self.input_file) as input_stream:
+                        output = []
+                        for i, (key, xpartition) in enumerate(
+                                xstream(input_stream,
+                                        skip_duplicates=skip_duplicates)
+                            ):
+                            if i % 2:
+                                output.append((key, xpartition.next()))
+                            else:
+                                output.append(key)
+                        outputs.append(output)
+                self.assertEqual(outputs[0], outputs[1])
+                self.assertEqual(outputs[0],
+                        [('read1',), (('read10',), ('C',)),
+                         ('read2',), (('read3',), ('F',)), ('read4',)]
+                    )
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestFramed(unittest.TestCase):
+        """ Tests framed intermediate format. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.framed_file = os.path.join(self.temp_dir_path, 'framed')
+
+        def test_round_trip(self):
+            """ Fails if lines don't survive framing for every codec. """
+            lines = ['chr1\t0\t00012\t12\t\tACGT\n',
+                     '\n',
+                     '\t\n',
+                     '%d\t-5\t1.5\n' % (10**30)] * 50 + ['partial']
+            for codec in ['none', 'zlib']:
+                with open(self.framed_file, 'w') as framed_stream:
+                    writer = FramedWriter(framed_stream, codec=codec,
+                                            block_size=100)
+                    for line in lines:
+                        writer.write(line)
+                    writer.close()
+                with open(self.framed_file) as framed_stream:
+                    self.assertEqual(''.join(framed_lines(framed_stream)),
+                                     ''.join(lines) + '\n')
+
+        def test_records_and_concatenation(self):
+            """ Fails if records or concatenated streams are misread. """
+            records = [('exon_diff', '000000000012', '7', '-1'),
+                       ('sam', 'read1', '', 'ACGT\t')]
+            with open(self.framed_file, 'w') as framed_stream:
+                for codec in ['zlib', 'none']:
+                    writer = FramedWriter(framed_stream, codec=codec)
+                    for record in records:
+                        writer.write_record(record)
+                    writer.flush()
+                writer.close()
+            with open(self.framed_file) as framed_stream:
+                self.assertEqual(list(framed_records(framed_stream)),
+                                 records * 2)
+
+        def test_truncation(self):
+            """ Fails if truncated framed stream isn't detected. """
+            with open(self.framed_file, 'w') as framed_stream:
+                writer = FramedWriter(framed_stream)
+                writer.write('a\tb\n' * 100)
+                writer.close()
+            with open(self.framed_file) as framed_stream:
+                data = framed_stream.read()
+            with open(self.framed_file, 'w') as framed_stream:
+                framed_stream.write(data[:-3])
+            with open(self.framed_file) as framed_stream:
+                with self.assertRaises(RuntimeError):
+                    list(framed_lines(framed_stream))
+
+        def test_framed_output_and_xlines(self):
+            """ Fails if steps' output isn't framed only when asked or if
+                xlines doesn't read both formats. """
+            lines = ['read1\t1', 'read2\t02']
+            for codec in [None, 'none']:
+                if codec is None:
+                    os.environ.pop(_framed_codec_variable, None)
+                else:
+                    os.environ[_framed_codec_variable] = codec
+                with open(self.framed_file, 'w') as output_stream:
+                    output_stream = framed_output(output_stream)
+                    for line in lines:
+                        print >>output_stream, line
+                    output_stream.write('read3')
+                    output_stream.close()
+                with open(self.framed_file) as input_stream:
+                    self.assertEqual(
+                            is_framed(input_stream.read()), bool(codec)
+                        )
+                with open(self.framed_file) as input_stream:
+                    self.assertEqual([line.rstrip('\n') for line
+                                        in xlines(input_stream)],
+                                     ['read1\t1', 'read2\t02', 'read3'])
+            os.environ.pop(_framed_codec_variable, None)
+
         def tearDown(self):
             # Kill temporary directory
             shutil.rmtree(self.temp_dir_path)
 
+    class TestBgzf(unittest.TestCase):
+        """ Tests BgzfWriter. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.bgzf_file = os.path.join(self.temp_dir_path, 'out.tsv.gz')
+            self.lines = ['track name="test"\n'] + [
+                    'chr%d\t%d\t%d\t%s\n' % (
+                            i / 40000 + 1, i * 7, i * 7 + 100, 'ACGT' * (i % 9)
+                        ) for i in xrange(100000)
+                ]
+
+        def test_round_trip(self):
+            """ Fails if gzip can't read BGZF or threads change output. """
+            outputs = []
+            for threads in [1, 4]:
+                with xopen('bgzf', self.bgzf_file, 'w', 3, threads) \
+                    as bgzf_stream:
+                    for line in self.lines:
+                        bgzf_stream.write(line)
+                with xopen(None, self.bgzf_file) as input_stream:
+                    self.assertEqual(input_stream.read(), ''.join(self.lines))
+                with open(self.bgzf_file, 'rb') as binary_stream:
+                    outputs.append(binary_stream.read())
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertTrue(outputs[0].endswith(_bgzf_eof))
+
+        def test_index(self):
+            """ Fails if virtual offsets in index don't point to lines. """
+            import zlib
+            import struct
+            with xopen('bgzf', self.bgzf_file, 'w', 3, 2,
+                        coordinate_index_key) as bgzf_stream:
+                for line in self.lines:
+                    # Write in pieces like print >> does
+                    bgzf_stream.write(line[:-1])
+                    bgzf_stream.write('\n')
+            with open(self.bgzf_file, 'rb') as binary_stream:
+                data = binary_stream.read()
+            entries = []
+            with open(self.bgzf_file + '.idx') as index_stream:
+                for line in index_stream:
+                    rname, coordinate, virtual_offset = line.split('\t')
+                    entries.append((rname, int(coordinate)))
+                    virtual_offset = int(virtual_offset)
+                    block_start = virtual_offset >> 16
+                    block_size = struct.unpack(
+                            '<H', data[block_start + 16:block_start + 18]
+                        )[0] + 1
+                    block = zlib.decompress(
+                            data[block_start + 18:block_start + block_size - 8],
+                            -15
+                        )
+                    self.assertTrue(block[virtual_offset & 0xffff:].startswith(
+                            '%s\t%s\t' % (rname, coordinate)
+                        ))
+            self.assertEqual(entries, sorted(entries))
+            self.assertEqual(set(rname for rname, _ in entries),
+                             set(['chr1', 'chr2', 'chr3']))
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    class FakeAsyncResult(object):
+        """ Stands in for an IPython AsyncResult. """
+        def __init__(self):
+            self.done = False
+
+        def ready(self):
+            return self.done
+
+    class FakeFutureResult(FakeAsyncResult):
+        """ Stands in for an ipyparallel AsyncResult with done callbacks. """
+        def __init__(self):
+            super(FakeFutureResult, self).__init__()
+            self.callbacks = []
+
+        def add_done_callback(self, callback):
+            self.callbacks.append(callback)
+
+        def finish(self):
+            self.done = True
+            for callback in self.callbacks:
+                callback(self)
+
+    class FakeClient(object):
+        """ Stands in for an IPython Client; finishes all results per wait.
+        """
+        def __init__(self):
+            self.waits = []
+
+        def wait(self, jobs=None, timeout=-1):
+            self.waits.append(timeout)
+            for job in jobs:
+                job.done = True
+            return True
+
+    class TestWaitForAsyncresults(unittest.TestCase):
+        """ Tests wait_for_asyncresults function. """
+        def test_all_completed(self):
+            """ Fails if results aren't all done after one blocking wait. """
+            rc = FakeClient()
+            asyncresults = [FakeAsyncResult() for _ in xrange(3)]
+            self.assertEqual(wait_for_asyncresults(rc, asyncresults),
+                             asyncresults)
+            self.assertEqual(rc.waits, [-1])
+
+        def test_first_completed(self):
+            """ Fails if first finished result isn't returned alone. """
+            rc = FakeClient()
+            asyncresults = [FakeAsyncResult() for _ in xrange(3)]
+            finisher = threading.Timer(
+                    0.05, setattr, args=(asyncresults[-1], 'done', True)
+                )
+            finisher.start()
+            try:
+                self.assertEqual(
+                        wait_for_asyncresults(rc, asyncresults,
+                                              first_completed=True),
+                        [asyncresults[-1]]
+                    )
+            finally:
+                finisher.join()
+            # Already done, so no wait
+            self.assertEqual(
+                    wait_for_asyncresults(rc, asyncresults,
+                                          first_completed=True),
+                    [asyncresults[-1]]
+                )
+            # Client.wait() would block until all results are done
+            self.assertEqual(rc.waits, [])
+
+        def test_done_callbacks(self):
+            """ Fails if a done callback doesn't wake the waiting thread. """
+            rc = FakeClient()
+            done_event = threading.Event()
+            asyncresults = [FakeFutureResult() for _ in xrange(3)]
+            for asyncresult in asyncresults:
+                self.assertTrue(notify_when_done(asyncresult, done_event))
+            self.assertFalse(
+                    notify_when_done(FakeAsyncResult(), done_event)
+                )
+            for expected in [1, 0]:
+                finisher = threading.Timer(
+                        0.05, asyncresults[expected].finish
+                    )
+                finisher.start()
+                try:
+                    self.assertEqual(
+                            wait_for_asyncresults(
+                                    rc, [asyncresult for asyncresult
+                                            in asyncresults
+                                            if not asyncresult.done
+                                            or asyncresult is
+                                            asyncresults[expected]],
+                                    first_completed=True,
+                                    done_event=done_event
+                                ),
+                            [asyncresults[expected]]
+                        )
+                finally:
+                    finisher.join()
+            # Callbacks were registered once each
+            self.assertEqual([len(asyncresult.callbacks)
+                                for asyncresult in asyncresults], [1] * 3)
+            self.assertEqual(rc.waits, [])
+
     class TestXopen(unittest.TestCase):
         """ Tests xopen function. """
         def setUp(self):
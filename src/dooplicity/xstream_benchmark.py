@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+xstream_benchmark.py
+Part of Dooplicity framework
+
+Times tools.xstream against a line-at-a-time reference implementation that
+splits every line into fields before comparing keys, the way xstream used to
+work. Intermediates like those Rail-RNA's reducers read are generated in a
+temporary directory, both as text and gzipped:
+
+alignments: SAM lines partitioned by QNAME, one to three lines per QNAME,
+    like the input of compare_alignments.py and break_ties.py
+exon_diffs: exon differentials partitioned by bin, thousands of lines per
+    bin, like the input of coverage_pre.py
+junctions: junction lines partitioned by RNAME/strand, start and end
+    positions, one to twenty lines per junction, like the input of
+    junction_filter.py
+
+Each is read both by iterating through every value of every partition and
+by reading only the first value of each partition, as align_reads_delegate.py
+does for unmapped reads. Outputs of the two implementations are checked for
+equality before they are timed.
+
+Licensed under the MIT License:
+
+Copyright (c) 2014 Abhi Nellore and Ben Langmead.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import os
+import sys
+import gzip
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+from tools import xstream
+
+class reference_xstream(object):
+    """ Groups lines of a text stream by splitting every line into fields.
+
+        Same interface as xstream for text input.
+    """
+    def __init__(self, input_stream, key_fields=1, separator='\t'):
+        self._key_fields = key_fields
+        self.it = (tuple(line.strip().split(separator))
+                    for line in input_stream)
+        self.tgtkey = self.currkey = self.currvalue = object()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.currkey == self.tgtkey:
+            self.currvalue = next(self.it)    # Exit on StopIteration
+            self.currkey = self.currvalue[:self._key_fields]
+        self.tgtkey = self.currkey
+        return self.currkey, self._grouper(self.tgtkey)
+
+    def _grouper(self, tgtkey):
+        while self.currkey == tgtkey:
+            yield self.currvalue[self._key_fields:]
+            self.currvalue = next(self.it)    # Exit on StopIteration
+            self.currkey = self.currvalue[:self._key_fields]
+
+def write_alignments(output_stream, line_count):
+    """ Writes SAM lines partitioned by QNAME.
+
+        output_stream: where to write lines
+        line_count: approximate number of lines to write
+
+        No return value.
+    """
+    seq, qual = 'ACGT' * 25, 'I' * 100
+    i = 0
+    while line_count > 0:
+        qname = 'read%09d\x1d%08x\x1dsample%d' % (
+                i, random.getrandbits(32), i % 7
+            )
+        for j in xrange(random.choice([1, 1, 2, 3])):
+            print >>output_stream, (
+                    '%s\t%d\tchr%d\t%d\t255\t100M\t*\t0\t0\t%s\t%s\t'
+                    'AS:i:-%d\tXS:i:-%d\tNM:i:0\tMD:Z:100\tYT:Z:UU'
+                ) % (qname, 256 if j else 0, random.randint(1, 22),
+                     random.randint(1, 10**8), seq, qual, j, j + 3)
+            line_count -= 1
+        i += 1
+
+def write_exon_diffs(output_stream, line_count):
+    """ Writes exon differentials partitioned by bin.
+
+        output_stream: where to write lines
+        line_count: number of lines to write
+
+        No return value.
+    """
+    for i in xrange(line_count):
+        print >>output_stream, 'chr%d;%d\t%012d\t%d\t%d\t%d' % (
+                i // 500000 + 1, i // 5000, i // 3, i % 20,
+                i % 2, random.choice([1, -1])
+            )
+
+def write_junctions(output_stream, line_count):
+    """ Writes junction lines partitioned by RNAME/strand, start, and end.
+
+        output_stream: where to write lines
+        line_count: approximate number of lines to write
+
+        No return value.
+    """
+    i = 0
+    while line_count > 0:
+        end_pos = i + random.randint(50, 5000)
+        for _ in xrange(random.randint(1, 20)):
+            print >>output_stream, 'chr%d+\t%012d\t%012d\t%d\t%d\t%d' % (
+                    i // 100000 + 1, i, end_pos, random.randint(0, 19),
+                    random.randint(1, 90), random.randint(1, 90)
+                )
+            line_count -= 1
+        i += 1
+
+_intermediates = [('alignments', write_alignments, 1),
+                  ('exon_diffs', write_exon_diffs, 1),
+                  ('junctions', write_junctions, 3)]
+
+def read_all(stream_class, input_stream, key_fields):
+    """ Iterates through every value of every partition.
+
+        Return value: number of values
+    """
+    value_count = 0
+    for _, xpartition in stream_class(input_stream, key_fields):
+        for _ in xpartition:
+            value_count += 1
+    return value_count
+
+def read_first(stream_class, input_stream, key_fields):
+    """ Reads only first value of every partition.
+
+        Return value: number of values
+    """
+    value_count = 0
+    for _, xpartition in stream_class(input_stream, key_fields):
+        xpartition.next()
+        value_count += 1
+    return value_count
+
+def run_benchmark(line_count=1000000, repeats=3, scratch=None):
+    """ Prints times taken by xstream and reference implementation.
+
+        line_count: approximate number of lines per intermediate
+        repeats: each time printed is the minimum over this many runs
+        scratch: where to write intermediates, or None for default
+            temporary directory
+
+        No return value.
+    """
+    random.seed(0)
+    temp_dir_path = tempfile.mkdtemp(dir=scratch)
+    try:
+        print 'intermediate\tgzipped\tread\treference (s)\txstream (s)\tspeedup'
+        for name, writer, key_fields in _intermediates:
+            filename = os.path.join(temp_dir_path, name)
+            with open(filename, 'w') as output_stream:
+                writer(output_stream, line_count)
+            with open(filename) as input_stream:
+                with gzip.open(filename + '.gz', 'wb', 1) as output_stream:
+                    shutil.copyfileobj(input_stream, output_stream)
+            for gzipped in [False, True]:
+                opener = ((lambda: gzip.open(filename + '.gz'))
+                            if gzipped else (lambda: open(filename)))
+                with opener() as input_stream:
+                    expected = [(key, list(xpartition)) for key, xpartition
+                                in reference_xstream(input_stream,
+                                                        key_fields)]
+                with opener() as input_stream:
+                    assert expected == [
+                            (key, list(xpartition)) for key, xpartition
+                            in xstream(input_stream, key_fields)
+                        ], 'xstream output differs for %s.' % name
+                del expected
+                for read in [read_all, read_first]:
+                    times = {}
+                    for stream_class in [reference_xstream, xstream]:
+                        times[stream_class] = []
+                        for _ in xrange(repeats):
+                            with opener() as input_stream:
+                                start_time = time.time()
+                                read(stream_class, input_stream, key_fields)
+                                times[stream_class].append(
+                                        time.time() - start_time
+                                    )
+                    reference_time = min(times[reference_xstream])
+                    xstream_time = min(times[xstream])
+                    print '%s\t%s\t%s\t%.3f\t%.3f\t%.2fx' % (
+                            name, 'yes' if gzipped else 'no',
+                            read.__name__[5:], reference_time, xstream_time,
+                            reference_time / xstream_time
+                        )
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(temp_dir_path, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, required=False,
+        default=1000000,
+        help='Approximate number of lines in each intermediate')
+    parser.add_argument('--repeats', type=int, required=False,
+        default=3,
+        help='Number of times to read each intermediate with each '
+             'implementation; the fastest time is reported')
+    parser.add_argument('--scratch', type=str, required=False,
+        default=None,
+        help='Where to write intermediates; default is temporary directory')
+    args = parser.parse_args(sys.argv[1:])
+    run_benchmark(args.lines, args.repeats, args.scratch)
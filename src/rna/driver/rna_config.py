@@ -557,6 +557,13 @@ def ready_engines(rc, base, prep=False):
                                     '.1.ebwt', '.2.ebwt', '.3.ebwt',
                                     '.4.ebwt', '.rev.1.ebwt', '.rev.2.ebwt'
                                 ]])
+        # Copy compiled reference last so it stays newer than the index
+        import bowtie_index
+        compiled_reference = bowtie_index.compiled_reference_path(
+                                    base.bowtie1_idx
+                                )
+        if os.path.exists(compiled_reference):
+            index_files.append(compiled_reference)
         try:
             import herd.herd as herd
             if '$' in temp_dir: raise ImportError
@@ -1935,6 +1942,35 @@ class RailRnaLocal(object):
                     % (exe_paths.sort
                         if exe_paths.sort is not None else 'sort'))
         )
+        exec_parser.add_argument(
+            '--shuffle', type=str, required=False, metavar='<choice>',
+            default='memory', choices=['memory', 'sort'],
+            help=('shuffle engine: "memory" sorts runs in process and merges '
+                  'them straight into reducers; "sort" uses the sort '
+                  'executable (def: memory)')
+        )
+        exec_parser.add_argument(
+            '--reuse-outputs', action='store_const', const=True,
+            default=False,
+            help=('skip steps whose outputs in the intermediate directory '
+                  'are up to date from a previous run with the same inputs '
+                  'and parameters; implies --keep-intermediates')
+        )
+        exec_parser.add_argument(
+            '--intermediate-format', type=str, required=False,
+            metavar='<choice>', default='text', choices=['text', 'framed'],
+            help=('format of intermediate files: "framed" writes compressed '
+                  'blocks of length-prefixed records with numbers stored as '
+                  'varints, which steps read directly; "text" writes lines '
+                  '(def: text)')
+        )
+        exec_parser.add_argument(
+            '--framed-compression', type=str, required=False,
+            metavar='<choice>', default='zlib',
+            choices=['none', 'zlib', 'lz4', 'zstd'],
+            help=('block compression of framed intermediates; lz4 and zstd '
+                  'require the corresponding Python modules (def: zlib)')
+        )
         if align:
             required_parser.add_argument(
                 '-i', '--input', type=str, required=True, metavar='<dir>',
@@ -3519,7 +3555,8 @@ class RailRnaPreprocess(object):
     """
     def __init__(self, base, nucleotides_per_input=8000000, gzip_input=True,
                     do_not_bin_quals=False, short_read_names=False,
-                    skip_bad_records=False, ignore_missing_sra_samples=False):
+                    skip_bad_records=False, ignore_missing_sra_samples=False,
+                    stream_downloads=False, preprocess_workers=0):
         if not (float(nucleotides_per_input).is_integer() and
                 nucleotides_per_input > 0):
             base.errors.append('Nucleotides per input '
@@ -3532,6 +3569,15 @@ class RailRnaPreprocess(object):
         base.do_not_bin_quals = do_not_bin_quals
         base.skip_bad_records = skip_bad_records
         base.ignore_missing_sra_samples = ignore_missing_sra_samples
+        base.stream_downloads = stream_downloads
+        if not (float(preprocess_workers).is_integer() and
+                    preprocess_workers >= 0):
+            base.errors.append('Number of preprocessing workers '
+                               '(--preprocess-workers) must be an integer '
+                               '>= 0, but {0} was entered.'.format(
+                                                        preprocess_workers
+                                                    ))
+        base.preprocess_workers = preprocess_workers
         base.short_read_names = short_read_names
 
 
@@ -3581,6 +3627,20 @@ class RailRnaPreprocess(object):
                       'doesn\'t find on server rather than raising '
                       'exception')
             )
+        output_parser.add_argument(
+                '--stream-downloads', action='store_const', const=True,
+                default=False,
+                help=('preprocess HTTP, FTP and S3 reads as they download '
+                      'rather than saving each file to scratch first')
+            )
+        output_parser.add_argument(
+                '--preprocess-workers', type=int, required=False,
+                metavar='<int>',
+                default=0,
+                help=('number of processes with which each preprocessing '
+                      'task parses and compresses FASTQ reads; 0 or 1 '
+                      'preprocesses serially')
+            )
         general_parser.add_argument(
             '--do-not-check-manifest', action='store_const', const=True,
             default=False,
@@ -3625,7 +3685,8 @@ class RailRnaPreprocess(object):
                     'name' : 'Preprocess reads',
                     'mapper' : ('preprocess.py --nucs-per-file={0} {1} '
                                 '--push={2} --gzip-level {3} {4} {5} '
-                                '{6} {7} {8} {9} {10}').format(
+                                '{6} {7} {8} {9} {10} {11} '
+                                '--workers {12}').format(
                                                 base.nucleotides_per_input,
                                                 '--gzip-output' if
                                                 base.gzip_input else '',
@@ -3657,7 +3718,11 @@ class RailRnaPreprocess(object):
                                                 '--ignore-missing-sra-samples'
                                                 if
                                                 base.ignore_missing_sra_samples
-                                                else ''
+                                                else '',
+                                                '--stream-downloads'
+                                                if base.stream_downloads
+                                                else '',
+                                                base.preprocess_workers
                                             ),
                     'inputs' : [os.path.join(base.intermediate_dir,
                                                 'split.manifest')],
@@ -3675,7 +3740,8 @@ class RailRnaPreprocess(object):
                     'name' : 'Preprocess reads',
                     'mapper' : ('preprocess.py --nucs-per-file={0} {1} '
                                 '--push={2} --gzip-level {3} {4} {5} {6} {7} '
-                                '--keep-alive {8} {9} {10}').format(
+                                '--keep-alive {8} {9} {10} {11} '
+                                '--workers {12}').format(
                                                 base.nucleotides_per_input,
                                                 '--gzip-output' if
                                                 base.gzip_input else '',
@@ -3709,7 +3775,11 @@ class RailRnaPreprocess(object):
                                                 '--ignore-missing-sra-samples'
                                                 if
                                                 base.ignore_missing_sra_samples
-                                                else ''
+                                                else '',
+                                                '--stream-downloads'
+                                                if base.stream_downloads
+                                                else '',
+                                                base.preprocess_workers
                                             ),
                     'inputs' : [base.old_manifest
                                 if hasattr(base, 'old_manifest')
@@ -3778,12 +3848,14 @@ class RailRnaAlign(object):
         motif_radius=5, genome_bowtie1_args='-v 0 -a -m 80',
         transcriptome_bowtie2_args='-k 30', experimental=False,
         count_multiplier=15, max_refs_per_strand=300,
+        max_paths_per_strand=1000,
         junction_criteria='0.5,5', indel_criteria='0.5,5', tie_margin=6,
         normalize_percentile=0.75, transcriptome_indexes_per_sample=500,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, output_sam=False,
         do_not_drop_polyA_tails=False, deliverables='idx,tsv,bed,bw',
         bam_basename='alignments', bed_basename='', tsv_basename='',
+        index_outputs=False,
         assembly='hg19', s3_ansible=None):
         if not elastic:
             '''Programs and Bowtie indexes should be checked only in local
@@ -3887,6 +3959,23 @@ class RailRnaAlign(object):
                                                 ) + ', and '
                                                 + missing_extensions[-1]
                                             ))
+                else:
+                    '''Compile reference once here so steps that load the
+                    Bowtie index memory-map its tables rather than parse
+                    them in every task. The decoded sequence is left out:
+                    it is about as large as the genome and would be copied
+                    to every node along with the index. Run
+                    bowtie_index.py --compile <idx> --with-sequence to
+                    store it.'''
+                    import bowtie_index
+                    try:
+                        bowtie_index.compile_reference(bowtie1_idx)
+                    except (IOError, OSError) as e:
+                        print_to_screen(('Warning: could not write compiled '
+                                         'reference for "{0}" ({1}); steps '
+                                         'will parse the Bowtie index '
+                                         'instead.').format(bowtie1_idx, e),
+                                        newline=True, carriage_return=False)
             base.bowtie1_idx, base.bowtie2_idx = bowtie1_idx, bowtie2_idx
             base.samtools_exe = base.check_program('samtools', 'SAMTools',
                                 '--samtools', entered_exe=samtools_exe,
@@ -4147,6 +4236,15 @@ class RailRnaAlign(object):
                                                     max_refs_per_strand
                                                 ))
         base.max_refs_per_strand = max_refs_per_strand
+        if not (float(max_paths_per_strand).is_integer() and
+                    max_paths_per_strand >= 1):
+            base.errors.append('Maximum enumerated paths through junction '
+                               'combinations per strand '
+                               '(--max-paths-per-strand) must be an integer '
+                               '>= 1, but {0} was entered.'.format(
+                                                    max_paths_per_strand
+                                                ))
+        base.max_paths_per_strand = max_paths_per_strand
         if not (float(library_size).is_integer() and
                     library_size >= 0):
             base.errors.append('Library size in millions of reads '
@@ -4239,8 +4337,9 @@ class RailRnaAlign(object):
         base.bam_basename = bam_basename
         base.bed_basename = bed_basename
         base.tsv_basename = tsv_basename
+        base.index_outputs = index_outputs
         deliverable_choices = set(
-                ['idx', 'bam', 'sam', 'bed', 'tsv', 'bw', 'jx']
+                ['idx', 'bam', 'sam', 'bed', 'tsv', 'sparse', 'bw', 'jx']
             )
         if isinstance(deliverables, str):
             deliverables = [deliverables]
@@ -4252,7 +4351,8 @@ class RailRnaAlign(object):
         if undeliverables:
             base.errors.append('Some deliverables (--deliverables) specified '
                                'are invalid. Valid choices are in {{"idx", '
-                               '"bam", "bed", "tsv", "bw", "jx"}}, but '
+                               '"bam", "bed", "tsv", "sparse", "bw", "jx"}}, '
+                               'but '
                                '"{0}" was entered.'.format(deliverables))
         elif not split_deliverables:
             base.errors.append('At least one deliverable (--deliverables) '
@@ -4261,7 +4361,15 @@ class RailRnaAlign(object):
             base.errors.append('Both "bam" and "sam" were entered among '
                                'deliverables (--deliverables), but only '
                                'one should be chosen.')
-        base.tsv = 'tsv' in split_deliverables
+        '''base.tsv is True iff junction/indel matrices are written in any
+        format.'''
+        base.tsv = ('tsv' in split_deliverables
+                        or 'sparse' in split_deliverables)
+        if 'sparse' in split_deliverables:
+            base.matrix_format = ('both' if 'tsv' in split_deliverables
+                                    else 'sparse')
+        else:
+            base.matrix_format = 'dense'
         base.idx = 'idx' in split_deliverables
         base.bam = 'bam' in split_deliverables or 'sam' in split_deliverables
         base.output_sam = 'sam' in split_deliverables
@@ -4580,6 +4688,11 @@ class RailRnaAlign(object):
             default=300,
             help=argparse.SUPPRESS
         )
+        algo_parser.add_argument(
+            '--max-paths-per-strand', type=int, required=False,
+            default=1000,
+            help=argparse.SUPPRESS
+        )
         algo_parser.add_argument(
             '--normalize-percentile', type=float, required=False,
             metavar='<dec>',
@@ -4614,8 +4727,9 @@ class RailRnaAlign(object):
             default='idx,tsv,bed,bw',
             nargs='+',
             help=('comma- or space-separated list of desired outputs. Choose '
-                  'from among {"idx", "tsv", "bed", "sam" | "bam", "bw", '
-                  '"jx"}.')
+                  'from among {"idx", "tsv", "sparse", "bed", "sam" | "bam", '
+                  '"bw", "jx"}; "sparse" writes junction/indel matrices in a '
+                  'sparse coordinate format.')
         )
         output_parser.add_argument(
             '--drop-deletions', action='store_const', const=True,
@@ -4661,6 +4775,13 @@ class RailRnaAlign(object):
             default='',
             help='basename for TSV output (def: *empty*)'
         )
+        output_parser.add_argument(
+            '--index-outputs', action='store_const', const=True,
+            default=False,
+            help=('write BEDs as BGZF and a coordinate index (.idx) next to '
+                  'each BED and junction/indel TSV for fast lookup of a '
+                  'region')
+        )
         output_parser.add_argument(
             '--idx-basename', type=str, required=False,
             metavar='<str>',
@@ -4863,7 +4984,8 @@ class RailRnaAlign(object):
             {
                 'name' : 'Write all detected junctions',
                 'reducer' : ('junction_collect.py --out={0} '
-                             '--gzip-level {1} {2}').format(
+                             '--gzip-level {1} --bgzf-threads={3} '
+                             '{2} {4}').format(
                                                         ab.Url(
                                                             path_join(elastic,
                                                             base.output_dir,
@@ -4876,7 +4998,13 @@ class RailRnaAlign(object):
                                                         base.gzip_level
                                                         if 'gzip_level' in
                                                         dir(base) else 3,
-                                                        scratch
+                                                        scratch,
+                                                        base.num_processes
+                                                        if 'num_processes' in
+                                                        dir(base) else 1,
+                                                        '--bgzf-index'
+                                                        if base.index_outputs
+                                                        else ''
                                                     ),
                 'inputs' : [path_join(elastic, 'junction_filter', 'collect')],
                 'output' : 'junction_collect',
@@ -4964,7 +5092,8 @@ class RailRnaAlign(object):
                          'cojunction_enum.py --bowtie2-idx={0} '
                          '--gzip-level {1} '
                          '--bowtie2-exe={2} {3} {4} --intermediate-dir {5} '
-                         '--max-refs {6} {7} -- {8}').format(
+                         '--max-refs {6} --max-paths {9} {7} '
+                         '-- {8}').format(
                                             base.transcript_in,
                                             base.gzip_level
                                             if 'gzip_level' in
@@ -4977,7 +5106,8 @@ class RailRnaAlign(object):
                                                 ).to_url(caps=True),
                                             base.max_refs_per_strand,
                                             scratch,
-                                            base.transcriptome_bowtie2_args
+                                            base.transcriptome_bowtie2_args,
+                                            base.max_paths_per_strand
                                         ),
                 'inputs' : [path_join(elastic, 'align_reads', 'unique')],
                 'output' : 'cojunction_enum',
@@ -5140,59 +5270,6 @@ class RailRnaAlign(object):
                         'elephantbird.combined.split.count={task_count}'
                     ]
             } if realign else {},
-            {
-                'name' : (('Write %s with alignments by sample'
-                            % ('SAMs' if base.output_sam else 'BAMs'))
-                            if base.bam
-                            else 'Count mapped reads by contig/sample'),
-                'reducer' : (
-                         'bam.py --out={0} --bowtie-idx={1} '
-                         '--samtools-exe={2} --bam-basename={3} '
-                         '--manifest={4} {5} {6} {7} {8} {9} '
-                         '--tie-margin {10}').format(
-                                        ab.Url(
-                                            path_join(elastic,
-                                            base.output_dir, 'alignments')
-                                        ).to_url(caps=True)
-                                        if elastic
-                                        else path_join(elastic,
-                                            base.output_dir, 'alignments'),
-                                        base.bowtie1_idx,
-                                        base.samtools_exe,
-                                        base.bam_basename,
-                                        manifest,
-                                        keep_alive,
-                                        '--output-by-chromosome'
-                                        if (not base.do_not_output_bam_by_chr
-                                            or not base.bam) else '',
-                                        scratch,
-                                        '--output-sam' if base.output_sam
-                                        else '',
-                                        '--suppress-bam' if not base.bam
-                                        else '',
-                                        base.tie_margin
-                                    ),
-                'inputs' : [path_join(elastic, 'compare_alignments', 'sam'),
-                            path_join(elastic, 'break_ties', 'sam')]
-                            + ([path_join(elastic, 'align_reads', 'sam')]
-                                if base.k in [1, None] else []),
-                'multiple_outputs' : True,
-                'mod_partitioner' : True,
-                'output' : 'bam',
-                'tasks' : '1x',
-                'partition' : '-k1,1',
-                'sort' : '-k1,1 -k2,3',
-                'extra_args' : [
-                        'mapreduce.reduce.shuffle.input.buffer.percent=0.4',
-                        'mapreduce.reduce.shuffle.merge.percent=0.4',
-                        'elephantbird.use.combine.input.format=true',
-                        'elephantbird.check.is.splitable=false',
-                        'elephantbird.lzo.output.index=true',
-                        'elephantbird.combine.split.size=%d'
-                            % (_base_combine_split_size),
-                        'elephantbird.combined.split.count={task_count}'
-                    ]
-            } if (base.bw or base.tsv or base.bam) else {},
             {
                 'name' : 'Write mapped read counts',
                 'reducer' : (
@@ -5209,7 +5286,11 @@ class RailRnaAlign(object):
                                                     scratch,
                                                     keep_alive
                                                 ),
-                'inputs' : [path_join(elastic, 'bam', 'counts')],
+                'inputs' : [path_join(elastic, 'compare_alignments',
+                                               'counts'),
+                            path_join(elastic, 'break_ties', 'counts')]
+                            + ([path_join(elastic, 'align_reads', 'counts')]
+                                if base.k in [1, None] else []),
                 'output' : 'read_counts',
                 'tasks' : 1,
                 'partition' : '-k1,1',
@@ -5309,6 +5390,57 @@ class RailRnaAlign(object):
                         'elephantbird.combined.split.count={task_count}'
                     ]
             } if base.bw else {},
+            {
+                'name' : ('Write %s with alignments by sample'
+                            % ('SAMs' if base.output_sam else 'BAMs')),
+                'reducer' : (
+                         'bam.py --out={0} --bowtie-idx={1} '
+                         '--samtools-exe={2} --bam-basename={3} '
+                         '--manifest={4} {5} {6} {7} {8} '
+                         '--bam-threads={9}').format(
+                                        ab.Url(
+                                            path_join(elastic,
+                                            base.output_dir, 'alignments')
+                                        ).to_url(caps=True)
+                                        if elastic
+                                        else path_join(elastic,
+                                            base.output_dir, 'alignments'),
+                                        base.bowtie1_idx,
+                                        base.samtools_exe,
+                                        base.bam_basename,
+                                        manifest,
+                                        keep_alive,
+                                        '--output-by-chromosome'
+                                        if not base.do_not_output_bam_by_chr
+                                        else '',
+                                        scratch,
+                                        '--output-sam' if base.output_sam
+                                        else '',
+                                        base.num_processes
+                                        if 'num_processes' in
+                                        dir(base) else 1
+                                    ),
+                'inputs' : [path_join(elastic, 'compare_alignments', 'sam'),
+                            path_join(elastic, 'break_ties', 'sam')]
+                            + ([path_join(elastic, 'align_reads', 'sam')]
+                                if base.k in [1, None] else []),
+                'multiple_outputs' : True,
+                'mod_partitioner' : True,
+                'output' : 'bam',
+                'tasks' : '1x',
+                'partition' : '-k1,1',
+                'sort' : '-k1,1 -k2,3',
+                'extra_args' : [
+                        'mapreduce.reduce.shuffle.input.buffer.percent=0.4',
+                        'mapreduce.reduce.shuffle.merge.percent=0.4',
+                        'elephantbird.use.combine.input.format=true',
+                        'elephantbird.check.is.splitable=false',
+                        'elephantbird.lzo.output.index=true',
+                        'elephantbird.combine.split.size=%d'
+                            % (_base_combine_split_size),
+                        'elephantbird.combined.split.count={task_count}'
+                    ]
+            } if base.bam else {},
             {
                 'name' : 'Aggregate junctions/indels',
                 'reducer' : ('bed_pre.py --manifest={0} '
@@ -5346,7 +5478,8 @@ class RailRnaAlign(object):
                             if base.tsv else 'Write normalization factors'),
                 'reducer' : ('tsv.py --bowtie-idx={0} --out={1} '
                              '--manifest={2} --gzip-level={3} '
-                             '--tsv-basename={4} {5} {6}').format(
+                             '--tsv-basename={4} --matrix-format={5} '
+                             '--bgzf-threads={8} {6} {7} {9}').format(
                                                     base.bowtie1_idx,
                                                     ab.Url(
                                                         path_join(elastic,
@@ -5362,8 +5495,15 @@ class RailRnaAlign(object):
                                                     if 'gzip_level' in
                                                     dir(base) else 3,
                                                     base.tsv_basename,
+                                                    base.matrix_format,
                                                     scratch,
-                                                    keep_alive
+                                                    keep_alive,
+                                                    base.num_processes
+                                                    if 'num_processes' in
+                                                    dir(base) else 1,
+                                                    '--bgzf-index'
+                                                    if base.index_outputs
+                                                    else ''
                                                 ),
                 'inputs' : ['coverage']
                             + ([path_join(elastic, 'prebed', 'collect')]
@@ -5386,7 +5526,8 @@ class RailRnaAlign(object):
                 'name' : 'Write BEDs with junctions/indels by sample',
                 'reducer' : (
                          'bed.py --bowtie-idx={0} --out={1} '
-                         '--manifest={2} --bed-basename={3} {4} {5}').format(
+                         '--manifest={2} --bed-basename={3} {4} {5} '
+                         '{6}').format(
                                                         base.bowtie1_idx,
                                                         ab.Url(
                                                             path_join(elastic,
@@ -5401,7 +5542,19 @@ class RailRnaAlign(object):
                                                         manifest,
                                                         base.bed_basename,
                                                         scratch,
-                                                        keep_alive
+                                                        keep_alive,
+                                                        ('--bgzf-threads={0} '
+                                                         '--bgzf-index '
+                                                         '--gzip-level={1}'
+                                                        ).format(
+                                                        base.num_processes
+                                                        if 'num_processes' in
+                                                        dir(base) else 1,
+                                                        base.gzip_level
+                                                        if 'gzip_level' in
+                                                        dir(base) else 3
+                                                        ) if base.index_outputs
+                                                        else ''
                                                     ),
                 'inputs' : [path_join(elastic, 'prebed', 'bed')],
                 'output' : 'bed',
@@ -5462,6 +5615,7 @@ class RailRnaLocalPreprocessJson(object):
         nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         num_processes=1, gzip_intermediates=False, gzip_level=3,
         sort_memory_cap=(300*1024), max_task_attempts=4, 
         keep_intermediates=False, check_manifest=True,
@@ -5482,7 +5636,9 @@ class RailRnaLocalPreprocessJson(object):
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
             skip_bad_records=skip_bad_records,
-            ignore_missing_sra_samples=ignore_missing_sra_samples)
+            ignore_missing_sra_samples=ignore_missing_sra_samples,
+            stream_downloads=stream_downloads,
+            preprocess_workers=preprocess_workers)
         raise_runtime_error(base)
         self._json_serial = {}
         step_dir = os.path.join(base_path, 'rna', 'steps')
@@ -5507,6 +5663,7 @@ class RailRnaParallelPreprocessJson(object):
         nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         num_processes=1, gzip_intermediates=False, gzip_level=3,
         sort_memory_cap=(300*1024), max_task_attempts=4, ipython_profile=None,
         ipcontroller_json=None, scratch=None, direct_write=False,
@@ -5539,7 +5696,9 @@ class RailRnaParallelPreprocessJson(object):
                 do_not_bin_quals=do_not_bin_quals,
                 short_read_names=short_read_names,
                 skip_bad_records=skip_bad_records,
-                ignore_missing_sra_samples=ignore_missing_sra_samples
+                ignore_missing_sra_samples=ignore_missing_sra_samples,
+                stream_downloads=stream_downloads,
+                preprocess_workers=preprocess_workers
             )
         raise_runtime_error(base)
         temp_base_path = ready_engines(rc, base, prep=True)
@@ -5599,6 +5758,7 @@ class RailRnaElasticPreprocessJson(object):
         verbose=False, nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         log_uri=None, ami_version='3.11.0',
         visible_to_all_users=False, tags='',
         name='Rail-RNA Job Flow',
@@ -5647,7 +5807,9 @@ class RailRnaElasticPreprocessJson(object):
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
             skip_bad_records=skip_bad_records,
-            ignore_missing_sra_samples=ignore_missing_sra_samples)
+            ignore_missing_sra_samples=ignore_missing_sra_samples,
+            stream_downloads=stream_downloads,
+            preprocess_workers=preprocess_workers)
         raise_runtime_error(base)
         self._json_serial = {}
         if base.core_instance_count > 0:
@@ -5709,12 +5871,14 @@ class RailRnaLocalAlignJson(object):
         motif_radius=5, genome_bowtie1_args='-v 0 -a -m 80',
         transcriptome_bowtie2_args='-k 30', experimental=False,
         count_multiplier=15, max_refs_per_strand=300,
+        max_paths_per_strand=1000,
         junction_criteria='0.5,5', indel_criteria='0.5,5', tie_margin=6,
         transcriptome_indexes_per_sample=500, normalize_percentile=0.75,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', num_processes=1,
+        index_outputs=False,
         gzip_intermediates=False, gzip_level=3, sort_memory_cap=(300*1024),
         max_task_attempts=4, keep_intermediates=False, scratch=None,
         sort_exe=None):
@@ -5754,6 +5918,7 @@ class RailRnaLocalAlignJson(object):
             count_multiplier=count_multiplier,
             experimental=experimental,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             tie_margin=tie_margin,
             normalize_percentile=normalize_percentile,
             transcriptome_indexes_per_sample=transcriptome_indexes_per_sample,
@@ -5762,7 +5927,8 @@ class RailRnaLocalAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            index_outputs=index_outputs)
         raise_runtime_error(base)
         print_to_screen(base.detect_message)
         self._json_serial = {}
@@ -5794,12 +5960,14 @@ class RailRnaParallelAlignJson(object):
         motif_radius=5, genome_bowtie1_args='-v 0 -a -m 80',
         transcriptome_bowtie2_args='-k 30', experimental=False,
         count_multiplier=15, max_refs_per_strand=300,
+        max_paths_per_strand=1000,
         junction_criteria='0.5,5', indel_criteria='0.5,5', tie_margin=6,
         transcriptome_indexes_per_sample=500, normalize_percentile=0.75,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', num_processes=1,
+        index_outputs=False,
         ipython_profile=None, ipcontroller_json=None, scratch=None,
         direct_write=False, gzip_intermediates=False, gzip_level=3,
         sort_memory_cap=(300*1024), max_task_attempts=4,
@@ -5850,6 +6018,7 @@ class RailRnaParallelAlignJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             tie_margin=tie_margin,
             normalize_percentile=normalize_percentile,
             transcriptome_indexes_per_sample=transcriptome_indexes_per_sample,
@@ -5858,7 +6027,8 @@ class RailRnaParallelAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            tsv_basename=tsv_basename, bed_basename=bed_basename)
+            tsv_basename=tsv_basename, bed_basename=bed_basename,
+            index_outputs=index_outputs)
         raise_runtime_error(base)
         temp_base_path = ready_engines(rc, base, prep=False)
         engine_bases = {}
@@ -5903,6 +6073,7 @@ class RailRnaParallelAlignJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             tie_margin=tie_margin,
             normalize_percentile=normalize_percentile,
             transcriptome_indexes_per_sample=transcriptome_indexes_per_sample,
@@ -5911,7 +6082,8 @@ class RailRnaParallelAlignJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            tsv_basename=tsv_basename, bed_basename=bed_basename)
+            tsv_basename=tsv_basename, bed_basename=bed_basename,
+            index_outputs=index_outputs)
         engine_base_checks = {}
         for i in rc.ids:
             engine_base_checks[i] = engine_bases[i].check_program
@@ -5957,12 +6129,14 @@ class RailRnaElasticAlignJson(object):
         motif_radius=5, genome_bowtie1_args='-v 0 -a -m 80',
         transcriptome_bowtie2_args='-k 30', experimental=False,
         count_multiplier=15, max_refs_per_strand=300,
+        max_paths_per_strand=1000,
         junction_criteria='0.5,5', indel_criteria='0.5,5', tie_margin=6,
         transcriptome_indexes_per_sample=500, normalize_percentile=0.75,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', log_uri=None, ami_version='3.11.0',
+        index_outputs=False,
         visible_to_all_users=False, tags='', name='Rail-RNA Job Flow',
         action_on_failure='TERMINATE_JOB_FLOW', hadoop_jar=None,
         master_instance_count=1, master_instance_type='c1.xlarge',
@@ -6030,6 +6204,7 @@ class RailRnaElasticAlignJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             tie_margin=tie_margin,
             normalize_percentile=normalize_percentile,
             transcriptome_indexes_per_sample=transcriptome_indexes_per_sample,
@@ -6039,6 +6214,7 @@ class RailRnaElasticAlignJson(object):
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
             tsv_basename=tsv_basename, bed_basename=bed_basename,
+            index_outputs=index_outputs,
             s3_ansible=ab.S3Ansible(aws_exe=base.aws_exe,
                                         profile=base.profile))
         raise_runtime_error(base)
@@ -6092,6 +6268,7 @@ class RailRnaLocalAllJson(object):
         verbose=False, nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         bowtie1_exe=None, bowtie_idx='genome', bowtie1_build_exe=None,
         bowtie2_exe=None, bowtie2_build_exe=None, k=1, bowtie2_args='',
         samtools_exe=None, bedgraphtobigwig_exe=None,
@@ -6104,11 +6281,13 @@ class RailRnaLocalAllJson(object):
         junction_criteria='0.5,5', indel_criteria='0.5,5',
         transcriptome_bowtie2_args='-k 30', tie_margin=6,
         max_refs_per_strand=300, experimental=False, count_multiplier=15,
+        max_paths_per_strand=1000,
         transcriptome_indexes_per_sample=500, normalize_percentile=0.75,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', num_processes=1,
+        index_outputs=False,
         gzip_intermediates=False, gzip_level=3,
         sort_memory_cap=(300*1024), max_task_attempts=4,
         keep_intermediates=False, check_manifest=True, scratch=None,
@@ -6123,7 +6302,9 @@ class RailRnaLocalAllJson(object):
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
             skip_bad_records=skip_bad_records,
-            ignore_missing_sra_samples=ignore_missing_sra_samples)
+            ignore_missing_sra_samples=ignore_missing_sra_samples,
+            stream_downloads=stream_downloads,
+            preprocess_workers=preprocess_workers)
         RailRnaLocal(base, check_manifest=check_manifest,
             num_processes=num_processes, gzip_intermediates=gzip_intermediates,
             gzip_level=gzip_level, sort_memory_cap=sort_memory_cap,
@@ -6153,6 +6334,7 @@ class RailRnaLocalAllJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             junction_criteria=junction_criteria,
             indel_criteria=indel_criteria,
             tie_margin=tie_margin,
@@ -6163,7 +6345,8 @@ class RailRnaLocalAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            index_outputs=index_outputs)
         raise_runtime_error(base)
         print_to_screen(base.detect_message)
         self._json_serial = {}
@@ -6195,6 +6378,7 @@ class RailRnaParallelAllJson(object):
         verbose=False, nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         bowtie1_exe=None, bowtie_idx='genome', bowtie1_build_exe=None,
         bowtie2_exe=None, bowtie2_build_exe=None, k=1, bowtie2_args='',
         samtools_exe=None, bedgraphtobigwig_exe=None,
@@ -6207,11 +6391,13 @@ class RailRnaParallelAllJson(object):
         junction_criteria='0.5,5', indel_criteria='0.5,5',
         transcriptome_bowtie2_args='-k 30', tie_margin=6,
         max_refs_per_strand=300, experimental=False, count_multiplier=15,
+        max_paths_per_strand=1000,
         transcriptome_indexes_per_sample=500, normalize_percentile=0.75,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', num_processes=1,
+        index_outputs=False,
         gzip_intermediates=False, gzip_level=3, sort_memory_cap=(300*1024),
         max_task_attempts=4, ipython_profile=None, ipcontroller_json=None,
         scratch=None, direct_write=False, keep_intermediates=False,
@@ -6240,7 +6426,9 @@ class RailRnaParallelAllJson(object):
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
             skip_bad_records=skip_bad_records,
-            ignore_missing_sra_samples=ignore_missing_sra_samples)
+            ignore_missing_sra_samples=ignore_missing_sra_samples,
+            stream_downloads=stream_downloads,
+            preprocess_workers=preprocess_workers)
         RailRnaAlign(base, bowtie1_exe=bowtie1_exe,
             bowtie_idx=bowtie_idx, bowtie1_build_exe=bowtie1_build_exe,
             bowtie2_exe=bowtie2_exe, bowtie2_build_exe=bowtie2_build_exe,
@@ -6264,6 +6452,7 @@ class RailRnaParallelAllJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             junction_criteria=junction_criteria,
             indel_criteria=indel_criteria,
             tie_margin=tie_margin,
@@ -6274,7 +6463,8 @@ class RailRnaParallelAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            index_outputs=index_outputs)
         raise_runtime_error(base)
         temp_base_path = ready_engines(rc, base, prep=False)
         engine_bases = {}
@@ -6319,6 +6509,7 @@ class RailRnaParallelAllJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             junction_criteria=junction_criteria,
             indel_criteria=indel_criteria,
             tie_margin=tie_margin,
@@ -6329,7 +6520,8 @@ class RailRnaParallelAllJson(object):
             do_not_output_ave_bw_by_chr=do_not_output_ave_bw_by_chr,
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
-            bed_basename=bed_basename, tsv_basename=tsv_basename)
+            bed_basename=bed_basename, tsv_basename=tsv_basename,
+            index_outputs=index_outputs)
         engine_base_checks = {}
         for i in rc.ids:
             engine_base_checks[i] = engine_bases[i].check_program
@@ -6375,6 +6567,7 @@ class RailRnaElasticAllJson(object):
         verbose=False, nucleotides_per_input=8000000, gzip_input=True,
         do_not_bin_quals=False, short_read_names=False,
         skip_bad_records=False, ignore_missing_sra_samples=False,
+        stream_downloads=False, preprocess_workers=0,
         bowtie1_exe=None, bowtie_idx='genome', bowtie1_build_exe=None,
         bowtie2_exe=None, bowtie2_build_exe=None, k=1, bowtie2_args='',
         samtools_exe=None, bedgraphtobigwig_exe=None,
@@ -6386,12 +6579,14 @@ class RailRnaElasticAllJson(object):
         motif_radius=5, genome_bowtie1_args='-v 0 -a -m 80',
         transcriptome_bowtie2_args='-k 30', tie_margin=6,
         max_refs_per_strand=300, experimental=False, count_multiplier=15,
+        max_paths_per_strand=1000,
         junction_criteria='0.5,5', indel_criteria='0.5,5',
         normalize_percentile=0.75, transcriptome_indexes_per_sample=500,
         drop_deletions=False, do_not_output_bam_by_chr=False,
         do_not_output_ave_bw_by_chr=False, do_not_drop_polyA_tails=False,
         deliverables='idx,tsv,bed,bw', bam_basename='alignments',
         bed_basename='', tsv_basename='', log_uri=None, ami_version='3.11.0',
+        index_outputs=False,
         visible_to_all_users=False, tags='', name='Rail-RNA Job Flow',
         action_on_failure='TERMINATE_JOB_FLOW', hadoop_jar=None,
         master_instance_count=1, master_instance_type='c1.xlarge',
@@ -6436,7 +6631,9 @@ class RailRnaElasticAllJson(object):
             gzip_input=gzip_input, do_not_bin_quals=do_not_bin_quals,
             short_read_names=short_read_names,
             skip_bad_records=skip_bad_records,
-            ignore_missing_sra_samples=ignore_missing_sra_samples)
+            ignore_missing_sra_samples=ignore_missing_sra_samples,
+            stream_downloads=stream_downloads,
+            preprocess_workers=preprocess_workers)
         RailRnaAlign(base, elastic=True,
             assembly=assembly, bowtie1_exe=bowtie1_exe,
             bowtie_idx=bowtie_idx, bowtie1_build_exe=bowtie1_build_exe,
@@ -6461,6 +6658,7 @@ class RailRnaElasticAllJson(object):
             experimental=experimental,
             count_multiplier=count_multiplier,
             max_refs_per_strand=max_refs_per_strand,
+            max_paths_per_strand=max_paths_per_strand,
             junction_criteria=junction_criteria,
             indel_criteria=indel_criteria,
             tie_margin=tie_margin,
@@ -6472,6 +6670,7 @@ class RailRnaElasticAllJson(object):
             do_not_drop_polyA_tails=do_not_drop_polyA_tails,
             deliverables=deliverables, bam_basename=bam_basename,
             bed_basename=bed_basename, tsv_basename=tsv_basename,
+            index_outputs=index_outputs,
             s3_ansible=ab.S3Ansible(aws_exe=base.aws_exe,
                                         profile=base.profile))
         raise_runtime_error(base)
@@ -76,6 +76,7 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 import bowtie
+import bowtie_pool
 from dooplicity.tools import xstream, register_cleanup, xopen, make_temp_dir
 import tempdel
 
@@ -180,8 +181,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie_exe='bowtie',
                 # Separate qnames with single + character
                 print >>qname_stream, '+'
     input_command = 'gzip -cd %s' % readlet_file
-    bowtie_command = ' '.join([bowtie_exe, bowtie_args,
-        '-S -t --sam-nohead --mm', bowtie_index_base, '--12 -'])
+    bowtie_command = bowtie_pool.command(' '.join([bowtie_exe, bowtie_args,
+        '-S -t --sam-nohead --mm', bowtie_index_base, '--12 -']))
     delegate_command = ''.join(
                 [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                     '_delegate.py --report-multiplier %08f --qnames-file %s %s'
@@ -61,8 +61,9 @@ Format 2 (exon_diff); tab-delimited output tuple columns:
 3. Sample index
 4. '1' if alignment from which diff originates is "unique" according to
     --tie-margin criterion; else '0'
-5. +1 or -1 * count, the number of instances of a read sequence for which to
-    print exonic chunks
+5. Sum of +1 or -1 * count, the number of instances of a read sequence for
+    which to print exonic chunks, over alignments printed by the task with the
+    same fields 1-4
 
 Note that only unique alignments are currently output as ivals and/or diffs.
 
@@ -139,6 +140,16 @@ Standard 11+ -column raw SAM output
 Single column (unique):
 1. A unique read sequence
 
+Mapped read counts (counts); tab-delimited output tuple columns:
+1. '-' to enforce that all records are placed in the same partition
+2. Sample index
+3. RNAME index
+4. Number of primary alignments written as sam overlapping contig with RNAME
+5. Number of those alignments that are unique
+
+If RNAME corresponds to unmapped reads, both counts are the number of unmapped
+reads. These are summed across tasks by Rail-RNA-collect_read_stats.
+
 Two columns, exactly one line (dummy); ensures creation of junction index:
 1. character "-"
 2. the word "dummy"
@@ -164,13 +175,14 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 import bowtie
+import bowtie_pool
 import bowtie_index
 import partition
 import manifest
 import tempdel
 import group_reads
 from dooplicity.tools import xstream, dlist, register_cleanup, xopen, \
-    make_temp_dir
+    make_temp_dir, framed_output
 from alignment_handlers import AlignmentPrinter
 
 # Initialize global variables for tracking number of input lines
@@ -245,8 +257,9 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         3. Sample index
         4. '1' if alignment from which diff originates is "unique" according to
             --tie-margin criterion; else '0'
-        5. +1 or -1 * count, the number of instances of a read sequence for
-            which to print exonic chunks
+        5. Sum of +1 or -1 * count, the number of instances of a read
+            sequence for which to print exonic chunks, over alignments
+            printed by the task with the same fields 1-4
 
         Note that only unique alignments are currently output as ivals and/or
         diffs.
@@ -328,6 +341,18 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         Single column (unique):
         1. A unique read sequence
 
+        Mapped read counts (counts); tab-delimited output tuple columns:
+        1. '-' to enforce that all records are placed in the same partition
+        2. Sample index
+        3. RNAME index
+        4. Number of primary alignments written as sam overlapping contig
+            with RNAME
+        5. Number of those alignments that are unique
+        
+        If RNAME corresponds to unmapped reads, both counts are the number of
+        unmapped reads. These are summed across tasks by
+        Rail-RNA-collect_read_stats.
+        
         Two columns, exactly one line (dummy); ensures creation of junction
             index:
         1. character "-"
@@ -389,7 +414,9 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         No return value.
     """
     global _input_line_count
-    reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
+    reference_index = bowtie_index.BowtieIndexReference(
+                            bowtie_index_base, with_sequence=False
+                        )
     manifest_object = manifest.LabelsAndIndices(manifest_file)
     alignment_printer = AlignmentPrinter(
             manifest_object,
@@ -492,17 +519,21 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                     if j != best_qual_index:
                         print >>other_stream, other_to_print
             print >>align_stream, to_align
+    # Count unmapped poly(A) reads before delegate writes to stdout
+    alignment_printer.flush_read_counts()
     # Print dummy line
-    print 'dummy\t-\tdummy'
-    sys.stdout.flush() # this is REALLY important b/c called script will stdout
+    print >>output_stream, 'dummy\t-\tdummy'
+    '''This is REALLY important b/c called script will stdout; framed output
+    is complete here, and the called script's framed output follows it.'''
+    output_stream.flush()
     if nothing_doing:
         # No input
         sys.exit(0)
     input_command = 'gzip -cd %s' % align_file
-    bowtie_command = ' '.join([bowtie2_exe,
+    bowtie_command = bowtie_pool.command(' '.join([bowtie2_exe,
         bowtie2_args if bowtie2_args is not None else '',
         ' --sam-no-qname-trunc --local -t --no-hd --mm -x',
-        bowtie2_index_base, '--12 -'])
+        bowtie2_index_base, '--12 -']))
     delegate_command = ''.join(
                 [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                     ('_delegate.py --task-partition {task_partition} '
@@ -572,10 +603,10 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     os.remove(other_reads_file)
     if not no_realign:
         input_command = 'gzip -cd %s' % second_pass_file
-        bowtie_command = ' '.join([bowtie2_exe,
+        bowtie_command = bowtie_pool.command(' '.join([bowtie2_exe,
             bowtie2_args if bowtie2_args is not None else '',
             ' --sam-no-qname-trunc --local -t --no-hd --mm -x',
-            bowtie2_index_base, '--12 -'])
+            bowtie2_index_base, '--12 -']))
         delegate_command = ''.join(
                     [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                         ('_delegate.py --task-partition {task_partition} '
@@ -738,7 +769,8 @@ if __name__ == '__main__':
         keep_alive_thread.start()
 
     start_time = time.time()
-    go(bowtie2_exe=os.path.expandvars(args.bowtie2_exe),
+    go(output_stream=framed_output(sys.stdout),
+        bowtie2_exe=os.path.expandvars(args.bowtie2_exe),
         bowtie_index_base=os.path.expandvars(args.bowtie_idx),
         bowtie2_index_base=os.path.expandvars(args.bowtie2_idx),
         bowtie2_args=bowtie_args,
@@ -21,7 +21,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream, xopen
+from dooplicity.tools import xstream, xopen, framed_output
 from alignment_handlers import AlignmentPrinter
 import bowtie_index
 import bowtie
@@ -884,6 +884,8 @@ def handle_bowtie_output(input_stream, reference_index, manifest_object,
                                 qname,
                                 qual_to_print
                             )
+    _output_line_count += alignment_printer.flush_exon_diffs()
+    _output_line_count += alignment_printer.flush_read_counts()
     output_stream.flush()
 
 def go(task_partition='0', other_reads=None, second_pass_reads=None,
@@ -955,7 +957,9 @@ def go(task_partition='0', other_reads=None, second_pass_reads=None,
             usually means only a transcript index is being constructed
         no_polyA: kill readlets that are all As
     """
-    reference_index = bowtie_index.BowtieIndexReference(bowtie_index_base)
+    reference_index = bowtie_index.BowtieIndexReference(
+                            bowtie_index_base, with_sequence=False
+                        )
     manifest_object = manifest.LabelsAndIndices(manifest_file)
     group_reads_object = group_reads.IndexGroup(index_count)
     if other_reads is not None:
@@ -1118,6 +1122,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
 if __name__ == '__main__' and not args.test:
+    output_stream = framed_output(sys.stdout)
     go(task_partition=args.task_partition,
         other_reads=args.other_reads,
         second_pass_reads=args.second_pass_reads,
@@ -1126,7 +1131,7 @@ if __name__ == '__main__' and not args.test:
         max_readlet_size=args.max_readlet_size,
         readlet_interval=args.readlet_interval,
         capping_multiplier=args.capping_multiplier,
-        output_stream=sys.stdout,
+        output_stream=output_stream,
         input_stream=sys.stdin,
         verbose=args.verbose,
         report_multiplier=args.report_multiplier,
@@ -1143,6 +1148,7 @@ if __name__ == '__main__' and not args.test:
         tie_margin=args.tie_margin,
         no_realign=args.no_realign,
         no_polyA=args.no_polyA)
+    output_stream.close()
 
 elif __name__ == '__main__':
     # Test units
@@ -59,7 +59,7 @@ from alignment_handlers import running_sum, pairwise
 import math
 import time
 from dooplicity.ansibles import Url
-from dooplicity.tools import register_cleanup, make_temp_dir
+from dooplicity.tools import register_cleanup, make_temp_dir, xlines
 import filemover
 import tempdel
 
@@ -103,7 +103,7 @@ else:
     output_path = os.path.join(temp_dir_path, args.filename)
 samples = {}
 saved = []
-for input_line_count, line in enumerate(sys.stdin):
+for input_line_count, line in enumerate(xlines(sys.stdin)):
     tokens = line.strip().split('\t')
     token_count = len(tokens)
     if not (token_count > 4 and tokens[0] == '#!splitload'):
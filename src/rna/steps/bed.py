@@ -55,7 +55,8 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.ansibles import Url
-from dooplicity.tools import xstream, register_cleanup, make_temp_dir
+from dooplicity.tools import xstream, register_cleanup, make_temp_dir, \
+    xopen, coordinate_index_key
 import bowtie
 import bowtie_index
 import manifest
@@ -79,6 +80,18 @@ parser.add_argument(\
     default='',
     help='The basename (excluding path) of all BED output. Basename is '
          'followed by ".[junctions/insertions/deletions].[sample_label].bed"')
+parser.add_argument('--bgzf-threads', type=int, required=False,
+        default=0,
+        help=('Write output as BGZF, a gzip-compatible format, to files '
+              'with extension .bed.gz, compressing blocks with this many '
+              'threads; 0 writes uncompressed BEDs'))
+parser.add_argument('--bgzf-index', action='store_const', const=True,
+        default=False,
+        help=('Write a coordinate index next to each BGZF output file with '
+              'extension .idx; ignored unless --bgzf-threads > 0'))
+parser.add_argument('--gzip-level', type=int, required=False,
+        default=3,
+        help='Level of compression to use if --bgzf-threads > 0')
 parser.add_argument('--keep-alive', action='store_const', const=True,
         default=False,
         help=('Periodically print Hadoop status messages to stderr to keep '
@@ -99,7 +112,8 @@ import time
 start_time = time.time()
 
 reference_index = bowtie_index.BowtieIndexReference(
-                            os.path.expandvars(args.bowtie_idx)
+                            os.path.expandvars(args.bowtie_idx),
+                            with_sequence=False
                         )
 # For mapping sample indices back to original sample labels
 manifest_object = manifest.LabelsAndIndices(
@@ -126,11 +140,20 @@ for (line_type, sample_label), xpartition in xstream(sys.stdin, 2):
     output_filename = ((args.bed_basename + '.' 
                           if args.bed_basename != '' else '')
                           + type_string + '.' + sample_label + '.bed')
+    if args.bgzf_threads:
+        output_filename += '.gz'
     if output_url.is_local:
         output_path = os.path.join(args.out, output_filename)
     else:
         output_path = os.path.join(temp_dir_path, output_filename)
-    with open(output_path, 'w') as output_stream:
+    if args.bgzf_threads:
+        output_opener = xopen('bgzf', output_path, 'w', args.gzip_level,
+                                args.bgzf_threads,
+                                coordinate_index_key if args.bgzf_index
+                                else None)
+    else:
+        output_opener = open(output_path, 'w')
+    with output_opener as output_stream:
         print >>output_stream, 'track name="%s_%s" description="' \
                                    'Rail-RNA v%s %s for sample %s"' \
                                                       % (sample_label,
@@ -178,6 +201,10 @@ for (line_type, sample_label), xpartition in xstream(sys.stdin, 2):
     if not output_url.is_local:
         mover.put(output_path, output_url.plus(output_filename))
         os.remove(output_path)
+        if args.bgzf_threads and args.bgzf_index:
+            mover.put(output_path + '.idx',
+                        output_url.plus(output_filename + '.idx'))
+            os.remove(output_path + '.idx')
 
 print >>sys.stderr, 'DONE with bed.py; in=%d; time=%0.3f s' \
                         % (input_line_count, time.time() - start_time)
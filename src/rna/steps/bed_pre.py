@@ -64,9 +64,12 @@ Tab-delimited output tuple columns (collect)
                     or last base of intron (INCLUSIVE HERE))
 5. '+' or '-' indicating which strand is the sense strand for junctions,
    inserted sequence for insertions, or deleted sequence for deletions
-6. Coverage of feature for sample with index N
+6. Sample index + ':' + coverage of feature in that sample for a sample in
+    which the feature was found
 ...
-N + 6. Coverage of feature in sample with index N
+N + 6. Sample index + ':' + coverage of feature in that sample for another
+    sample in which the feature was found; samples in which the feature was
+    not found are omitted
 --------------------------------------------------------------------
 10. SUMMED number of instances of junction, insertion, or deletion in sample
 
@@ -87,7 +90,7 @@ base_path = os.path.abspath(
 utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 import manifest
 
 def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
@@ -164,9 +167,12 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
         5. '+' or '-' indicating which strand is the sense strand for
             junctions, inserted sequence for insertions, or deleted sequence
             for deletions
-        6. Coverage of feature for sample with index N
+        6. Sample index + ':' + coverage of feature in that sample for a
+            sample in which the feature was found
         ...
-        N + 6. Coverage of feature in sample with index N
+        N + 6. Sample index + ':' + coverage of feature in that sample for
+            another sample in which the feature was found; samples in which
+            the feature was not found are omitted
         --------------------------------------------------------------------
         10. SUMMED number of instances of junction, insertion, or deletion in
             sample
@@ -202,17 +208,12 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
                                              else str(int(end_pos) - 1),
                                      strand_or_seq]
         coverages = []
-        i = 0
         if line_type == 'N':
             for sample_index, data in itertools.groupby(
                                                     xpartition, 
                                                     key=lambda val: val[0]
                                                 ):
                 sample_index = int(sample_index)
-                while i != sample_index:
-                    # Write 0 coverage for sample indexes reporting 0 junctions
-                    coverages.append(0)
-                    i += 1
                 coverage_sum = 0
                 max_left_displacement, max_right_displacement = None, None
                 maximin_displacement = None
@@ -238,28 +239,19 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
                         max_left_displacement, max_right_displacement,
                         maximin_displacement, coverage_sum
                     )
-                coverages.append(coverage_sum)
-                i += 1
+                coverages.append('%d:%d' % (sample_index, coverage_sum))
                 output_line_count += 1
             output_stream.write('collect\t2\t')
-            print >>output_stream, '\t'.join(
-                        collect_specs
-                        + [str(coverage_value) for coverage_value in coverages]
-                        + ['0']*(total_sample_count - len(coverages))
-                    )
+            print >>output_stream, '\t'.join(collect_specs + coverages)
             output_line_count += 1
         else:
             assert line_type in 'ID'
-            sample_count = 0
+            sample_count, max_coverage = 0, 0
             for sample_index, data in itertools.groupby(
                                                     xpartition, 
                                                     key=lambda val: val[0]
                                                 ):
                 sample_index = int(sample_index)
-                while i != sample_index:
-                    # Write 0 coverage for sample indexes reporting 0 indels
-                    coverages.append(0)
-                    i += 1
                 coverage_sum = 0
                 for _, _, _, coverage in data:
                     input_line_count += 1
@@ -269,11 +261,10 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
                         line_type, sample_index, rname, pos, end_pos,
                         strand_or_seq, coverage_sum
                     )
-                coverages.append(coverage_sum)
+                coverages.append('%d:%d' % (sample_index, coverage_sum))
+                max_coverage = max(coverage_sum, max_coverage)
                 sample_count += 1
-                i += 1
                 output_line_count += 1
-            max_coverage = max(coverages)
             if (sample_count >= min_sample_count
                 or (max_coverage >= coverage_threshold
                     and coverage_threshold != -1)):
@@ -281,12 +272,7 @@ def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
                     output_stream.write('collect\t0\t')
                 else:
                     output_stream.write('collect\t1\t')
-                print >>output_stream, \
-                    '\t'.join(
-                        collect_specs 
-                        + [str(coverage_value) for coverage_value in coverages]
-                        + ['0']*(total_sample_count - len(coverages))
-                    )
+                print >>output_stream, '\t'.join(collect_specs + coverages)
                 output_line_count += 1
             elif verbose:
                 print >>sys.stderr, (
@@ -343,14 +329,16 @@ if __name__ == '__main__' and not args.test:
     manifest_object = manifest.LabelsAndIndices(
                                 os.path.expandvars(args.manifest)
                             )
+    output_stream = framed_output(sys.stdout)
     input_line_count, output_line_count = go(
             manifest_object=manifest_object,
             input_stream=sys.stdin,
-            output_stream=sys.stdout,
+            output_stream=output_stream,
             sample_fraction=args.sample_fraction,
             coverage_threshold=args.coverage_threshold,
             verbose=args.verbose
         )
+    output_stream.close()
     print >>sys.stderr, 'DONE with bed_pre.py; in/out =%d/%d; time=%0.3f s' \
                          % (input_line_count, output_line_count,
                             time.time() - start_time)
@@ -442,15 +430,15 @@ elif __name__ == '__main__':
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t0\t000000000000\t140\t140\tATAC\t12\t0\t0'
+                    'collect\t0\t000000000000\t140\t140\tATAC\t0:12'
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t1\t000000000001\t150\t156\tAACCTT\t3\t3\t0'
+                    'collect\t1\t000000000001\t150\t156\tAACCTT\t0:3\t1:3'
                     in output_lines
                 )
             self.assertTrue(
-                    'collect\t2\t000000000003\t3567\t3889\t+\t0\t0\t2'
+                    'collect\t2\t000000000003\t3567\t3889\t+\t2:2'
                     in output_lines
                 )
             self.assertEquals(
@@ -2,7 +2,7 @@
 """
 Rail-RNA-break-ties
 Follows Rail-RNA-junction_coverage, Rail-RNA-realign_reads
-Precedes Rail-RNA-bed_pre, Rail-RNA-bam
+Precedes Rail-RNA-bed_pre, Rail-RNA-bam, Rail-RNA-collect_read_stats
 
 Decides primary alignments from among ties according to the read coverage
 (by "uniquely" aligning reads) of the minimally covered junction overlapped
@@ -52,7 +52,7 @@ Format 2 (exon_diff); tab-delimited output tuple columns:
 3. Sample label
 4. '1' if alignment from which diff originates is "unique" according to
     --tie-margin criterion; else '0'
-4. +1 or -1.
+4. +1 or -1, summed over alignments with the same fields above
 
 Note that only unique alignments are currently output as ivals and/or diffs.
 
@@ -105,6 +105,16 @@ Format 4; tab-delimited output tuple columns:
 9. Number of instances of junction, insertion, or deletion in sample; this is
     always +1 before bed_pre combiner/reducer
 
+Mapped read counts (counts); tab-delimited output tuple columns:
+1. '-' to enforce that all records are placed in the same partition
+2. Sample index
+3. RNAME index
+4. Number of primary alignments written as sam overlapping contig with RNAME
+5. Number of those alignments that are unique
+
+If RNAME corresponds to unmapped reads, both counts are the number of unmapped
+reads. These are summed across tasks by Rail-RNA-collect_read_stats.
+
 ALL OUTPUT COORDINATES ARE 1-INDEXED.
 """
 import sys
@@ -122,7 +132,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 from alignment_handlers import AlignmentPrinter, multiread_to_report
 import bowtie
 import bowtie_index
@@ -173,7 +183,8 @@ different command-line arguments can be passed to it for unit tests.'''
 args = parser.parse_args(argv[1:])
 
 reference_index = bowtie_index.BowtieIndexReference(
-                            os.path.expandvars(args.bowtie_idx)
+                            os.path.expandvars(args.bowtie_idx),
+                            with_sequence=False
                         )
 manifest_object = manifest.LabelsAndIndices(
                             os.path.expandvars(args.manifest)
@@ -181,10 +192,11 @@ manifest_object = manifest.LabelsAndIndices(
 alignment_count_to_report, seed, non_deterministic \
     = bowtie.parsed_bowtie_args(bowtie_args)
 
+output_stream = framed_output(sys.stdout)
 alignment_printer = AlignmentPrinter(
                                 manifest_object,
                                 reference_index,
-                                output_stream=sys.stdout,
+                                output_stream=output_stream,
                                 bin_size=args.partition_length,
                                 exon_ivals=args.exon_intervals,
                                 exon_diffs=args.exon_differentials,
@@ -253,6 +265,10 @@ for (qname,), xpartition in xstream(sys.stdin, 1):
                     )
                 )
 
+output_line_count += alignment_printer.flush_exon_diffs()
+output_line_count += alignment_printer.flush_read_counts()
+output_stream.close()
+
 print >>sys.stderr, 'DONE with break_ties.py; in/out=%d/%d; ' \
                     'time=%0.3f s' % (input_line_count, output_line_count,
                                         time.time() - start_time)
\ No newline at end of file
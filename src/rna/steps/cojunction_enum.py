@@ -46,8 +46,9 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 import bowtie
+import bowtie_pool
 from dooplicity.tools import xstream, register_cleanup, xopen, \
-    make_temp_dir
+    make_temp_dir, xlines
 from dooplicity.ansibles import Url
 import tempdel
 import filemover
@@ -57,8 +58,8 @@ _input_line_count = 0
 
 def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     bowtie2_index_base='genome', bowtie2_args='', verbose=False,
-    report_multiplier=1.2, stranded=False, fudge=5, max_refs=300, score_min=60,
-    gzip_level=3, mover=filemover.FileMover(), intermediate_dir='.',
+    report_multiplier=1.2, stranded=False, fudge=5, max_refs=300,
+    max_paths=1000, score_min=60, gzip_level=3, mover=filemover.FileMover(), intermediate_dir='.',
     scratch=None):
     """ Runs Rail-RNA-cojunction_enum 
 
@@ -110,6 +111,8 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                 to accommodate potential indels
         max_refs: hard limit on number of reference seqs to enumerate per
             read per strand
+        max_paths: hard limit on number of paths through junction
+            combinations to enumerate per read per strand
         score_min: Bowtie2 CONSTANT minimum alignment score
         gzip_level: compression level to use for temporary files
         mover: FileMover object, for use in case Bowtie2 idx needs to be
@@ -144,19 +147,21 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
     reads_file = os.path.join(temp_dir_path, 'reads.temp.gz')
     with xopen(True, reads_file, 'w', gzip_level) as reads_stream:
-        for _input_line_count, line in enumerate(input_stream):
+        for _input_line_count, line in enumerate(xlines(input_stream)):
             seq = line.strip()
             print >>reads_stream, '\t'.join([seq, seq, 'I'*len(seq)])
     input_command = 'gzip -cd %s' % reads_file
-    bowtie_command = ' '.join([bowtie2_exe,
+    bowtie_command = bowtie_pool.command(' '.join([bowtie2_exe,
         bowtie2_args if bowtie2_args is not None else '',
         ' --local -t --no-hd --mm -x', bowtie2_index_base, '--12 -',
         '--score-min L,%d,0' % score_min, 
-        '-D 24 -R 3 -N 1 -L 20 -i L,4,0'])
+        '-D 24 -R 3 -N 1 -L 20 -i L,4,0']))
     delegate_command = ''.join(
             [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                 ('_delegate.py --report-multiplier %08f --fudge %d '
-                 '--max-refs %d %s %s') % (report_multiplier, fudge, max_refs,
+                 '--max-refs %d --max-paths %d %s %s') % (
+                                            report_multiplier, fudge,
+                                            max_refs, max_paths,
                                             '--stranded' if stranded else '',
                                             '--verbose' if verbose else '')]
         )
@@ -210,6 +215,11 @@ if __name__ == '__main__':
         help='Hard limit on the number of reference sequences to emit '
              'per read per strand. Prioritizes reference sequences that '
              'overlap the fewest junctions')
+    parser.add_argument('--max-paths', type=int, required=False,
+        default=1000,
+        help='Hard limit on the number of paths through junction '
+             'combinations to enumerate per read per strand. Prioritizes '
+             'paths that overlap the fewest junctions')
     parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
         help='Gzip compression level to use for temporary Bowtie input file')
@@ -256,6 +266,7 @@ if __name__ == '__main__' and not args.test:
         stranded=args.stranded,
         fudge=args.fudge,
         max_refs=args.max_refs,
+        max_paths=args.max_paths,
         score_min=args.score_min,
         mover=mover,
         intermediate_dir=args.intermediate_dir,
@@ -9,6 +9,9 @@ import sys
 import os
 import site
 from collections import defaultdict
+from itertools import groupby, islice
+import bisect
+import heapq
 import random
 
 base_path = os.path.abspath(
@@ -20,7 +23,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 from alignment_handlers import multiread_with_junctions, \
     indels_junctions_exons_mismatches
 
@@ -37,31 +40,32 @@ def cojunction_length(cojunction):
     return sum([cojunction[i][0] - cojunction[i-1][1]
                     for i in xrange(1, len(cojunction))])
 
-def paths_from_cojunctions(cojunctions, span=50):
+def paths_from_cojunctions(cojunctions, span=50, max_paths=None):
     """ Finds junction combinations that can be overlapped by span bases
 
         Consider a directed acyclic graph (DAG) where each node is a different
-        intron (intron_start, intron_end). There is an edge extending from a
-        node A to a node B only if:
-        1) their corresponding introns have no overlapping bases
-        2) A's start and end positions are less than B's start and end
-            positions
-        3) there is no intron C between A and B such that C overlaps neither
-            A nor B
-        Such a graph is constructed from input cojunctions, or junction
-        combinations that may be overlapped by a read. A cojunction is a
-        linear subgraph of the DAG: if it has three junctions, it looks like
-        this---
+        cojunction, or junction combination that may be overlapped by a read.
+        There is an edge extending from a node A to a node B only if:
+        1) A ends before B starts, so their introns have no overlapping bases
+        2) span is at least the number of exonic bases spanned by A and B
+            together, including those between them, plus 2
+        With cojunctions sorted by start position, the nodes B for a given
+        node A are found by a sweep from the first cojunction that starts
+        after A ends to the last that starts within span bases of A's end.
 
-           A ---> B ---> C
+        Every path from a source to a sink of the DAG is enumerated. The
+        paths from a node are computed once, from the paths of the nodes
+        its edges extend to, so paths sharing a suffix aren't recomputed for
+        every source and sink, and identical junction combinations obtained
+        from different paths are reported once. Nodes that are neither
+        sources nor sinks are also returned as paths of their own.
 
-        ---for its constituent node A, B, and C. It can be connected to the 
-        rest of the DAG only via its source and/or its sink. All possible
-        edges among sources and sinks of cojunctions are included in the graph.
-
-        Assign a weight to each edge equal to the number of exonic bases
-        between the introns it connects. Now use DFS to enumerate paths
-        through the graph that span at least "span" nodes.
+        If max_paths is not None, only the max_paths source-to-sink paths
+        ranked highest are returned. Paths are ranked by number of
+        junctions, fewest first, with ties broken by comparing the
+        junctions themselves, so the same paths are returned every time.
+        Only the max_paths highest-ranked paths from any node are kept,
+        which bounds work on dense loci.
 
         cojunctions: a list of lists of tuples (intron start, intron end,
             left displacement, right displacement); each list of tuples
@@ -70,74 +74,72 @@ def paths_from_cojunctions(cojunctions, span=50):
             up resorted
         span: the number of exonic bases (total weight) that can be spanned by
             a path through nodes to return
+        max_paths: maximum number of source-to-sink paths to return, or None
+            if there is no maximum
 
-        Return value: list of junction combinations that can be spanned by
-            span bases; junction combos with "edge" junctions removed are
-            also included
+        Return value: tuple (list of junction combinations that can be
+            spanned by span bases, where junction combos with "edge"
+            junctions removed are also included; True iff paths were
+            discarded because there were more than max_paths)
     """
     cojunctions_count = len(cojunctions)
-    if cojunctions_count <= 1: return cojunctions
+    if cojunctions_count <= 1: return cojunctions, False
     '''Make each node of DAG a cojunction; cojunctions are linear subgraphs
     anyway'''
-    DAG = defaultdict(set)
-    reverse_DAG = defaultdict(set)
     cojunctions.sort(key=lambda x: (x[0][0], x[-1][1]))
+    starts = [cojunction[0][0] for cojunction in cojunctions]
+    lengths = [cojunction_length(cojunction) for cojunction in cojunctions]
+    DAG = [[] for _ in xrange(cojunctions_count)]
+    has_predecessor = [False] * cojunctions_count
     for i in xrange(cojunctions_count):
-        source_cojunction_length = cojunction_length(cojunctions[i])
-        for j in xrange(i+1, cojunctions_count):
-            negative_separation = (
-                    min(cojunctions[j][-1][1], cojunctions[i][-1][1])
-                    - max(cojunctions[j][0][0], cojunctions[i][0][0])
-                )
-            if negative_separation >= 0:
-                # Overlap between cojunctions, so continue
-                continue
-            if -negative_separation > span:
+        end = cojunctions[i][-1][1]
+        # Cojunctions that start after this one ends don't overlap it
+        for j in xrange(bisect.bisect_right(starts, end), cojunctions_count):
+            separation = starts[j] - end
+            if separation > span:
                 # Too far away
                 break
-            if (-negative_separation
-                + cojunction_length(cojunctions[j])
-                + source_cojunction_length + 2) <= span:
+            if separation + lengths[i] + lengths[j] + 2 <= span:
                 # span can span both cojunctions
-                DAG[i].add(j)
-                reverse_DAG[j].add(i)
-            '''Add edges while there's overlap between jth cojunction and
-            a successive cojunction'''
-            for k in xrange(j+1, cojunctions_count):
-                overlap = (
-                        min(cojunctions[k][-1][1], cojunctions[j][-1][1])
-                        - max(cojunctions[k][0][0], cojunctions[j][0][0])
-                    )
-                if overlap >= 0:
-                    negative_separation = (
-                        min(cojunctions[k][-1][1], cojunctions[i][-1][1])
-                        - max(cojunctions[k][0][0], cojunctions[i][0][0])
-                    )
-                    if (-negative_separation
-                        + cojunction_length(cojunctions[k])
-                        + source_cojunction_length + 2) <= span:
-                        DAG[i].add(k)
-                        reverse_DAG[k].add(i)
-                else:
-                    break
-    sources = set(DAG.keys()) - set(reverse_DAG.keys())
-    sinks = set(reverse_DAG.keys()) - set(DAG.keys())
-    # DFS to enumerate paths; start with isolated vertices
-    paths = [[i] for i in xrange(cojunctions_count) if (
-                                i not in sources and i not in sinks
-                            )]
-    for source in sources:
-        for sink in sinks:
-            stack = [(source, [source])]
-            while stack:
-                (vertex, path) = stack.pop()
-                for next_vertex in DAG[vertex] - set(path):
-                    if next_vertex == sink:
-                        paths.append(path + [next_vertex])
-                    else:
-                        stack.append((next_vertex, path + [next_vertex]))
-    prereturn = [[j for i in [cojunctions[k] for k in path] for j in i]
-                 for path in paths]
+                DAG[i].append(j)
+                has_predecessor[j] = True
+    '''Store sorted paths from each node to sinks as tuples (junction count,
+    junctions); edges extend only to later nodes, so visit nodes in reverse
+    order.'''
+    truncated = False
+    suffixes = [None] * cojunctions_count
+    for i in reversed(xrange(cojunctions_count)):
+        cojunction = tuple(cojunctions[i])
+        if not DAG[i]:
+            suffixes[i] = [(len(cojunction), cojunction)]
+            continue
+        merged_suffixes = (key for key, _ in groupby(heapq.merge(*[
+                    [(junction_count + len(cojunction),
+                        cojunction + junctions)
+                        for junction_count, junctions in suffixes[j]]
+                    for j in DAG[i]
+                ])))
+        if max_paths is None:
+            suffixes[i] = list(merged_suffixes)
+        else:
+            suffixes[i] = list(islice(merged_suffixes, max_paths + 1))
+            if len(suffixes[i]) > max_paths:
+                truncated = True
+                suffixes[i].pop()
+    paths = (key for key, _ in groupby(heapq.merge(*[
+                    suffixes[i] for i in xrange(cojunctions_count)
+                    if DAG[i] and not has_predecessor[i]
+                ])))
+    if max_paths is not None:
+        paths = list(islice(paths, max_paths + 1))
+        if len(paths) > max_paths:
+            truncated = True
+            paths.pop()
+    prereturn = [junctions for _, junctions in paths]
+    # Add isolated nodes and nodes in the middle of paths
+    prereturn.extend(tuple(cojunctions[i])
+                        for i in xrange(cojunctions_count)
+                        if bool(DAG[i]) == has_predecessor[i])
     to_return = set()
     # Add edge combos
     for junction_combo in prereturn:
@@ -145,7 +147,8 @@ def paths_from_cojunctions(cojunctions, span=50):
         to_return.add(tuple(junction_combo[1:-1]))
         to_return.add(tuple(junction_combo[1:]))
         to_return.add(tuple(junction_combo[:-1]))
-    return [junction_combo for junction_combo in to_return if junction_combo]
+    return ([junction_combo for junction_combo in to_return
+                if junction_combo], truncated)
 
 def selected_cojunctions(cojunctions, max_refs=300,
                             seq='ATC', rname='chr1', sense='+'):
@@ -170,7 +173,8 @@ def selected_cojunctions(cojunctions, max_refs=300,
     return cojunctions[:max_refs]
 
 def go(input_stream=sys.stdin, output_stream=sys.stdout, fudge=5,
-        stranded=False, verbose=False, max_refs=300, report_multiplier=1.2):
+        stranded=False, verbose=False, max_refs=300, max_paths=1000,
+        report_multiplier=1.2):
     """ Emits junction combinations associated with reads.
 
         Soft-clipped Bowtie 2 alignments of read sequences to the transcript
@@ -192,11 +196,14 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, fudge=5,
         max_refs: maximum number of reference sequences to enumerate per read;
             if more are present, prioritize those sequences that overlap
             the fewest junctions
+        max_paths: maximum number of paths through cojunctions to enumerate
+            per read per strand; see paths_from_cojunctions()
         report_multiplier: if verbose is True, the line number of an
             alignment written to stderr increases exponentially with base
             report_multiplier.
     """
     output_line_count, next_report_line, i = 0, 0, 0
+    truncated_count = 0
     for (qname,), xpartition in xstream(input_stream, 1):
         '''While labeled multireadlet, this list may end up simply a
         unireadlet.'''
@@ -261,9 +268,14 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, fudge=5,
                             ][1], junction[3])
         for rname, sense in all_junctions:
             to_write = set()
-            for cojunction in selected_cojunctions(paths_from_cojunctions(
-                    list(cojunctions[(rname, sense)]), span=(seq_size + fudge)
-                ), max_refs=max_refs, seq=seq, rname=rname, sense=sense):
+            paths, truncated = paths_from_cojunctions(
+                    list(cojunctions[(rname, sense)]), span=(seq_size + fudge),
+                    max_paths=max_paths
+                )
+            if truncated:
+                truncated_count += 1
+            for cojunction in selected_cojunctions(paths,
+                    max_refs=max_refs, seq=seq, rname=rname, sense=sense):
                 left_extend_size = all_junctions[(rname, sense)][
                                         cojunction[0]
                                     ][0]
@@ -290,11 +302,12 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, fudge=5,
                             seq=seq_to_print
                        ))
             for line_to_write in to_write:
-                print line_to_write
+                print >>output_stream, line_to_write
                 output_line_count += 1
     output_stream.flush()
-    print >>sys.stderr, ('cojunction_enum_delegate.py reports %d output lines.'
-                            % output_line_count)
+    print >>sys.stderr, ('cojunction_enum_delegate.py reports %d output lines '
+                         'and truncated path enumeration for %d loci.'
+                            % (output_line_count, truncated_count))
 
 if __name__ == '__main__':
     import argparse
@@ -313,6 +326,11 @@ if __name__ == '__main__':
         help='Hard limit on the number of reference sequences to emit '
              'per read per strand. Prioritizes reference sequences that '
              'overlap the fewest junctions')
+    parser.add_argument('--max-paths', type=int, required=False,
+        default=1000,
+        help='Hard limit on the number of paths through junction '
+             'combinations to enumerate per read per strand. Prioritizes '
+             'paths that overlap the fewest junctions')
     parser.add_argument(
         '--stranded', action='store_const', const=True, default=False,
         help='Assume input reads come from the sense strand; then partitions '
@@ -328,9 +346,11 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
 if __name__ == '__main__' and not args.test:
-    go(stranded=args.stranded, fudge=args.fudge,
+    output_stream = framed_output(sys.stdout)
+    go(output_stream=output_stream, stranded=args.stranded, fudge=args.fudge,
         verbose=args.verbose, max_refs=args.max_refs,
-        report_multiplier=args.report_multiplier)
+        max_paths=args.max_paths, report_multiplier=args.report_multiplier)
+    output_stream.close()
 elif __name__ == '__main__':
     # Test units
     del sys.argv[1:] # Don't choke on extra command-line parameters
@@ -360,7 +380,7 @@ elif __name__ == '__main__':
         def test_lengths(self):
             """ Fails if output of paths_from_cojunctions() is wrong. """
             # Test that cojunctions are merged for long-enough span
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((160, 170), (190, 200))], span=50
                         )
@@ -369,7 +389,7 @@ elif __name__ == '__main__':
                     in paths
                 )
             # Test that cojunctions remain distinct for short span
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((160, 170), (190, 200))], span=20
                         )
@@ -382,7 +402,7 @@ elif __name__ == '__main__':
                     in paths
                 )
             # Test edge cases: cojunctions remain distinct for span 46
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((160, 170), (190, 200))], span=46
                         )
@@ -395,7 +415,7 @@ elif __name__ == '__main__':
                     in paths
                 )
             # ...but not for span 47
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((160, 170), (190, 200))], span=47
                         )
@@ -404,7 +424,7 @@ elif __name__ == '__main__':
                     in paths
                 )
             # Test complicated cases
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((10, 110), (123, 221)),
                              ((110, 150), (180, 210)),
@@ -429,7 +449,7 @@ elif __name__ == '__main__':
                 self.assertEquals(
                         len(paths), 11
                     )
-            paths = paths_from_cojunctions(
+            paths, _ = paths_from_cojunctions(
                             [((2, 5), (10, 100), (110, 150)),
                              ((10, 110), (123, 221)),
                              ((110, 150), (180, 210)),
@@ -455,6 +475,31 @@ elif __name__ == '__main__':
                         len(paths), 11
                     )
 
+        def test_max_paths(self):
+            """ Fails if paths aren't capped deterministically. """
+            cojunctions = [((i * 7, i * 7 + 3),) for i in xrange(12)]
+            all_paths, truncated = paths_from_cojunctions(
+                            list(cojunctions), span=100
+                        )
+            self.assertFalse(truncated)
+            paths, truncated = paths_from_cojunctions(
+                            list(cojunctions), span=100, max_paths=5
+                        )
+            self.assertTrue(truncated)
+            self.assertTrue(set(paths) < set(all_paths))
+            # Path with fewest junctions from source to sink is kept
+            self.assertTrue(
+                    ((0, 3), (77, 80)) in paths
+                )
+            random.seed(0)
+            random.shuffle(cojunctions)
+            self.assertEquals(
+                    set(paths_from_cojunctions(
+                            cojunctions, span=100, max_paths=5
+                        )[0]),
+                    set(paths)
+                )
+
     class TestSelectedCojunctions(unittest.TestCase):
         """ Tests selected_cojunctions(). """
 
@@ -25,14 +25,28 @@ Input is partitioned by the first three fields.
 
 Hadoop output (written to stdout)
 ----------------------------
-Tab-delimited tuple columns, one for each read sequence:
+Tab-delimited tuple columns
+(two kinds)
+
+Isofrag, output once for each index group of the read sequences:
 1. Transcriptome Bowtie 2 index group number
-2. '0' + FASTA reference name including '>'. The following format is used:
+2. '0' + isofrag ID: a short digest of the FASTA reference name
+3. FASTA reference name including '>'. The following format is used:
     original RNAME + '+' or '-' indicating which strand is the sense strand
     + '\x1d' + start position of sequence + '\x1d' + comma-separated list of
     subsequence sizes framing introns + '\x1d' + comma-separated list of intron
-    sizes + '\x1d' + 'i' to indicate base string overlaps junctions
-3. FASTA sequence
+    sizes
+4. FASTA sequence
+
+Read sequence, output once for each read sequence:
+1. Transcriptome Bowtie 2 index group number
+2. Read sequence
+3. '0' + isofrag ID
+
+Isofrag sequences thus cross the shuffle once per index group rather than once
+per read sequence; Rail-RNA-realign_reads joins read sequences to them by ID.
+Field 2 of isofrags starts with '0', so they precede read sequences in an index
+group when sorted.
 """
 import sys
 import time
@@ -41,6 +55,8 @@ import site
 import argparse
 import copy
 import string
+import hashlib
+import base64
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -56,91 +72,220 @@ import bowtie_index
 from dooplicity.tools import xstream, dlist
 import group_reads
 
-parser = argparse.ArgumentParser(description=__doc__, 
-            formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument(\
-    '--verbose', action='store_const', const=True, default=False,
-    help='Print out extra debugging statements')
-bowtie.add_args(parser)
-group_reads.add_args(parser)
-args = parser.parse_args()
-
-start_time = time.time()
-input_line_count = 0
-reference_index = bowtie_index.BowtieIndexReference(
-                            os.path.expandvars(args.bowtie_idx)
-                        )
-group_reads_object = group_reads.IndexGroup(args.index_count)
-for (rname, poses, end_poses), xpartition in xstream(sys.stdin, 3,
-                                                        skip_duplicates=True):
-    reverse_strand_string = rname[-1]
-    rname = rname[:-1]
-    read_seqs = dlist()
-    poses = [int(pos) for pos in poses.split(',')]
-    end_poses = [int(end_pos) for end_pos in end_poses.split(',')]
-    max_left_extend_size, max_right_extend_size = None, None
-    for left_extend_size, right_extend_size, read_seq in xpartition:
-        input_line_count += 1
-        max_left_extend_size = max(max_left_extend_size, int(left_extend_size))
-        max_right_extend_size \
-            = max(max_right_extend_size, int(right_extend_size))
-        read_seqs.append(read_seq)
-    junction_combo = zip(poses, end_poses)
-    assert max_left_extend_size is not None
-    assert max_right_extend_size is not None
-    reference_length = reference_index.length[rname]
-    subseqs = []
-    left_start = max(junction_combo[0][0] - max_left_extend_size, 1)
-    # Add sequence before first junction
-    subseqs.append(
-            reference_index.get_stretch(rname, left_start - 1, 
-                junction_combo[0][0] - left_start)
-        )
-    # Add sequences between junctions
-    for i in xrange(1, len(junction_combo)):
+def go(input_stream=sys.stdin, output_stream=sys.stdout,
+        reference_index=None, index_count=100, verbose=False):
+    """ Runs Rail-RNA-cojunction_fasta.
+
+        Writes each isofrag once per index group of the read sequences
+        framing it, followed by those read sequences with the isofrag's ID;
+        see the docstring of this file for the format.
+
+        input_stream: where to find input
+        output_stream: where to write output
+        reference_index: object of class bowtie_index.BowtieIndexReference
+            from which isofrag sequences are obtained
+        index_count: number of transcriptome Bowtie 2 indexes to which reads
+            are assigned
+        verbose: True iff extra debugging statements should be printed to
+            stderr
+
+        Return value: number of input lines
+    """
+    input_line_count = 0
+    group_reads_object = group_reads.IndexGroup(index_count)
+    for (rname, poses, end_poses), xpartition in xstream(
+                                        input_stream, 3, skip_duplicates=True
+                                    ):
+        reverse_strand_string = rname[-1]
+        rname = rname[:-1]
+        read_seqs = dlist()
+        poses = [int(pos) for pos in poses.split(',')]
+        end_poses = [int(end_pos) for end_pos in end_poses.split(',')]
+        max_left_extend_size, max_right_extend_size = None, None
+        for left_extend_size, right_extend_size, read_seq in xpartition:
+            input_line_count += 1
+            max_left_extend_size = max(max_left_extend_size,
+                                        int(left_extend_size))
+            max_right_extend_size \
+                = max(max_right_extend_size, int(right_extend_size))
+            read_seqs.append(read_seq)
+        junction_combo = zip(poses, end_poses)
+        assert max_left_extend_size is not None
+        assert max_right_extend_size is not None
+        reference_length = reference_index.length[rname]
+        subseqs = []
+        left_start = max(junction_combo[0][0] - max_left_extend_size, 1)
+        # Add sequence before first junction
         subseqs.append(
-                reference_index.get_stretch(rname, 
-                    junction_combo[i-1][1] - 1,
-                    junction_combo[i][0]
-                    - junction_combo[i-1][1]
+                reference_index.get_stretch(rname, left_start - 1, 
+                    junction_combo[0][0] - left_start)
+            )
+        # Add sequences between junctions
+        for i in xrange(1, len(junction_combo)):
+            subseqs.append(
+                    reference_index.get_stretch(rname, 
+                        junction_combo[i-1][1] - 1,
+                        junction_combo[i][0]
+                        - junction_combo[i-1][1]
+                    )
                 )
+        # Add final sequence
+        subseqs.append(
+                reference_index.get_stretch(rname,
+                    junction_combo[-1][1] - 1,
+                    min(max_right_extend_size, reference_length - 
+                                        junction_combo[-1][1] + 1))
             )
-    # Add final sequence
-    subseqs.append(
-            reference_index.get_stretch(rname,
-                junction_combo[-1][1] - 1,
-                min(max_right_extend_size, reference_length - 
-                                    junction_combo[-1][1] + 1))
-        )
-    '''A given reference name in the index will be in the following format:
-    original RNAME + '+' or '-' indicating which strand is the sense strand
-    + ';' + start position of sequence + ';' + comma-separated list of
-    subsequence sizes framing introns + ';' + comma-separated list of intron
-    sizes'''
-    fasta_info = ('0>' + rname + reverse_strand_string 
-                 + '\x1d' + str(left_start) + '\x1d'
-                 + ','.join([str(len(subseq)) for subseq in subseqs])
-                 + '\x1d' + ','.join([str(junction_end_pos - junction_pos)
-                              for junction_pos, junction_end_pos
-                              in junction_combo])
-                 + '\x1di\t' + ''.join(subseqs))
-    if args.verbose:
+        '''A given reference name in the index will be in the following
+        format: original RNAME + '+' or '-' indicating which strand is the
+        sense strand + ';' + start position of sequence + ';' +
+        comma-separated list of subsequence sizes framing introns + ';' +
+        comma-separated list of intron sizes'''
+        isofrag_name = ('>' + rname + reverse_strand_string 
+                        + '\x1d' + str(left_start) + '\x1d'
+                        + ','.join([str(len(subseq)) for subseq in subseqs])
+                        + '\x1d' + ','.join(
+                                [str(junction_end_pos - junction_pos)
+                                    for junction_pos, junction_end_pos
+                                    in junction_combo]
+                            ))
+        isofrag_seq = ''.join(subseqs)
+        # Name determines sequence, so its digest identifies isofrag
+        isofrag_id = '0' + base64.urlsafe_b64encode(
+                                hashlib.md5(isofrag_name).digest()
+                            )[:16]
+        index_groups = set()
         read_seq_count = 0
         for read_seq in read_seqs:
             read_seq_count += 1
-            print '\t'.join([group_reads_object.index_group(read_seq),
-                                read_seq, fasta_info])
-        print >>sys.stderr, ('Printed %d read seqs for transcript fragment '
-                             'on %s with junctions %s.') % (
+            index_group = group_reads_object.index_group(read_seq)
+            if index_group not in index_groups:
+                index_groups.add(index_group)
+                print >>output_stream, '\t'.join([index_group, isofrag_id,
+                                                  isofrag_name, isofrag_seq])
+            print >>output_stream, '\t'.join([index_group, read_seq,
+                                              isofrag_id])
+        if verbose:
+            print >>sys.stderr, ('Printed %d read seqs for transcript '
+                                 'fragment on %s with junctions %s to %d '
+                                 'index groups.') % (
                                                         read_seq_count,
                                                         rname,
-                                                        str(junction_combo)
+                                                        str(junction_combo),
+                                                        len(index_groups)
                                                     )
-    else:
-        for read_seq in read_seqs:
-            print '\t'.join([group_reads_object.index_group(read_seq),
-                                read_seq, fasta_info])
+    output_stream.flush()
+    return input_line_count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, 
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(\
+        '--verbose', action='store_const', const=True, default=False,
+        help='Print out extra debugging statements')
+    parser.add_argument('--test', action='store_const', const=True,
+        default=False,
+        help='Run unit tests; DOES NOT NEED INPUT FROM STDIN')
+    bowtie.add_args(parser)
+    group_reads.add_args(parser)
+    args = parser.parse_args()
+
+if __name__ == '__main__' and not args.test:
+    start_time = time.time()
+    input_line_count = go(
+            reference_index=bowtie_index.BowtieIndexReference(
+                    os.path.expandvars(args.bowtie_idx)
+                ),
+            index_count=args.index_count,
+            verbose=args.verbose
+        )
+    print >>sys.stderr, 'DONE with cojunction_fasta.py; in=%d; ' \
+                        'time=%0.3f s' % (input_line_count,
+                                            time.time() - start_time)
+elif __name__ == '__main__':
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    from StringIO import StringIO
+
+    class FakeReferenceIndex(object):
+        """ Stands in for BowtieIndexReference. """
+        def __init__(self, seqs):
+            """
+                seqs: dictionary mapping RNAMEs to sequences
+            """
+            self.seqs = seqs
+            self.length = dict((rname, len(seq))
+                                for rname, seq in seqs.items())
+
+        def get_stretch(self, rname, start, size):
+            return self.seqs[rname][start:start+size]
+
+    class TestGo(unittest.TestCase):
+        """ Tests go(). """
+        def setUp(self):
+            self.reference_index = FakeReferenceIndex(
+                    {'chr1' : 'ACGTTGCA' * 25}
+                )
+            self.read_seqs = ['ACGTA' + 'C' * i for i in xrange(20)]
+            self.input_lines = (['chr1+\t51,101\t61,121\t20\t15\t%s'
+                                    % read_seq
+                                    for read_seq in self.read_seqs]
+                                + ['chr1-\t31\t41\t10\t10\tGGG'])
+
+        def output_lines(self, index_count):
+            """ Runs go() on self.input_lines.
+
+                index_count: number of index groups
+
+                Return value: list of lists of fields of output lines
+            """
+            output_stream = StringIO()
+            self.assertEqual(go(
+                    input_stream=StringIO(
+                            '\n'.join(self.input_lines) + '\n'
+                        ),
+                    output_stream=output_stream,
+                    reference_index=self.reference_index,
+                    index_count=index_count
+                ), len(self.input_lines))
+            return [line.split('\t') for line
+                    in output_stream.getvalue().strip().split('\n')]
+
+        def test_isofrag_once_per_index_group(self):
+            """ Fails if an isofrag isn't output exactly once per index
+                group of its read sequences.
+            """
+            group_reads_object = group_reads.IndexGroup(4)
+            output = self.output_lines(4)
+            isofrags = [fields for fields in output if len(fields) == 4]
+            reads = [fields for fields in output if len(fields) == 3]
+            self.assertEqual(
+                    sorted((fields[0], fields[1]) for fields in isofrags),
+                    sorted(set((fields[0], fields[2]) for fields in reads))
+                )
+            # One isofrag per junction combo
+            self.assertEqual(len(set(fields[1] for fields in isofrags)), 2)
+            self.assertEqual(
+                    sorted(fields[1] for fields in reads),
+                    sorted(self.read_seqs + ['GGG'])
+                )
+            for fields in reads:
+                self.assertEqual(fields[0], group_reads_object.index_group(
+                                                    fields[1]
+                                                ))
+            name, seq = [fields[2:] for fields in isofrags
+                            if fields[2].startswith('>chr1+')][0]
+            self.assertEqual(name, '>chr1+\x1d31\x1d20,40,15\x1d10,20')
+            reference = self.reference_index.seqs['chr1']
+            self.assertEqual(seq, reference[30:50] + reference[60:100]
+                                    + reference[120:135])
+            # Isofrags have IDs that sort before read sequences
+            self.assertTrue(all(fields[1][0] == '0' for fields in isofrags))
+            # Single index group sends each isofrag once
+            self.assertEqual(
+                    len([fields for fields in self.output_lines(1)
+                            if len(fields) == 4]), 2
+                )
 
-print >>sys.stderr, 'DONE with cojunction_fasta.py; in=%d; ' \
-                    'time=%0.3f s' % (input_line_count,
-                                        time.time() - start_time)
+    unittest.main()
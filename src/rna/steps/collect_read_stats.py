@@ -1,6 +1,7 @@
 """
 collect_read_stats.py
-Follows Rail-RNA-bam.py
+Follows Rail-RNA-align_reads, Rail-RNA-compare_alignments,
+    Rail-RNA-break_ties
 TERMINUS: no steps follow
 
 Reduce step in MapReduce pipelines that collects numbers of primary alignments
@@ -15,7 +16,9 @@ Tab-delimited columns:
 4. Number of primary alignments overlapping contig with RNAME
 5. Number of unique alignments overlapping contig with RNAME
 
-Input is partitioned by the first field and sorted by the second one.
+Input is partitioned by the first field and sorted by the second one. There
+may be more than one line for a given sample/RNAME since the steps that
+finalize alignments count them in each task; these are summed.
 
 Hadoop output (written to stdout)
 ----------------------------
@@ -90,7 +93,8 @@ import time
 start_time = time.time()
 
 reference_index = bowtie_index.BowtieIndexReference(
-                                os.path.expandvars(args.bowtie_idx)
+                                os.path.expandvars(args.bowtie_idx),
+                                with_sequence=False
                             )
 # For mapping sample indices back to original sample labels
 manifest_object = manifest.LabelsAndIndices(
@@ -135,8 +139,9 @@ with xopen(True, output_path, 'w', args.gzip_level) as output_stream:
         total_counts, unique_counts = defaultdict(int), defaultdict(int)
         for rname_index, total_count, unique_count in xpartition:
             rname = reference_index.string_to_rname[rname_index]
-            total_counts[rname] = int(total_count)
-            unique_counts[rname] = int(unique_count)
+            total_counts[rname] += int(total_count)
+            unique_counts[rname] += int(unique_count)
+            input_line_count += 1
         total_reads = sum(total_counts.values())
         total_mapped_reads = total_reads - total_counts['*']
         total_uniques = sum(unique_counts.values())
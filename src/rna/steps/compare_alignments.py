@@ -38,8 +38,9 @@ Format 2 (exon_diff); tab-delimited output tuple columns:
 3. Sample index
 4. '1' if alignment from which diff originates is "unique" according to
     --tie-margin criterion; else '0'
-5. +1 or -1 * count, the number of instances of a read sequence for which to
-    print exonic chunks
+5. Sum of +1 or -1 * count, the number of instances of a read sequence for
+    which to print exonic chunks, over alignments printed by the task with the
+    same fields 1-4
 
 Note that only unique alignments are currently output as ivals and/or diffs.
 
@@ -124,6 +125,16 @@ Format 6; tab-delimited output tuple columns:
 9. Number of instances of junction, insertion, or deletion in sample; this is
     always +1 before bed_pre combiner/reducer
 
+Mapped read counts (counts); tab-delimited output tuple columns:
+1. '-' to enforce that all records are placed in the same partition
+2. Sample index
+3. RNAME index
+4. Number of primary alignments written as sam overlapping contig with RNAME
+5. Number of those alignments that are unique
+
+If RNAME corresponds to unmapped reads, both counts are the number of unmapped
+reads. These are summed across tasks by Rail-RNA-collect_read_stats.
+
 ALL OUTPUT COORDINATES ARE 1-INDEXED.
 """
 
@@ -143,7 +154,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 from alignment_handlers \
     import multiread_with_junctions, AlignmentPrinter, multiread_to_report
 import partition
@@ -205,13 +216,15 @@ if __name__ == '__main__':
                                     os.path.expandvars(args.manifest)
                                 )
     reference_index = bowtie_index.BowtieIndexReference(
-                                    os.path.expandvars(args.bowtie_idx)
+                                    os.path.expandvars(args.bowtie_idx),
+                                    with_sequence=False
                                 )
+    output_stream = framed_output(sys.stdout)
     alignment_printer = AlignmentPrinter(
                     manifest_object,
                     reference_index,
                     bin_size=args.partition_length,
-                    output_stream=sys.stdout,
+                    output_stream=output_stream,
                     exon_ivals=args.exon_intervals,
                     exon_diffs=args.exon_differentials,
                     drop_deletions=args.drop_deletions,
@@ -279,6 +292,9 @@ if __name__ == '__main__':
                     tie_margin=args.tie_margin
                 )
             )
+    output_line_count += alignment_printer.flush_exon_diffs()
+    output_line_count += alignment_printer.flush_read_counts()
+    output_stream.close()
 
     print >>sys.stderr, 'DONE with compare_alignments.py; in/out=%d/%d; ' \
         'time=%0.3f s' % (input_line_count, output_line_count,
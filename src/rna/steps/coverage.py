@@ -11,8 +11,9 @@ base coverage (horizontal axis: number of exonic chunks covering given base;
     vertical axis: number of bases covered) as the (k*100)-th coverage
 percentile, where k is input by the user via the command-line parameter
 --percentile. bigwig files encoding coverage per sample are also written to a
-specified destination, local or remote. Rail-RNA-coverage_post merely collects
-the normalization factors and writes them to a file.
+specified destination, local or remote; they are encoded directly from the
+coverage stream, the two per sample concurrently. Rail-RNA-coverage_post
+merely collects the normalization factors and writes them to a file.
 
 Input (read from stdin)
 ----------------------------
@@ -20,7 +21,8 @@ Tab-delimited input tuple columns:
 1. Sample index OR mean[.RNAME] OR median[.RNAME]
 2. Number string representing reference name (RNAME in SAM format; see 
     BowtieIndexReference class in bowtie_index for conversion information)
-3. Position
+3. Position at which run starts; coverages hold until the next line for the
+    same sample or aggregate track
 4. Coverage counting all primary alignments (that is, the number of called ECs
     in the sample overlapping the position) (mean or median of sample coverages
     normalized by --library-size if field 1 specifies)
@@ -51,8 +53,6 @@ import os
 import sys
 import site
 import argparse
-import subprocess
-import threading
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -67,6 +67,7 @@ import manifest
 import bowtie
 import bowtie_index
 import filemover
+import bigwig
 import itertools
 from collections import defaultdict
 from dooplicity.tools import xstream, register_cleanup, make_temp_dir
@@ -91,7 +92,13 @@ parser.add_argument('--manifest', type=str, required=False,
         help='Path to manifest file')
 parser.add_argument(
     '--bigwig-exe', type=str, required=False, default='bedGraphToBigWig',
-    help='Location of the Kent Tools bedGraphToBigWig executable')
+    help='Location of the Kent Tools bedGraphToBigWig executable; unused '
+         'because bigwigs are now encoded natively, but retained for '
+         'compatibility')
+parser.add_argument(
+    '--bigwig-zoom', metavar='INT', type=int, required=False, default=1024,
+    help='Number of bases per summary record in the first bigwig zoom '
+         'level; each subsequent level has 4x as many')
 parser.add_argument('--bigwig-basename', type=str, required=False, default='',
     help='The basename (excluding path) of all bigwig output. Basename is'
          'followed by ".[sample label].bw"; if basename is an empty string, '
@@ -104,6 +111,10 @@ parser.add_argument(
         '--verbose', action='store_const', const=True, default=False,
         help='Print out extra debugging statements'
     )
+parser.add_argument(
+    '--test', action='store_const', const=True, default=False,
+    help='Run unit tests; DOES NOT NEED INPUT FROM STDIN, AND DOES NOT '
+         'WRITE TO STDOUT')
 
 filemover.add_args(parser)
 bowtie.add_args(parser)
@@ -116,19 +127,6 @@ if args.keep_alive:
     keep_alive_thread = KeepAlive(sys.stderr)
     keep_alive_thread.start()
 
-if args.keep_alive:
-    class BedTobigwigThread(threading.Thread):
-        """ Wrapper class for bedtobigwig that permits polling for completion.
-        """
-        def __init__(self, command_list):
-            super(BedTobigwigThread, self).__init__()
-            self.command_list = command_list
-            self.bedtobigwig_process = None
-        def run(self):
-            self.bedtobigwig_process = subprocess.Popen(self.command_list,
-                                            stdout=sys.stderr,
-                                            stderr=sys.stderr).wait()
-
 def percentile(histogram, percentile=0.75):
     """ Given histogram, computes desired percentile.
 
@@ -149,94 +147,51 @@ def percentile(histogram, percentile=0.75):
     raise RuntimeError('Percentile computation should have terminated '
                        'mid-loop.')
 
-import time
-start_time = time.time()
+def write_bigwigs(xpartition, bigwig_file_paths, rname_lengths,
+                    l_string_to_rname, initial_reduction=1024,
+                    temp_dir=None):
+    """ Encodes a sample's coverage runs as bigwigs and tallies histograms.
 
-temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
-# Clean up after script
-register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
-bed_filename = os.path.join(temp_dir_path, 'temp.bed')
-unique_bed_filename = os.path.join(temp_dir_path, 'temp.unique.bed')
-if args.verbose:
-    print >>sys.stderr, 'Writing to temporary beds %s and %s.' % (
-            bed_filename,
-            unique_bed_filename
-        )
-output_filename, output_url = None, None
+        Each bigwig is encoded on its own thread as coverage is read, so
+        the tracks are written concurrently with no intermediate bedGraph.
 
-'''Make RNAME lengths available from reference FASTA so SAM header can be
-formed; reference_index.rname_lengths[RNAME] is the length of RNAME.''' 
-reference_index = bowtie_index.BowtieIndexReference(
-                        os.path.expandvars(args.bowtie_idx)
-                    )
-# For mapping sample indices back to original sample labels
-manifest_object = manifest.LabelsAndIndices(
-                        os.path.expandvars(args.manifest)
-                    )
-# Create file with chromosome sizes for bedTobigwig
-sizes_filename = os.path.join(temp_dir_path, 'chrom.sizes')
-if args.verbose:
-    print >>sys.stderr, 'Sizes file: %s .' % sizes_filename
-with open(sizes_filename, 'w') as sizes_stream:
-    for rname in reference_index.rname_lengths:
-        print >>sizes_stream, '%s %d' % (rname, 
-            reference_index.rname_lengths[rname])
+        xpartition: partition of a sample yielded by xstream; each value
+            is a tuple (RNAME number string, position, coverage, unique
+            coverage)
+        bigwig_file_paths: list of paths to bigwigs to write: one for
+            coverage and one for unique coverage
+        rname_lengths: dictionary mapping RNAMEs to their lengths
+        l_string_to_rname: dictionary mapping RNAME number strings to RNAMEs
+        initial_reduction: number of bases per summary record in the first
+            bigwig zoom level
+        temp_dir: where to store temporary files
 
-input_line_count, output_line_count = 0, 0
-output_url = Url(args.out)
-if output_url.is_local:
-    # Set up destination directory
-    try: os.makedirs(output_url.to_url())
-    except: pass
-mover = filemover.FileMover(args=args)
-track_line = ('track type=bedGraph name="{name}" '
-         'description="{description}" visibility=full '
-         'color=227,29,118 altColor=0,179,220 priority=400')
-for (sample_index,), xpartition in xstream(sys.stdin, 1):
-    real_sample = True
-    try:
-        sample_label = manifest_object.index_to_label[sample_index]
-    except KeyError:
-        # It's a nonref track, a mean, or a median
-        real_sample = False
-        if search('\.[ATCGN]', sample_index):
-            try:
-                sample_label = (
-                        manifest_object.index_to_label[sample_index[:-2]]
-                        + sample_index[-2:]
-                    )
-            except KeyError:
-                raise RuntimeError('Sample label index "%s" was not recorded.'
-                                    % sample_index)
-        elif 'mean' in sample_index or 'median' in sample_index:
-            sample_label = sample_index
-        else:
-            raise RuntimeError('Sample label index "%s" was not recorded.'
-                                % sample_index)
+        Return value: tuple (number of input lines, coverage histogram,
+            unique coverage histogram); each histogram is a dictionary
+            mapping a nonzero coverage to the number of bases with that
+            coverage
+    """
+    input_line_count = 0
     '''Dictionary for which each key is a coverage (i.e., number of ECs
-    covering a given base). Its corresponding value is the number of bases with
-    that coverage.'''
+    covering a given base). Its corresponding value is the number of bases
+    with that coverage. Input is run-length encoded, so each is updated once
+    per run rather than once per base.'''
     coverage_histogram, unique_coverage_histogram = (
             defaultdict(int),
             defaultdict(int)
         )
-    with open(bed_filename, 'w') as bed_stream, \
-        open(unique_bed_filename, 'w') as unique_bed_stream:
-        print >>bed_stream, track_line.format(name=sample_label,
-                                              description=(
-                                                    'base coverage by '
-                                                    'primary alignments'
-                                                ))
-        print >>unique_bed_stream, track_line.format(name=sample_label,
-                                                     description=(
-                                                        'base coverage by '
-                                                        'uniquely mapping '
-                                                        'reads')
-                                                     )
+    with bigwig.BigWigThread(bigwig_file_paths[0], rname_lengths,
+                             initial_reduction=initial_reduction,
+                             temp_dir=temp_dir) as bigwig_writer, \
+        bigwig.BigWigThread(bigwig_file_paths[1], rname_lengths,
+                            initial_reduction=initial_reduction,
+                            temp_dir=temp_dir) as unique_bigwig_writer:
+        add_run, add_unique_run = (bigwig_writer.add,
+                                   unique_bigwig_writer.add)
         for rname, coverages in itertools.groupby(xpartition, 
                                                     key=lambda val: val[0]):
             try:
-                rname = reference_index.l_string_to_rname[rname]
+                rname = l_string_to_rname[rname]
             except KeyError:
                 raise RuntimeError(
                         'RNAME number string "%s" not in Bowtie index.' 
@@ -251,15 +206,14 @@ for (sample_index,), xpartition in xstream(sys.stdin, 1):
                     )
                 input_line_count += 1
                 if coverage != last_coverage:
-                    print >>bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_pos, pos, last_coverage)
+                    add_run(rname, last_pos, pos, last_coverage)
                     if last_coverage != 0:
                         # Only care about nonzero-coverage regions
                         coverage_histogram[last_coverage] += pos - last_pos
                     last_pos, last_coverage = pos, coverage
                 if unique_coverage != last_unique_coverage:
-                    print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (rname,
-                        last_unique_pos, pos, last_unique_coverage)
+                    add_unique_run(rname, last_unique_pos, pos,
+                                   last_unique_coverage)
                     if last_unique_coverage != 0:
                         # Only care about nonzero-coverage regions
                         unique_coverage_histogram[last_unique_coverage] \
@@ -268,74 +222,168 @@ for (sample_index,), xpartition in xstream(sys.stdin, 1):
                             pos,
                             unique_coverage
                         )
-            if last_pos != reference_index.rname_lengths[rname]:
-                # Print coverage up to end of strand
-                print >>bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_pos,
-                        reference_index.rname_lengths[rname],
-                        coverage
-                    )
-            if last_unique_pos != reference_index.rname_lengths[rname]:
-                # Print unique coverage up to end of strand
-                print >>unique_bed_stream, '%s\t%d\t%d\t%08f' % (
-                        rname,
-                        last_unique_pos,
-                        reference_index.rname_lengths[rname],
-                        unique_coverage
-                    )
-    # Output normalization factors iff working with real sample
-    if real_sample:
-        print '3\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d' % (sample_index,
-                                                percentile(coverage_histogram,
-                                                            args.percentile),
-                                                percentile(
-                                                    unique_coverage_histogram,
-                                                    args.percentile))
-    output_line_count += 1
-    # Write bigwigs
-    assert os.path.exists(sizes_filename)
-    bigwig_filenames = [((args.bigwig_basename + '.') 
-                        if args.bigwig_basename != '' else '')
-                        + sample_label]*2
-    bigwig_filenames[0] += '.bw'
-    bigwig_filenames[1] += '.unique.bw'
+            # Add coverage up to end of strand
+            add_run(rname, last_pos, rname_lengths[rname], last_coverage)
+            add_unique_run(rname, last_unique_pos, rname_lengths[rname],
+                           last_unique_coverage)
+    return input_line_count, coverage_histogram, unique_coverage_histogram
+
+if not args.test:
+    import time
+    start_time = time.time()
+
+    temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
+    # Clean up after script
+    register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
+    output_filename, output_url = None, None
+
+    '''Make RNAME lengths available from reference FASTA so SAM header can
+    be formed; reference_index.rname_lengths[RNAME] is the length of
+    RNAME.''' 
+    reference_index = bowtie_index.BowtieIndexReference(
+                            os.path.expandvars(args.bowtie_idx),
+                            with_sequence=False
+                        )
+    # For mapping sample indices back to original sample labels
+    manifest_object = manifest.LabelsAndIndices(
+                            os.path.expandvars(args.manifest)
+                        )
+    input_line_count, output_line_count = 0, 0
+    output_url = Url(args.out)
     if output_url.is_local:
-        # Write directly to local destination
-        bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    else:
-        # Write to temporary directory, and later upload to URL
-        bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
-                                for bigwig_filename in bigwig_filenames]
-    bigwig_commands = [[args.bigwig_exe, bed_filename, sizes_filename,
-                        bigwig_file_paths[0]], 
-                       [args.bigwig_exe, unique_bed_filename, sizes_filename,
-                        bigwig_file_paths[1]]]
-    for i, bigwig_command in enumerate(bigwig_commands):
-        if args.verbose:
-            print >>sys.stderr, 'Writing bigwig with command %s .' \
-                % ' '.join(bigwig_command)
-        bedtobigwig_process = subprocess.Popen(
-                                    bigwig_command,
-                                    stderr=sys.stderr,
-                                    stdout=sys.stderr,
-                                    bufsize=-1
-                                )
-        bedtobigwig_process.wait()
-        if bedtobigwig_process.returncode:
-            raise RuntimeError('bedgraphtobigwig process failed w/ '
-                               'exitlevel %d.'
-                                % bedtobigwig_process.returncode)
+        # Set up destination directory
+        try: os.makedirs(output_url.to_url())
+        except: pass
+    mover = filemover.FileMover(args=args)
+    for (sample_index,), xpartition in xstream(sys.stdin, 1):
+        real_sample = True
+        try:
+            sample_label = manifest_object.index_to_label[sample_index]
+        except KeyError:
+            # It's a nonref track, a mean, or a median
+            real_sample = False
+            if search('\.[ATCGN]', sample_index):
+                try:
+                    sample_label = (
+                            manifest_object.index_to_label[
+                                    sample_index[:-2]
+                                ] + sample_index[-2:]
+                        )
+                except KeyError:
+                    raise RuntimeError(
+                            'Sample label index "%s" was not recorded.'
+                            % sample_index
+                        )
+            elif 'mean' in sample_index or 'median' in sample_index:
+                sample_label = sample_index
+            else:
+                raise RuntimeError('Sample label index "%s" was not '
+                                   'recorded.' % sample_index)
+        # Write bigwigs
+        bigwig_filenames = [((args.bigwig_basename + '.') 
+                            if args.bigwig_basename != '' else '')
+                            + sample_label]*2
+        bigwig_filenames[0] += '.bw'
+        bigwig_filenames[1] += '.unique.bw'
+        if output_url.is_local:
+            # Write directly to local destination
+            bigwig_file_paths = [os.path.join(args.out, bigwig_filename)
+                                    for bigwig_filename in bigwig_filenames]
+        else:
+            # Write to temporary directory, and later upload to URL
+            bigwig_file_paths = [os.path.join(temp_dir_path, bigwig_filename)
+                                    for bigwig_filename in bigwig_filenames]
         if args.verbose:
-            print >>sys.stderr, ('bedTobigwig command %s succeeded .'
-                                  % ' '.join(bigwig_command))
+            print >>sys.stderr, 'Writing bigwigs %s and %s .' % tuple(
+                    bigwig_file_paths
+                )
+        (sample_input_line_count, coverage_histogram,
+            unique_coverage_histogram) = write_bigwigs(
+                    xpartition, bigwig_file_paths,
+                    reference_index.rname_lengths,
+                    reference_index.l_string_to_rname,
+                    initial_reduction=args.bigwig_zoom,
+                    temp_dir=temp_dir_path
+                )
+        input_line_count += sample_input_line_count
+        # Output normalization factors iff working with real sample
+        if real_sample:
+            print '3\t%s\t\x1c\t\x1c\t\x1c\t%d\t%d' % (
+                    sample_index,
+                    percentile(coverage_histogram, args.percentile),
+                    percentile(unique_coverage_histogram, args.percentile)
+                )
+        output_line_count += 1
         if not output_url.is_local:
-            # bigwig must be uploaded to URL and deleted
-            mover.put(bigwig_file_paths[i],
-                        output_url.plus(bigwig_filenames[i]))
-            os.remove(bigwig_file_paths[i])
+            # bigwigs must be uploaded to URL and deleted
+            for bigwig_file_path, bigwig_filename in zip(bigwig_file_paths,
+                                                         bigwig_filenames):
+                mover.put(bigwig_file_path, output_url.plus(bigwig_filename))
+                os.remove(bigwig_file_path)
+
+    print >>sys.stderr, ('DONE with coverage.py; in/out=%d/%d; '
+                         'time=%0.3f s') % (input_line_count,
+                                            output_line_count,
+                                            time.time() - start_time)
+else:
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    import shutil
+    import tempfile
+
+    class TestWriteBigwigs(unittest.TestCase):
+        """ Tests write_bigwigs(). """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.bigwig_file_paths = [
+                    os.path.join(self.temp_dir_path, 'sample.bw'),
+                    os.path.join(self.temp_dir_path, 'sample.unique.bw')
+                ]
+            self.rname_lengths = {'chr1' : 1000, 'chr2' : 500}
+            self.l_string_to_rname = {'000000000000' : 'chr1',
+                                      '000000000001' : 'chr2'}
+
+        def test_round_trip(self):
+            """ Fails if coverage runs aren't read back from bigwigs. """
+            partition = [('000000000000', '11', '2', '1'),
+                         ('000000000000', '21', '5', '1'),
+                         ('000000000000', '31', '0', '0'),
+                         ('000000000001', '1', '3', '3'),
+                         ('000000000001', '101', '0', '0')]
+            input_line_count, histogram, unique_histogram = write_bigwigs(
+                    partition, self.bigwig_file_paths, self.rname_lengths,
+                    self.l_string_to_rname, initial_reduction=16,
+                    temp_dir=self.temp_dir_path
+                )
+            self.assertEqual(input_line_count, 5)
+            self.assertEqual(dict(histogram), {2.0 : 10, 5.0 : 10,
+                                               3.0 : 100})
+            self.assertEqual(dict(unique_histogram), {1.0 : 20, 3.0 : 100})
+            self.assertEqual(percentile(histogram, 0.75), 3)
+            items, chroms, zooms = bigwig.read_bigwig(
+                    self.bigwig_file_paths[0], 'chr1', 0, 1000
+                )
+            self.assertEqual(sorted(chroms), ['chr1', 'chr2'])
+            self.assertEqual([item for item in items if item[2]],
+                             [(10, 20, 2.0), (20, 30, 5.0)])
+            # Runs cover the whole chromosome
+            self.assertEqual((items[0][0], items[-1][1]), (0, 1000))
+            self.assertEqual(zooms[0][0], 16)
+            items, _, _ = bigwig.read_bigwig(
+                    self.bigwig_file_paths[1], 'chr2', 0, 500
+                )
+            self.assertEqual([item for item in items if item[2]],
+                             [(0, 100, 3.0)])
+            items, _, _ = bigwig.read_bigwig(
+                    self.bigwig_file_paths[1], 'chr1', 0, 1000
+                )
+            self.assertEqual([item for item in items if item[2]],
+                             [(10, 30, 1.0)])
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
 
-print >>sys.stderr, 'DONE with coverage.py; in/out=%d/%d; time=%0.3f s' \
-                        % (input_line_count, output_line_count,
-                            time.time() - start_time)
\ No newline at end of file
+    unittest.main()
@@ -27,11 +27,15 @@ Hadoop output (written to stdout)
 ----------------------------
 Coverage (coverage)
 
+Coverage is run-length encoded: a line is written only where a sample's or
+aggregate track's coverages change, and those coverages hold until the next
+line for the same track.
+
 Tab-delimited output tuple columns:
 1. Sample index OR mean[.RNAME] OR median[.RNAME]
 2. Number string representing reference name (RNAME in SAM format; see 
     BowtieIndexReference class in bowtie_index for conversion information)
-3. Position
+3. Position at which run starts
 4. Coverage counting all primary alignments (that is, the number of called ECs
     in the sample overlapping the position) (mean or median of sample coverages
     normalized by --library-size if field 1 specifies)
@@ -70,10 +74,16 @@ site.addsitedir(base_path)
 import bowtie
 import bowtie_index
 import manifest
-from dooplicity.tools import xstream, xopen
+from dooplicity.tools import xstream, xopen, framed_output
 from collections import defaultdict
 from re import search
 
+try:
+    import numpy as _numpy
+except ImportError:
+    # PyPy without NumPy; see dict_coverages()
+    _numpy = None
+
 parser = argparse.ArgumentParser(description=__doc__, 
             formatter_class=argparse.RawDescriptionHelpFormatter)
 parser.add_argument(
@@ -86,15 +96,19 @@ parser.add_argument(
     help=('Library size (in millions of reads) to which every sample\'s '
           'coverage should be normalized when computing average coverage'))
 parser.add_argument(
-        '--read-counts', type=str, required=True,
+        '--read-counts', type=str, required=False, default=None,
         help=('File with read counts by sample output by '
-              'collect_read_stats.py')
+              'collect_read_stats.py; required unless --test is invoked')
     )
 parser.add_argument(
         '--output-ave-bigwig-by-chr', action='store_const', const=True,
         default=False,
         help='Divides bigwigs storing average coverages up by chromosome'
     )
+parser.add_argument('--test', action='store_const', const=True,
+    default=False,
+    help='Run unit tests; DOES NOT NEED INPUT FROM STDIN, AND DOES NOT '
+         'WRITE TO STDOUT')
 bowtie.add_args(parser)
 manifest.add_args(parser)
 args = parser.parse_args()
@@ -116,55 +130,30 @@ def median(a_list):
         return sorted_list[index]
     return (sorted_list[index] + sorted_list[index + 1]) / 2.0
 
-library_size = args.library_size * 1000000
-start_time = time.time()
-input_line_count, output_line_count = 0, 0
-bin_count = 0
-# For converting RNAMEs to number strings
-reference_index = bowtie_index.BowtieIndexReference(
-                        os.path.expandvars(args.bowtie_idx)
-                    )
-manifest_object = manifest.LabelsAndIndices(
-                        os.path.expandvars(args.manifest)
-                    )
-# Grab read counts
-mapped_read_counts, unique_mapped_read_counts = {}, {}
-with xopen(None, args.read_counts) as read_count_stream:
-    read_count_stream.readline()
-    for line in read_count_stream:
-        tokens = line.strip().split('\t')
-        sample_index = manifest_object.label_to_index[tokens[0]]
-        (mapped_read_counts[sample_index],
-            unique_mapped_read_counts[sample_index]) = [
-                                        int(token) for token
-                                        in tokens[-2].split(',')
-                                    ]
-try:
-    mean_weight = 1. / len([_ for _ in mapped_read_counts.values() if _])
-except ZeroDivisionError:
-    mean_weight = 0.0
-try:
-    unique_mean_weight = 1. / len(
-                        [_ for _ in unique_mapped_read_counts.values() if _]
-                    )
-except ZeroDivisionError:
-    unique_mean_weight = 0.0
-
-for (partition_id,), xpartition in xstream(sys.stdin, 1):
-    bin_count += 1
-    bin_start_time, bin_diff_count = time.time(), 0
-    rname = partition_id.rpartition(';')[0]
-    maybe_rname = (('.' + rname)
-                            if args.output_ave_bigwig_by_chr else '')
-    rname_index = reference_index.l_rname_to_string[rname]
+def dict_coverages(xpartition, rname_index, maybe_rname):
+    """ Computes coverages of a partition, keeping running sums in dicts.
+
+        Used when NumPy is unavailable, as under PyPy.
+
+        xpartition: partition yielded by xstream
+        rname_index: number string representing RNAME
+        maybe_rname: '.' + RNAME if average bigwigs are divided up by
+            chromosome, else ''
+
+        Return value: tuple (number of positions, number of output lines,
+            number of diffs)
+    """
+    position_count, output_line_count, diff_count = 0, 0, 0
     coverages, unique_coverages = defaultdict(int), defaultdict(int)
+    # Last (coverage, unique coverage) output for each track
+    last_values = {}
     nonref_coverages, unique_nonref_coverages = (
             defaultdict(int), defaultdict(int)
         )
     for (pos, sample_indexes_and_diffs) in itertools.groupby(
                                             xpartition, lambda val: val[0]
                                         ):
-        input_line_count += 1
+        position_count += 1
         pos = int(pos)
         for sample_index, diffs in itertools.groupby(
                                 sample_indexes_and_diffs, lambda val: val[1]
@@ -180,72 +169,599 @@ for (partition_id,), xpartition in xstream(sys.stdin, 1):
                     nonref_coverages[real_sample_index] += diff
                     if uniqueness == '1':
                         unique_nonref_coverages[real_sample_index] += diff
-                bin_diff_count += 1
-            print 'coverage\t%s\t%s\t%012d\t%d\t%d' % (
-                        sample_index, 
-                        rname_index, pos, coverages[sample_index],
-                        unique_coverages[sample_index]
-                    )
-            output_line_count += 1
+                diff_count += 1
+            values = (coverages[sample_index],
+                        unique_coverages[sample_index])
+            if last_values.get(sample_index) != values:
+                # Coverage changed, so start a new run
+                last_values[sample_index] = values
+                print 'coverage\t%s\t%s\t%012d\t%d\t%d' % (
+                            (sample_index, rname_index, pos) + values
+                        )
+                output_line_count += 1
         # Now output measures of center
         coverage_row = [float(coverages[sample_index])
                          / mapped_read_counts[sample_index]
                          * library_size
-                        for sample_index in manifest_object.index_to_label
+                        for sample_index in sample_indexes
                         if mapped_read_counts[sample_index]]
         unique_coverage_row = [float(unique_coverages[sample_index])
                                 / unique_mapped_read_counts[sample_index]
                                 * library_size
-                               for sample_index
-                               in manifest_object.index_to_label
+                               for sample_index in sample_indexes
                                if unique_mapped_read_counts[sample_index]]
         nonref_coverage_row = [float(nonref_coverages[sample_index])
                                 / mapped_read_counts[sample_index]
                                 * library_size
-                                for sample_index
-                                in manifest_object.index_to_label
+                                for sample_index in sample_indexes
                                 if mapped_read_counts[sample_index]]
         unique_nonref_coverage_row = [
                     float(unique_nonref_coverages[sample_index])
                         / unique_mapped_read_counts[sample_index]
                         * library_size
-                        for sample_index in manifest_object.index_to_label
+                        for sample_index in sample_indexes
                         if unique_mapped_read_counts[sample_index]
                 ]
-        print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
-                'mean' + maybe_rname, 
-                rname_index, pos,
-                sum([cov * mean_weight for cov in coverage_row]),
-                sum([cov * unique_mean_weight for cov in unique_coverage_row])
+        for track, values in (
+                    ('mean', (
+                        sum([cov * mean_weight for cov in coverage_row]),
+                        sum([cov * unique_mean_weight
+                                for cov in unique_coverage_row])
+                    )),
+                    ('median', (
+                        median(coverage_row),
+                        median(unique_coverage_row)
+                    )),
+                    ('mean.nonref', (
+                        sum([cov * mean_weight
+                                for cov in nonref_coverage_row]),
+                        sum([cov * unique_mean_weight for cov
+                                in unique_nonref_coverage_row])
+                    )),
+                    ('median.nonref', (
+                        median(nonref_coverage_row),
+                        median(unique_nonref_coverage_row)
+                    ))
+                ):
+            if last_values.get(track) != values:
+                last_values[track] = values
+                print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
+                        (track + maybe_rname, rname_index, pos) + values
+                    )
+                output_line_count += 1
+    return position_count, output_line_count, diff_count
+
+def centers(sample_coverages, read_counts, weight):
+    """ Computes mean and median normalized coverages at positions.
+
+        sample_coverages: samples x positions NumPy array of coverages,
+            with samples in the order of sample_indexes
+        read_counts: NumPy array of samples' read counts; samples with no
+            reads are excluded
+        weight: weight of each sample's normalized coverage in mean
+
+        Return value: tuple (NumPy array of means, NumPy array of medians)
+    """
+    included = read_counts > 0
+    if not included.any():
+        zeros = _numpy.zeros(sample_coverages.shape[1])
+        return zeros, zeros
+    normalized = (sample_coverages[included]
+                    / read_counts[included][:, None].astype(float)
+                    * library_size)
+    return (normalized * weight).sum(axis=0), _numpy.median(normalized,
+                                                            axis=0)
+
+def array_coverages(xpartition, rname_index, maybe_rname,
+                        max_cells=(1 << 22)):
+    """ Computes coverages of a partition with NumPy arrays.
+
+        Diffs are gathered into rows x positions arrays, where rows are the
+        sample indexes seen so far, and summed cumulatively along positions,
+        starting from the coverages at the end of the previous chunk of
+        positions. Coverages of rows are then gathered into samples x
+        positions arrays, from which means and medians across samples are
+        computed over whole chunks. A chunk is ended once it has
+        max_cells / max(number of rows, number of samples) positions, so
+        no array holds more than max_cells elements by more than one
+        position's worth. Output is the same as dict_coverages()'s.
+
+        xpartition: partition yielded by xstream
+        rname_index: number string representing RNAME
+        maybe_rname: '.' + RNAME if average bigwigs are divided up by
+            chromosome, else ''
+        max_cells: maximum number of elements in an array of coverages,
+            give or take a position
+
+        Return value: tuple (number of positions, number of output lines,
+            number of diffs)
+    """
+    position_count, output_line_count, diff_count = 0, 0, 0
+    '''Rows of arrays are sample indexes as they appear in input, including
+    nonreference sample indexes like 5.A. For each row, the index in
+    sample_indexes of the sample it counts toward is stored, or -1 if it
+    doesn't count toward one.'''
+    rows, row_samples, row_nonref_samples = {}, [], []
+    carry, unique_carry = (_numpy.zeros(0, dtype=_numpy.int64),
+                            _numpy.zeros(0, dtype=_numpy.int64))
+    sample_count = len(sample_indexes)
+    # Per-chunk positions, diffs, and (column, row) of each output line
+    positions, diff_columns, diff_rows, diff_values, diff_uniquenesses = (
+            [], [], [], [], []
+        )
+    line_columns, line_rows = [], []
+    '''Last (coverage, unique coverage) output for each row and aggregate
+    track'''
+    last_values = {}
+    for pos, sample_indexes_and_diffs in itertools.chain(
+                itertools.groupby(xpartition, lambda val: val[0]),
+                [(None, None)]
+            ):
+        if pos is not None:
+            column = len(positions)
+            positions.append(int(pos))
+            for sample_index, diffs in itertools.groupby(
+                                sample_indexes_and_diffs, lambda val: val[1]
+                            ):
+                try:
+                    row = rows[sample_index]
+                except KeyError:
+                    row = rows[sample_index] = len(row_samples)
+                    row_samples.append(
+                            sample_positions.get(sample_index, -1)
+                        )
+                    if search('\.[ATCG]', sample_index):
+                        # All non-N nonreference bases go here
+                        row_nonref_samples.append(
+                                sample_positions.get(sample_index[:-2], -1)
+                            )
+                    else:
+                        row_nonref_samples.append(-1)
+                for _, _, uniqueness, diff in diffs:
+                    diff_columns.append(column)
+                    diff_rows.append(row)
+                    diff_values.append(int(diff))
+                    diff_uniquenesses.append(uniqueness == '1')
+                line_columns.append(column)
+                line_rows.append(row)
+            if (len(positions) * max(len(row_samples), sample_count)
+                    < max_cells):
+                continue
+        if not positions:
+            break
+        # Apply chunk's diffs
+        shape = (len(row_samples), len(positions))
+        carry = _numpy.concatenate((carry, _numpy.zeros(
+                            shape[0] - carry.shape[0], dtype=_numpy.int64
+                        )))
+        unique_carry = _numpy.concatenate((unique_carry, _numpy.zeros(
+                            shape[0] - unique_carry.shape[0],
+                            dtype=_numpy.int64
+                        )))
+        diff_columns, diff_rows, diff_values, diff_uniquenesses = (
+                _numpy.array(diff_columns, dtype=_numpy.intp),
+                _numpy.array(diff_rows, dtype=_numpy.intp),
+                _numpy.array(diff_values, dtype=_numpy.int64),
+                _numpy.array(diff_uniquenesses, dtype=bool)
+            )
+        diff_count += len(diff_values)
+        coverages = _numpy.zeros(shape, dtype=_numpy.int64)
+        _numpy.add.at(coverages, (diff_rows, diff_columns), diff_values)
+        unique_coverages = _numpy.zeros(shape, dtype=_numpy.int64)
+        _numpy.add.at(unique_coverages,
+                      (diff_rows[diff_uniquenesses],
+                        diff_columns[diff_uniquenesses]),
+                      diff_values[diff_uniquenesses])
+        _numpy.cumsum(coverages, axis=1, out=coverages)
+        _numpy.cumsum(unique_coverages, axis=1, out=unique_coverages)
+        coverages += carry[:, None]
+        unique_coverages += unique_carry[:, None]
+        carry, unique_carry = (coverages[:, -1].copy(),
+                                unique_coverages[:, -1].copy())
+        # Gather coverages of samples and nonreference coverages
+        samples, nonref_samples = (
+                _numpy.array(row_samples, dtype=_numpy.intp),
+                _numpy.array(row_nonref_samples, dtype=_numpy.intp)
             )
-        print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
-                'median' + maybe_rname, 
-                rname_index, pos,
-                median(coverage_row),
-                median(unique_coverage_row)
+        summaries = []
+        for row_coverages in (coverages, unique_coverages):
+            sample_coverages = _numpy.zeros((sample_count, shape[1]),
+                                            dtype=_numpy.int64)
+            sample_coverages[samples[samples >= 0]] \
+                = row_coverages[samples >= 0]
+            nonref_coverages = _numpy.zeros((sample_count, shape[1]),
+                                            dtype=_numpy.int64)
+            _numpy.add.at(nonref_coverages,
+                          nonref_samples[nonref_samples >= 0],
+                          row_coverages[nonref_samples >= 0])
+            summaries.append((sample_coverages, nonref_coverages))
+        means, medians = centers(summaries[0][0], mapped_read_count_array,
+                                 mean_weight)
+        unique_means, unique_medians = centers(
+                summaries[1][0], unique_mapped_read_count_array,
+                unique_mean_weight
             )
-        print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
-                'mean.nonref' + maybe_rname, 
-                rname_index, pos,
-                sum([cov * mean_weight for cov in nonref_coverage_row]),
-                sum([cov * unique_mean_weight for cov
-                        in unique_nonref_coverage_row])
+        nonref_means, nonref_medians = centers(
+                summaries[0][1], mapped_read_count_array, mean_weight
+            )
+        unique_nonref_means, unique_nonref_medians = centers(
+                summaries[1][1], unique_mapped_read_count_array,
+                unique_mean_weight
+            )
+        '''Find positions where each aggregate track changes; runs of equal
+        values are output only where they start.'''
+        track_runs = []
+        for track, values, unique_values in (
+                    ('mean', means, unique_means),
+                    ('median', medians, unique_medians),
+                    ('mean.nonref', nonref_means, unique_nonref_means),
+                    ('median.nonref', nonref_medians, unique_nonref_medians)
+                ):
+            changes = _numpy.empty(len(positions), dtype=bool)
+            changes[0] = last_values.get(track) != (values[0],
+                                                    unique_values[0])
+            changes[1:] = ((values[1:] != values[:-1])
+                            | (unique_values[1:] != unique_values[:-1]))
+            last_values[track] = (values[-1], unique_values[-1])
+            track_runs.append((track + maybe_rname, changes.tolist(),
+                               values.tolist(), unique_values.tolist()))
+        line_coverages = coverages[line_rows, line_columns].tolist()
+        line_unique_coverages = unique_coverages[
+                                        line_rows, line_columns
+                                    ].tolist()
+        row_sample_indexes = [None] * len(rows)
+        for sample_index, row in rows.iteritems():
+            row_sample_indexes[row] = sample_index
+        line = 0
+        for column, pos in enumerate(positions):
+            while line < len(line_rows) and line_columns[line] == column:
+                values = (line_coverages[line], line_unique_coverages[line])
+                row = line_rows[line]
+                if last_values.get(row) != values:
+                    # Coverage changed, so start a new run
+                    last_values[row] = values
+                    print 'coverage\t%s\t%s\t%012d\t%d\t%d' % (
+                            (row_sample_indexes[row], rname_index, pos)
+                            + values
+                        )
+                    output_line_count += 1
+                line += 1
+            for track, changes, values, unique_values in track_runs:
+                if changes[column]:
+                    print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
+                            track, rname_index, pos,
+                            values[column], unique_values[column]
+                        )
+                    output_line_count += 1
+        position_count += len(positions)
+        positions, diff_columns, diff_rows, diff_values, diff_uniquenesses = (
+                [], [], [], [], []
+            )
+        line_columns, line_rows = [], []
+    return position_count, output_line_count, diff_count
+
+def set_read_counts(mapped_counts, unique_mapped_counts, indexes):
+    """ Sets globals giving samples' read counts and weights in means.
+
+        mapped_counts: dictionary mapping each sample index to its number of
+            mapped reads
+        unique_mapped_counts: dictionary mapping each sample index to its
+            number of uniquely mapped reads
+        indexes: list of sample indexes in manifest
+
+        No return value.
+    """
+    global mapped_read_counts, unique_mapped_read_counts, mean_weight, \
+        unique_mean_weight, sample_indexes, sample_positions, \
+        mapped_read_count_array, unique_mapped_read_count_array
+    mapped_read_counts, unique_mapped_read_counts = (mapped_counts,
+                                                        unique_mapped_counts)
+    try:
+        mean_weight = 1. / len([_ for _ in mapped_read_counts.values() if _])
+    except ZeroDivisionError:
+        mean_weight = 0.0
+    try:
+        unique_mean_weight = 1. / len(
+                        [_ for _ in unique_mapped_read_counts.values() if _]
+                    )
+    except ZeroDivisionError:
+        unique_mean_weight = 0.0
+    sample_indexes = list(indexes)
+    # For finding a sample index's row in arrays of sample coverages
+    sample_positions = dict((sample_index, i) for i, sample_index
+                                in enumerate(sample_indexes))
+    if _numpy is not None:
+        mapped_read_count_array = _numpy.array(
+                [mapped_read_counts[sample_index]
+                    for sample_index in sample_indexes], dtype=_numpy.int64
             )
-        print 'coverage\t%s\t%s\t%012d\t%08f\t%08f' % (
-                'median.nonref' + maybe_rname, 
-                rname_index, pos,
-                median(nonref_coverage_row),
-                median(unique_nonref_coverage_row)
+        unique_mapped_read_count_array = _numpy.array(
+                [unique_mapped_read_counts[sample_index]
+                    for sample_index in sample_indexes], dtype=_numpy.int64
             )
 
+partition_coverages = (array_coverages if _numpy is not None
+                        else dict_coverages)
+library_size = args.library_size * 1000000
+
+if __name__ == '__main__' and not args.test:
+    if args.read_counts is None:
+        parser.error('argument --read-counts is required')
+    start_time = time.time()
+    input_line_count, output_line_count = 0, 0
+    bin_count = 0
+    # For converting RNAMEs to number strings
+    reference_index = bowtie_index.BowtieIndexReference(
+                            os.path.expandvars(args.bowtie_idx),
+                            with_sequence=False
+                        )
+    manifest_object = manifest.LabelsAndIndices(
+                            os.path.expandvars(args.manifest)
+                        )
+    # Grab read counts
+    mapped_read_counts, unique_mapped_read_counts = {}, {}
+    with xopen(None, args.read_counts) as read_count_stream:
+        read_count_stream.readline()
+        for line in read_count_stream:
+            tokens = line.strip().split('\t')
+            sample_index = manifest_object.label_to_index[tokens[0]]
+            (mapped_read_counts[sample_index],
+                unique_mapped_read_counts[sample_index]) = [
+                                            int(token) for token
+                                            in tokens[-2].split(',')
+                                        ]
+    set_read_counts(mapped_read_counts, unique_mapped_read_counts,
+                        manifest_object.index_to_label)
+
+    # Coverage functions print to stdout
+    stdout, sys.stdout = sys.stdout, framed_output(sys.stdout)
+    for (partition_id,), xpartition in xstream(sys.stdin, 1):
+        bin_count += 1
+        bin_start_time = time.time()
+        rname = partition_id.rpartition(';')[0]
+        maybe_rname = (('.' + rname)
+                                if args.output_ave_bigwig_by_chr else '')
+        rname_index = reference_index.l_rname_to_string[rname]
+        (position_count, partition_output_line_count,
+            bin_diff_count) = partition_coverages(xpartition, rname_index,
+                                                  maybe_rname)
+        input_line_count += position_count
+        output_line_count += partition_output_line_count
+
+        if args.partition_stats:
+            print 'partition_stats\t%d\t%s' % (bin_diff_count, 
+                                                time.time() - bin_start_time)
+
+    end_time = time.time()
     if args.partition_stats:
-        print 'partition_stats\t%d\t%s' % (bin_diff_count, 
-                                            time.time() - bin_start_time)
+        print 'reducer_stats\t%d\t%d\t%d\t%d' % (bin_count, input_line_count,
+            output_line_count, end_time - start_time)
+    sys.stdout.flush()
+    sys.stdout = stdout
+
+    print >>sys.stderr, ('DONE with coverage_pre.py; in/out = %d/%d; '
+                         'time=%0.3f s') % (input_line_count,
+                                            output_line_count,
+                                            end_time - start_time)
+elif __name__ == '__main__':
+    # Test units
+    import unittest
+    import random
+    from cStringIO import StringIO
+
+    def random_partition(position_count, sample_count, seed=0):
+        """ Generates a sorted partition of random exon_diffs.
+
+            Nonreference sample indexes like 1.A and sample indexes
+            that aren't in the manifest are included.
+
+            position_count: number of positions to sample from
+            sample_count: number of samples
+            seed: random seed
+
+            Return value: list of tuples (position, sample index,
+                uniqueness, diff)
+        """
+        random.seed(seed)
+        sample_choices = ([str(i) for i in xrange(sample_count)]
+                            + ['%d.%s' % (i, base)
+                                for i in xrange(sample_count)
+                                for base in 'ACN']
+                            + [str(sample_count)])
+        diffs = []
+        for pos in random.sample(xrange(1, 10 * position_count),
+                                    position_count):
+            for sample_index in random.sample(sample_choices, 3):
+                start = '%012d' % pos
+                end = '%012d' % (pos + random.randint(1, 20))
+                uniqueness = random.choice('01')
+                count = random.randint(1, 3)
+                diffs.append((start, sample_index, uniqueness,
+                                '+%d' % count))
+                diffs.append((end, sample_index, uniqueness,
+                                '-%d' % count))
+        diffs.sort(key=lambda diff: (diff[0], diff[1]))
+        return diffs
+
+    def captured_coverages(partition_function, partition, **kwargs):
+        """ Runs a function computing coverages, capturing stdout.
+
+            partition_function: dict_coverages or array_coverages
+            partition: list of tuples (position, sample index, uniqueness,
+                diff)
+            kwargs: other keyword arguments of partition_function
+
+            Return value: tuple (output, tuple returned by
+                partition_function)
+        """
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            counts = partition_function(iter(partition), '000000000000',
+                                        '.chr1', **kwargs)
+            return sys.stdout.getvalue(), counts
+        finally:
+            sys.stdout = stdout
+
+    def uncollapsed_coverages(partition):
+        """ Computes coverages without run-length encoding them.
+
+            Gives a line for every sample index with diffs at a position
+            and for every aggregate track at every position, as
+            coverage_pre did before its output was run-length encoded.
+
+            partition: list of tuples (position, sample index, uniqueness,
+                diff)
+
+            Return value: list of output lines
+        """
+        coverages, unique_coverages = defaultdict(int), defaultdict(int)
+        nonref_coverages, unique_nonref_coverages = (
+                defaultdict(int), defaultdict(int)
+            )
+        lines = []
+        for pos, diffs in itertools.groupby(partition, lambda val: val[0]):
+            for sample_index, sample_diffs in itertools.groupby(
+                                                diffs, lambda val: val[1]
+                                            ):
+                for _, _, uniqueness, diff in sample_diffs:
+                    for sums, nonref_sums, include in (
+                            (coverages, nonref_coverages, True),
+                            (unique_coverages, unique_nonref_coverages,
+                                uniqueness == '1')
+                        ):
+                        if not include: continue
+                        sums[sample_index] += int(diff)
+                        if sample_index[-2:-1] == '.' \
+                            and sample_index[-1] != 'N':
+                            nonref_sums[sample_index[:-2]] += int(diff)
+                lines.append('coverage\t%s\t000000000000\t%012d\t%d\t%d' % (
+                        sample_index, int(pos), coverages[sample_index],
+                        unique_coverages[sample_index]
+                    ))
+            rows = []
+            for sums, read_counts in (
+                    (coverages, mapped_read_counts),
+                    (unique_coverages, unique_mapped_read_counts),
+                    (nonref_coverages, mapped_read_counts),
+                    (unique_nonref_coverages, unique_mapped_read_counts)
+                ):
+                rows.append([float(sums[sample_index])
+                                / read_counts[sample_index] * library_size
+                                for sample_index in sample_indexes
+                                if read_counts[sample_index]])
+            for track, values in (
+                    ('mean', (sum([cov * mean_weight for cov in rows[0]]),
+                              sum([cov * unique_mean_weight
+                                    for cov in rows[1]]))),
+                    ('median', (median(rows[0]), median(rows[1]))),
+                    ('mean.nonref', (
+                            sum([cov * mean_weight for cov in rows[2]]),
+                            sum([cov * unique_mean_weight
+                                    for cov in rows[3]])
+                        )),
+                    ('median.nonref', (median(rows[2]), median(rows[3])))
+                ):
+                lines.append(
+                        'coverage\t%s\t000000000000\t%012d\t%08f\t%08f'
+                        % ((track + '.chr1', int(pos)) + values)
+                    )
+        return lines
+
+    class TestPartitionCoverages(unittest.TestCase):
+        """ Tests that NumPy and dict paths give the same coverages. """
+        def setUp(self):
+            set_read_counts({'0' : 1000, '1' : 2000, '2' : 0, '3' : 500},
+                            {'0' : 800, '1' : 0, '2' : 0, '3' : 400},
+                            ['0', '1', '2', '3'])
+            self.partition = random_partition(300, 4)
+
+        def coverages(self, partition_function, **kwargs):
+            """ Runs captured_coverages() on self.partition. """
+            return captured_coverages(partition_function, self.partition,
+                                        **kwargs)
+
+        @unittest.skipIf(_numpy is None, 'NumPy is not installed')
+        def test_paths_agree(self):
+            """ Fails if outputs or line counts of paths differ. """
+            output, counts = self.coverages(dict_coverages)
+            self.assertEquals(len(output.strip().split('\n')), counts[1])
+            self.assertTrue('\tmedian.nonref.chr1\t' in output)
+            for max_cells in [1 << 22, 200, 1]:
+                self.assertEquals(
+                        self.coverages(array_coverages,
+                                        max_cells=max_cells),
+                        (output, counts)
+                    )
+
+    class TestRunLengthEncoding(unittest.TestCase):
+        """ Tests run-length encoded output against uncollapsed output. """
+        def setUp(self):
+            set_read_counts({'0' : 1000, '1' : 2000, '2' : 500},
+                            {'0' : 800, '1' : 0, '2' : 400},
+                            ['0', '1', '2'])
+            # Abutting intervals of a sample leave its coverage unchanged
+            intervals = [('0', 10, 20), ('0', 20, 30), ('0', 30, 45),
+                         ('1', 15, 30), ('2', 15, 30), ('1', 30, 45),
+                         ('1.A', 12, 20), ('1.A', 20, 40), ('2.N', 5, 50),
+                         ('0', 50, 60), ('1', 50, 60), ('2', 50, 60)]
+            random.seed(1)
+            for _ in xrange(200):
+                start = random.randint(1, 500)
+                for sample_index in random.sample(['0', '1', '2', '0.C'],
+                                                    2):
+                    intervals.append(
+                            (sample_index, start,
+                                start + random.choice([5, 10]))
+                        )
+            self.partition = []
+            for sample_index, start, end in intervals:
+                uniqueness = '1' if start % 3 else '0'
+                self.partition.extend([
+                        ('%012d' % start, sample_index, uniqueness, '+1'),
+                        ('%012d' % end, sample_index, uniqueness, '-1')
+                    ])
+            self.partition.sort(key=lambda diff: (diff[0], diff[1]))
+            self.uncollapsed = uncollapsed_coverages(self.partition)
+
+        def assert_expands_to_uncollapsed(self, output):
+            """ Fails if runs in output don't give uncollapsed coverages.
+
+                output: output of dict_coverages() or array_coverages()
+            """
+            lines = output.strip().split('\n')
+            self.assertTrue(len(lines) < len(self.uncollapsed))
+            # Every run starts at a line of uncollapsed output
+            self.assertTrue(set(lines) <= set(self.uncollapsed))
+            runs = {}
+            for line in lines:
+                tokens = line.split('\t')
+                runs.setdefault(tokens[1], []).append(
+                        (int(tokens[3]), tokens[4:])
+                    )
+            for line in self.uncollapsed:
+                tokens = line.split('\t')
+                pos = int(tokens[3])
+                # Find run covering position
+                covering = [values for start, values in runs[tokens[1]]
+                                if start <= pos]
+                self.assertEquals(covering[-1], tokens[4:])
+
+        def test_dict_coverages(self):
+            """ Fails if dict path's runs are wrong. """
+            output, counts = captured_coverages(dict_coverages,
+                                                self.partition)
+            self.assert_expands_to_uncollapsed(output)
+            self.assertEquals(counts[1], len(output.strip().split('\n')))
 
-end_time = time.time()
-if args.partition_stats:
-    print 'reducer_stats\t%d\t%d\t%d\t%d' % (bin_count, input_line_count,
-        output_line_count, end_time - start_time)
+        @unittest.skipIf(_numpy is None, 'NumPy is not installed')
+        def test_array_coverages(self):
+            """ Fails if NumPy path's runs are wrong. """
+            for max_cells in [1 << 22, 30]:
+                output, counts = captured_coverages(array_coverages,
+                                                    self.partition,
+                                                    max_cells=max_cells)
+                self.assert_expands_to_uncollapsed(output)
+                self.assertEquals(counts[1],
+                                    len(output.strip().split('\n')))
 
-print >>sys.stderr, "DONE with coverage_pre.py; in/out = %d/%d; time=%0.3f s" \
-    % (input_line_count, output_line_count, start_time - end_time)
+    unittest.main(argv=[sys.argv[0]])
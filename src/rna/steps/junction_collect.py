@@ -53,7 +53,8 @@ site.addsitedir(base_path)
 
 import manifest
 from dooplicity.ansibles import Url
-from dooplicity.tools import register_cleanup, make_temp_dir, xopen
+from dooplicity.tools import register_cleanup, make_temp_dir, xopen, \
+    coordinate_index_key, xlines
 import filemover
 import tempdel
 
@@ -72,6 +73,15 @@ parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
         help=('Level of gzip compression to use for temporary file storing '
               'qnames.'))
+parser.add_argument('--bgzf-threads', type=int, required=False,
+        default=0,
+        help=('Write output as BGZF, a gzip-compatible format, compressing '
+              'blocks with this many threads; 0 writes gzip output with a '
+              'single gzip process'))
+parser.add_argument('--bgzf-index', action='store_const', const=True,
+        default=False,
+        help=('Write a coordinate index next to each BGZF output file with '
+              'extension .idx; ignored unless --bgzf-threads > 0'))
 parser.add_argument(\
     '--verbose', action='store_const', const=True, default=False,
     help='Print out extra debugging statements')
@@ -100,8 +110,15 @@ if args.out is not None:
                             [temp_dir_path])
         output_filename = args.junction_filename + '.temp'
         output_filename = os.path.join(temp_dir_path, output_filename)
-    with xopen(True, output_filename, 'w', args.gzip_level) as output_stream:
-        for line in sys.stdin:
+    if args.bgzf_threads:
+        output_opener = xopen('bgzf', output_filename, 'w', args.gzip_level,
+                                args.bgzf_threads,
+                                coordinate_index_key if args.bgzf_index
+                                else None)
+    else:
+        output_opener = xopen(True, output_filename, 'w', args.gzip_level)
+    with output_opener as output_stream:
+        for line in xlines(sys.stdin):
             tokens = line.strip().split('\t')
             # Remove leading zeros from ints
             print >>output_stream, '\t'.join(
@@ -111,7 +128,7 @@ if args.out is not None:
             input_line_count += 1
 else:
     # Default --out is stdout
-    for line in sys.stdin:
+    for line in xlines(sys.stdin):
         tokens = line.strip().split('\t')
         # Remove leading zeros from ints
         print '\t'.join([tokens[0], str(int(tokens[1])),
@@ -122,6 +139,9 @@ else:
 if args.out is not None and not output_url.is_local:
     mover = filemover.FileMover(args=args)
     mover.put(output_filename, output_url.plus(args.junction_filename))
+    if args.bgzf_threads and args.bgzf_index:
+        mover.put(output_filename + '.idx',
+                    output_url.plus(args.junction_filename + '.idx'))
 
 print >>sys.stderr, 'DONE with junction_collect.py; in = %d; time=%0.3f s' \
                         % (input_line_count, time.time() - start_time)
\ No newline at end of file
@@ -56,7 +56,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 _input_line_count, _output_line_count = 0, 0
 
 def edges_from_input_stream(input_stream, readlet_size=20,
@@ -621,13 +621,15 @@ if __name__ == '__main__':
 
 if __name__ == '__main__' and not args.test:
     start_time = time.time()
-    go(input_stream=sys.stdin, output_stream=sys.stdout,
+    output_stream = framed_output(sys.stdout)
+    go(input_stream=sys.stdin, output_stream=output_stream,
         min_overlap_exon_size=args.min_overlap_exon_size,
         edge_span=args.edge_span,
         min_edge_span_size=args.min_edge_span_size,
         readlet_size=args.readlet_size,
         verbose=args.verbose,
         fudge=args.fudge)
+    output_stream.close()
     print >>sys.stderr, 'DONE with junction_config.py; in/out=%d/%d; ' \
                         'time=%0.3f s' % (_input_line_count, 
                                             _output_line_count,
@@ -94,7 +94,8 @@ input_line_count, output_line_count = 0, 0
 start_time = time.time()
 
 reference_index = bowtie_index.BowtieIndexReference(
-                        os.path.expandvars(args.bowtie_idx)
+                        os.path.expandvars(args.bowtie_idx),
+                        with_sequence=False
                     )
 for (_, rname_string, intron_pos, intron_end_pos,
         sense, sample_index), xpartition in xstream(sys.stdin, 6):
@@ -61,7 +61,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 import manifest
 
 def go(manifest_object, input_stream=sys.stdin, output_stream=sys.stdout,
@@ -211,15 +211,17 @@ if __name__ == '__main__' and not args.test:
     manifest_object = manifest.LabelsAndIndices(
                                     os.path.expandvars(args.manifest)
                                 )
+    output_stream = framed_output(sys.stdout)
     input_line_count, output_line_count = go(
             manifest_object=manifest_object,
             input_stream=sys.stdin,
-            output_stream=sys.stdout,
+            output_stream=output_stream,
             sample_fraction=args.sample_fraction,
             coverage_threshold=args.coverage_threshold,
             collect_junctions=args.collect_junctions,
             verbose=args.verbose
         )
+    output_stream.close()
     print >>sys.stderr, 'DONE with junction_filter.py; in/out=%d/%d; ' \
         'time=%0.3f s' % (input_line_count, output_line_count,
                             time.time() - start_time)
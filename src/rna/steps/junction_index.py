@@ -40,7 +40,6 @@ A given reference name in the index is in the following format:
 import os
 import sys
 import site
-import subprocess
 import argparse
 import tarfile
 import threading
@@ -56,9 +55,10 @@ site.addsitedir(base_path)
 
 import bowtie
 from dooplicity.ansibles import Url
-from dooplicity.tools import register_cleanup, make_temp_dir
+from dooplicity.tools import register_cleanup, make_temp_dir, xlines
 import filemover
 import tempdel
+import index_cache
 
 # Print file's docstring if -h is invoked
 parser = argparse.ArgumentParser(description=__doc__, 
@@ -80,6 +80,7 @@ parser.add_argument(\
 filemover.add_args(parser)
 bowtie.add_args(parser)
 tempdel.add_args(parser)
+index_cache.add_args(parser)
 args = parser.parse_args()
 
 import time
@@ -102,7 +103,7 @@ fasta_file = os.path.join(temp_dir_path, 'temp.fa')
 print >>sys.stderr, 'Opened %s for writing....' % fasta_file
 with open(fasta_file, 'w') as fasta_stream:
     input_line_count = 0
-    for line in sys.stdin:
+    for line in xlines(sys.stdin):
         if args.keep_alive and not (input_line_count % 1000):
             print >>sys.stderr, 'reporter:status:alive'
         tokens = line.rstrip().split('\t')
@@ -130,23 +131,29 @@ with open(fasta_file, 'w') as fasta_stream:
         print >>sys.stderr, ('Wrote bum index because no transcripts were '
                              'passed.')
 
-# Build index
+# Build index, or take it from the cache if the same FASTA was indexed before
 print >>sys.stderr, 'Running bowtie2-build....'
-
+bowtie2_index_cache = index_cache.cache_from_args(
+        args, salt=args.bowtie2_build_exe
+    )
 if args.keep_alive:
     class BowtieBuildThread(threading.Thread):
         """ Wrapper class for bowtie-build that permits polling for completion.
         """
-        def __init__(self, command_list):
+        def __init__(self, fasta_file, index_basename):
             super(BowtieBuildThread, self).__init__()
-            self.command_list = command_list
+            self.fasta_file = fasta_file
+            self.index_basename = index_basename
             self.bowtie_build_process = None
         def run(self):
-            self.bowtie_build_process = subprocess.Popen(self.command_list,
-                                            stdout=sys.stderr).wait()
-    bowtie_build_thread = BowtieBuildThread([args.bowtie2_build_exe,
-                                                fasta_file,
-                                                index_basename])
+            self.bowtie_build_process = index_cache.build(
+                                            args.bowtie2_build_exe,
+                                            self.fasta_file,
+                                            self.index_basename,
+                                            cache=bowtie2_index_cache,
+                                            output_stream=sys.stderr
+                                        )
+    bowtie_build_thread = BowtieBuildThread(fasta_file, index_basename)
     bowtie_build_thread.start()
     while bowtie_build_thread.is_alive():
         print >>sys.stderr, 'reporter:status:alive'
@@ -156,17 +163,16 @@ if args.keep_alive:
         raise RuntimeError('Bowtie index construction failed w/ exitlevel %d.'
                                 % bowtie_build_thread.bowtie_build_process)
 else:
-    bowtie_build_process = subprocess.Popen(
-                                [args.bowtie2_build_exe,
+    bowtie_build_return_code = index_cache.build(
+                                    args.bowtie2_build_exe,
                                     fasta_file,
-                                    index_basename],
-                                stderr=sys.stderr,
-                                stdout=sys.stderr
-                            )
-    bowtie_build_process.wait()
-    if bowtie_build_process.returncode:
+                                    index_basename,
+                                    cache=bowtie2_index_cache,
+                                    output_stream=sys.stderr
+                                )
+    if bowtie_build_return_code:
         raise RuntimeError('Bowtie index construction failed w/ exitlevel %d.'
-                                % bowtie_build_process.returncode)
+                                % bowtie_build_return_code)
 
 # Compress index files
 print >>sys.stderr, 'Compressing isofrag index...'
@@ -49,6 +49,11 @@ import subprocess
 import re
 import random
 import itertools
+import ctypes
+import hashlib
+import tempfile
+import shutil
+import errno
 from collections import defaultdict
 
 base_path = os.path.abspath(
@@ -63,9 +68,15 @@ site.addsitedir(base_path)
 import bowtie
 import bowtie_index
 import partition
-from dooplicity.tools import xstream
+from dooplicity.tools import xstream, framed_output
 from alignment_handlers import pairwise
 
+try:
+    import numpy as _numpy
+except ImportError:
+    # PyPy without NumPy; see GlobalAlignment
+    _numpy = None
+
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
 # Initialize global variables for tracking number of input/output lines
@@ -86,217 +97,354 @@ _right_forward_elements = set(['AG', 'AC'])
 _left_elements = _left_reverse_elements | _left_forward_elements
 _right_elements = _right_reverse_elements | _right_forward_elements
 
-if 'pypy' not in sys.version.lower():
-    # For fast global alignment without PyPy
-    from scipy import weave
-    class GlobalAlignment(object):
-        """ Invokes Weave to obtain alignment score matrix with C. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                Places substitution_matrix directly in string containing C code
-                that obtains score matrix for global alignment. Executes C with
-                Weave on trivial case (two sequences, each one character) to 
-                ensure code is precompiled.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            '''Set supporting code including libraries and the function 
-            integer_sequence(), which converts a sequence of nucleotides to
-            an array of indices that correspond to indices of the substitution
-            matrix---also set in the constructor.'''
-            self.support_code = """ 
-                        int* integer_sequence(const char* seq, int length) {
-                            int i;
-                            int* int_seq = (int *)malloc(sizeof(int)*length);
-                            for (i = 0; seq[i]; i++) {
-                                switch (seq[i]) {
-                                    case 'A':
-                                    case 'a':
-                                        int_seq[i] = 0;
-                                        break;
-                                    case 'C':
-                                    case 'c':
-                                        int_seq[i] = 1;
-                                        break;
-                                    case 'G':
-                                    case 'g':
-                                        int_seq[i] = 2;
-                                        break;
-                                    case 'T':
-                                    case 't':
-                                        int_seq[i] = 3;
-                                        break;
-                                    case 'N':
-                                        int_seq[i] = 4;
-                                        break;
-                                    case '-':
-                                        int_seq[i] = 5;
-                                        break;
-                                    default:
-                                        int_seq[i] = 4;
-                                }
-                            }
-                            return int_seq;
-                        }
-                        """
-            '''Score matrix code is written in C/C++; see self.support_code
-            above for dependencies. substitution_matrix is embedded in code
-            below.'''
-            self.score_matrix_code = """
-                const char* c_first_seq = first_seq.c_str();
-                const char* c_second_seq = second_seq.c_str();
-                int row_count = first_seq.length() + 1;
-                int column_count = second_seq.length() + 1;
-                npy_intp dims[2] = {row_count, column_count};
-                PyObject* to_return = PyArray_SimpleNew(2, dims, NPY_INT);
-                int* score_matrix = (int *)((PyArrayObject*) to_return)->data;
-                int* substitution_matrix = (int *)malloc(sizeof(int)*6*6);
-                int* int_first_seq = integer_sequence(c_first_seq,
-                                                        row_count - 1);
-                int* int_second_seq = integer_sequence(c_second_seq,
-                                                        column_count - 1);
-            """ + """""".join(
-                            [("""substitution_matrix[%d] = %d;""" % ((i*6 + j), 
-                                substitution_matrix[i][j])) 
-                                for i in xrange(6) for j in xrange(6)]
-                        ) \
-            + """
-                int i, j;
-                score_matrix[0] = 0;
-                for (i = 1; i < row_count; i++) {
-                    score_matrix[i*column_count] = i 
-                        * substitution_matrix[int_first_seq[i-1]*6+5];
-                }
-                for (j = 1; j < column_count; j++) {
-                    score_matrix[j] = j 
-                        * substitution_matrix[5*6+int_second_seq[j-1]];
-                }
-                int diagonal, vertical, horizontal;
-                for (i = 1; i < row_count; i++) {
-                    for (j = 1; j < column_count; j++) {
-                        diagonal = score_matrix[(i-1)*column_count + j-1]
-                            + substitution_matrix[int_first_seq[i-1]*6
-                                                    +int_second_seq[j-1]];
-                        vertical = score_matrix[(i-1)*column_count + j]
-                            + substitution_matrix[int_first_seq[i-1]*6+5];
-                        horizontal = score_matrix[i*column_count + j-1]
-                            + substitution_matrix[5*6+int_second_seq[j-1]];
-                        score_matrix[i*column_count + j] = std::max(
-                                horizontal, std::max(diagonal, vertical)
-                            );
-                    }
-                }
-                free(int_first_seq);
-                free(int_second_seq);
-                free(substitution_matrix);
-                return_val = to_return;
-            """
-            stdout_holder = os.dup(sys.stdout.fileno())
+'''C kernel for banded global alignment; compiled once per node and source
+version by _alignment_kernel(), then loaded with ctypes.'''
+_alignment_kernel_source = r"""
+#include <stdlib.h>
+#include <limits.h>
+
+#define NEGATIVE_INFINITY (INT_MIN / 2)
+
+static int base_code(char base) {
+    switch (base) {
+        case 'A': case 'a': return 0;
+        case 'C': case 'c': return 1;
+        case 'G': case 'g': return 2;
+        case 'T': case 't': return 3;
+        case '-': return 5;
+        default: return 4;
+    }
+}
+
+int score_batch(int count, const char* firsts, const int* first_offsets,
+                const char* seconds, const int* second_offsets,
+                const int* substitution_matrix, int band, int* scores) {
+    int k, i, j, m, n, width, low, high, base, best, score;
+    int capacity = 0;
+    int *previous = NULL, *current = NULL, *swap, *second = NULL;
+    const char *first_seq, *second_seq;
+    for (k = 0; k < count; k++) {
+        first_seq = firsts + first_offsets[k];
+        second_seq = seconds + second_offsets[k];
+        m = first_offsets[k + 1] - first_offsets[k];
+        n = second_offsets[k + 1] - second_offsets[k];
+        if (band >= 0 && abs(m - n) > band) {
+            scores[k] = -band - 1;
+            continue;
+        }
+        if (n + 2 > capacity) {
+            capacity = n + 2;
+            free(previous); free(current); free(second);
+            previous = (int *)malloc(sizeof(int) * capacity);
+            current = (int *)malloc(sizeof(int) * capacity);
+            second = (int *)malloc(sizeof(int) * capacity);
+            if (!previous || !current || !second) {
+                free(previous); free(current); free(second);
+                return -1;
+            }
+        }
+        for (j = 0; j < n; j++) second[j] = base_code(second_seq[j]);
+        width = (band >= 0) ? band : (m > n ? m : n);
+        high = (n < width) ? n : width;
+        previous[0] = 0;
+        for (j = 1; j <= high; j++) {
+            previous[j] = previous[j - 1]
+                            + substitution_matrix[5 * 6 + second[j - 1]];
+        }
+        previous[high + 1] = NEGATIVE_INFINITY;
+        for (i = 1; i <= m; i++) {
+            base = base_code(first_seq[i - 1]) * 6;
+            low = (i > width) ? i - width : 0;
+            high = (i + width < n) ? i + width : n;
+            if (low == 0) {
+                current[0] = previous[0] + substitution_matrix[base + 5];
+                j = 1;
+            } else {
+                current[low - 1] = NEGATIVE_INFINITY;
+                j = low;
+            }
+            for (; j <= high; j++) {
+                best = previous[j - 1]
+                        + substitution_matrix[base + second[j - 1]];
+                score = previous[j] + substitution_matrix[base + 5];
+                if (score > best) best = score;
+                score = current[j - 1]
+                        + substitution_matrix[5 * 6 + second[j - 1]];
+                if (score > best) best = score;
+                current[j] = best;
+            }
+            current[high + 1] = NEGATIVE_INFINITY;
+            swap = previous; previous = current; current = swap;
+        }
+        scores[k] = previous[n];
+    }
+    free(previous); free(current); free(second);
+    return 0;
+}
+"""
+
+# Maps characters to rows/columns ACGTN- of substitution matrix
+_alignment_code_table = ['\x04'] * 256
+for _i, _bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for _base in _bases:
+        _alignment_code_table[ord(_base)] = chr(_i)
+_alignment_code_table[ord('-')] = '\x05'
+_alignment_code_table = ''.join(_alignment_code_table)
+
+# None until first use; then loaded kernel or False if none is available
+_loaded_alignment_kernel = None
+# Half-width of band above which NumPy fallback is used rather than Python
+_numpy_min_band = 32
+
+def _alignment_kernel():
+    """ Loads C kernel for banded global alignment, compiling it if necessary.
+
+        The shared library is compiled at most once per version of the
+        source; it is stored in a per-user directory under the system's
+        temporary directory and renamed into place so concurrent tasks on
+        the same node can share it.
+
+        Return value: ctypes function score_batch() or False if the kernel
+            could not be compiled or loaded
+    """
+    global _loaded_alignment_kernel
+    if _loaded_alignment_kernel is not None:
+        return _loaded_alignment_kernel
+    _loaded_alignment_kernel = False
+    try:
+        kernel_dir = os.path.join(tempfile.gettempdir(),
+                                    'rail-rna-%d' % os.getuid())
+        kernel_path = os.path.join(
+                kernel_dir, 'global_alignment.%s.so'
+                    % hashlib.md5(_alignment_kernel_source).hexdigest()
+            )
+        if not os.path.exists(kernel_path):
             try:
-                # Suppress compiler output by redirecting stdout temporarily
-                devnull = open(os.devnull, 'w')
-                os.dup2(devnull.fileno(), sys.stdout.fileno())
-                self.score_matrix('N', 'N')
-            except Exception as e:
-                print >>sys.stderr, 'C code for computing score matrix ' \
-                                    'failed to compile. Get Python\'s ' \
-                                    'distutils to use g++, and try again.'
-                raise
+                os.makedirs(kernel_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+            build_dir = tempfile.mkdtemp(dir=kernel_dir)
+            try:
+                source_path = os.path.join(build_dir, 'global_alignment.c')
+                with open(source_path, 'w') as source_stream:
+                    source_stream.write(_alignment_kernel_source)
+                built_path = os.path.join(build_dir, 'global_alignment.so')
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.check_call(
+                            [os.environ.get('CC', 'cc'), '-O3', '-shared',
+                                '-fPIC', '-o', built_path, source_path],
+                            stdout=devnull, stderr=devnull
+                        )
+                os.rename(built_path, kernel_path)
             finally:
-                # Turn the tap back on
-                os.dup2(stdout_holder, sys.stdout.fileno())
-
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
+                shutil.rmtree(build_dir, ignore_errors=True)
+        score_batch = ctypes.CDLL(kernel_path).score_batch
+    except (OSError, IOError, subprocess.CalledProcessError):
+        print >>sys.stderr, 'C kernel for global alignment could not be ' \
+                            'compiled or loaded; falling back on a slower ' \
+                            'implementation.'
+        return _loaded_alignment_kernel
+    score_batch.restype = ctypes.c_int
+    score_batch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                            ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                            ctypes.POINTER(ctypes.c_int),
+                            ctypes.POINTER(ctypes.c_int), ctypes.c_int,
+                            ctypes.POINTER(ctypes.c_int)]
+    _loaded_alignment_kernel = score_batch
+    return _loaded_alignment_kernel
+
+class GlobalAlignment(object):
+    """ Computes global alignment scores with a banded DP.
+
+        Only the score of the best global alignment is computed; the full
+        score matrix is never stored. Scores are computed by a C kernel
+        loaded with ctypes if a compiler is available, else with NumPy by
+        filling anti-diagonals at once, else in pure Python (fast enough
+        under PyPy).
+    """
 
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
+    def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
+                                            [-1, 0,-1,-1,-1,-1],
+                                            [-1,-1, 0,-1,-1,-1],
+                                            [-1,-1,-1, 0,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1],
+                                            [-1,-1,-1,-1,-1,-1]],
+                    use_kernel=True):
+        """ Constructor for GlobalAlignment.
+
+            substitution_matrix: 6 x 6 substitution matrix (list of
+                lists); rows and columns correspond to ACGTN-, where N is
+                aNy and - is a gap. Default: 0 for match, -1 for everything
+                else.
+            use_kernel: False iff C kernel should not be used even if it
+                can be compiled
+        """
+        self.substitution_matrix = substitution_matrix
+        self._flat_matrix = [substitution_matrix[i][j]
+                                for i in xrange(6) for j in xrange(6)]
+        self._kernel_matrix = (ctypes.c_int * 36)(*self._flat_matrix)
+        '''A band of half-width c is exact for alignments scoring at least -c
+        only if no substitution scores above 0 and every gap costs at
+        least 1.'''
+        self._bandable = (max(self._flat_matrix) <= 0
+                            and max(substitution_matrix[5]) <= -1
+                            and max([row[5] for row in substitution_matrix])
+                                <= -1)
+        self._use_kernel = use_kernel
+
+    def scores(self, pairs, max_cost=None):
+        """ Computes global alignment scores of many pairs of sequences.
+
+            pairs: list of tuples (first_seq, second_seq) of strings
+            max_cost: if not None, the DP is restricted to a band of this
+                half-width about the diagonal. Scores >= -max_cost are then
+                exact, and any other score is reported as some value
+                < -max_cost. Ignored if the substitution matrix does not
+                allow banding.
+
+            Return value: list of scores, one per pair in pairs
+        """
+        if not pairs:
+            return []
+        band = max_cost if (max_cost is not None and self._bandable) else -1
+        kernel = self._use_kernel and _alignment_kernel()
+        if kernel:
+            count = len(pairs)
+            first_offsets, second_offsets = [0], [0]
+            for first_seq, second_seq in pairs:
+                first_offsets.append(first_offsets[-1] + len(first_seq))
+                second_offsets.append(second_offsets[-1] + len(second_seq))
+            scores = (ctypes.c_int * count)()
+            if kernel(count, ''.join([pair[0] for pair in pairs]),
+                        (ctypes.c_int * (count + 1))(*first_offsets),
+                        ''.join([pair[1] for pair in pairs]),
+                        (ctypes.c_int * (count + 1))(*second_offsets),
+                        self._kernel_matrix, band, scores):
+                raise MemoryError('Global alignment kernel is out of memory.')
+            return list(scores)
+        scores = []
+        for first_seq, second_seq in pairs:
+            '''Vector operations on anti-diagonals only beat a plain loop
+            over the band when the band is wide.'''
+            if _numpy is not None and (
+                    band if band >= 0
+                    else max(len(first_seq), len(second_seq))
+                ) > _numpy_min_band:
+                scores.append(self._numpy_score(first_seq, second_seq, band))
+            else:
+                scores.append(self._python_score(first_seq, second_seq, band))
+        return scores
 
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
+    def score(self, first_seq, second_seq, max_cost=None):
+        """ Computes global alignment score of two sequences.
 
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            return weave.inline(
-                                    self.score_matrix_code,
-                                    ['first_seq', 'second_seq'], 
-                                    support_code=self.support_code,
-                                    verbose=0
-                                )
-else:
-    # Use Python version of class
-    class GlobalAlignment(object):
-        """ Uses Python to obtain alignment score matrix. """
-
-        def __init__(self, substitution_matrix=[[ 0,-1,-1,-1,-1,-1],
-                                                [-1, 0,-1,-1,-1,-1],
-                                                [-1,-1, 0,-1,-1,-1],
-                                                [-1,-1,-1, 0,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1],
-                                                [-1,-1,-1,-1,-1,-1]]):
-            """ Constructor for GlobalAlignment.
-
-                substitution_matrix: 6 x 6 substitution matrix (list of
-                    lists); rows and columns correspond to ACGTN-, where N is
-                    aNy and - is a gap. Default: +1 for match, -5 for gap,
-                    -1 for everything else.
-            """
-            self.substitution_matrix = substitution_matrix
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+            max_cost: see scores()
 
-        def score_matrix(self, first_seq, second_seq):
-            """ Computes score matrix for global alignment of two sequences.
+            Return value: score of best global alignment
+        """
+        return self.scores([(first_seq, second_seq)], max_cost=max_cost)[0]
 
-                The substitution matrix is specified when the GlobalAlignment
-                class is instantiated.
+    def _python_score(self, first_seq, second_seq, band):
+        """ Computes banded global alignment score in pure Python.
 
-                first_seq: first sequence (string).
-                second_seq: second sequence (string).
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+            band: half-width of band or -1 if unbanded
 
-                Return value: score_matrix, a numpy array whose dimensions are
-                    (len(first_seq) + 1) x (len(second_seq) + 1). It can be
-                    used to trace back the best global alignment.
-            """
-            first_seq = ['ACGTN-'.index(char) for char in first_seq]
-            second_seq = ['ACGTN-'.index(char) for char in second_seq]
-            row_count = len(first_seq) + 1
-            column_count = len(second_seq) + 1
-            score_matrix = [[0 for i in xrange(column_count)]
-                                for j in xrange(row_count)]
-            for j in xrange(1, column_count):
-                score_matrix[0][j] = j \
-                    * self.substitution_matrix[5][second_seq[j-1]]
-            for i in xrange(1, row_count):
-                score_matrix[i][0] = i \
-                    * self.substitution_matrix[first_seq[i-1]][5]
-            for i in xrange(1, row_count):
-                for j in xrange(1, column_count):
-                    score_matrix[i][j] = max(score_matrix[i-1][j-1] 
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]]
-                                                        [second_seq[j-1]
-                                                    ], # diagonal
-                                             score_matrix[i-1][j]
-                                                + self.substitution_matrix[
-                                                        first_seq[i-1]][5
-                                                    ], # vertical
-                                             score_matrix[i][j-1]
-                                                + self.substitution_matrix[
-                                                        5][second_seq[j-1]
-                                                    ] # horizontal
-                                            )
-            return score_matrix
+            Return value: alignment score; see scores()
+        """
+        m, n = len(first_seq), len(second_seq)
+        if band >= 0 and abs(m - n) > band:
+            return -band - 1
+        matrix = self.substitution_matrix
+        first = map(ord, first_seq.translate(_alignment_code_table))
+        second = map(ord, second_seq.translate(_alignment_code_table))
+        gap_row = matrix[5]
+        width = band if band >= 0 else max(m, n)
+        negative_infinity = -(m + n + 1) * (
+                                max([abs(score)
+                                    for score in self._flat_matrix]) + 1
+                            )
+        previous = [negative_infinity] * (n + 2)
+        current = [negative_infinity] * (n + 2)
+        previous[0] = 0
+        for j in xrange(1, min(n, width) + 1):
+            previous[j] = previous[j - 1] + gap_row[second[j - 1]]
+        for i in xrange(1, m + 1):
+            row = matrix[first[i - 1]]
+            gap = row[5]
+            low, high = max(i - width, 0), min(i + width, n)
+            if low == 0:
+                current[0] = previous[0] + gap
+                low = 1
+            else:
+                current[low - 1] = negative_infinity
+            for j in xrange(low, high + 1):
+                current[j] = max(previous[j - 1] + row[second[j - 1]],
+                                 previous[j] + gap,
+                                 current[j - 1] + gap_row[second[j - 1]])
+            current[high + 1] = negative_infinity
+            previous, current = current, previous
+        return previous[n]
+
+    def _numpy_score(self, first_seq, second_seq, band):
+        """ Computes banded global alignment score with NumPy.
+
+            Cells on the same anti-diagonal i + j = d depend only on cells on
+            the previous two anti-diagonals, so each anti-diagonal is filled
+            with a few vector operations. Anti-diagonals are indexed by i.
+
+            first_seq: first sequence (string).
+            second_seq: second sequence (string).
+            band: half-width of band or -1 if unbanded
+
+            Return value: alignment score; see scores()
+        """
+        m, n = len(first_seq), len(second_seq)
+        if band >= 0 and abs(m - n) > band:
+            return -band - 1
+        matrix = _numpy.array(self.substitution_matrix, dtype=_numpy.int64)
+        first = _numpy.frombuffer(first_seq.translate(_alignment_code_table),
+                                  dtype=_numpy.uint8).astype(_numpy.intp)
+        second = _numpy.frombuffer(
+                    second_seq.translate(_alignment_code_table),
+                    dtype=_numpy.uint8
+                ).astype(_numpy.intp)
+        width = band if band >= 0 else max(m, n)
+        negative_infinity = _numpy.iinfo(_numpy.int64).min // 2
+        before_previous = _numpy.empty(m + 1, dtype=_numpy.int64)
+        previous = _numpy.empty(m + 1, dtype=_numpy.int64)
+        current = _numpy.empty(m + 1, dtype=_numpy.int64)
+        previous.fill(negative_infinity)
+        previous[0] = 0
+        before_previous.fill(negative_infinity)
+        for d in xrange(1, m + n + 1):
+            current.fill(negative_infinity)
+            # Bounds on i from 0 <= j <= n and |i - j| <= width
+            low = max(0, d - n, -((width - d) // 2))
+            high = min(m, d, (d + width) // 2)
+            interior_low, interior_high = max(low, 1), min(high, d - 1)
+            if interior_low <= interior_high:
+                i = _numpy.arange(interior_low, interior_high + 1)
+                first_codes = first[i - 1]
+                second_codes = second[d - i - 1]
+                current[interior_low:interior_high + 1] = _numpy.maximum(
+                        _numpy.maximum(
+                            before_previous[i - 1]
+                                + matrix[first_codes, second_codes],
+                            previous[i - 1] + matrix[first_codes, 5]
+                        ),
+                        previous[i] + matrix[5, second_codes]
+                    )
+            if low == 0:
+                current[0] = previous[0] + matrix[5, second[d - 1]]
+            if high == d:
+                current[d] = previous[d - 1] + matrix[first[d - 1], 5]
+            before_previous, previous, current = (previous, current,
+                                                    before_previous)
+        return int(previous[m])
 
 def maximal_suffix_match(query_seq, search_window,
                             min_cap_size=8, max_cap_count=5):
@@ -758,7 +906,8 @@ def junctions_from_clique(clique, read_seq, reference_index,
         reverse_reverse_strand: if True, original read sequence was
             reverse-complemented before alignment of constituent readlets
         global_alignment: object of class GlobalAlignment used for fast
-            realignment to reference
+            realignment to reference; all realignments between a pair of
+            flanking readlets are scored in one batch
         max_gaps_mismatches: maximum number of (gaps + mismatches) to permit
             in realignments to reference minus intron per 100 bp or None if
             unlimited
@@ -909,6 +1058,10 @@ def junctions_from_clique(clique, read_seq, reference_index,
         product_offsets = list(itertools.product(left_offsets, right_offsets))
         product_motifs = list(itertools.product(left_motifs, right_motifs))
         candidate_junctions = []
+        '''Alignment scores of candidate junctions are computed in one batch
+        below; until then, each candidate junction holds the index of its
+        pair of sequences to align in alignment_pairs.'''
+        alignment_pairs = []
         for i in xrange(len(product_motifs)):
             if product_motifs[i] in search_motifs:
                 '''Appropriate motif combo found! Compute intron size
@@ -950,12 +1103,14 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         - intron_end_pos
                                                     )
                         reference_minus_intron = left_stretch + right_stretch
-                        alignment_score = global_alignment.score_matrix(
-                                                read_seq[
-                                                    left_displacement:
-                                                    left_displacement+read_span
-                                                ],
-                                                reference_minus_intron)[-1][-1]
+                        alignment_pairs.append((
+                                read_seq[
+                                    left_displacement:
+                                    left_displacement+read_span
+                                ],
+                                reference_minus_intron
+                            ))
+                        alignment_score = len(alignment_pairs) - 1
                         candidate_junctions.append(
                                 (
                                     rname,
@@ -1026,24 +1181,24 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                         - 1,
                                                         search_window_size
                                                     )]
-                        found_alignment_score = False
+                        alignment_score = None
                         for cap_combo in cap_combos:
                             capped_exon \
                                 = cap_combo[0] + small_exon + cap_combo[1]
                             for j, search_window in enumerate(search_windows):
                                 for small_exon_match \
                                     in re.finditer(capped_exon, search_window):
-                                    if not found_alignment_score:
+                                    if alignment_score is None:
+                                        alignment_pairs.append((
+                                                read_seq[
+                                                    left_displacement:
+                                                    left_displacement
+                                                    + read_span
+                                                ],
+                                                reference_minus_introns
+                                            ))
                                         alignment_score \
-                                            = global_alignment.score_matrix(
-                                                    read_seq[
-                                                        left_displacement:
-                                                        left_displacement
-                                                        + read_span
-                                                    ],
-                                                    reference_minus_introns
-                                                )[-1][-1]
-                                        found_alignment_score = True
+                                            = len(alignment_pairs) - 1
                                     # Split original intron
                                     if j == 0:
                                         # First search-window type
@@ -1090,6 +1245,17 @@ def junctions_from_clique(clique, read_seq, reference_index,
                                                   intron_end_pos,
                                                   alignment_score)
                                             )
+        '''Scores worse than the gap/mismatch cap are filtered out below,
+        so the DP need only be exact within a band of that half-width.'''
+        alignment_scores = global_alignment.scores(
+                alignment_pairs,
+                max_cost=(None if max_gaps_mismatches is None
+                            else int(max_gaps_mismatches
+                                        * read_seq_size / 100.))
+            )
+        candidate_junctions = [junction[:-1]
+                                + (alignment_scores[junction[-1]],)
+                                for junction in candidate_junctions]
         try:
             max_score = max([junction[-1] for junction in candidate_junctions])
             if max_gaps_mismatches is None \
@@ -1181,7 +1347,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
         max_cap_count: maximum number of possible caps of size
             min_cap_size to consider when searching for caps.
         global_alignment: instance of GlobalAlignment class used for fast
-                realignment via Weave or Pypy.
+                banded realignment.
         max_gaps_mismatches: maximum number of gaps/mismatches to permit in
             a realignment to reference without intron per 100 bp
             or None if unlimited
@@ -1281,7 +1447,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                             intron_pos, intron_end_pos) in itertools.chain(
                                 junctions, fake_junctions
                             ):
-                        print '%s%s\t%d\t%d\t%s\t%s' % (
+                        print >>output_stream, '%s%s\t%d\t%d\t%s\t%s' % (
                                 junction_rname,
                                 '-' if junction_reverse_strand else '+',
                                 intron_pos,
@@ -1325,7 +1491,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                              intron_pos, intron_end_pos) in itertools.chain(
                                 junctions, fake_junctions
                             ):
-                        print '%s%s\t%d\t%d\t%s\t%s' % (
+                        print >>output_stream, '%s%s\t%d\t%d\t%s\t%s' % (
                                 junction_rname,
                                 '-' if junction_reverse_strand else '+',
                                 intron_pos,
@@ -1385,7 +1551,7 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout,
                             intron_pos, intron_end_pos) in itertools.chain(
                             junctions, fake_junctions
                         ):
-                    print '%s%s\t%d\t%d\t%s\t%s' % (
+                    print >>output_stream, '%s%s\t%d\t%d\t%s\t%s' % (
                             junction_rname,
                             '-' if junction_reverse_strand else '+',
                             intron_pos,
@@ -1452,7 +1618,9 @@ if __name__ == '__main__' and not args.test:
     import time
     start_time = time.time()
     global_alignment = GlobalAlignment()
-    go(bowtie_index_base=os.path.expandvars(args.bowtie_idx),
+    output_stream = framed_output(sys.stdout)
+    go(output_stream=output_stream,
+        bowtie_index_base=os.path.expandvars(args.bowtie_idx),
         verbose=args.verbose, 
         stranded=args.stranded,
         min_intron_size=args.min_intron_size,
@@ -1463,6 +1631,7 @@ if __name__ == '__main__' and not args.test:
         max_gaps_mismatches=args.max_gaps_mismatches,
         experimental=args.experimental,
         global_alignment=global_alignment)
+    output_stream.close()
     print >> sys.stderr, 'DONE with junction_search.py; in/out=%d/%d; ' \
         'time=%0.3f s' % (_input_line_count, _output_line_count,
                                 time.time() - start_time)
@@ -1474,9 +1643,7 @@ elif __name__ == '__main__':
     import shutil
     import tempfile
 
-    # Precomile global_alignment
-    if 'pypy' not in sys.version.lower():
-        global_alignment = GlobalAlignment()
+    global_alignment = GlobalAlignment()
 
     def random_sequence(seq_size):
         """ Gets random sequence of nucleotides.
@@ -1533,6 +1700,67 @@ elif __name__ == '__main__':
                     None
                 )
 
+    class TestGlobalAlignment(unittest.TestCase):
+        """ Tests GlobalAlignment; needs no fixture. """
+        def full_score(self, first_seq, second_seq):
+            """ Computes global alignment score with an unbanded DP.
+
+                Default substitution matrix is assumed.
+
+                first_seq: first sequence (string).
+                second_seq: second sequence (string).
+
+                Return value: score of best global alignment
+            """
+            previous = [-j for j in xrange(len(second_seq) + 1)]
+            for i, first_base in enumerate(first_seq):
+                current = [-i - 1]
+                for j, second_base in enumerate(second_seq):
+                    current.append(max(
+                            previous[j] - (first_base != second_base
+                                            or first_base == 'N'),
+                            previous[j + 1] - 1, current[j] - 1
+                        ))
+                previous = current
+            return previous[-1]
+
+        def test_implementations_agree(self):
+            """ Fails if kernel, NumPy, or Python scores are wrong. """
+            random.seed(1)
+            pairs = [('', ''), ('', 'ACG'), ('AN', 'AN'), ('ACGT', 'ACGT')]
+            for _ in xrange(200):
+                first_seq = random_sequence(random.randint(1, 60))
+                second_seq = list(first_seq)
+                for _ in xrange(random.randint(0, 8)):
+                    position = random.randint(0, len(second_seq))
+                    edit = random.randint(0, 2)
+                    if edit == 0:
+                        second_seq.insert(position, random.choice('ACGTN'))
+                    elif position < len(second_seq):
+                        if edit == 1:
+                            del second_seq[position]
+                        else:
+                            second_seq[position] = random.choice('ACGTN')
+                pairs.append((first_seq, ''.join(second_seq)))
+            expected = [self.full_score(*pair) for pair in pairs]
+            for use_kernel in [True, False]:
+                alignment = GlobalAlignment(use_kernel=use_kernel)
+                self.assertEqual(alignment.scores(pairs), expected)
+                for max_cost in [0, 2, 5]:
+                    for score, expected_score in zip(
+                            alignment.scores(pairs, max_cost=max_cost),
+                            expected
+                        ):
+                        if expected_score >= -max_cost:
+                            self.assertEqual(score, expected_score)
+                        else:
+                            self.assertTrue(score < -max_cost)
+            alignment = GlobalAlignment(use_kernel=False)
+            self.assertEqual([alignment._python_score(first_seq,
+                                                        second_seq, -1)
+                                for first_seq, second_seq in pairs],
+                             expected)
+
     class TestJunctionsFromClique(unittest.TestCase):
         """ Tests junctions_from_clique(). """
         def setUp(self):
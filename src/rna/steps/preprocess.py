@@ -73,6 +73,10 @@ import sys
 import tempfile
 import site
 import string
+import math
+import zlib
+from collections import deque
+from cStringIO import StringIO
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -84,11 +88,12 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.ansibles import Url
-from dooplicity.tools import xopen, register_cleanup, make_temp_dir
+from dooplicity.tools import xopen, register_cleanup, make_temp_dir, \
+    decompressed_input, xlines
 import filemover
 import tempdel
 import subprocess
-from guess import phred_converter
+from guess import phred_converter, phred_translation_table
 from encode import encode, encode_sequence
 
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
@@ -98,6 +103,9 @@ _input_line_count, _output_line_count = 0, 0
 # Maximum length of read to ignore if dealing with barcodes
 _max_stubby_read_length = 10
 
+# Number of records from the start of a source used to guess its Phred format
+_phred_sample_size = 10000
+
 '''Set Bowtie 2's default quality-based mismatch penalties; see
 http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml#bowtie2-options-mp
 for more information.'''
@@ -105,6 +113,69 @@ _MX, _MN = 6, 2
 '''This table depends on _MX, _MN above; it maps mismatch penalties to quality
 scores, each an "exemplar" from a different bin.'''
 _mismatch_penalties_to_quality_scores = string.maketrans('23456', '#05Hh')
+'''Maps every Sanger-format quality character to the exemplar of its bin in one
+str.translate() table; characters below '!' fall in the lowest bin.'''
+_quality_binning_table = ''.join(
+        [str(int(
+            _MN + math.floor((_MX - _MN) * min(
+                                        max(i - 33.0, 0.0), 40.0
+                                    ) / 40.0)
+        )) for i in xrange(256)]
+    ).translate(_mismatch_penalties_to_quality_scores)
+
+class PeekableStream(object):
+    """ Opened source whose first lines can be peeked at and then reread.
+
+        go() peeks at the first records of a source to guess its Phred format;
+        they're replayed to the parser through this object so the source,
+        which may be a download in progress, is read only once.
+
+        source_context: context manager yielding the source's stream, e.g.
+            the return value of xopen()
+    """
+    def __init__(self, source_context):
+        self.context = source_context
+        self.stream = source_context.__enter__()
+        self.name = getattr(self.stream, 'name', None)
+        self.lines, self.closed = deque(), False
+
+    def peek(self, line_count):
+        """ Reads lines that are then returned again by readline().
+
+            line_count: maximum number of lines to read
+
+            Return value: list of lines read
+        """
+        while len(self.lines) < line_count:
+            line = self.stream.readline()
+            if not line: break
+            self.lines.append(line)
+        return list(self.lines)[:line_count]
+
+    def readline(self):
+        if self.lines:
+            return self.lines.popleft()
+        return self.stream.readline()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.context.__exit__(None, None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 def qname_from_read(qname, seq, sample_label, mate=None):
     """ Returns QNAME including sample label and ID formed from hash.
@@ -149,11 +220,397 @@ def max_min_read_lengths_from_fastq_stream(fastq_stream):
             min_len = min(min_len, len(line.strip()))
     return max_len, min_len
 
+def output_filename(destination, file_number, gzip_output):
+    """ Names an output file using the Hadoop task partition.
+
+        Uses Hadoop task environment property mapred.task.partition, and tacks
+        ".gz" onto output filename as appropriate.
+
+        destination: directory in which to write output file
+        file_number: index of output file written by task
+        gzip_output: True iff output file is gzipped
+
+        Return value: path to output file
+    """
+    filename_suffix = '.gz' if gzip_output else ''
+    try:
+        return os.path.join(
+                destination, 
+                '.'.join([
+                    os.environ['mapred_task_partition'],
+                    str(file_number)
+                ]) + filename_suffix
+            )
+    except KeyError:
+        '''Hadoop 2.x: mapreduce.task.partition; see 
+        http://hadoop.apache.org/docs/r2.0.3-alpha/
+        hadoop-project-dist/hadoop-common/
+        DeprecatedProperties.html.'''
+        return os.path.join(
+                destination, 
+                '.'.join([
+                    os.environ['mapreduce_task_partition'],
+                    str(file_number)
+                ]) + filename_suffix
+            )
+
+def preprocessed_line(original_qnames, seqs, quals, read_index,
+        sample_label, bin_qualities=True, short_qnames=False):
+    """ Formats a read or read pair as a line of preprocess output.
+
+        Used by both the serial record loop in go() and the worker processes
+        of pipelined mode (preprocessed_batch()), so their outputs match.
+
+        original_qnames: list of two read names with spaces replaced by
+            underscores; the second is empty for single-end reads
+        seqs: list of two read sequences; the second is empty for
+            single-end reads
+        quals: list of two quality strings in Sanger format corresponding to
+            seqs
+        read_index: index of read; used to shorten read names
+        sample_label: sample label
+        bin_qualities: True iff quality strings should be binned
+            according to _quality_binning_table
+        short_qnames: True iff read names should be replaced by short
+            names formed from read_index
+
+        Return value: output line without newline
+    """
+    seqs = [seq.upper() for seq in seqs]
+    strands = []
+    for seq, qual in zip(seqs, quals):
+        reversed_complement_seq = seq[::-1].translate(
+                _reversed_complement_translation_table
+            )
+        if bin_qualities:
+            qual = qual.translate(_quality_binning_table)
+        if seq < reversed_complement_seq:
+            strands.append((seq, '0', qual))
+        else:
+            strands.append((reversed_complement_seq, '1', qual[::-1]))
+    if original_qnames[1]:
+        # Paired-end write
+        assert seqs[1]
+        assert quals[1]
+        if short_qnames:
+            qnames_to_write = [encode(read_index) + '/1',
+                                encode(read_index) + '/2']
+        elif original_qnames[0] == original_qnames[1]:
+            # Add paired-end identifiers
+            qnames_to_write = [original_qnames[0] + '/1',
+                                original_qnames[1] + '/2']
+        else:
+            qnames_to_write = original_qnames
+        return '\t'.join([
+                strands[0][0], strands[0][1],
+                qname_from_read(qnames_to_write[0], seqs[0] + quals[0],
+                                    sample_label, mate=seqs[1]),
+                '\n'.join([strands[0][2], strands[1][0]]),
+                strands[1][1],
+                qname_from_read(qnames_to_write[1], seqs[1] + quals[1],
+                                    sample_label, mate=seqs[0]),
+                strands[1][2]
+            ])
+    # Single-end write
+    return '\t'.join([
+            strands[0][0], strands[0][1],
+            qname_from_read(
+                    encode(read_index) if short_qnames
+                    else original_qnames[0],
+                    seqs[0] + quals[0], sample_label
+                ),
+            strands[0][2]
+        ])
+
+def preprocessed_batch(batch):
+    """ Converts a batch of FASTQ records to preprocess output lines.
+
+        Run by worker processes in pipelined mode; does what the FASTQ branch
+        of the record loop in go() does once a record has been read, using
+        the same preprocessed_line().
+
+        batch: tuple (list of records, read index of first record, list of
+            source filenames, sample label, 256-character table converting
+            qualities to Sanger format, True iff qualities should be binned,
+            True iff read names should be shortened, True iff bad records
+            should be skipped). A record is either None if it was found to
+            be malformed when it was read or a tuple (line number of header,
+            list of original qnames, list of seqs, list of quals), where each
+            list has two elements, the second of which is empty for
+            single-end reads.
+
+        Return value: list of tuples (output line or None if record was
+            skipped, number of nucleotides read), one for each record
+    """
+    (records, read_index, sources, sample_label, conversion_table,
+        bin_qualities, short_qnames, skip_bad_records) = batch
+    outputs = []
+    for record in records:
+        if record is None:
+            outputs.append((None, 0))
+            read_index += 1
+            continue
+        line_number, original_qnames, seqs, quals = record
+        quals = [qual.translate(conversion_table) for qual in quals]
+        try: 
+            for i in xrange(2):
+                assert len(seqs[i]) == len(quals[i]), (
+                    'Length of read sequence does not '
+                    'match length of quality string '
+                    'at line %d of file "%s".'
+                ) % (line_number + 3, sources[i])
+        except AssertionError as e:
+            if skip_bad_records:
+                print >>sys.stderr, (
+                        'Error "%s" encountered; '
+                        'skipping bad record.'
+                    ) % e.message
+                outputs.append((None, 0))
+                read_index += 1
+                continue
+            raise
+        outputs.append((preprocessed_line(original_qnames, seqs, quals,
+                                            read_index, sample_label,
+                                            bin_qualities=bin_qualities,
+                                            short_qnames=short_qnames),
+                        len(seqs[0]) + len(seqs[1])))
+        read_index += 1
+    return outputs
+
+def gzip_member(chunk):
+    """ Compresses a chunk of output as a complete gzip member.
+
+        Concatenated gzip members form a valid gzip file, so chunks of an
+        output file can be compressed by different worker processes.
+
+        chunk: tuple (data to compress, compression level)
+
+        Return value: gzip member
+    """
+    data, level = chunk
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def fastq_records(source_streams, sources, skip_bad_records=False):
+    """ Reads FASTQ records from one or two streams in lockstep.
+
+        source_streams: list of two streams; the second is /dev/null for
+            single-end reads
+        sources: list of source filenames, for error messages
+        skip_bad_records: True iff malformed records should be yielded as
+            None; otherwise, raises exception if a bad record is encountered
+
+        Yield value: None if record is malformed or a tuple (line number of
+            header, list of original qnames, list of seqs, list of quals) as
+            described in preprocessed_batch()'s docstring
+    """
+    line_number = 1
+    while True:
+        lines = [source_stream.readline() for source_stream in source_streams]
+        if not lines[0]:
+            break
+        seqs = [source_stream.readline().strip()
+                    for source_stream in source_streams]
+        plus_lines = [source_stream.readline().strip()
+                        for source_stream in source_streams]
+        quals = [source_stream.readline().strip()
+                    for source_stream in source_streams]
+        lines = [line.strip() for line in lines]
+        try:
+            for i in xrange(2):
+                if not i or plus_lines[i]:
+                    assert lines[i][:1] == '@' and plus_lines[i][:1] == '+', (
+                            'Malformed read "%s" at line %d of file "%s".'
+                        ) % (lines[i], line_number, sources[i])
+        except AssertionError as e:
+            if skip_bad_records:
+                print >>sys.stderr, (
+                        'Error "%s" encountered; skipping bad record.'
+                    ) % e.message
+                yield None
+            else:
+                raise
+        else:
+            # Kill spaces in name
+            yield (line_number, [line[1:].replace(' ', '_') for line in lines],
+                    seqs, quals)
+        line_number += 4
+
+def pipelined_preprocess(pool, workers, sources, paired, sample_label,
+        skip_count, records_to_consume, read_index, conversion_table,
+        file_number, destination=None, to_stdout=False, gzip_output=True,
+        gzip_level=3, nucleotides_per_input=8000000, push_url=None,
+        mover=None, bin_qualities=True, short_qnames=False,
+        skip_bad_records=False, batch_size=10000, chunk_size=4194304,
+        opener=decompressed_input):
+    """ Preprocesses FASTQ files from one sample in three pipelined stages.
+
+        1. Each source is decompressed by pigz/gzip in a subprocess
+            (decompressed_input()) while the main process splits the
+            decompressed stream into batches of records.
+        2. Batches are converted to output lines by preprocessed_batch() in
+            pool's worker processes.
+        3. Output lines are gathered in order into chunks, which are
+            compressed by the same workers as independent gzip members
+            (gzip_member()) and appended to output files.
+
+        At most 2*workers batches and 2*workers chunks are in flight at once,
+        so memory use is bounded. Output files are named and split exactly as
+        in go().
+
+        pool: multiprocessing.Pool object
+        workers: number of processes in pool
+        sources: list of two source filenames; the second is os.devnull for
+            single-end reads
+        paired: True iff reads are paired-end
+        sample_label: sample label
+        skip_count: number of records to skip before starting
+        records_to_consume: number of records to consume or None if all
+            should be consumed
+        read_index: index of first read; used to shorten read names
+        conversion_table: 256-character table converting qualities to Sanger
+            format
+        file_number: index of first output file to write
+        destination: directory in which to write output files
+        to_stdout: True iff output should be written to stdout
+        gzip_output: True iff output files should be gzipped
+        gzip_level: level of gzip compression to use
+        nucleotides_per_input: maximum number of nucleotides per output file
+        push_url: Url object for push destination
+        mover: instance of filemover.FileMover
+        bin_qualities: True iff quality string should be binned
+        short_qnames: True iff read names should be shortened
+        skip_bad_records: True iff bad records should be skipped
+        batch_size: number of records per parser batch
+        chunk_size: minimum number of bytes per compressed chunk
+        opener: function that takes a source and returns a context manager
+            yielding a decompressed stream
+
+        Return value: index of last output file written
+    """
+    compress = gzip_output and not to_stdout
+    max_in_flight = 2 * workers
+    pending_batches, pending_chunks = deque(), deque()
+    # State of the output file currently being written
+    state = {'stream' : None, 'file' : None, 'file_number' : file_number,
+             'chunk' : [], 'chunk_bytes' : 0, 'nucs_read' : 0,
+             'records_printed' : 0}
+    def write_compressed(drain=False):
+        while pending_chunks and (drain
+                                    or len(pending_chunks) >= max_in_flight):
+            state['stream'].write(pending_chunks.popleft().get())
+    def flush_chunk():
+        if not state['chunk']: return
+        data = '\n'.join(state['chunk']) + '\n'
+        state['chunk'], state['chunk_bytes'] = [], 0
+        if compress:
+            pending_chunks.append(
+                    pool.apply_async(gzip_member, ((data, gzip_level),))
+                )
+            write_compressed()
+        else:
+            state['stream'].write(data)
+    def open_output():
+        state['nucs_read'] = 0
+        if to_stdout:
+            state['stream'] = sys.stdout
+            return
+        state['file'] = output_filename(
+                destination, state['file_number'], gzip_output
+            )
+        try:
+            os.makedirs(os.path.dirname(state['file']))
+        except OSError:
+            pass
+        state['stream'] = open(state['file'], 'ab' if compress else 'a')
+    def close_output(perform_push):
+        flush_chunk()
+        write_compressed(drain=True)
+        if to_stdout: return
+        state['stream'].close()
+        if (push_url.is_nfs or push_url.is_s3 or push_url.is_hdfs) \
+            and ((not records_to_consume) or perform_push):
+            print >>sys.stderr, 'Pushing "%s" to "%s" ...' % (
+                                                            state['file'],
+                                                            push_url.to_url()
+                                                        )
+            print >>sys.stderr, 'reporter:status:alive'
+            mover.put(state['file'], push_url.plus(os.path.basename(
+                                                                state['file']
+                                                            )))
+            try:
+                os.remove(state['file'])
+            except OSError:
+                pass
+    def write_batch(outputs):
+        global _output_line_count
+        for line, nucs in outputs:
+            if line is not None:
+                state['chunk'].append(line)
+                state['chunk_bytes'] += len(line) + 1
+                if state['chunk_bytes'] >= chunk_size:
+                    flush_chunk()
+                _output_line_count += 1
+            state['records_printed'] += 2 if paired else 1
+            state['nucs_read'] += nucs
+            if not to_stdout and not records_to_consume and \
+                state['nucs_read'] > nucleotides_per_input:
+                close_output(False)
+                state['file_number'] += 1
+                open_output()
+    if paired:
+        line_skip_count = (skip_count / 2) * 4
+        records_to_read = (records_to_consume / 2
+                            if records_to_consume else None)
+    else:
+        line_skip_count = skip_count * 4
+        records_to_read = records_to_consume
+    with opener(sources[0]) as source_stream_1, \
+        opener(sources[1]) as source_stream_2:
+        source_streams = [source_stream_1, source_stream_2]
+        for _ in xrange(line_skip_count):
+            for source_stream in source_streams[:2 if paired else 1]:
+                source_stream.readline()
+        open_output()
+        records = fastq_records(source_streams, sources,
+                                    skip_bad_records=skip_bad_records)
+        records_read = 0
+        while True:
+            batch_records = []
+            for record in records:
+                batch_records.append(record)
+                if len(batch_records) == batch_size or (
+                        records_to_read is not None
+                        and records_read + len(batch_records)
+                        == records_to_read
+                    ):
+                    break
+            if batch_records:
+                pending_batches.append(pool.apply_async(
+                        preprocessed_batch,
+                        ((batch_records, read_index, sources, sample_label,
+                            conversion_table, bin_qualities, short_qnames,
+                            skip_bad_records),)
+                    ))
+                read_index += len(batch_records)
+                records_read += len(batch_records)
+            done = (not batch_records or (records_to_read is not None
+                                            and records_read
+                                            == records_to_read))
+            while pending_batches and (done
+                                        or len(pending_batches)
+                                        >= max_in_flight):
+                write_batch(pending_batches.popleft().get())
+            if done: break
+    close_output(state['records_printed'] == records_to_consume)
+    return state['file_number']
+
 def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         to_stdout=False, push='.', mover=filemover.FileMover(),
         verbose=False, scratch=None, bin_qualities=True, short_qnames=False,
         skip_bad_records=False, workspace_dir=None,
-        fastq_dump_exe='fastq-dump', ignore_missing_sra_samples=False):
+        fastq_dump_exe='fastq-dump', ignore_missing_sra_samples=False,
+        workers=0, stream_downloads=False):
     """ Runs Rail-RNA-preprocess
 
         Input (read from stdin)
@@ -226,7 +683,7 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
             securely created temporary directory
         bin_qualities: True iff quality string should be binned according to
             rules in _mismatch_penalties_to_quality_scores
-            and round_quality_string() defined in go()
+            and _quality_binning_table
         short_qnames: True iff original qname should be killed and a new qname
             should be written in a short base64-encoded format
         skip_bad_records: True iff bad records should be skipped; otherwise,
@@ -236,37 +693,16 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         fastq_dump_exe: path to fastq-dump executable
         ignore_missing_sra_samples: does not return error if fastq-dump doesn't
             find a sample
+        workers: if > 1, FASTQ files are preprocessed by
+            pipelined_preprocess() with a pool of this many processes;
+            otherwise, records are parsed and written serially
+        stream_downloads: True iff HTTP, FTP and S3 sources should be
+            streamed by filemover.DownloadStream rather than downloaded to
+            scratch before they're preprocessed; manifest MD5s are then
+            checked as data arrives
 
         No return value
     """
-    if bin_qualities:
-        import math
-        def round_quality_string(qual):
-            """ Bins phred+33 quality string to improve compression.
-
-                Uses 5-bin scheme that does not affect Bowtie 2 alignments
-
-                qual: quality string
-
-                Return value: "binned" quality string.
-            """
-            return ''.join(
-                [str(int(
-                    _MN + math.floor((_MX - _MN) * min(
-                                                    ord(qual_char) - 33.0, 40.0
-                                                ) / 40.0)
-                        )) for qual_char in qual]).translate(
-                                _mismatch_penalties_to_quality_scores
-                            )
-    else:
-        def round_quality_string(qual):
-            """ Leaves quality string unbinned and untouched.
-
-                qual: quality string
-
-                Return value: qual
-            """
-            return qual
     global _input_line_count, _output_line_count
     skip_stubs = False
     temp_dir = make_temp_dir(scratch)
@@ -285,8 +721,10 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
     fastq_cues = set(['@'])
     fasta_cues = set(['>', ';'])
     source_dict = {}
+    # Maps URLs of sources to be streamed to their manifest MD5s
+    md5s, streamed = {}, {}
     onward = False
-    for line in sys.stdin:
+    for line in xlines(sys.stdin):
         _input_line_count += 1
         if not line.strip(): continue
         # Kill offset from start of manifest file
@@ -330,13 +768,31 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         elif token_count == 3:
             # SRA or single-end reads
             source_dict[(Url(tokens[0]),)] = (tokens[-1],)
+            md5s[Url(tokens[0]).to_url()] = tokens[1]
         elif token_count == 5:
             # Paired-end reads
             source_dict[(Url(tokens[0]), Url(tokens[2]))] = (tokens[-1],)
+            md5s[Url(tokens[0]).to_url()] = tokens[1]
+            md5s[Url(tokens[2]).to_url()] = tokens[3]
         else:
             # Not a valid line, but continue for robustness
             continue
+    def open_source(source):
+        """ Opens a source for reading, streaming it if it's remote.
+
+            source: path to local file or URL of a source to be streamed
+
+            Return value: file object
+        """
+        if source in streamed:
+            return mover.stream(Url(source), md5=streamed[source])
+        return xopen(None, source)
     file_number = 0
+    if workers > 1:
+        import multiprocessing
+        from dooplicity.emr_simulator import init_worker
+        pool = multiprocessing.Pool(workers, init_worker)
+        register_cleanup(pool.terminate)
     for source_urls in source_dict:
         sample_label = source_dict[source_urls][0]
         downloaded = set()
@@ -366,7 +822,13 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         if records_to_consume == 0: continue
         skipped = False
         for source_url in source_urls:
-            if not source_url.is_local:
+            if stream_downloads and (source_url.is_curlable
+                                        or source_url.is_s3):
+                print >>sys.stderr, 'Streaming URL "%s"...' \
+                    % source_url.to_url()
+                streamed[source_url.to_url()] = md5s.get(source_url.to_url())
+                sources.append(source_url.to_url())
+            elif not source_url.is_local:
                 # Download
                 print >>sys.stderr, 'Retrieving URL "%s"...' \
                     % source_url.to_url()
@@ -500,13 +962,60 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
         loop.'''
         if len(sources) == 1:
             sources.append(os.devnull)
-        if qual_getter is None:
-            # Figure out Phred format
+        is_streamed = sources[0] in streamed
+        if qual_getter is None and not is_streamed:
+            # Figure out Phred format from a sample of the whole file
             with xopen(None, sources[0]) as source_stream:
                 qual_getter = phred_converter(fastq_stream=source_stream)
-        with xopen(None, sources[0]) as source_stream_1, xopen(
-                None, sources[1]
-            ) as source_stream_2:
+        '''A streamed source can be read only once, so read just enough of it
+        to figure out its Phred format and whether it's FASTQ, then replay
+        those lines to the parser rather than opening the source again.'''
+        source_stream_1 = PeekableStream(open_source(sources[0]))
+        prefix = source_stream_1.peek(
+                4 * _phred_sample_size if qual_getter is None else 1
+            )
+        if qual_getter is None:
+            # Figure out Phred format from the beginning of the stream
+            qual_getter = phred_converter(
+                    fastq_stream=StringIO(''.join(prefix)),
+                    sample_size=_phred_sample_size
+                )
+        if workers > 1 and os.devnull not in sources[:1]:
+            is_fastq = (''.join(prefix[:1])[:1] in fastq_cues)
+            if is_fastq:
+                if is_streamed:
+                    opener = lambda source: (
+                            source_stream_1 if source == sources[0]
+                            else open_source(source)
+                        )
+                else:
+                    # Local files are decompressed in a subprocess instead
+                    source_stream_1.close()
+                    opener = decompressed_input
+                file_number = pipelined_preprocess(
+                        pool, workers, sources, sources[1] != os.devnull,
+                        sample_label, skip_count, records_to_consume,
+                        read_index,
+                        qual_getter(''.join(map(chr, xrange(256)))),
+                        file_number,
+                        destination=(destination if not to_stdout
+                                        else None),
+                        to_stdout=to_stdout, gzip_output=gzip_output,
+                        gzip_level=gzip_level,
+                        nucleotides_per_input=nucleotides_per_input,
+                        push_url=(push_url if not to_stdout else None),
+                        mover=mover, bin_qualities=bin_qualities,
+                        short_qnames=short_qnames,
+                        skip_bad_records=skip_bad_records,
+                        opener=opener
+                    )
+                for input_file in os.listdir(temp_dir):
+                    try:
+                        os.remove(os.path.join(temp_dir, input_file))
+                    except OSError:
+                        pass
+                continue
+        with source_stream_1, open_source(sources[1]) as source_stream_2:
             source_streams = [source_stream_1, source_stream_2]
             reorganize = all([source == os.devnull for source in sources])
             if reorganize:
@@ -518,36 +1027,15 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
             break_outer_loop = False
             while True:
                 if not to_stdout:
-                    '''Name files using Hadoop task environment property
-                    mapred.task.partition, and tack ".gz" onto output filename
-                    and gzip compression level onto arguments passed to opener
-                    as appropriate.'''
+                    '''Tack gzip compression level onto arguments passed to
+                    opener as appropriate.'''
                     if gzip_output:
-                        filename_suffix = '.gz'
                         open_args_suffix = [gzip_level]
                     else:
-                        filename_suffix = ''
                         open_args_suffix = []
-                    try:
-                        output_file = os.path.join(
-                                destination, 
-                                '.'.join([
-                                    os.environ['mapred_task_partition'],
-                                    str(file_number)
-                                ]) + filename_suffix
-                            )
-                    except KeyError:
-                        '''Hadoop 2.x: mapreduce.task.partition; see 
-                        http://hadoop.apache.org/docs/r2.0.3-alpha/
-                        hadoop-project-dist/hadoop-common/
-                        DeprecatedProperties.html.'''
-                        output_file = os.path.join(
-                                destination, 
-                                '.'.join([
-                                    os.environ['mapreduce_task_partition'],
-                                    str(file_number)
-                                ]) + filename_suffix
-                            )
+                    output_file = output_filename(
+                            destination, file_number, gzip_output
+                        )
                     open_args = [output_file, 'a'] + open_args_suffix
                     try:
                         os.makedirs(os.path.dirname(output_file))
@@ -768,107 +1256,15 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                 records_printed += 1
                             else:
                                 records_printed += 2
-                        elif len(original_qnames) == 2 and original_qnames[1]:
-                            # Paired-end write
-                            if original_qnames[0] == original_qnames[1]:
-                                # Add paired-end identifiers
-                                original_qnames[0] += '/1'
-                                original_qnames[1] += '/2'
-                            assert seqs[1]
-                            assert quals[1]
-                            seqs = [seq.upper() for seq in seqs]
-                            reversed_complement_seqs = [
-                                    seqs[0][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    ),
-                                    seqs[1][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
-                                ]
-                            if seqs[0] < reversed_complement_seqs[0]:
-                                left_seq = seqs[0]
-                                left_qual = quals[0]
-                                left_reversed = '0'
-                            else:
-                                left_seq = reversed_complement_seqs[0]
-                                left_qual = quals[0][::-1]
-                                left_reversed = '1'
-                            if seqs[1] < reversed_complement_seqs[1]:
-                                right_seq = seqs[1]
-                                right_qual = quals[1]
-                                right_reversed = '0'
-                            else:
-                                right_seq = reversed_complement_seqs[1]
-                                right_qual = quals[1][::-1]
-                                right_reversed = '1'
-                            if short_qnames:
-                                left_qname_to_write = encode(read_index) + '/1'
-                                right_qname_to_write = encode(
-                                                            read_index
-                                                        ) + '/2'
-                            else:
-                                left_qname_to_write = original_qnames[0]
-                                right_qname_to_write = original_qnames[1]
-                            print >>output_stream, '\t'.join(
-                                        [
-                                            left_seq,
-                                            left_reversed,
-                                            qname_from_read(
-                                                    left_qname_to_write,
-                                                    seqs[0] + quals[0], 
-                                                    sample_label,
-                                                    mate=seqs[1]
-                                                ),
-                                            '\n'.join([
-                                                round_quality_string(
-                                                    left_qual
-                                                ), right_seq
-                                            ]),
-                                            right_reversed,
-                                            qname_from_read(
-                                                    right_qname_to_write,
-                                                    seqs[1] + quals[1], 
-                                                    sample_label,
-                                                    mate=seqs[0]
-                                                ),
-                                            round_quality_string(right_qual)
-                                        ]
-                                    )
-                            records_printed += 2
-                            _output_line_count += 1
                         else:
-                            seqs[0] = seqs[0].upper()
-                            reversed_complement_seqs = [
-                                    seqs[0][::-1].translate(
-                                        _reversed_complement_translation_table
-                                    )
-                                ]
-                            # Single-end write
-                            if seqs[0] < reversed_complement_seqs[0]:
-                                seq = seqs[0]
-                                qual = quals[0]
-                                is_reversed = '0'
-                            else:
-                                seq = reversed_complement_seqs[0]
-                                qual = quals[0][::-1]
-                                is_reversed = '1'
-                            if short_qnames:
-                                qname_to_write = encode(read_index)
-                            else:
-                                qname_to_write = original_qnames[0]
-                            print >>output_stream, '\t'.join(
-                                        [
-                                            seq,
-                                            is_reversed,
-                                            qname_from_read(
-                                                qname_to_write,
-                                                seqs[0] + quals[0], 
-                                                sample_label
-                                            ),
-                                            round_quality_string(qual)
-                                        ]
-                                    )
-                            records_printed += 1
+                            print >>output_stream, preprocessed_line(
+                                    original_qnames, seqs, quals, read_index,
+                                    sample_label,
+                                    bin_qualities=bin_qualities,
+                                    short_qnames=short_qnames
+                                )
+                            records_printed += (2 if original_qnames[1]
+                                                    else 1)
                             _output_line_count += 1
                         read_index += 1
                         for seq in seqs:
@@ -922,6 +1318,74 @@ def go(nucleotides_per_input=8000000, gzip_output=True, gzip_level=3,
                                         % (sra_return_code,
                                             fastq_dump_command))
             del sra_process
+    if workers > 1:
+        pool.close()
+        pool.join()
+
+def quality_benchmark(read_count=100000, read_length=100,
+                        phred_format='Solexa'):
+    """ Times quality conversion and binning in reads per second.
+
+        Compares the per-character conversion and binning preprocess used
+        to perform against the translation tables now used. Results are
+        written to stderr.
+
+        read_count: number of random quality strings to process
+        read_length: length of each quality string
+        phred_format: one of {Sanger, Solexa, Phred64}
+
+        Return value: tuple (per-character reads/s, translation table reads/s)
+    """
+    import random
+    import time
+    random.seed(read_length)
+    low, high = {
+            'Sanger' : (33, 74), 'Solexa' : (59, 104), 'Phred64' : (64, 104)
+        }[phred_format]
+    quals = [''.join([chr(random.randint(low, high))
+                        for _ in xrange(read_length)])
+                for _ in xrange(read_count)]
+    if phred_format == 'Solexa':
+        def old_converter(qual):
+            return ''.join([
+                    chr(int(round(
+                        10*math.log(1+10**((min(max(ord(char), 59), 104)-64)
+                            /10.0),10)
+                    )+33)) for char in qual
+                ])
+    elif phred_format == 'Sanger':
+        def old_converter(qual):
+            return ''.join(chr(min(max(ord(char), 33), 93)) for char in qual)
+    else:
+        def old_converter(qual):
+            return ''.join(chr(min(max(ord(char), 64), 104) - 31)
+                                for char in qual)
+    def old_round_quality_string(qual):
+        return ''.join(
+                [str(int(
+                    _MN + math.floor((_MX - _MN) * min(
+                                                    ord(qual_char) - 33.0, 40.0
+                                                ) / 40.0)
+                        )) for qual_char in qual]).translate(
+                                _mismatch_penalties_to_quality_scores
+                            )
+    conversion_table = phred_translation_table(phred_format)
+    start_time = time.time()
+    old_quals = [old_round_quality_string(old_converter(qual))
+                    for qual in quals]
+    old_rate = read_count / (time.time() - start_time)
+    start_time = time.time()
+    new_quals = [qual.translate(conversion_table).translate(
+                        _quality_binning_table
+                    ) for qual in quals]
+    new_rate = read_count / (time.time() - start_time)
+    assert old_quals == new_quals
+    print >>sys.stderr, (
+            '%s qualities of length %d: per-character %0.1f reads/s; '
+            'translation tables %0.1f reads/s (%0.1fx).'
+        ) % (phred_format, read_length, old_rate, new_rate,
+                new_rate / old_rate)
+    return old_rate, new_rate
 
 if __name__ == '__main__':
     import argparse
@@ -976,12 +1440,36 @@ if __name__ == '__main__':
         const=True, default=False,
         help='Does not raise exception if fastq-dump doesn\'t find an SRA '
              'sample; instead, sample is skipped')
+    parser.add_argument('--workers', type=int, required=False,
+        default=0,
+        help=('Preprocess FASTQ input in a pipeline that decompresses with '
+              'pigz/gzip, parses and compresses with this many processes; '
+              '0 or 1 preprocesses serially'))
+    parser.add_argument('--stream-downloads', action='store_const',
+        const=True, default=False,
+        help=('Preprocess HTTP, FTP and S3 input files as they download '
+              'rather than saving them to scratch first, checking MD5s '
+              'from the manifest if present'))
     parser.add_argument('--verbose', action='store_const', const=True,
         default=False,
         help='Print out extra debugging statements')
+    parser.add_argument('--benchmark', action='store_const', const=True,
+        default=False,
+        help='Prints throughput of quality conversion and binning in reads '
+             'per second for each Phred format, then exits')
+    parser.add_argument('--test', action='store_const', const=True,
+        default=False,
+        help='Run unit tests; DOES NOT NEED INPUT FROM STDIN, AND DOES NOT '
+             'WRITE TO STDOUT')
     filemover.add_args(parser)
     tempdel.add_args(parser)
     args = parser.parse_args()
+
+if __name__ == '__main__' and not args.test:
+    if args.benchmark:
+        for phred_format in ['Sanger', 'Solexa', 'Phred64']:
+            quality_benchmark(phred_format=phred_format)
+        sys.exit(0)
     # Start keep_alive thread immediately
     if args.keep_alive:
         from dooplicity.tools import KeepAlive
@@ -1003,7 +1491,184 @@ if __name__ == '__main__':
         mover=mover,
         workspace_dir=args.workspace_dir,
         fastq_dump_exe=args.fastq_dump_exe,
-        ignore_missing_sra_samples=args.ignore_missing_sra_samples)
+        ignore_missing_sra_samples=args.ignore_missing_sra_samples,
+        workers=args.workers,
+        stream_downloads=args.stream_downloads)
     print >>sys.stderr, 'DONE with preprocess.py; in/out=%d/%d; ' \
         'time=%0.3f s' % (_input_line_count, _output_line_count,
-                            time.time() - start_time)
\ No newline at end of file
+                            time.time() - start_time)
+elif __name__ == '__main__':
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    import shutil
+    import random
+
+    def random_fastq(fastq_file, read_count, qnames=None, seed=0):
+        """ Writes random FASTQ records with mixed-case bases.
+
+            fastq_file: path to FASTQ file to write
+            read_count: number of records to write
+            qnames: list of read names or None to use read_0, read_1, ...
+            seed: random seed
+
+            No return value.
+        """
+        random.seed(seed)
+        with open(fastq_file, 'w') as fastq_stream:
+            for i in xrange(read_count):
+                read_length = random.randint(20, 60)
+                print >>fastq_stream, '@%s extra' % (
+                        qnames[i] if qnames else 'read_%d' % i
+                    )
+                print >>fastq_stream, ''.join(
+                        random.choice('ACGTNacgt')
+                        for _ in xrange(read_length)
+                    )
+                print >>fastq_stream, '+'
+                print >>fastq_stream, ''.join(
+                        chr(random.randint(35, 74))
+                        for _ in xrange(read_length)
+                    )
+
+    class TestWorkers(unittest.TestCase):
+        """ Tests that pipelined and serial preprocessing agree. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            # Output filenames include task partition
+            os.environ['mapreduce_task_partition'] = '0'
+            self.left_file = os.path.join(self.temp_dir_path, 'left.fastq')
+            self.right_file = os.path.join(
+                                    self.temp_dir_path, 'right.fastq'
+                                )
+            random_fastq(self.left_file, 1000, seed=1)
+            random_fastq(self.right_file, 1000, seed=2)
+            self.manifest_file = os.path.join(
+                                    self.temp_dir_path, 'manifest'
+                                )
+
+        def preprocessed(self, manifest_line, workers, **kwargs):
+            """ Runs go() on a single manifest line.
+
+                manifest_line: line of manifest, without offset field
+                workers: number of worker processes; 0 for serial mode
+                kwargs: other keyword arguments of go()
+
+                Return value: list of lines across output files
+            """
+            with open(self.manifest_file, 'w') as manifest_stream:
+                print >>manifest_stream, '0\t' + manifest_line
+            push = os.path.join(self.temp_dir_path, 'out%d' % workers)
+            os.makedirs(push)
+            old_stdin = sys.stdin
+            try:
+                with open(self.manifest_file) as sys.stdin:
+                    go(push=push, gzip_output=False, workers=workers,
+                        scratch=self.temp_dir_path, **kwargs)
+            finally:
+                sys.stdin = old_stdin
+            lines = []
+            for output_file in sorted(os.listdir(push)):
+                with open(os.path.join(push, output_file)) as output_stream:
+                    lines.extend(output_stream.read().split('\n'))
+            return lines
+
+        def test_single_end(self):
+            """ Fails if single-end output differs with workers. """
+            for kwargs in [{}, {'bin_qualities' : False,
+                                'short_qnames' : True}]:
+                serial = self.preprocessed(
+                        '\t'.join([self.left_file, '0', 'sample']), 0,
+                        **kwargs
+                    )
+                pipelined = self.preprocessed(
+                        '\t'.join([self.left_file, '0', 'sample']), 2,
+                        **kwargs
+                    )
+                self.assertTrue(len(serial) > 1000)
+                self.assertEquals(serial, pipelined)
+                shutil.rmtree(os.path.join(self.temp_dir_path, 'out0'))
+                shutil.rmtree(os.path.join(self.temp_dir_path, 'out2'))
+
+        def test_paired_end(self):
+            """ Fails if paired-end output differs with workers. """
+            # Mates with equal names get paired-end identifiers
+            random_fastq(self.right_file, 1000,
+                            qnames=['read_%d' % i for i in xrange(500)]
+                                    + ['mate_%d' % i for i in xrange(500)],
+                            seed=2)
+            manifest_line = '\t'.join([self.left_file, '0',
+                                        self.right_file, '0', 'sample'])
+            for kwargs in [{}, {'bin_qualities' : False,
+                                'short_qnames' : True}]:
+                serial = self.preprocessed(manifest_line, 0, **kwargs)
+                pipelined = self.preprocessed(manifest_line, 2, **kwargs)
+                self.assertTrue(len(serial) > 2000)
+                self.assertTrue('/1' in serial[0])
+                self.assertEquals(serial, pipelined)
+                shutil.rmtree(os.path.join(self.temp_dir_path, 'out0'))
+                shutil.rmtree(os.path.join(self.temp_dir_path, 'out2'))
+
+        def test_streamed_sources(self):
+            """ Fails if a streamed source is opened more than once. """
+            class StreamCountingMover(object):
+                """ Stands in for FileMover; streams local files. """
+                def __init__(self, files):
+                    self.files, self.streamed = files, []
+
+                def stream(self, url, md5=None):
+                    self.streamed.append(url.to_url())
+                    return open(self.files[url.to_url()])
+            urls = ['http://example.com/left.fastq',
+                    'http://example.com/right.fastq']
+            local = self.preprocessed('\t'.join([self.left_file, '0',
+                                                    self.right_file, '0',
+                                                    'sample']), 0)
+            shutil.rmtree(os.path.join(self.temp_dir_path, 'out0'))
+            for workers in [0, 2]:
+                mover = StreamCountingMover(
+                        dict(zip(urls, [self.left_file, self.right_file]))
+                    )
+                self.assertEquals(
+                        self.preprocessed('\t'.join([urls[0], '0', urls[1],
+                                                        '0', 'sample']),
+                                            workers, mover=mover,
+                                            stream_downloads=True),
+                        local
+                    )
+                self.assertEquals(sorted(mover.streamed), urls)
+                shutil.rmtree(
+                        os.path.join(self.temp_dir_path, 'out%d' % workers)
+                    )
+
+        def test_local_phred_guess(self):
+            """ Fails if a local file's Phred format is guessed from its
+                beginning alone.
+            """
+            global _phred_sample_size
+            with open(self.left_file, 'w') as fastq_stream:
+                for i in xrange(100):
+                    print >>fastq_stream, '@read_%d\n%s\n+\n%s' % (
+                            i, 'ACGT' * 10, 'h' * 40 if i < 10 else '#h' * 20
+                        )
+            # The first five records alone look like Phred64
+            sample_size, _phred_sample_size = _phred_sample_size, 5
+            try:
+                for workers in [0, 2]:
+                    output = self.preprocessed(
+                            '\t'.join([self.left_file, '0', 'sample']),
+                            workers, bin_qualities=False
+                        )
+                    self.assertTrue(']' * 40 in output[0])
+                    shutil.rmtree(
+                        os.path.join(self.temp_dir_path, 'out%d' % workers)
+                    )
+            finally:
+                _phred_sample_size = sample_size
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
@@ -17,20 +17,23 @@ in the next step.
 Input (read from stdin)
 ----------------------------
 Tab-delimited input tuple columns:
-(two kinds)
+(three kinds)
 
-Type 1:
+Type 0:
 1. Transcriptome Bowtie 2 index group number
-2. Read sequence
-3. '0' + FASTA reference name including '>'. The following format is used:
+2. '0' + isofrag ID
+3. FASTA reference name including '>'. The following format is used:
     original RNAME + '+' or '-' indicating which strand is the sense strand
     + '\x1d' + start position of sequence + '\x1d' + comma-separated list of
     subsequence sizes framing introns + '\x1d' + comma-separated list of intron
-    sizes) + '\x1d' + 'p' if derived from primary alignment to genome; 's' if
-    derived from secondary alignment to genome; 'i' if derived from cojunction
-    search
+    sizes
 4. FASTA sequence
 
+Type 1:
+1. Transcriptome Bowtie 2 index group number
+2. Read sequence
+3. '0' + isofrag ID
+
 Type 2:
 1. Transcriptome Bowtie 2 index group number
 2. Read sequence
@@ -38,9 +41,10 @@ Type 2:
 4. QNAME
 5. QUAL
 
-Type 1 corresponds to a FASTA line to index to which the read sequence is
-predicted to align. Type 2 corresponds to a distinct read. Input is partitioned
-by field 1 and sorted by field 2.
+Type 0 corresponds to a FASTA line to index, written once per index group.
+Type 1 names an isofrag of type 0 to which the read sequence is predicted to
+align. Type 2 corresponds to a distinct read. Input is partitioned by field 1
+and sorted by field 2, so isofrags precede read sequences.
 
 Hadoop output (written to stdout)
 ----------------------------
@@ -57,6 +61,8 @@ import subprocess
 import time
 import string
 import glob
+import hashlib
+import collections
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -68,24 +74,129 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.tools import xstream, register_cleanup, xopen, \
-    make_temp_dir
+    make_temp_dir, framed_output
 import bowtie
 import argparse
 import tempdel
+import index_cache
 import itertools
 
 # Initialize global variable for tracking number of input lines
 _input_line_count = 0
 
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
+# Rough number of bytes a 16-byte digest takes up in a Python set
+_bytes_per_digest = 100
+
+def write_fasta_record(fasta_stream, rname, seq, line_length=80):
+    """ Writes FASTA record with sequence split into fixed-length lines.
+
+        fasta_stream: where to write record
+        rname: FASTA reference name including '>'
+        seq: sequence
+        line_length: maximum number of bases per line
+
+        No return value.
+    """
+    fasta_stream.write(rname)
+    fasta_stream.write('\n')
+    for i in xrange(0, len(seq), line_length):
+        fasta_stream.write(seq[i:i+line_length])
+        fasta_stream.write('\n')
+
+class FastaDeduplicator(object):
+    """ Writes FASTA records, skipping those that were already written.
+
+        A record is identified by the MD5 digest of its RNAME and sequence.
+        Digests are kept in a set until it holds max_digests. After that,
+        records whose digests aren't in the set are spilled to bucket files
+        chosen by digest, so copies of a record always land in the same
+        bucket, and each bucket is deduplicated and written on close().
+    """
+    def __init__(self, fasta_stream, temp_dir_path, max_digests=5000000,
+                    bucket_count=64):
+        """
+            fasta_stream: where to write FASTA
+            temp_dir_path: where to store spilled records
+            max_digests: maximum number of digests to keep in memory before
+                spilling records to disk
+            bucket_count: number of bucket files among which to spill
+                records
+        """
+        self.fasta_stream = fasta_stream
+        self.temp_dir_path = temp_dir_path
+        self.max_digests = max_digests
+        self.bucket_count = bucket_count
+        self.digests = set()
+        self.buckets = None
+        self.record_count, self.spilled_count = 0, 0
+
+    def add(self, rname, seq):
+        """ Writes FASTA record if it hasn't been written yet.
+
+            rname: FASTA reference name including '>'
+            seq: sequence
+
+            No return value.
+        """
+        digest = hashlib.md5(rname + '\t' + seq).digest()
+        if digest in self.digests: return
+        if len(self.digests) < self.max_digests:
+            self.digests.add(digest)
+            write_fasta_record(self.fasta_stream, rname, seq)
+            self.record_count += 1
+            return
+        if self.buckets is None:
+            self.buckets = [
+                    open(os.path.join(self.temp_dir_path,
+                                      'fasta.bucket.%d' % i), 'w+')
+                    for i in xrange(self.bucket_count)
+                ]
+        print >>self.buckets[ord(digest[0]) % self.bucket_count], '\t'.join(
+                [rname, seq]
+            )
+        self.spilled_count += 1
+
+    def close(self):
+        """ Deduplicates and writes spilled records; deletes bucket files.
+
+            No return value.
+        """
+        self.digests = set()
+        if self.buckets is None: return
+        for bucket in self.buckets:
+            bucket.seek(0)
+            digests = set()
+            for line in bucket:
+                digest = hashlib.md5(line[:-1]).digest()
+                if digest in digests: continue
+                digests.add(digest)
+                rname, seq = line[:-1].split('\t')
+                write_fasta_record(self.fasta_stream, rname, seq)
+                self.record_count += 1
+            bucket.close()
+            os.remove(bucket.name)
+        self.buckets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 def input_files_from_input_stream(input_stream,
                                     output_stream,
                                     temp_dir_path=None,
                                     verbose=False,
-                                    gzip_level=3):
+                                    gzip_level=3,
+                                    max_digests=5000000):
     """ Generates FASTA reference to index and file with reads.
 
+        Isofrags are written to the FASTA as they are encountered; read
+        sequences are joined to them by isofrag ID, which need only be
+        remembered for the index group. Duplicate FASTA records are removed
+        in process by a FastaDeduplicator as the reference is written.
+
         Each line of the read file is in the following format:
 
         read number <TAB> SEQ <TAB> QUAL
@@ -95,34 +206,52 @@ def input_files_from_input_stream(input_stream,
         temp_dir_path: where to store files
         verbose: output extra debugging messages
         gzip_level: gzip compression level (0-9)
+        max_digests: maximum number of FASTA record digests to keep in
+            memory per index group before spilling records to disk
 
         Yield value: tuple (path to FASTA reference file, path to read file)
     """
     global _input_line_count
     if temp_dir_path is None: temp_dir_path = tempfile.mkdtemp()
-    prefasta_filename = os.path.join(temp_dir_path, 'temp.prefa')
-    deduped_fasta_filename = os.path.join(temp_dir_path, 'temp.deduped.prefa')
-    final_fasta_filename = os.path.join(temp_dir_path, 'temp.fa')
-    reads_filename = os.path.join(temp_dir_path, 'reads.temp.gz')
     for (counter, ((index_group,), xpartition)) in enumerate(
                                                     xstream(input_stream, 1)
                                                 ):
+        '''Files are distinct for each index group so earlier groups' files
+        can be used while later groups' are written.'''
+        final_fasta_filename = os.path.join(temp_dir_path,
+                                            'temp.%d.fa' % counter)
+        reads_filename = os.path.join(temp_dir_path,
+                                      'reads.%d.temp.gz' % counter)
         if verbose:
             print >>sys.stderr, (
-                        'Group %d: Writing prefasta and input reads...'
-                        % counter
+                        'Group %d: Writing deduplicated FASTA and input '
+                        'reads...' % counter
                     )
-        with open(prefasta_filename, 'w') as fasta_stream:
+        with open(final_fasta_filename, 'w') as fasta_stream, \
+            FastaDeduplicator(fasta_stream, temp_dir_path,
+                                max_digests=max_digests) as deduplicator:
             with xopen(True, reads_filename, 'w') as read_stream:
+                isofrag_ids = set()
                 for read_seq, values in itertools.groupby(xpartition, 
                                                     key=lambda val: val[0]):
+                    if read_seq[0] == '0':
+                        # Isofrag; add FASTA record
+                        for value in values:
+                            _input_line_count += 1
+                            deduplicator.add(value[1], value[2])
+                        isofrag_ids.add(read_seq)
+                        continue
                     fasta_printed = False
                     for value in values:
                         _input_line_count += 1
                         if value[1][0] == '0':
-                            # Print FASTA line
-                            print >>fasta_stream, '\t'.join([value[1][1:-2],
-                                                                value[2]])
+                            if value[1] not in isofrag_ids:
+                                raise RuntimeError(
+                                        'Isofrag ID "%s" of read sequence '
+                                        '%s was not found in index group '
+                                        '%s.' % (value[1], read_seq,
+                                                    index_group)
+                                    )
                             fasta_printed = True
                         elif fasta_printed:
                             '''Add to temporary seq stream only if an
@@ -160,58 +289,13 @@ def input_files_from_input_stream(input_stream,
                                     )
         if verbose:
             print >>sys.stderr, (
-                        'Group %d: Done! Sorting and deduplicating prefasta...'
-                        % counter
-                    )
-        # Sort prefasta and eliminate duplicate lines
-        dedup_process_return = subprocess.call(
-                r'''sort %s | uniq >%s'''
-                % (prefasta_filename, deduped_fasta_filename), shell=True,
-                executable='/bin/bash'
-            )
-        if dedup_process_return != 0:
-            raise RuntimeError(
-                    'Problem encountered deduplicating FASTA reference'
-                )
-        if verbose:
-            print >>sys.stderr, (
-                    'Group %d Done! Writing final FASTA.' % counter
+                    'Group %d: Done! Wrote %d distinct FASTA records, %d of '
+                    'which were spilled to disk.'
+                    % (counter, deduplicator.record_count,
+                        deduplicator.spilled_count)
                 )
-        with open(final_fasta_filename, 'w') as final_fasta_stream:
-            with open(deduped_fasta_filename) as fasta_stream:
-                for line in fasta_stream:
-                    rname, seq = line.strip().split('\t')
-                    print >>final_fasta_stream, rname
-                    final_fasta_stream.write(
-                        '\n'.join([seq[i:i+80] for i 
-                                    in xrange(0, len(seq), 80)])
-                    )
-                    final_fasta_stream.write('\n')
-        os.remove(deduped_fasta_filename)
-        os.remove(prefasta_filename)
         yield final_fasta_filename, reads_filename
 
-def create_index_from_reference_fasta(bowtie2_build_exe, fasta_file,
-        index_basename):
-    """ Creates Bowtie2 index from reference fasta.
-
-        bowtie2_build_exe: Path to Bowtie2
-        fasta_file: Path to reference FASTA to index
-        index_basename: Path to index basename to be created
-
-        Return value: return value of bowtie-build process
-    """
-    with open(os.devnull) as null_stream:
-        bowtie_build_process = subprocess.Popen(
-                                    [args.bowtie2_build_exe,
-                                        fasta_file,
-                                        index_basename],
-                                    stderr=null_stream,
-                                    stdout=null_stream
-                                )
-    bowtie_build_process.wait()
-    return bowtie_build_process.returncode
-
 def handle_temporary_directory(archive, temp_dir_path):
     """ Archives or deletes temporary directory.
 
@@ -234,7 +318,8 @@ def handle_temporary_directory(archive, temp_dir_path):
 def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
     bowtie2_build_exe='bowtie2-build', bowtie2_args=None,
     temp_dir_path=None, verbose=False, report_multiplier=1.2, gzip_level=3,
-    count_multiplier=4, tie_margin=0):
+    count_multiplier=4, tie_margin=0, dedup_memory=512,
+    bowtie2_index_cache=None, build_threads=2):
     """ Runs Rail-RNA-realign.
 
         Realignment script for MapReduce pipelines that wraps Bowtie2. Creates
@@ -250,31 +335,35 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         Input (read from stdin)
         ----------------------------
         Tab-delimited input tuple columns:
-        (two kinds)
+        (three kinds)
 
-        Type 1:
+        Type 0:
         1. Transcriptome Bowtie 2 index group number
-        2. Read sequence
-        3. '\x1c' + FASTA reference name including '>'. The following format is
+        2. '0' + isofrag ID
+        3. FASTA reference name including '>'. The following format is
             used: original RNAME + '+' or '-' indicating which strand is the
             sense strand + '\x1d' + start position of sequence + '\x1d'
             + comma-separated list of subsequence sizes framing junctions
-            + '\x1d' + comma-separated list of intron sizes) + '\x1d'
-            + 'p' if derived from primary alignment to genome; 's' if derived
-            from secondary alignment to genome; 'i' if derived from cojunction
-            search
+            + '\x1d' + comma-separated list of intron sizes
         4. FASTA sequence
 
+        Type 1:
+        1. Transcriptome Bowtie 2 index group number
+        2. Read sequence
+        3. '0' + isofrag ID
+
         Type 2:
         1. Transcriptome Bowtie 2 index group number
         2. Read sequence
-        3. 1 if SEQ is reverse-complemented, else 0
+        3. 2 if SEQ is reverse-complemented, else 1
         4. QNAME
         5. QUAL
 
-        Type 1 corresponds to a FASTA line to index to which the read sequence
-        is predicted to align. Type 2 corresponds to a distinct read. Input is
-        partitioned by field 1 and sorted by field 2.
+        Type 0 corresponds to a FASTA line to index, written once per index
+        group. Type 1 names an isofrag of type 0 to which the read sequence is
+        predicted to align. Type 2 corresponds to a distinct read. Input is
+        partitioned by field 1 and sorted by field 2, so isofrags precede
+        read sequences.
 
         Hadoop output (written to stdout)
         ----------------------------
@@ -304,22 +393,24 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
             alignment_count_to_report is the user-specified bowtie2 -k arg
         tie_margin: allowed score difference per 100 bases among ties in 
              max alignment score.
+        dedup_memory: approximate memory (in MB) to use for deduplicating
+            FASTA records of an index group before spilling to disk
+        bowtie2_index_cache: index_cache.IndexCache object to consult
+            before building an index group's index, or None to always build
+        build_threads: number of threads in which to build indexes
 
         No return value.
     """
     start_time = time.time()
     if temp_dir_path is None: temp_dir_path = tempfile.mkdtemp()
-    bowtie2_index_base = os.path.join(temp_dir_path, 'tempidx')
     alignment_count_to_report, _, _ \
             = bowtie.parsed_bowtie_args(bowtie2_args)
-    reads_filename = os.path.join(temp_dir_path, 'reads.temp')
-    input_command = 'gzip -cd %s' % reads_filename
     bowtie_command = ' ' .join([bowtie2_exe,
         bowtie2_args if bowtie2_args is not None else '',
         '{0} --local -t --no-hd --mm -x'.format(
                 '-k {0}'.format(alignment_count_to_report * count_multiplier)
             ),
-        bowtie2_index_base, '--12 -'])
+        '{index_basename}', '--12 -'])
     delegate_command = ''.join(
             [sys.executable, ' ', os.path.realpath(__file__)[:-3],
                 ('_delegate.py --report-multiplier %08f '
@@ -329,28 +420,36 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
                         tie_margin, '--verbose' if verbose else '')]
         )
     # Use grep to kill empty lines terminating python script
-    full_command = ' | '.join([input_command, 
+    full_command = ' | '.join(['gzip -cd {reads_file}', 
                                 bowtie_command, delegate_command])
     print >>sys.stderr, 'Bowtie2 command to execute: ' + full_command
-    for fasta_file, reads_file in input_files_from_input_stream(
-                                                input_stream,
-                                                output_stream,
-                                                verbose=verbose,
-                                                temp_dir_path=temp_dir_path,
-                                                gzip_level=gzip_level
-                                            ):
-        bowtie_build_return_code = create_index_from_reference_fasta(
-                                        bowtie2_build_exe,
-                                        fasta_file,
-                                        bowtie2_index_base
-                                    )
+
+    def align_group(bowtie_build_return_code, fasta_file, reads_file,
+                        index_basename):
+        """ Aligns reads of an index group once its index is built.
+
+            bowtie_build_return_code: return value of index_cache.build()
+            fasta_file: path to index group's FASTA reference
+            reads_file: path to index group's reads
+            index_basename: path to basename of index group's index
+
+            No return value.
+        """
+        try:
+            os.remove(fasta_file)
+        except OSError:
+            pass
         if bowtie_build_return_code == 0:
-            try:
-                os.remove(fasta_file)
-            except OSError:
-                pass
+            '''Don't let buffered output interleave with Bowtie 2's. The
+            delegate's framed output starts a new framed stream, and blocks
+            written here afterward are read with its codec, which is the
+            same as output_stream's.'''
+            output_stream.flush()
             bowtie_process = subprocess.Popen(' '.join(
-                        ['set -exo pipefail;', full_command]
+                        ['set -exo pipefail;', full_command.format(
+                                reads_file=reads_file,
+                                index_basename=index_basename
+                            )]
                     ), bufsize=-1,
                 stdout=sys.stdout, stderr=sys.stderr, shell=True,
                 executable='/bin/bash')
@@ -366,6 +465,54 @@ def go(input_stream=sys.stdin, output_stream=sys.stdout, bowtie2_exe='bowtie2',
         else:
             raise RuntimeError('Bowtie build process failed with exitlevel %d.'
                                 % bowtie_build_return_code)
+        for index_file in glob.glob(index_basename + '.*') + [reads_file]:
+            os.remove(index_file)
+
+    '''Indexes are built in a thread pool while later index groups' files
+    are written; groups are aligned in order as their indexes finish.'''
+    if build_threads > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(build_threads)
+    else:
+        pool = None
+    pending = collections.deque()
+    for counter, (fasta_file, reads_file) in enumerate(
+                input_files_from_input_stream(
+                        input_stream,
+                        output_stream,
+                        verbose=verbose,
+                        temp_dir_path=temp_dir_path,
+                        gzip_level=gzip_level,
+                        max_digests=(
+                            dedup_memory * 1048576 // _bytes_per_digest
+                        )
+                    )
+            ):
+        index_basename = os.path.join(temp_dir_path, 'tempidx.%d' % counter)
+        if pool is None:
+            align_group(index_cache.build(bowtie2_build_exe, fasta_file,
+                                          index_basename,
+                                          cache=bowtie2_index_cache),
+                        fasta_file, reads_file, index_basename)
+            continue
+        pending.append((pool.apply_async(index_cache.build,
+                                         (bowtie2_build_exe, fasta_file,
+                                            index_basename),
+                                         dict(cache=bowtie2_index_cache)),
+                        fasta_file, reads_file, index_basename))
+        while len(pending) > build_threads:
+            build_result, fasta_file, reads_file, index_basename \
+                = pending.popleft()
+            align_group(build_result.get(), fasta_file, reads_file,
+                        index_basename)
+    while pending:
+        build_result, fasta_file, reads_file, index_basename \
+            = pending.popleft()
+        align_group(build_result.get(), fasta_file, reads_file,
+                    index_basename)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     print >>sys.stderr, 'DONE with realign_reads.py; in=%d; ' \
         'time=%0.3f s' % (_input_line_count, time.time() - start_time)
@@ -406,10 +553,20 @@ if __name__ == '__main__':
     parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
         help='Level of gzip compression to use, if applicable')
+    parser.add_argument('--dedup-memory', metavar='MB', type=int,
+        required=False, default=512,
+        help='Approximate memory to use for deduplicating the FASTA '
+             'reference of an index group; records are spilled to disk '
+             'past this')
+
+    parser.add_argument('--build-threads', metavar='INT', type=int,
+        required=False, default=2,
+        help='Number of threads in which to build indexes of index groups')
 
     # Add command-line arguments for dependencies
     bowtie.add_args(parser)
     tempdel.add_args(parser)
+    index_cache.add_args(parser)
     from alignment_handlers import add_args as alignment_handlers_add_args
     alignment_handlers_add_args(parser)
 
@@ -444,7 +601,9 @@ if __name__ == '__main__' and not args.test:
     if args.verbose:
         print >>sys.stderr, 'Creating temporary directory %s' \
             % temp_dir_path
-    go(bowtie2_exe=os.path.expandvars(args.bowtie2_exe),
+    output_stream = framed_output(sys.stdout)
+    go(output_stream=output_stream,
+        bowtie2_exe=os.path.expandvars(args.bowtie2_exe),
         bowtie2_build_exe=os.path.expandvars(args.bowtie2_build_exe),
         bowtie2_args=bowtie_args,
         temp_dir_path=temp_dir_path,
@@ -452,9 +611,161 @@ if __name__ == '__main__' and not args.test:
         report_multiplier=args.report_multiplier,
         gzip_level=args.gzip_level,
         count_multiplier=args.count_multiplier,
-        tie_margin=args.tie_margin)
+        tie_margin=args.tie_margin,
+        dedup_memory=args.dedup_memory,
+        bowtie2_index_cache=index_cache.cache_from_args(
+                args, salt=args.bowtie2_build_exe
+            ),
+        build_threads=args.build_threads)
+    output_stream.close()
 elif __name__ == '__main__':
     # Test units
     del sys.argv[1:] # Don't choke on extra command-line parameters
     import unittest
+    import shutil
+    from StringIO import StringIO
+
+    def fasta_records(fasta):
+        """ Parses FASTA text.
+
+            fasta: FASTA text
+
+            Return value: list of tuples (RNAME including '>', sequence)
+        """
+        records = []
+        for line in fasta.split('\n'):
+            if not line: continue
+            if line[0] == '>':
+                records.append((line, []))
+            else:
+                records[-1][1].append(line)
+        return [(rname, ''.join(seq)) for rname, seq in records]
+
+    class TestFastaDeduplicator(unittest.TestCase):
+        """ Tests FastaDeduplicator. """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.records = [('>%d' % (i % 5), 'ACGT' * (i % 7 + 1) + 'A')
+                                for i in xrange(200)]
+            self.unique_records = []
+            for record in self.records:
+                if record not in self.unique_records:
+                    self.unique_records.append(record)
+
+        def deduplicated(self, records, **kwargs):
+            """ Adds records to a FastaDeduplicator.
+
+                records: list of tuples (RNAME, sequence)
+                kwargs: keyword arguments of FastaDeduplicator
+
+                Return value: tuple (FASTA records written, deduplicator)
+            """
+            fasta_stream = StringIO()
+            with FastaDeduplicator(fasta_stream, self.temp_dir_path,
+                                    **kwargs) as deduplicator:
+                for rname, seq in records:
+                    deduplicator.add(rname, seq)
+            return fasta_records(fasta_stream.getvalue()), deduplicator
+
+        def test_duplicates(self):
+            """ Fails if a record is written more than once. """
+            records, deduplicator = self.deduplicated(self.records)
+            self.assertEqual(records, self.unique_records)
+            self.assertEqual(deduplicator.record_count,
+                             len(self.unique_records))
+            self.assertEqual(deduplicator.spilled_count, 0)
+            # Same sequence under another RNAME is a distinct record
+            records, _ = self.deduplicated([('>0', 'ACGT'), ('>1', 'ACGT'),
+                                            ('>0', 'ACGT')])
+            self.assertEqual(records, [('>0', 'ACGT'), ('>1', 'ACGT')])
+
+        def test_spill(self):
+            """ Fails if spilled records aren't deduplicated. """
+            records, deduplicator = self.deduplicated(
+                    self.records, max_digests=4, bucket_count=3
+                )
+            self.assertEqual(sorted(records), sorted(self.unique_records))
+            self.assertEqual(len(records), len(self.unique_records))
+            self.assertEqual(deduplicator.record_count,
+                             len(self.unique_records))
+            self.assertTrue(deduplicator.spilled_count > 0)
+            # Buckets are deleted on close()
+            self.assertEqual(os.listdir(self.temp_dir_path), [])
+
+        def test_order(self):
+            """ Fails if records kept in memory aren't written first, in the
+                order they were added.
+            """
+            records, _ = self.deduplicated(self.records, max_digests=4)
+            self.assertEqual(records[:4], self.unique_records[:4])
+            fasta_stream = StringIO()
+            with FastaDeduplicator(fasta_stream,
+                                    self.temp_dir_path) as deduplicator:
+                deduplicator.add('>long', 'A' * 80 + 'C' * 80 + 'G')
+            self.assertEqual(fasta_stream.getvalue(),
+                             '>long\n' + 'A' * 80 + '\n' + 'C' * 80
+                             + '\nG\n')
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
+    class TestInputFilesFromInputStream(unittest.TestCase):
+        """ Tests input_files_from_input_stream(). """
+        def setUp(self):
+            # Set up temporary directory
+            self.temp_dir_path = tempfile.mkdtemp()
+
+        def test_join(self):
+            """ Fails if read sequences aren't joined to isofrags by ID. """
+            input_stream = StringIO('\n'.join([
+                    '000000000000\t0abc\t>chr1+\x1d1\x1d4,4\x1d10\tACGTTGCA',
+                    '000000000000\tAAAAC\t0abc',
+                    '000000000000\tAAAAC\t1\tread1\tIIIII',
+                    '000000000000\tCCCCA\t2\tread2\tIIIIH',
+                    '000000000001\t0abc\t>chr1+\x1d1\x1d4,4\x1d10\tACGTTGCA',
+                    '000000000001\tGGGGT\t0abc',
+                    '000000000001\tGGGGT\t2\tread3\tHIIII'
+                ]) + '\n')
+            output_stream = StringIO()
+            fasta_and_reads = []
+            for fasta_filename, reads_filename in \
+                input_files_from_input_stream(input_stream, output_stream,
+                                                self.temp_dir_path):
+                with open(fasta_filename) as fasta_stream:
+                    fasta = fasta_records(fasta_stream.read())
+                with xopen(True, reads_filename) as read_stream:
+                    reads = read_stream.read().strip().split('\n')
+                fasta_and_reads.append((fasta, reads))
+            self.assertEqual(
+                    fasta_and_reads,
+                    [([('>chr1+\x1d1\x1d4,4\x1d10', 'ACGTTGCA')],
+                      ['read1\tAAAAC\tIIIII']),
+                     ([('>chr1+\x1d1\x1d4,4\x1d10', 'ACGTTGCA')],
+                      ['read3\tACCCC\tIIIIH'])]
+                )
+            # Read without isofrag is output as unmapped
+            self.assertEqual(output_stream.getvalue().split('\t')[0],
+                             'read2')
+
+        def test_missing_isofrag(self):
+            """ Fails if a read sequence whose isofrag ID wasn't seen in its
+                index group passes.
+            """
+            input_stream = StringIO('\n'.join([
+                    '000000000000\t0abc\t>chr1+\x1d1\x1d4,4\x1d10\tACGTTGCA',
+                    '000000000001\tAAAAC\t0abc',
+                    '000000000001\tAAAAC\t1\tread1\tIIIII'
+                ]) + '\n')
+            with self.assertRaises(RuntimeError):
+                for _ in input_files_from_input_stream(
+                        input_stream, StringIO(), self.temp_dir_path
+                    ):
+                    pass
+
+        def tearDown(self):
+            # Kill temporary directory
+            shutil.rmtree(self.temp_dir_path)
+
     unittest.main()
\ No newline at end of file
@@ -18,7 +18,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import xstream, xopen
+from dooplicity.tools import xstream, xopen, framed_output
 
 import string
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
@@ -103,7 +103,10 @@ if __name__ == '__main__':
     alignment_handlers_add_args(parser)
     args = parser.parse_args()
 
-    go(verbose=args.verbose,
+    output_stream = framed_output(sys.stdout)
+    go(output_stream=output_stream,
+        verbose=args.verbose,
         report_multiplier=args.report_multiplier,
         alignment_count_to_report=args.alignment_count_to_report,
-        tie_margin=args.tie_margin)
\ No newline at end of file
+        tie_margin=args.tie_margin)
+    output_stream.close()
\ No newline at end of file
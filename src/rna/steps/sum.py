@@ -60,7 +60,7 @@ utils_path = os.path.join(base_path, 'rna', 'utils')
 site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
-from dooplicity.tools import dlist
+from dooplicity.tools import dlist, xlines, framed_output
 
 start_time = time.time()
 
@@ -90,9 +90,11 @@ if args.keep_alive:
     keep_alive_thread = KeepAlive(sys.stderr)
 
 input_line_count, output_line_count = 0, 0
+input_lines = xlines(sys.stdin)
+output_stream = framed_output(sys.stdout)
 
 # Must consume a line of stdin before outputting status messages
-line = sys.stdin.readline()
+line = next(input_lines, '')
 if args.keep_alive: keep_alive_thread.start()
 
 if args.type == 1:
@@ -112,15 +114,17 @@ if args.type == 1:
             if key != last_key and last_key is not None:
                 write_line = True
         if write_line:
-            print '\t'.join(last_key + [('%d' % totals[i])
-                                            for i in xrange(len(totals))])
+            print >>output_stream, '\t'.join(
+                    last_key + [('%d' % totals[i])
+                                    for i in xrange(len(totals))]
+                )
             output_line_count += 1
             totals, write_line = [0]*args.value_count, False
         if not line: break
         for i in xrange(1, args.value_count+1):
             totals[-i] += int(tokens[-i])
         last_key = key
-        line = sys.stdin.readline()
+        line = next(input_lines, '')
 elif args.type == 2:
     last_key, totals, write_line = None, [0.0]*args.value_count, False
     while True:
@@ -138,15 +142,17 @@ elif args.type == 2:
             if key != last_key and last_key is not None:
                 write_line = True
         if write_line:
-            print '\t'.join(last_key + [('%0.11f' % totals[i])
-                                            for i in xrange(len(totals))])
+            print >>output_stream, '\t'.join(
+                    last_key + [('%0.11f' % totals[i])
+                                    for i in xrange(len(totals))]
+                )
             output_line_count += 1
             totals, write_line = [0.0]*args.value_count, False
         if not line: break
         for i in xrange(1, args.value_count+1):
             totals[-i] += float(tokens[-i])
         last_key = key
-        line = sys.stdin.readline()
+        line = next(input_lines, '')
 else:
     last_key, totals, write_line \
         = None, [dlist() for i in xrange(args.value_count)], False
@@ -165,16 +171,16 @@ else:
             if key != last_key and last_key is not None:
                 write_line = True
         if write_line:
-            sys.stdout.write('\t'.join(last_key))
+            output_stream.write('\t'.join(last_key))
             for total in totals:
-                sys.stdout.write('\t')
+                output_stream.write('\t')
                 j = None
                 for j, item in enumerate(total):
-                    if j > 0: sys.stdout.write('\x1d')
-                    sys.stdout.write(item)
+                    if j > 0: output_stream.write('\x1d')
+                    output_stream.write(item)
                 if j is None:
-                    sys.stdout.write('\x1c')
-            sys.stdout.write('\n')
+                    output_stream.write('\x1c')
+            output_stream.write('\n')
             output_line_count += 1
             for a_list in totals:
                 a_list.tear_down()
@@ -185,8 +191,8 @@ else:
             if tokens[-i] != '\x1c':
                 totals[-i].append(tokens[-i])
         last_key = key
-        line = sys.stdin.readline()
-    sys.stdout.flush()
+        line = next(input_lines, '')
+output_stream.close()
 
 print >>sys.stderr, 'DONE with sum.py; in/out=%d/%d; time=%0.3f s' \
                         % (input_line_count, output_line_count, 
@@ -23,10 +23,13 @@ Tab-delimited output tuple columns (collect)
 5. '+' or '-' indicating which strand is the sense strand for junctions,
    inserted sequence for insertions, or deleted sequence for deletions
    or '\x1c' if field 1 is '3'
-6. Coverage of feature for sample with index N
-    or normalization factor
+6. Sample index + ':' + coverage of feature in that sample for a sample in
+    which the feature was found, or normalization factor
 ...
-N + 6. Coverage of feature in sample with index N
+N + 6. Sample index + ':' + coverage of feature in that sample for another
+    sample in which the feature was found
+(A dense list of coverages in all samples, where missing coverages at the end
+are zeros, is also accepted in place of the sample index/coverage pairs.)
 
 Input is partitioned by field 1 and sorted by fields 2-5.
 
@@ -48,6 +51,16 @@ insertion, first base of deletion, or first base of intron) + ';' +
 end position (last base before insertion, last base of deletion (exclusive), or
 last base of intron (exclusive))
 
+If --matrix-format is sparse or both, each matrix is (also) written in a
+sparse coordinate format to three TSV files, where rows and columns are
+numbered from 0:
+[junctions/insertions/deletions].sparse.tsv.gz: one line for each nonzero
+    element with tab-separated fields (row index, column index, coverage)
+[junctions/insertions/deletions].rows.tsv.gz: feature on each row, one per
+    line in row order, specified as above
+[junctions/insertions/deletions].columns.tsv.gz: sample label in each column,
+    one per line in column order
+
 2) Normalization factors for sample read coverage distributions
 Tab-delimited tuple columns:
 1. Sample name
@@ -58,6 +71,7 @@ import os
 import sys
 import site
 import argparse
+import contextlib
 
 base_path = os.path.abspath(
                     os.path.dirname(os.path.dirname(os.path.dirname(
@@ -69,7 +83,8 @@ site.addsitedir(utils_path)
 site.addsitedir(base_path)
 
 from dooplicity.ansibles import Url
-from dooplicity.tools import xstream, register_cleanup, make_temp_dir, xopen
+from dooplicity.tools import xstream, register_cleanup, make_temp_dir, \
+    xopen
 import bowtie
 import bowtie_index
 import manifest
@@ -91,96 +106,323 @@ parser.add_argument(
     default='',
     help='The basename (excluding path) of TSV output. Basename is '
          'followed by ".[junctions/insertions/deletions].tsv.gz"')
+parser.add_argument(
+    '--matrix-format', type=str, required=False, default='dense',
+    choices=['dense', 'sparse', 'both'],
+    help='Whether to write junction/indel matrices as dense TSVs with a '
+         'column for every sample, in a sparse coordinate format that '
+         'stores only nonzero coverages, or both')
 parser.add_argument('--gzip-level', type=int, required=False,
         default=3,
         help='Level of gzip compression to use for temporary files')
+parser.add_argument('--bgzf-threads', type=int, required=False,
+        default=0,
+        help=('Write output as BGZF, a gzip-compatible format, compressing '
+              'blocks with this many threads; 0 writes gzip output with a '
+              'single gzip process'))
+parser.add_argument('--bgzf-index', action='store_const', const=True,
+        default=False,
+        help=('Write a coordinate index next to each BGZF output file with '
+              'extension .idx; ignored unless --bgzf-threads > 0'))
 parser.add_argument(
     '--keep-alive', action='store_const', const=True, default=False,
     help='Prints reporter:status:alive messages to stderr to keep EMR '
          'task alive')
+parser.add_argument(
+    '--test', action='store_const', const=True, default=False,
+    help='Run unit tests; DOES NOT NEED INPUT FROM STDIN, AND DOES NOT '
+         'WRITE TO STDOUT')
 
 bowtie.add_args(parser)
 filemover.add_args(parser)
 tempdel.add_args(parser)
 args = parser.parse_args()
 
-# Start keep_alive thread immediately
-if args.keep_alive:
-    from dooplicity.tools import KeepAlive
-    keep_alive_thread = KeepAlive(sys.stderr)
-    keep_alive_thread.start()
+def output_path_and_filename(suffix):
+    """ Gets path to which output file should be written and its name.
 
-import time
-start_time = time.time()
+        suffix: end of filename following basename, if any
 
-reference_index = bowtie_index.BowtieIndexReference(
-                        os.path.expandvars(args.bowtie_idx)
-                    )
-# For mapping sample indices back to original sample labels
-manifest_object = manifest.LabelsAndIndices(
-                        os.path.expandvars(args.manifest)
-                    )
-output_url = Url(args.out) if args.out is not None \
-    else Url(os.getcwd())
-input_line_count = 0
-if output_url.is_local:
-    # Set up destination directory
-    try: os.makedirs(output_url.to_url())
-    except: pass
-else:
-    mover = filemover.FileMover(args=args)
-    # Set up temporary destination
-    import tempfile
-    temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
-    register_cleanup(tempdel.remove_temporary_directories, [temp_dir_path])
-
-input_line_count = 0
-for (line_type,), xpartition in xstream(sys.stdin, 1):
-    type_string = ('insertions' if line_type == '0' else
-                    ('deletions' if line_type == '1' else
-                      ('junctions' if line_type == '2' else
-                        'normalization')))
+        Return value: tuple (path to output file, output filename)
+    """
     output_filename = ((args.tsv_basename + '.' 
                           if args.tsv_basename != '' else '')
-                          + type_string + '.tsv.gz')
+                          + suffix)
+    if output_url.is_local:
+        return os.path.join(args.out, output_filename), output_filename
+    return os.path.join(temp_dir_path, output_filename), output_filename
+
+def sample_coverages(coverages):
+    """ Gets nonzero coverages of a feature by sample.
+
+        coverages: tuple of coverage fields from a collect line, either
+            sample index + ':' + coverage for each sample in which feature
+            was found or coverages in all samples in order, possibly missing
+            zeros at the end
+
+        Return value: list of tuples (sample index, coverage string) in order
+            of sample index
+    """
+    if coverages and ':' in coverages[0]:
+        return [(int(sample_index), coverage) for sample_index, coverage
+                in (sample_coverage.split(':')
+                    for sample_coverage in coverages)]
+    return [(i, coverage) for i, coverage in enumerate(coverages)
+            if coverage != '0']
+
+def matrix_index_key(line):
+    """ Gets the coordinate of a matrix row for a BGZF index.
+
+        line: line of dense matrix or row index without its newline
+
+        Return value: tuple (RNAME, start position) or None if line is a
+            header
+    """
+    feature = line.partition('\t')[0].split(';')
+    try:
+        return feature[0], int(feature[-2])
+    except (IndexError, ValueError):
+        return None
+
+def output_opener(output_path, index_key=None):
+    """ Opens an output file for writing with gzip or BGZF compression.
+
+        output_path: path to output file
+        index_key: function passed to BgzfWriter for indexing the file or None
+            if it shouldn't be indexed
+
+        Return value: context manager yielding output stream
+    """
+    if args.bgzf_threads:
+        return xopen('bgzf', output_path, 'w', args.gzip_level,
+                        args.bgzf_threads,
+                        index_key if args.bgzf_index else None)
+    return xopen(True, output_path, 'w', args.gzip_level)
+
+def write_coverage_matrix(xpartition, string_to_rname, labels,
+                            dense_stream=None, sparse_streams=None):
+    """ Writes a junction/indel coverage matrix in dense and/or sparse format.
+
+        xpartition: iterable over tuples (RNAME number string, start
+            position, end position, strand or sequence, coverage fields...)
+            from collect lines of one type
+        string_to_rname: dictionary mapping RNAME number strings to RNAMEs
+        labels: list of sample labels in order of sample index
+        dense_stream: where to write dense matrix or None if it shouldn't be
+            written
+        sparse_streams: tuple (stream for coordinate triplets, stream for row
+            index, stream for column index) or None if sparse matrix
+            shouldn't be written
+
+        Return value: number of input lines read
+    """
+    sample_count = len(labels)
+    if dense_stream is not None:
+        '''Print all labels in the order in which they appear in the manifest
+        file.'''
+        for label in labels:
+            dense_stream.write('\t' + label)
+        dense_stream.write('\n')
+    if sparse_streams is not None:
+        triplet_stream, row_stream, column_stream = sparse_streams
+        for label in labels:
+            print >>column_stream, label
+    input_line_count = 0
+    for row_index, coverage_line in enumerate(xpartition):
+        input_line_count += 1
+        (rname, pos, end_pos, strand_or_seq) = coverage_line[:4]
+        feature = ';'.join(
+                [string_to_rname[rname],
+                    strand_or_seq, str(int(pos)), str(int(end_pos))]
+            )
+        coverages = sample_coverages(coverage_line[4:])
+        if dense_stream is not None:
+            '''Fill in zeros here; in previous step, they were left out so
+            they wouldn't cross the shuffle.'''
+            dense_coverages = ['0'] * sample_count
+            for sample_index, coverage in coverages:
+                dense_coverages[sample_index] = coverage
+            print >>dense_stream, '\t'.join([feature] + dense_coverages)
+        if sparse_streams is not None:
+            print >>row_stream, feature
+            for sample_index, coverage in coverages:
+                print >>triplet_stream, '%d\t%d\t%s' % (
+                        row_index, sample_index, coverage
+                    )
+    return input_line_count
+
+if __name__ == '__main__' and not args.test:
+    # Start keep_alive thread immediately
+    if args.keep_alive:
+        from dooplicity.tools import KeepAlive
+        keep_alive_thread = KeepAlive(sys.stderr)
+        keep_alive_thread.start()
+
+    import time
+    start_time = time.time()
+
+    reference_index = bowtie_index.BowtieIndexReference(
+                            os.path.expandvars(args.bowtie_idx),
+                            with_sequence=False
+                        )
+    # For mapping sample indices back to original sample labels
+    manifest_object = manifest.LabelsAndIndices(
+                            os.path.expandvars(args.manifest)
+                        )
+    output_url = Url(args.out) if args.out is not None \
+        else Url(os.getcwd())
+    input_line_count = 0
     if output_url.is_local:
-        output_path = os.path.join(args.out, output_filename)
+        # Set up destination directory
+        try: os.makedirs(output_url.to_url())
+        except: pass
     else:
-        output_path = os.path.join(temp_dir_path, output_filename)
-    with xopen(True, output_path, 'w', args.gzip_level) as output_stream:
+        mover = filemover.FileMover(args=args)
+        # Set up temporary destination
+        import tempfile
+        temp_dir_path = make_temp_dir(tempdel.silentexpandvars(args.scratch))
+        register_cleanup(tempdel.remove_temporary_directories,
+                            [temp_dir_path])
+
+    dense = args.matrix_format in ['dense', 'both']
+    sparse = args.matrix_format in ['sparse', 'both']
+    input_line_count = 0
+    for (line_type,), xpartition in xstream(sys.stdin, 1):
+        type_string = ('insertions' if line_type == '0' else
+                        ('deletions' if line_type == '1' else
+                          ('junctions' if line_type == '2' else
+                            'normalization')))
         if line_type != '3':
-            '''Print all labels in the order in which they appear in the
-            manifest file.'''
             sample_count = len(manifest_object.index_to_label)
-            for i in xrange(sample_count):
-                output_stream.write(
-                        '\t' + manifest_object.index_to_label[str(i)]
+            suffixes_and_index_keys = (
+                    [(type_string + '.tsv.gz', matrix_index_key)]
+                    if dense else []
+                ) + ([('.'.join([type_string, 'sparse', 'tsv.gz']), None),
+                      ('.'.join([type_string, 'rows', 'tsv.gz']),
+                        matrix_index_key),
+                      ('.'.join([type_string, 'columns', 'tsv.gz']), None)]
+                    if sparse else [])
+        else:
+            suffixes_and_index_keys = [(type_string + '.tsv.gz', None)]
+        output_paths_and_filenames = [
+                output_path_and_filename(suffix)
+                for suffix, _ in suffixes_and_index_keys
+            ]
+        with contextlib.nested(*[output_opener(output_path, index_key)
+                                    for (output_path, _), (_, index_key)
+                                    in zip(output_paths_and_filenames,
+                                            suffixes_and_index_keys)]) \
+            as output_streams:
+            if line_type != '3':
+                input_line_count += write_coverage_matrix(
+                        xpartition, reference_index.string_to_rname,
+                        [manifest_object.index_to_label[str(i)]
+                            for i in xrange(sample_count)],
+                        dense_stream=(output_streams[0] if dense else None),
+                        sparse_streams=(output_streams[-3:] if sparse
+                                            else None)
                     )
-            output_stream.write('\n')
-            for coverage_line in xpartition:
-                input_line_count += 1
-                (rname, pos, end_pos, strand_or_seq) = coverage_line[:4]
-                '''Handle missing zeros at end of line here; in previous step,
-                the total number of samples was unknown, so this was not
-                done.'''
-                print >>output_stream, '\t'.join(
-                    (';'.join(
-                        [reference_index.string_to_rname[rname],
-                            strand_or_seq, str(int(pos)), str(int(end_pos))]
-                    ),) + coverage_line[4:] + ('0',)*(-len(coverage_line) + 4
-                                                        + sample_count)
+            else:
+                output_stream = output_streams[0]
+                for (sample_index, _, _, _,
+                        factor, unique_factor) in xpartition:
+                    input_line_count += 1
+                    print >>output_stream, '\t'.join([
+                            manifest_object.index_to_label[sample_index],
+                            factor, unique_factor
+                        ])
+
+        if not output_url.is_local:
+            for (output_path, output_filename), (_, index_key) in zip(
+                    output_paths_and_filenames, suffixes_and_index_keys
+                ):
+                mover.put(output_path, output_url.plus(output_filename))
+                os.remove(output_path)
+                if args.bgzf_threads and args.bgzf_index and index_key:
+                    mover.put(output_path + '.idx',
+                                output_url.plus(output_filename + '.idx'))
+                    os.remove(output_path + '.idx')
+
+    print >>sys.stderr, 'DONE with tsv.py; in=%d; time=%0.3f s' \
+                            % (input_line_count, time.time() - start_time)
+elif __name__ == '__main__':
+    # Test units
+    import unittest
+    from cStringIO import StringIO
+
+    class TestWriteCoverageMatrix(unittest.TestCase):
+        """ Tests write_coverage_matrix() in dense and sparse modes. """
+        def setUp(self):
+            self.string_to_rname = {'000000000000' : 'chr1',
+                                    '000000000001' : 'chr2'}
+            self.labels = ['a', 'b', 'c']
+            self.xpartition = [
+                    ('000000000000', '140', '140', 'ATAC', '0:12'),
+                    ('000000000000', '150', '156', 'AACCTT', '0:3', '2:5'),
+                    # Dense coverages missing zeros at the end
+                    ('000000000001', '3567', '3889', '+', '0', '2'),
+                ]
+
+        def test_dense(self):
+            """ Fails if dense matrix is wrong. """
+            dense_stream = StringIO()
+            self.assertEquals(
+                    write_coverage_matrix(self.xpartition,
+                                            self.string_to_rname,
+                                            self.labels,
+                                            dense_stream=dense_stream),
+                    3
                 )
-        else:
-            for (sample_index, _, _, _, factor, unique_factor) in xpartition:
-                input_line_count += 1
-                print >>output_stream, '\t'.join([
-                        manifest_object.index_to_label[sample_index],
-                        factor, unique_factor
-                    ])
-
-    if not output_url.is_local:
-        mover.put(output_path, output_url.plus(output_filename))
-        os.remove(output_path)
-
-print >>sys.stderr, 'DONE with tsv.py; in=%d; time=%0.3f s' \
-                        % (input_line_count, time.time() - start_time)
\ No newline at end of file
+            self.assertEquals(
+                    dense_stream.getvalue(),
+                    '\ta\tb\tc\n'
+                    'chr1;ATAC;140;140\t12\t0\t0\n'
+                    'chr1;AACCTT;150;156\t3\t0\t5\n'
+                    'chr2;+;3567;3889\t0\t2\t0\n'
+                )
+
+        def test_sparse(self):
+            """ Fails if sparse matrix is wrong. """
+            sparse_streams = (StringIO(), StringIO(), StringIO())
+            write_coverage_matrix(self.xpartition, self.string_to_rname,
+                                    self.labels,
+                                    sparse_streams=sparse_streams)
+            self.assertEquals(
+                    sparse_streams[0].getvalue(),
+                    '0\t0\t12\n1\t0\t3\n1\t2\t5\n2\t1\t2\n'
+                )
+            self.assertEquals(
+                    sparse_streams[1].getvalue(),
+                    'chr1;ATAC;140;140\nchr1;AACCTT;150;156\n'
+                    'chr2;+;3567;3889\n'
+                )
+            self.assertEquals(sparse_streams[2].getvalue(), 'a\nb\nc\n')
+
+        def test_both(self):
+            """ Fails if sparse and dense matrices disagree. """
+            dense_stream = StringIO()
+            sparse_streams = (StringIO(), StringIO(), StringIO())
+            write_coverage_matrix(self.xpartition, self.string_to_rname,
+                                    self.labels, dense_stream=dense_stream,
+                                    sparse_streams=sparse_streams)
+            dense_lines = dense_stream.getvalue().strip('\n').split('\n')
+            columns = dense_lines[0].split('\t')[1:]
+            expanded = [[0] * len(columns) for _ in dense_lines[1:]]
+            for triplet in sparse_streams[0].getvalue().strip().split('\n'):
+                row, column, coverage = triplet.split('\t')
+                expanded[int(row)][int(column)] = int(coverage)
+            self.assertEquals(
+                    sparse_streams[2].getvalue().strip().split('\n'),
+                    columns
+                )
+            self.assertEquals(
+                    sparse_streams[1].getvalue().strip().split('\n'),
+                    [line.split('\t')[0] for line in dense_lines[1:]]
+                )
+            self.assertEquals(
+                    expanded,
+                    [[int(coverage) for coverage in line.split('\t')[1:]]
+                        for line in dense_lines[1:]]
+                )
+
+    unittest.main(argv=[sys.argv[0]])
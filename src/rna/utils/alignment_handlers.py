@@ -17,6 +17,7 @@ import bisect
 import partition
 import itertools
 import string
+from collections import defaultdict
 
 _reversed_complement_translation_table = string.maketrans('ATCG', 'TAGC')
 
@@ -603,7 +604,7 @@ class AlignmentPrinter(object):
                  output_stream=sys.stdout, bin_size=5000, exon_ivals=False,
                  exon_diffs=True, drop_deletions=False,
                  output_bam_by_chr=True, tie_margin=0,
-                 mismatch_diffs=True):
+                 mismatch_diffs=True, exon_diff_buffer_size=100000):
         """
             manifest_object: object of type LabelsAndIndices; see manifest.py
             reference_index: object of type BowtieIndexReference; see bowtie.py
@@ -616,6 +617,11 @@ class AlignmentPrinter(object):
                 100 bases under which a primary alignment should be considered
                 unique; this affects classifying whether an exon_diff
                 originates from a unique alignment
+            exon_diff_buffer_size: max number of distinct (partition,
+                position, sample index, uniqueness) keys whose exon diffs are
+                summed in memory before they are printed; 0 prints every
+                exon diff as it is computed. Call flush_exon_diffs() and
+                flush_read_counts() after the last alignment is printed.
         """
         self.manifest_object = manifest_object
         self.reference_index = reference_index
@@ -633,6 +639,14 @@ class AlignmentPrinter(object):
                                                     output_bam_by_chr
                                                 )
         self.secondary_set = set(['XS:i:', 'ZS:i:'])
+        '''Exon diffs at the same key are summed here before they are printed
+        since they otherwise dominate output for deep samples.'''
+        self.exon_diff_buffer_size = exon_diff_buffer_size
+        self._exon_diff_sums = defaultdict(int)
+        '''Numbers of primary and unique primary alignments by sample and
+        RNAME, printed by flush_read_counts() so normalizing coverage doesn't
+        wait on writing BAMs.'''
+        self._read_counts = defaultdict(lambda: [0, 0])
 
     def unique(self, alignment, seq_index=9):
         """ Returns True iff alignment is unique according to tie_margin.
@@ -660,6 +674,47 @@ class AlignmentPrinter(object):
             return False
         return True
 
+    def _count_read(self, sample_index, rname_index, unique):
+        """ Adds primary alignment to counts printed by flush_read_counts().
+
+            sample_index: sample index
+            rname_index: number string representing RNAME
+            unique: True iff alignment is unique
+
+            No return value.
+        """
+        counts = self._read_counts[(sample_index, rname_index)]
+        counts[0] += 1
+        if unique:
+            counts[1] += 1
+
+    def flush_read_counts(self):
+        """ Prints counts of primary alignments summed by _count_read().
+
+            Tab-delimited output columns (counts):
+            1. '-' to enforce that all records are placed in the same
+                partition
+            2. Sample index
+            3. RNAME index
+            4. Number of primary alignments overlapping contig with RNAME
+            5. Number of unique alignments overlapping contig with RNAME
+
+            If RNAME corresponds to unmapped reads, both counts are the
+            number of unmapped reads. A sample/RNAME may be printed by more
+            than one task, so counts must be summed downstream.
+
+            Return value: number of lines output
+        """
+        output_line_count = 0
+        for (sample_index, rname_index), (total_count, unique_count) \
+            in self._read_counts.iteritems():
+            print >>self.output_stream, 'counts\t-\t%s\t%s\t%d\t%d' % (
+                    sample_index, rname_index, total_count, unique_count
+                )
+            output_line_count += 1
+        self._read_counts.clear()
+        return output_line_count
+
     def print_unmapped_read(self, qname, seq, qual):
         """ Prints an unmapped read from a qname, qual, and seq.
 
@@ -677,19 +732,26 @@ class AlignmentPrinter(object):
 
             Return value: 1, the number of lines output
         """
+        sample_index = self.manifest_object.label_to_index[
+                                qname.rpartition('\x1d')[2]
+                            ]
+        rname_index = self.reference_index.rname_to_string['*']
         print >>self.output_stream, (
                 'sam\t%s\t%012d\t%s\t4\t0\t*\t*\t0\t0\t%s\t%s\tYT:Z:UU'
             ) % (self.sample_and_rname_indexes.index(
-                            self.manifest_object.label_to_index[
-                                qname.rpartition('\x1d')[2]
-                            ],
-                            self.reference_index.rname_to_string['*']
+                            sample_index, rname_index
                         ), 0, qname.partition('\x1d')[0], seq, qual)
+        # Unmapped read; it's unique
+        self._count_read(sample_index, rname_index, True)
         return 1
 
     def _print_exon_diffs(self, rname, exon_pos, exon_end_pos,
                             uniqueness, count, sample_index):
-        """ Prints exon diffs/mismatch diffs.
+        """ Adds exon diffs/mismatch diffs to sums held in memory.
+
+            Sums are printed by flush_exon_diffs() when the number of keys
+            reaches exon_diff_buffer_size. If exon_diff_buffer_size is 0,
+            exon diffs are printed immediately.
 
             rname: reference name
             exon_pos: exon start pos (or mismatch position)
@@ -700,6 +762,54 @@ class AlignmentPrinter(object):
 
             Return value: number of lines output
         """
+        if not self.exon_diff_buffer_size:
+            return self._print_exon_diffs_unbuffered(
+                    rname, exon_pos, exon_end_pos,
+                    uniqueness, count, sample_index
+                )
+        exon_diff_sums = self._exon_diff_sums
+        partitions = partition.partition(
+                                rname, exon_pos, exon_end_pos, self.bin_size
+                            )
+        for (partition_id, partition_start, partition_end) in partitions:
+            assert exon_pos <= partition_end
+            # Add increment at interval start
+            exon_diff_sums[(partition_id, max(partition_start, exon_pos),
+                            sample_index, uniqueness)] += count
+            assert exon_end_pos > partition_start
+            if exon_end_pos <= partition_end:
+                '''Add decrement at interval end iff exon ends before
+                partition ends.'''
+                exon_diff_sums[(partition_id, exon_end_pos,
+                                sample_index, uniqueness)] -= count
+        if len(exon_diff_sums) >= self.exon_diff_buffer_size:
+            return self.flush_exon_diffs()
+        return 0
+
+    def flush_exon_diffs(self):
+        """ Prints exon diffs summed by _print_exon_diffs(); skips zero sums.
+
+            Return value: number of lines output
+        """
+        output_line_count = 0
+        for (partition_id, pos, sample_index, uniqueness), diff \
+            in self._exon_diff_sums.iteritems():
+            if diff:
+                print >>self.output_stream, (
+                        'exon_diff\t%s\t%012d\t%s\t%s\t%d'
+                    ) % (partition_id, pos, sample_index, uniqueness, diff)
+                output_line_count += 1
+        self._exon_diff_sums.clear()
+        return output_line_count
+
+    def _print_exon_diffs_unbuffered(self, rname, exon_pos, exon_end_pos,
+                                        uniqueness, count, sample_index):
+        """ Prints exon diffs/mismatch diffs as they are computed.
+
+            See _print_exon_diffs() for arguments.
+
+            Return value: number of lines output
+        """
         output_line_count = 0
         partitions = partition.partition(
                                 rname, exon_pos, exon_end_pos, self.bin_size
@@ -811,7 +921,8 @@ class AlignmentPrinter(object):
             4. '1' if alignment from which diff originates is "unique"
                 according to --tie-margin criterion; else '0'
             5. +1 or -1 * count, the number of instances of a read sequence
-                for which to print exonic chunks
+                for which to print exonic chunks, summed over alignments
+                with the same fields 1-4 unless exon_diff_buffer_size is 0
 
             Junctions (junction_bed) / insertions/deletions (indel_bed);
             tab-delimited output tuple columns:
@@ -962,17 +1073,25 @@ class AlignmentPrinter(object):
                         output_line_count += 1
             # Write SAM output
             for alignment in multiread_reports_and_ties[0]:
+                rname_index = self.reference_index.rname_to_string[
+                                        alignment[2]
+                                    ]
                 print >>self.output_stream, 'sam\t' \
                         + '\t'.join(
                             (self.sample_and_rname_indexes.index(
-                                    sample_index,
-                                    self.reference_index.rname_to_string[
-                                        alignment[2]
-                                    ]
+                                    sample_index, rname_index
                                 ), '%012d' % int(alignment[3]),
                                 alignment[0].partition('\x1d')[0],
                                 alignment[1]) + alignment[4:]
                         )
+                # Only primary alignments (flag & 256 != 1) are counted
+                if not (int(alignment[1]) & 256):
+                    try:
+                        unique = self.unique(alignment)
+                    except IndexError:
+                        # Unmapped read; it's unique
+                        unique = True
+                    self._count_read(sample_index, rname_index, unique)
         try:
             ties_to_print = multiread_reports_and_ties[1]
         except IndexError:
@@ -1104,4 +1223,105 @@ if __name__ == '__main__':
                                 drop_deletions=False)
                     )
 
+    class TestExonDiffCombining(unittest.TestCase):
+        """ Tests AlignmentPrinter's summing of exon diffs in memory. """
+        def setUp(self):
+            class Manifest(object):
+                label_to_index = {'sample' : '0'}
+            self.manifest_object = Manifest()
+            self.exons = [(95, 130), (100, 130), (100, 130), (120, 180),
+                          (130, 150)]
+
+        def printed_exon_diffs(self, exon_diff_buffer_size):
+            """ Prints exon diffs of self.exons.
+
+                exon_diff_buffer_size: see AlignmentPrinter
+
+                Return value: tuple (output lines, number of lines reported)
+            """
+            from StringIO import StringIO
+            output_stream = StringIO()
+            alignment_printer = AlignmentPrinter(
+                    self.manifest_object, None, output_stream=output_stream,
+                    bin_size=100, exon_diff_buffer_size=exon_diff_buffer_size
+                )
+            output_line_count = 0
+            for exon_pos, exon_end_pos in self.exons:
+                output_line_count += alignment_printer._print_exon_diffs(
+                        'chr1', exon_pos, exon_end_pos, '1', 2, '0'
+                    )
+            output_line_count += alignment_printer.flush_exon_diffs()
+            return output_stream.getvalue().splitlines(), output_line_count
+
+        def sums(self, lines):
+            """ Sums exon diffs from output lines by key; omits zero sums """
+            sums = defaultdict(int)
+            for line in lines:
+                tokens = line.split('\t')
+                sums[tuple(tokens[:5])] += int(tokens[5])
+            return dict([(key, value) for key, value in sums.items()
+                            if value])
+
+        def test_sums_match(self):
+            """ Fails if summed exon diffs differ from unsummed exon diffs. """
+            lines, output_line_count = self.printed_exon_diffs(0)
+            self.assertEquals(len(lines), output_line_count)
+            for exon_diff_buffer_size in [1, 3, 100]:
+                buffered_lines, buffered_line_count \
+                    = self.printed_exon_diffs(exon_diff_buffer_size)
+                self.assertEquals(len(buffered_lines), buffered_line_count)
+                self.assertEquals(self.sums(lines),
+                                  self.sums(buffered_lines))
+            self.assertTrue(buffered_line_count < output_line_count)
+
+    class TestReadCounts(unittest.TestCase):
+        """ Tests AlignmentPrinter's counting of primary alignments. """
+        def setUp(self):
+            class Manifest(object):
+                label_to_index = {'first' : '0', 'second' : '1'}
+            class ReferenceIndex(object):
+                rname_to_string = {'chr1' : '000000000000',
+                                   '*' : '000000000001'}
+            from StringIO import StringIO
+            self.output_stream = StringIO()
+            self.alignment_printer = AlignmentPrinter(
+                    Manifest(), ReferenceIndex(),
+                    output_stream=self.output_stream, exon_diffs=False,
+                    mismatch_diffs=False, output_bam_by_chr=False
+                )
+
+        def alignment(self, sample, flag, score, second_score=None):
+            """ Returns alignment of a 10-base read to chr1. """
+            return (('read\x1dhash\x1d%s' % sample, str(flag), 'chr1',
+                     '100', '255', '10M', '*', '0', '0', 'A' * 10, 'I' * 10,
+                     'AS:i:%d' % score)
+                    + (('XS:i:%d' % second_score,)
+                        if second_score is not None else ())
+                    + ('MD:Z:10',))
+
+        def test_counts(self):
+            """ Fails if counts don't cover primaries and unmapped reads. """
+            self.alignment_printer.print_alignment_data(
+                    ([self.alignment('first', 0, 0, -10),
+                      self.alignment('first', 256, -10, 0)],)
+                )
+            self.alignment_printer.print_alignment_data(
+                    ([self.alignment('first', 16, 0, 0)],)
+                )
+            self.alignment_printer.print_alignment_data(
+                    ([self.alignment('second', 0, 0)],)
+                )
+            self.alignment_printer.print_unmapped_read(
+                    'read\x1dhash\x1dsecond', 'A' * 10, 'I' * 10
+                )
+            self.output_stream.truncate(0)
+            self.assertEquals(self.alignment_printer.flush_read_counts(), 3)
+            self.assertEquals(
+                    sorted(self.output_stream.getvalue().splitlines()),
+                    ['counts\t-\t0\t000000000000\t2\t1',
+                     'counts\t-\t1\t000000000000\t1\t1',
+                     'counts\t-\t1\t000000000001\t1\t1']
+                )
+            self.assertEquals(self.alignment_printer.flush_read_counts(), 0)
+
     unittest.main()
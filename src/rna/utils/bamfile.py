@@ -0,0 +1,571 @@
+"""
+bamfile.py
+Part of Rail-RNA
+
+Native BAM encoder. Records are encoded from SAM fields as they are added
+and written with dooplicity's BgzfWriter, which may compress BGZF blocks in
+a thread pool while more records are encoded. When records are added in
+order of position, the BAI index is built alongside, so no second pass over
+the BAM is needed. Every BGZF block but the last holds exactly
+_bgzf_block_size bytes of uncompressed data, so the virtual file offset of
+any uncompressed offset is known as soon as the compressed offsets of blocks
+are. See the SAM/BAM format specification at
+https://samtools.github.io/hts-specs/SAMv1.pdf for a description of the
+formats.
+"""
+import re
+import struct
+
+if __name__ == '__main__':
+    # For tests: make dooplicity importable
+    import os
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
+                                os.path.realpath(__file__)
+                            ))))
+from dooplicity.tools import BgzfWriter, _bgzf_block_size
+
+_bam_magic = 'BAM\x01'
+_bai_magic = 'BAI\x01'
+_core = struct.Struct('<iiiBBHHHiiii')
+_int32 = struct.Struct('<i')
+_uint32 = struct.Struct('<I')
+_uint64 = struct.Struct('<Q')
+_chunk = struct.Struct('<QQ')
+# Bin holding a reference's offsets and mapped/unmapped read counts
+_pseudo_bin = 37450
+# Bases per window of linear index
+_linear_shift = 14
+_cigar_re = re.compile(r'(\d+)([MIDNSHP=X])')
+_cigar_codes = dict((op, i) for i, op in enumerate('MIDNSHP=X'))
+_reference_ops = set('MDN=X')
+_bases = '=ACMGRSVTWYHKDBN'
+_base_codes = dict((base, i) for i, base in enumerate(_bases))
+_base_codes.update((base.lower(), i) for i, base in enumerate(_bases))
+_base_singles = dict((base, chr(code << 4))
+                        for base, code in _base_codes.items())
+_base_pairs = dict((first + second, chr(first_code << 4 | second_code))
+                        for first, first_code in _base_codes.items()
+                        for second, second_code in _base_codes.items())
+_qual_table = ''.join([chr(max(i - 33, 0)) for i in xrange(256)])
+# struct format characters of BAM's numeric field types
+_struct_codes = {'c' : 'b', 'C' : 'B', 's' : 'h', 'S' : 'H', 'i' : 'i',
+                 'I' : 'I', 'f' : 'f'}
+
+def reg2bin(start, end):
+    """ Computes smallest bin containing an interval, as in SAM spec.
+
+        start: 0-based start position of interval
+        end: 0-based end position of interval, exclusive
+
+        Return value: bin number
+    """
+    end -= 1
+    if start >> 14 == end >> 14: return 4681 + (start >> 14)
+    if start >> 17 == end >> 17: return 585 + (start >> 17)
+    if start >> 20 == end >> 20: return 73 + (start >> 20)
+    if start >> 23 == end >> 23: return 9 + (start >> 23)
+    if start >> 26 == end >> 26: return 1 + (start >> 26)
+    return 0
+
+def encode_tag(tag):
+    """ Encodes optional field of SAM record as in BAM.
+
+        Integers are stored in the smallest type that holds them, as by
+        samtools.
+
+        tag: optional field in format TAG:TYPE:VALUE
+
+        Return value: encoded field
+    """
+    name, tag_type, value = tag[:2], tag[3], tag[5:]
+    if tag_type == 'i':
+        value = int(value)
+        if value < 0:
+            if value >= -128: tag_type = 'c'
+            elif value >= -32768: tag_type = 's'
+        elif value < 256: tag_type = 'C'
+        elif value < 65536: tag_type = 'S'
+        else: tag_type = 'I'
+        return name + tag_type + struct.pack('<' + _struct_codes[tag_type],
+                                             value)
+    if tag_type == 'Z' or tag_type == 'H':
+        return ''.join([name, tag_type, value, '\x00'])
+    if tag_type == 'A':
+        return name + 'A' + value[0]
+    if tag_type == 'f':
+        return name + 'f' + struct.pack('<f', float(value))
+    if tag_type == 'B':
+        values = value.split(',')
+        subtype, values = values[0], values[1:]
+        return ''.join([name, 'B', subtype, _int32.pack(len(values)),
+                        struct.pack('<%d%s' % (len(values),
+                                               _struct_codes[subtype]),
+                            *[float(number) if subtype == 'f'
+                                else int(number) for number in values])])
+    raise RuntimeError('Optional field "%s" has invalid type.' % tag)
+
+class ReferenceIndex(object):
+    """ Bins, linear index, and counts of records on one reference.
+
+        Offsets are uncompressed offsets into the BAM until they're
+        converted to virtual file offsets when the index is written.
+    """
+    def __init__(self, start_offset):
+        """
+            start_offset: uncompressed offset of first record
+        """
+        self.bins = {}
+        self.linear = []
+        self.start_offset = start_offset
+        self.end_offset = start_offset
+        self.mapped_count, self.unmapped_count = 0, 0
+
+    def add(self, start, end, unmapped, start_offset, end_offset):
+        """ Adds record to index.
+
+            start: 0-based start position of record
+            end: 0-based end position of record, exclusive
+            unmapped: True iff record is unmapped
+            start_offset: uncompressed offset of record
+            end_offset: uncompressed offset of end of record
+
+            No return value.
+        """
+        chunks = self.bins.setdefault(reg2bin(start, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+        last_window = (end - 1) >> _linear_shift
+        if len(self.linear) <= last_window:
+            self.linear.extend([None] * (last_window + 1 - len(self.linear)))
+        for window in xrange(start >> _linear_shift, last_window + 1):
+            if self.linear[window] is None:
+                self.linear[window] = start_offset
+        self.end_offset = end_offset
+        if unmapped:
+            self.unmapped_count += 1
+        else:
+            self.mapped_count += 1
+
+class BamWriter(object):
+    """ Writes a BAM and, optionally, its index from SAM fields. """
+    def __init__(self, filename, references, header, threads=1,
+                    compresslevel=6, index=True):
+        """
+            filename: path to output BAM; index is written to
+                filename + '.bai'
+            references: list of tuples (name, length) of references in the
+                order of @SQ lines of header
+            header: SAM header text
+            threads: number of threads in which to compress blocks; if 1,
+                blocks are compressed in the calling thread
+            compresslevel: zlib compression level of BGZF blocks
+            index: True iff a BAI index should be written; records must then
+                be added in order of position
+        """
+        self.filename = filename
+        self.index = index
+        self.reference_ids = dict((name, i)
+                                    for i, (name, _) in enumerate(references))
+        self.reference_count = len(references)
+        self.writer = BgzfWriter(filename, 'w', compresslevel, threads)
+        self.reference_indexes = {}
+        self.last_position = (0, -1)
+        self.unplaced_count = 0
+        self.closed = False
+        if not header.endswith('\n'): header += '\n'
+        self.writer.write(''.join(
+                [_bam_magic, _int32.pack(len(header)), header,
+                 _int32.pack(len(references))]
+                + [_int32.pack(len(name) + 1) + name + '\x00'
+                    + _int32.pack(length) for name, length in references]
+            ))
+
+    def add(self, fields):
+        """ Adds record to BAM.
+
+            fields: list of SAM fields QNAME, FLAG, RNAME, POS, MAPQ, CIGAR,
+                RNEXT, PNEXT, TLEN, SEQ, QUAL, and then optional fields
+
+            No return value.
+        """
+        (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen,
+            seq, qual) = fields[:11]
+        flag, pos = int(flag), int(pos) - 1
+        reference_id = -1 if rname == '*' else self.reference_ids[rname]
+        if rnext == '=':
+            next_reference_id = reference_id
+        elif rnext == '*':
+            next_reference_id = -1
+        else:
+            next_reference_id = self.reference_ids[rnext]
+        if cigar == '*':
+            operations = []
+        else:
+            operations = _cigar_re.findall(cigar)
+        reference_length = sum([int(length) for length, op in operations
+                                    if op in _reference_ops])
+        end = pos + (reference_length or 1)
+        if seq == '*':
+            seq, encoded_seq = '', ''
+        else:
+            encoded_seq = ''.join([_base_pairs[seq[i:i+2]]
+                                    for i in xrange(0, len(seq) - 1, 2)])
+            if len(seq) % 2: encoded_seq += _base_singles[seq[-1]]
+        if qual == '*':
+            qual = '\xff' * len(seq)
+        else:
+            qual = qual.translate(_qual_table)
+        qname += '\x00'
+        data = ''.join([qname,
+                        struct.pack('<%dI' % len(operations),
+                            *[int(length) << 4 | _cigar_codes[op]
+                                for length, op in operations]),
+                        encoded_seq, qual]
+                       + [encode_tag(tag) for tag in fields[11:]])
+        record = _core.pack(_core.size - 4 + len(data), reference_id, pos,
+                            len(qname), int(mapq), reg2bin(pos, end),
+                            len(operations), flag, len(seq),
+                            next_reference_id, int(pnext) - 1,
+                            int(tlen)) + data
+        start_offset = self.writer.tell()
+        self.writer.write(record)
+        if not self.index: return
+        if reference_id < 0:
+            self.unplaced_count += 1
+            self.last_position = (self.reference_count, 0)
+            return
+        if (reference_id, pos) < self.last_position:
+            raise RuntimeError('BAM records must be added in order of '
+                               'position to be indexed.')
+        self.last_position = (reference_id, pos)
+        try:
+            reference_index = self.reference_indexes[reference_id]
+        except KeyError:
+            reference_index = self.reference_indexes[reference_id] \
+                = ReferenceIndex(start_offset)
+        reference_index.add(pos, end, flag & 4, start_offset,
+                            self.writer.tell())
+
+    def _write_index(self):
+        """ Writes BAI.
+
+            No return value.
+        """
+        with open(self.filename + '.bai', 'wb') as index_stream:
+            index_stream.write(_bai_magic
+                                + _int32.pack(self.reference_count))
+            for reference_id in xrange(self.reference_count):
+                try:
+                    reference_index = self.reference_indexes[reference_id]
+                except KeyError:
+                    index_stream.write(_int32.pack(0) + _int32.pack(0))
+                    continue
+                index_stream.write(
+                        _int32.pack(len(reference_index.bins) + 1)
+                    )
+                for bin_number in sorted(reference_index.bins):
+                    '''Merge chunks separated by less than a block, as by
+                    htslib; reading the records between them is free.'''
+                    chunks = []
+                    for start, end in reference_index.bins[bin_number]:
+                        start = self.writer.virtual_offset(start)
+                        end = self.writer.virtual_offset(end)
+                        if chunks and chunks[-1][1] >> 16 == start >> 16:
+                            chunks[-1][1] = end
+                        else:
+                            chunks.append([start, end])
+                    index_stream.write(_uint32.pack(bin_number)
+                                        + _int32.pack(len(chunks)))
+                    index_stream.write(''.join([_chunk.pack(start, end)
+                                                for start, end in chunks]))
+                index_stream.write(''.join([
+                        _uint32.pack(_pseudo_bin), _int32.pack(2),
+                        _chunk.pack(
+                            self.writer.virtual_offset(reference_index.start_offset),
+                            self.writer.virtual_offset(reference_index.end_offset)
+                        ),
+                        _chunk.pack(reference_index.mapped_count,
+                                    reference_index.unmapped_count)
+                    ]))
+                # Windows without records take offset of previous window
+                linear, last_offset = [], 0
+                for offset in reference_index.linear:
+                    if offset is not None:
+                        last_offset = self.writer.virtual_offset(offset)
+                    linear.append(last_offset)
+                index_stream.write(_int32.pack(len(linear)) + struct.pack(
+                        '<%dQ' % len(linear), *linear
+                    ))
+            index_stream.write(_uint64.pack(self.unplaced_count))
+
+    def close(self):
+        """ Writes remaining blocks, EOF marker, and index.
+
+            No return value.
+        """
+        if self.closed: return
+        self.closed = True
+        self.writer.close()
+        if self.index: self._write_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # Don't write index of incomplete BAM
+            self.index = False
+            self.close()
+
+class SamWriter(object):
+    """ Writes SAM records to a stream with the same interface as BamWriter.
+    """
+    def __init__(self, output_stream, header):
+        """
+            output_stream: where to write SAM; not closed by close()
+            header: SAM header text
+        """
+        self.output_stream = output_stream
+        print >>self.output_stream, header.rstrip('\n')
+
+    def add(self, fields):
+        """ Adds record to SAM.
+
+            fields: list of SAM fields
+
+            No return value.
+        """
+        print >>self.output_stream, '\t'.join(fields)
+
+    def close(self):
+        """ Flushes output stream.
+
+            No return value.
+        """
+        self.output_stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+if __name__ == '__main__':
+    import unittest
+    import shutil
+    import tempfile
+    import zlib
+
+    _bgzf_header = struct.Struct('<4sIBBH2sHH')
+    _bgzf_footer = struct.Struct('<II')
+
+    def read_bgzf(filename):
+        """ Decompresses BGZF file.
+
+            filename: path to BGZF file
+
+            Return value: tuple (uncompressed data, list of compressed
+                offsets of blocks)
+        """
+        with open(filename, 'rb') as input_stream:
+            compressed = input_stream.read()
+        data, block_offsets, offset = [], [], 0
+        while offset < len(compressed):
+            header = _bgzf_header.unpack_from(compressed, offset)
+            assert header[0] == '\x1f\x8b\x08\x04' and header[5] == 'BC'
+            block_end = offset + header[7] + 1
+            block_data = zlib.decompress(
+                    compressed[offset+_bgzf_header.size
+                               :block_end-_bgzf_footer.size], -15
+                )
+            crc, size = _bgzf_footer.unpack_from(
+                    compressed, block_end - _bgzf_footer.size
+                )
+            assert crc == zlib.crc32(block_data) & 0xffffffff
+            assert size == len(block_data)
+            block_offsets.append(offset)
+            data.append(block_data)
+            offset = block_end
+        return ''.join(data), block_offsets
+
+    def read_bam(filename):
+        """ Parses BAM.
+
+            filename: path to BAM
+
+            Return value: tuple (header text, list of references, list of
+                tuples (uncompressed offset, core fields, read name, cigar,
+                seq, qual, tags) for records)
+        """
+        data, _ = read_bgzf(filename)
+        assert data[:4] == _bam_magic
+        header_size = _int32.unpack_from(data, 4)[0]
+        header = data[8:8+header_size]
+        offset = 8 + header_size
+        reference_count = _int32.unpack_from(data, offset)[0]
+        offset += 4
+        references = []
+        for _ in xrange(reference_count):
+            name_size = _int32.unpack_from(data, offset)[0]
+            references.append((
+                    data[offset+4:offset+3+name_size],
+                    _int32.unpack_from(data, offset + 4 + name_size)[0]
+                ))
+            offset += 8 + name_size
+        records = []
+        while offset < len(data):
+            core = _core.unpack_from(data, offset)
+            record_end = offset + 4 + core[0]
+            position = offset + _core.size
+            name = data[position:position+core[3]-1]
+            position += core[3]
+            cigar = struct.unpack_from('<%dI' % core[6], data, position)
+            cigar = ''.join(['%d%s' % (op >> 4, 'MIDNSHP=X'[op & 15])
+                                for op in cigar]) or '*'
+            position += 4 * core[6]
+            seq = ''.join([_bases[ord(data[position + i // 2])
+                                    >> (4 * (1 - i % 2)) & 15]
+                            for i in xrange(core[8])]) or '*'
+            position += (core[8] + 1) // 2
+            qual = data[position:position+core[8]]
+            qual = ('*' if qual[:1] == '\xff'
+                    else ''.join([chr(ord(q) + 33) for q in qual])) or '*'
+            position += core[8]
+            records.append((offset, core[1:], name, cigar, seq, qual,
+                            data[position:record_end]))
+            offset = record_end
+        return header, references, records
+
+    def read_index(filename):
+        """ Parses BAI.
+
+            filename: path to BAI
+
+            Return value: tuple (list of tuples (dictionary mapping bins to
+                chunks, linear index) for references, unplaced count)
+        """
+        with open(filename, 'rb') as index_stream:
+            data = index_stream.read()
+        assert data[:4] == _bai_magic
+        references, offset = [], 8
+        for _ in xrange(_int32.unpack_from(data, 4)[0]):
+            bins = {}
+            bin_count = _int32.unpack_from(data, offset)[0]
+            offset += 4
+            for _ in xrange(bin_count):
+                bin_number, chunk_count = struct.unpack_from('<Ii', data,
+                                                             offset)
+                offset += 8
+                bins[bin_number] = [_chunk.unpack_from(data, offset + 16 * i)
+                                        for i in xrange(chunk_count)]
+                offset += 16 * chunk_count
+            linear_size = _int32.unpack_from(data, offset)[0]
+            offset += 4
+            references.append((bins, list(struct.unpack_from(
+                    '<%dQ' % linear_size, data, offset
+                ))))
+            offset += 8 * linear_size
+        return references, _uint64.unpack_from(data, offset)[0]
+
+    class TestBamWriter(unittest.TestCase):
+        """ Tests BamWriter. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.bam = os.path.join(self.temp_dir_path, 'test.bam')
+            self.references = [('chr1', 1000000), ('chr2', 50000)]
+            self.header = '\n'.join(['@HD\tVN:1.0\tSO:coordinate']
+                                    + ['@SQ\tSN:%s\tLN:%d' % reference
+                                        for reference in self.references])
+            self.records = [
+                    ['read%d' % i, str(i % 2 * 16), 'chr1',
+                        str(i * 37 + 1), '255', '20M%dN30M' % (i % 7),
+                        '*', '0', '0', 'ACGTNacgtn=ACGT' * 3 + 'ACGTA',
+                        'I' * 25 + '#' * 25, 'NM:i:%d' % (i % 300 - 100),
+                        'XS:A:+', 'MD:Z:50', 'ZF:f:1.5']
+                    for i in xrange(30000)
+                ] + [
+                    ['spliced', '256', 'chr2', '40000', '3', '5S10M20000N5M',
+                        '=', '10', '-5', 'ACGTACGTACGTACGTACGT', '*',
+                        'XB:B:s,-1,2,300']
+                ] + [
+                    ['unmapped%d' % i, '4', '*', '0', '0', '*', '*', '0',
+                        '0', 'ACG', 'III'] for i in xrange(5)
+                ]
+
+        def test_records(self):
+            """ Fails if records or header can't be decoded. """
+            with BamWriter(self.bam, self.references, self.header,
+                            threads=3) as writer:
+                for record in self.records:
+                    writer.add(record)
+            header, references, records = read_bam(self.bam)
+            self.assertEquals(header, self.header + '\n')
+            self.assertEquals(references, self.references)
+            self.assertEquals(len(records), len(self.records))
+            for (_, core, name, cigar, seq, qual, tags), fields in zip(
+                    records, self.records
+                ):
+                self.assertEquals(name, fields[0])
+                self.assertEquals(core[6], int(fields[1]))
+                self.assertEquals(core[1], int(fields[3]) - 1)
+                self.assertEquals(cigar, fields[5])
+                self.assertEquals(seq, fields[9].upper())
+                self.assertEquals(qual, fields[10])
+            self.assertEquals(records[0][6],
+                    'NMc\x9c' + 'XSA+' + 'MDZ50\x00' + 'ZFf\x00\x00\xc0\x3f')
+            self.assertEquals(records[30000][1][:8],
+                              (1, 39999, 8, 3, reg2bin(39999, 60014), 4,
+                               256, 20))
+            self.assertEquals(records[30000][6],
+                              'XBBs\x03\x00\x00\x00\xff\xff\x02\x00\x2c\x01')
+            self.assertEquals(records[-1][1][:2], (-1, -1))
+            self.assertEquals(records[-1][1][4], 4680)
+
+        def test_index(self):
+            """ Fails if index doesn't locate records. """
+            with BamWriter(self.bam, self.references, self.header) \
+                as writer:
+                for record in self.records:
+                    writer.add(record)
+            _, block_offsets = read_bgzf(self.bam)
+            self.assertTrue(len(block_offsets) > 3)
+            _, _, records = read_bam(self.bam)
+            virtual_offsets = [block_offsets[offset // _bgzf_block_size] << 16
+                                | offset % _bgzf_block_size
+                                for offset, _, _, _, _, _, _ in records]
+            references, unplaced_count = read_index(self.bam + '.bai')
+            self.assertEquals(unplaced_count, 5)
+            bins, linear = references[0]
+            self.assertEquals(bins[_pseudo_bin],
+                              [(virtual_offsets[0], virtual_offsets[30000]),
+                               (30000, 0)])
+            # Every record is in one of its bin's chunks
+            for i in xrange(30000):
+                core = records[i][1]
+                self.assertTrue(any([start <= virtual_offsets[i] < end
+                                     for start, end in bins[core[4]]]))
+            # Linear index points at first record overlapping each window
+            for window, offset in enumerate(linear):
+                first = min([i for i in xrange(30000)
+                             if (i * 37 + 49 + i % 7) >> 14 >= window])
+                self.assertEquals(offset, virtual_offsets[first])
+            bins, linear = references[1]
+            self.assertEquals(sorted(bins), [reg2bin(39999, 60014),
+                                             _pseudo_bin])
+            self.assertEquals(len(linear), 4)
+
+        def test_out_of_order(self):
+            """ Fails if out-of-order records are indexed. """
+            writer = BamWriter(self.bam, self.references, self.header)
+            writer.add(self.records[1])
+            self.assertRaises(RuntimeError, writer.add, self.records[0])
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
@@ -0,0 +1,716 @@
+"""
+bigwig.py
+Part of Rail-RNA
+
+Streaming bigWig encoder. Intervals are written as zlib-compressed bedGraph
+data sections as they are added; zoom levels are built as the data streams
+by, each from the records of the level below it, and R-tree indexes, the
+chromosome B+ tree and the header are written when the file is closed.
+read_bigwig() reads items and zoom records back through the indexes, for
+checking output. See Kent et al., "BigWig and BigBed: enabling browsing of
+large distributed datasets," Bioinformatics 2010 for a description of the
+format.
+"""
+import os
+import struct
+import zlib
+import tempfile
+import threading
+import Queue
+
+_bigwig_magic = 0x888FFC26
+_chrom_tree_magic = 0x78CA8C91
+_rtree_magic = 0x2468ACE0
+_header = struct.Struct('<IHHQQQHHQQIQ')
+_zoom_header = struct.Struct('<IIQQ')
+_summary = struct.Struct('<Qdddd')
+_section_header = struct.Struct('<IIIIIBBH')
+_bedgraph_item = struct.Struct('<IIf')
+_zoom_record = struct.Struct('<IIIIffff')
+_chrom_tree_header = struct.Struct('<IIIIQQ')
+_rtree_header = struct.Struct('<IIQIIIIQII')
+_rtree_leaf_item = struct.Struct('<IIIIQQ')
+_rtree_node_item = struct.Struct('<IIIIQ')
+_node_header = struct.Struct('<BBH')
+_count = struct.Struct('<Q')
+_zoom_count = struct.Struct('<I')
+# bedGraph data section type
+_bedgraph_type = 1
+# Maximum number of zoom levels in a bigWig
+_max_zoom_levels = 10
+
+def write_rtree(output_stream, items, block_size=256, items_per_slot=1024,
+                    end_file_offset=0):
+    """ Writes R-tree index of data blocks at current position of stream.
+
+        Nodes are padded to block_size items as by Kent Tools so every node
+        at a given level has the same size.
+
+        output_stream: seekable file object
+        items: list of tuples (start chrom ID, start base, end chrom ID,
+            end base, file offset of block, size of block), one per data
+            block, sorted by position
+        block_size: maximum number of children per node
+        items_per_slot: maximum number of items per data block; recorded
+            in the index header
+        end_file_offset: offset of end of data indexed
+
+        No return value.
+    """
+    if items:
+        output_stream.write(_rtree_header.pack(
+                _rtree_magic, block_size, len(items), items[0][0],
+                items[0][1], items[-1][2], items[-1][3], end_file_offset,
+                items_per_slot, 0
+            ))
+    else:
+        output_stream.write(_rtree_header.pack(
+                _rtree_magic, block_size, 0, 0, 0, 0, 0, end_file_offset,
+                items_per_slot, 0
+            ))
+    '''Each level is a list of nodes; each node is a list of indexes of items
+    or of nodes from the level below. Bounds of nodes are stored in
+    parallel.'''
+    bounds = [[item[:4] for item in items]]
+    levels = []
+    while True:
+        below = bounds[-1]
+        nodes = [range(i, min(i + block_size, len(below)))
+                    for i in xrange(0, max(len(below), 1), block_size)]
+        levels.append(nodes)
+        bounds.append([(below[node[0]][0], below[node[0]][1],
+                        below[node[-1]][2], below[node[-1]][3])
+                        if node else (0, 0, 0, 0) for node in nodes])
+        if len(nodes) == 1: break
+    # Lay out levels from the root down
+    levels.reverse()
+    bounds.reverse()
+    leaf_size = _node_header.size + block_size * _rtree_leaf_item.size
+    node_size = _node_header.size + block_size * _rtree_node_item.size
+    level_offsets = []
+    offset = output_stream.tell()
+    for i, nodes in enumerate(levels):
+        level_offsets.append(offset)
+        offset += len(nodes) * (
+                leaf_size if i == len(levels) - 1 else node_size
+            )
+    for i, nodes in enumerate(levels):
+        leaf = (i == len(levels) - 1)
+        if not leaf:
+            child_size = (leaf_size if i + 1 == len(levels) - 1
+                            else node_size)
+        for node in nodes:
+            output_stream.write(_node_header.pack(leaf, 0, len(node)))
+            if leaf:
+                for index in node:
+                    output_stream.write(_rtree_leaf_item.pack(*items[index]))
+                output_stream.write(
+                        '\x00' * ((block_size - len(node))
+                                    * _rtree_leaf_item.size)
+                    )
+            else:
+                for index in node:
+                    output_stream.write(_rtree_node_item.pack(
+                            *(bounds[i + 1][index]
+                                + (level_offsets[i + 1]
+                                    + index * child_size,))
+                        ))
+                output_stream.write(
+                        '\x00' * ((block_size - len(node))
+                                    * _rtree_node_item.size)
+                    )
+
+def write_chrom_tree(output_stream, chroms, block_size=256):
+    """ Writes B+ tree of chromosome names at current position of stream.
+
+        output_stream: seekable file object
+        chroms: list of tuples (chrom name, chrom ID, chrom size)
+        block_size: maximum number of children per node
+
+        No return value.
+    """
+    chroms = sorted(chroms)
+    block_size = max(min(block_size, len(chroms)), 1)
+    key_size = max([len(chrom[0]) for chrom in chroms] + [1])
+    output_stream.write(_chrom_tree_header.pack(
+            _chrom_tree_magic, block_size, key_size, 8, len(chroms), 0
+        ))
+    # Each node is a list of indexes of chroms or of nodes from level below
+    keys = [[chrom[0] for chrom in chroms]]
+    levels = []
+    while True:
+        below = keys[-1]
+        nodes = [range(i, min(i + block_size, len(below)))
+                    for i in xrange(0, max(len(below), 1), block_size)]
+        levels.append(nodes)
+        keys.append([below[node[0]] if node else '' for node in nodes])
+        if len(nodes) == 1: break
+    levels.reverse()
+    keys.reverse()
+    item_size = key_size + 8
+    node_size = _node_header.size + block_size * item_size
+    level_offsets = []
+    offset = output_stream.tell()
+    for nodes in levels:
+        level_offsets.append(offset)
+        offset += len(nodes) * node_size
+    for i, nodes in enumerate(levels):
+        leaf = (i == len(levels) - 1)
+        for node in nodes:
+            output_stream.write(_node_header.pack(leaf, 0, len(node)))
+            for index in node:
+                if leaf:
+                    name, chrom_id, chrom_size = chroms[index]
+                    output_stream.write(name.ljust(key_size, '\x00'))
+                    output_stream.write(struct.pack('<II', chrom_id,
+                                                           chrom_size))
+                else:
+                    output_stream.write(
+                            keys[i + 1][index].ljust(key_size, '\x00')
+                        )
+                    output_stream.write(_count.pack(
+                            level_offsets[i + 1] + index * node_size
+                        ))
+            output_stream.write('\x00' * ((block_size - len(node))
+                                            * item_size))
+
+class ZoomLevel(object):
+    """ Accumulates summary records of one zoom level.
+
+        Records summarize fixed windows of reduction bases, aligned to
+        multiples of reduction, so each record of a level whose reduction
+        is a multiple of this one's falls in exactly one of its windows.
+        Closed records are packed into blocks of items_per_slot records,
+        compressed and spooled to a temporary file, and passed on to the
+        next zoom level, if any.
+    """
+    def __init__(self, reduction, items_per_slot=1024, compresslevel=6,
+                    temp_dir=None, next_level=None):
+        """
+            reduction: number of bases per window
+            items_per_slot: maximum number of records per block
+            compresslevel: zlib compression level of blocks
+            temp_dir: where to spool compressed blocks if they get big,
+                or None for the default temporary directory
+            next_level: ZoomLevel object fed records closed here, or None
+        """
+        self.reduction = reduction
+        self.items_per_slot = items_per_slot
+        self.compresslevel = compresslevel
+        self.next_level = next_level
+        self.spool = tempfile.SpooledTemporaryFile(max_size=(1 << 26),
+                                                   dir=temp_dir)
+        self.record = None
+        self.record_count = 0
+        self.max_block_size = 0
+        self._records, self._bounds = [], []
+        # List of (start chrom, start, end chrom, end, offset, size)
+        self.blocks = []
+
+    def add(self, chrom_id, chrom_size, position, count, minimum, maximum,
+                total, squares):
+        """ Adds summary of bases within a window to that window's record.
+
+            chrom_id: chromosome ID
+            chrom_size: chromosome size
+            position: any position within the window summarized
+            count: number of bases summarized
+            minimum: minimum value across bases
+            maximum: maximum value across bases
+            total: sum of values across bases
+            squares: sum of squares of values across bases
+
+            No return value.
+        """
+        record = self.record
+        start = position - position % self.reduction
+        if record is None or record[1] != start or record[0] != chrom_id:
+            self.close_record()
+            self.record = [chrom_id, start,
+                            min(start + self.reduction, chrom_size),
+                            count, minimum, maximum, total, squares,
+                            chrom_size]
+            return
+        record[3] += count
+        if minimum < record[4]: record[4] = minimum
+        if maximum > record[5]: record[5] = maximum
+        record[6] += total
+        record[7] += squares
+
+    def close_record(self):
+        """ Packs the open record, passing it on to the next zoom level.
+
+            No return value.
+        """
+        record = self.record
+        if record is None: return
+        self.record = None
+        self._records.append(_zoom_record.pack(*record[:8]))
+        self._bounds.append(record[:3])
+        self.record_count += 1
+        if self.next_level is not None:
+            self.next_level.add(record[0], record[8], record[1],
+                                *record[3:8])
+        if len(self._records) >= self.items_per_slot:
+            self.flush_block()
+
+    def flush_block(self):
+        """ Compresses and spools packed records.
+
+            No return value.
+        """
+        if not self._records: return
+        data = ''.join(self._records)
+        self.max_block_size = max(self.max_block_size, len(data))
+        compressed = zlib.compress(data, self.compresslevel)
+        self.blocks.append((self._bounds[0][0], self._bounds[0][1],
+                            self._bounds[-1][0], self._bounds[-1][2],
+                            self.spool.tell(), len(compressed)))
+        self.spool.write(compressed)
+        self._records, self._bounds = [], []
+
+class BigWigWriter(object):
+    """ Writes a bigWig from intervals added in order of position.
+
+        Chromosome IDs are assigned in order of first appearance, so
+        chromosomes may be added in any order as long as each is added in
+        one run of calls to add(). Intervals are stored as bedGraph items
+        in data sections of at most items_per_slot items.
+    """
+    def __init__(self, filename, chrom_sizes, items_per_slot=1024,
+                    block_size=256, initial_reduction=1024,
+                    compresslevel=6, temp_dir=None):
+        """
+            filename: path to output file
+            chrom_sizes: dictionary mapping chromosome names to sizes
+            items_per_slot: maximum number of items per data section
+            block_size: maximum number of children per index node
+            initial_reduction: number of bases per window of the first zoom
+                level; each subsequent level has 4x the bases per window,
+                up to _max_zoom_levels levels or the size of the largest
+                chromosome
+            compresslevel: zlib compression level of blocks
+            temp_dir: where to spool zoom levels if they get big, or None
+                for the default temporary directory
+        """
+        self.filename = filename
+        self.chrom_sizes = chrom_sizes
+        self.items_per_slot = items_per_slot
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        max_chrom_size = max(chrom_sizes.values() + [1])
+        reductions = [initial_reduction]
+        while (len(reductions) < _max_zoom_levels
+                and reductions[-1] * 4 < max_chrom_size):
+            reductions.append(reductions[-1] * 4)
+        self.zoom_levels = []
+        next_level = None
+        for reduction in reversed(reductions):
+            next_level = ZoomLevel(reduction, items_per_slot=items_per_slot,
+                                   compresslevel=compresslevel,
+                                   temp_dir=temp_dir, next_level=next_level)
+            self.zoom_levels.append(next_level)
+        self.zoom_levels.reverse()
+        self.output_stream = open(filename, 'wb')
+        # Placeholders for header, zoom headers and total summary
+        self.output_stream.write('\x00' * (
+                _header.size + _zoom_header.size * len(self.zoom_levels)
+                + _summary.size
+            ))
+        self.data_offset = self.output_stream.tell()
+        self.output_stream.write(_count.pack(0))
+        self.offset = self.output_stream.tell()
+        # (name, ID, size) of each chromosome in order of appearance
+        self.chroms = []
+        self.chrom, self.chrom_id, self.chrom_size = None, None, None
+        self._items, self._section_start, self._last_end = [], None, 0
+        self.sections = []
+        self.max_block_size = 0
+        self.bases_covered, self.total, self.squares = 0, 0.0, 0.0
+        self.minimum, self.maximum = None, None
+        self.closed = False
+
+    def _flush_section(self):
+        """ Compresses and writes buffered items as a data section.
+
+            No return value.
+        """
+        if not self._items: return
+        data = ''.join([_section_header.pack(
+                    self.chrom_id, self._section_start, self._last_end,
+                    0, 0, _bedgraph_type, 0, len(self._items)
+                )] + self._items)
+        self.max_block_size = max(self.max_block_size, len(data))
+        compressed = zlib.compress(data, self.compresslevel)
+        self.sections.append((self.chrom_id, self._section_start,
+                              self.chrom_id, self._last_end,
+                              self.offset, len(compressed)))
+        self.output_stream.write(compressed)
+        self.offset += len(compressed)
+        self._items = []
+
+    def add(self, chrom, start, end, value):
+        """ Adds interval to bigWig.
+
+            chrom: chromosome name
+            start: 0-based start position of interval
+            end: 0-based end position of interval, exclusive
+            value: value of every base in interval
+
+            No return value.
+        """
+        if start == end: return
+        if chrom != self.chrom:
+            self._flush_section()
+            if chrom in [name for name, _, _ in self.chroms]:
+                raise RuntimeError(
+                        'Intervals on chromosome "%s" were not added '
+                        'consecutively.' % chrom
+                    )
+            try:
+                self.chrom_size = self.chrom_sizes[chrom]
+            except KeyError:
+                raise RuntimeError('Chromosome "%s" has no size.' % chrom)
+            self.chrom, self.chrom_id = chrom, len(self.chroms)
+            self.chroms.append((chrom, self.chrom_id, self.chrom_size))
+            self._last_end = 0
+        if start < self._last_end or start > end or end > self.chrom_size:
+            raise RuntimeError(
+                    'Interval %s:%d-%d is out of order or out of bounds.'
+                    % (chrom, start, end)
+                )
+        if not self._items:
+            self._section_start = start
+        self._items.append(_bedgraph_item.pack(start, end, value))
+        self._last_end = end
+        if len(self._items) >= self.items_per_slot:
+            self._flush_section()
+        span = end - start
+        self.bases_covered += span
+        self.total += value * span
+        self.squares += value * value * span
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        # Split interval across windows of first zoom level
+        zoom_level = self.zoom_levels[0]
+        reduction = zoom_level.reduction
+        while start < end:
+            window_end = min(start - start % reduction + reduction, end)
+            span = window_end - start
+            zoom_level.add(self.chrom_id, self.chrom_size, start, span,
+                           value, value, value * span, value * value * span)
+            start = window_end
+
+    def close(self):
+        """ Writes indexes, zoom levels, chromosome tree and header.
+
+            No return value.
+        """
+        if self.closed: return
+        self.closed = True
+        self._flush_section()
+        output_stream = self.output_stream
+        full_index_offset = self.offset
+        write_rtree(output_stream, self.sections,
+                    block_size=self.block_size,
+                    items_per_slot=self.items_per_slot,
+                    end_file_offset=full_index_offset)
+        for zoom_level in self.zoom_levels:
+            zoom_level.close_record()
+        zoom_headers = []
+        for zoom_level in self.zoom_levels:
+            zoom_level.flush_block()
+            self.max_block_size = max(self.max_block_size,
+                                      zoom_level.max_block_size)
+            zoom_data_offset = output_stream.tell()
+            output_stream.write(_zoom_count.pack(zoom_level.record_count))
+            blocks_offset = output_stream.tell()
+            zoom_level.spool.seek(0)
+            while True:
+                data = zoom_level.spool.read(1 << 20)
+                if not data: break
+                output_stream.write(data)
+            zoom_level.spool.close()
+            zoom_index_offset = output_stream.tell()
+            write_rtree(output_stream,
+                        [block[:4] + (block[4] + blocks_offset, block[5])
+                            for block in zoom_level.blocks],
+                        block_size=self.block_size,
+                        items_per_slot=self.items_per_slot,
+                        end_file_offset=zoom_index_offset)
+            zoom_headers.append(_zoom_header.pack(
+                    zoom_level.reduction, 0, zoom_data_offset,
+                    zoom_index_offset
+                ))
+        chrom_tree_offset = output_stream.tell()
+        write_chrom_tree(output_stream, self.chroms,
+                         block_size=self.block_size)
+        output_stream.seek(0)
+        summary_offset = _header.size + _zoom_header.size * len(zoom_headers)
+        output_stream.write(_header.pack(
+                _bigwig_magic, 4, len(zoom_headers), chrom_tree_offset,
+                self.data_offset, full_index_offset, 0, 0, 0,
+                summary_offset, max(self.max_block_size, 1), 0
+            ))
+        output_stream.write(''.join(zoom_headers))
+        output_stream.write(_summary.pack(
+                self.bases_covered, self.minimum or 0.0, self.maximum or 0.0,
+                self.total, self.squares
+            ))
+        output_stream.write(_count.pack(len(self.sections)))
+        output_stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+class BigWigThread(threading.Thread):
+    """ Encodes a bigWig on a separate thread.
+
+        Intervals passed to add() are batched and queued for a BigWigWriter
+        running on the thread, so several bigWigs can be encoded at once
+        while the caller reads input; zlib releases the GIL while it
+        compresses. close() waits for the thread to finish and reraises any
+        exception it encountered.
+    """
+    def __init__(self, *args, **kwargs):
+        """ Takes same arguments as BigWigWriter and starts thread. """
+        super(BigWigThread, self).__init__()
+        self.daemon = True
+        self.writer = BigWigWriter(*args, **kwargs)
+        self.queue = Queue.Queue(maxsize=16)
+        self.batch = []
+        self.exception = None
+        self.start()
+
+    def run(self):
+        batch = []
+        try:
+            add = self.writer.add
+            for batch in iter(self.queue.get, None):
+                for interval in batch:
+                    add(*interval)
+            batch = None
+            self.writer.close()
+        except Exception as e:
+            self.exception = e
+            # Drain queue so producer isn't blocked
+            while batch is not None:
+                batch = self.queue.get()
+
+    def add(self, chrom, start, end, value):
+        """ Queues interval to add to bigWig; see BigWigWriter.add().
+
+            No return value.
+        """
+        self.batch.append((chrom, start, end, value))
+        if len(self.batch) >= 4096:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def close(self):
+        """ Flushes queued intervals and waits for bigWig to be written.
+
+            No return value.
+        """
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+        self.queue.put(None)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def read_rtree(input_stream, offset, start, end):
+    """ Finds blocks of R-tree overlapping (chrom ID, base) range.
+
+        input_stream: file object
+        offset: offset of R-tree header
+        start: tuple (chrom ID, base) of start of range
+        end: tuple (chrom ID, base) of end of range, exclusive
+
+        Return value: list of (offset, size) of blocks
+    """
+    input_stream.seek(offset)
+    header = _rtree_header.unpack(input_stream.read(_rtree_header.size))
+    assert header[0] == _rtree_magic
+    blocks, to_visit = [], [input_stream.tell()]
+    while to_visit:
+        input_stream.seek(to_visit.pop(0))
+        leaf, _, count = _node_header.unpack(
+                input_stream.read(_node_header.size)
+            )
+        item = _rtree_leaf_item if leaf else _rtree_node_item
+        for _ in xrange(count):
+            fields = item.unpack(input_stream.read(item.size))
+            if (fields[:2] < end and fields[2:4] > start):
+                if leaf:
+                    blocks.append(fields[4:])
+                else:
+                    to_visit.append(fields[4])
+    return blocks
+
+def read_bigwig(filename, chrom, start, end):
+    """ Reads items overlapping an interval of a bigWig.
+
+        filename: path to bigWig
+        chrom: chromosome name
+        start: 0-based start of interval
+        end: 0-based end of interval, exclusive
+
+        Return value: tuple (list of (start, end, value) items,
+            dictionary mapping chrom names to (ID, size),
+            list of (reduction, list of zoom records))
+    """
+    with open(filename, 'rb') as input_stream:
+        header = _header.unpack(input_stream.read(_header.size))
+        assert header[0] == _bigwig_magic
+        zoom_headers = [_zoom_header.unpack(
+                            input_stream.read(_zoom_header.size)
+                        ) for _ in xrange(header[2])]
+        input_stream.seek(header[3])
+        (magic, block_size, key_size, _,
+            item_count, _) = _chrom_tree_header.unpack(
+                    input_stream.read(_chrom_tree_header.size)
+                )
+        assert magic == _chrom_tree_magic
+        chroms, to_visit = {}, [input_stream.tell()]
+        while to_visit:
+            input_stream.seek(to_visit.pop(0))
+            leaf, _, count = _node_header.unpack(
+                    input_stream.read(_node_header.size)
+                )
+            for _ in xrange(count):
+                key = input_stream.read(key_size).rstrip('\x00')
+                if leaf:
+                    chroms[key] = struct.unpack(
+                            '<II', input_stream.read(8)
+                        )
+                else:
+                    to_visit.append(
+                            _count.unpack(input_stream.read(8))[0]
+                        )
+        assert len(chroms) == item_count
+        chrom_id = chroms[chrom][0]
+        items = []
+        for offset, size in read_rtree(input_stream, header[5],
+                                       (chrom_id, start),
+                                       (chrom_id, end)):
+            input_stream.seek(offset)
+            data = zlib.decompress(input_stream.read(size))
+            assert len(data) <= header[10]
+            fields = _section_header.unpack(
+                    data[:_section_header.size]
+                )
+            for i in xrange(fields[-1]):
+                item = _bedgraph_item.unpack_from(
+                        data, _section_header.size
+                        + i * _bedgraph_item.size
+                    )
+                if item[0] < end and item[1] > start:
+                    items.append(item)
+        zooms = []
+        for reduction, _, _, index_offset in zoom_headers:
+            records = []
+            for offset, size in read_rtree(input_stream, index_offset,
+                                           (chrom_id, start),
+                                           (chrom_id, end)):
+                input_stream.seek(offset)
+                data = zlib.decompress(input_stream.read(size))
+                for i in xrange(0, len(data), _zoom_record.size):
+                    record = _zoom_record.unpack_from(data, i)
+                    if (record[0] == chrom_id and record[1] < end
+                            and record[2] > start):
+                        records.append(record)
+            zooms.append((reduction, records))
+    return items, chroms, zooms
+
+if __name__ == '__main__':
+    import unittest
+    import shutil
+
+    class TestBigWigWriter(unittest.TestCase):
+        """ Tests BigWigWriter and BigWigThread. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.bigwig = os.path.join(self.temp_dir_path, 'test.bw')
+            self.chrom_sizes = {'chr2' : 100000, 'chr1' : 50000,
+                                'chrM' : 16000}
+
+        def test_items_and_index(self):
+            """ Fails if items aren't recovered through R-tree. """
+            intervals = [('chr2', i * 10, i * 10 + 7, float(i % 13))
+                            for i in xrange(5000)] + [
+                        ('chr1', i * 3, i * 3 + 3, 1.5)
+                            for i in xrange(10000)]
+            '''Small blocks and sections exercise multilevel trees and
+            section boundaries.'''
+            with BigWigWriter(self.bigwig, self.chrom_sizes,
+                                items_per_slot=16, block_size=4,
+                                initial_reduction=64) as writer:
+                for interval in intervals:
+                    writer.add(*interval)
+            items, chroms, _ = read_bigwig(self.bigwig, 'chr2', 0, 100000)
+            self.assertEquals(chroms, {'chr2' : (0, 100000),
+                                       'chr1' : (1, 50000)})
+            self.assertEquals([('chr2',) + item for item in items],
+                              intervals[:5000])
+            items, _, _ = read_bigwig(self.bigwig, 'chr1', 995, 1003)
+            self.assertEquals(items, [(993, 996, 1.5), (996, 999, 1.5),
+                                      (999, 1002, 1.5), (1002, 1005, 1.5)])
+
+        def test_zoom_levels(self):
+            """ Fails if zoom records don't summarize intervals. """
+            with BigWigThread(self.bigwig, self.chrom_sizes,
+                                items_per_slot=8, block_size=3,
+                                initial_reduction=100) as writer:
+                writer.add('chrM', 0, 150, 2.0)
+                writer.add('chrM', 150, 250, 0.0)
+                writer.add('chrM', 250, 15990, 4.0)
+            _, _, zooms = read_bigwig(self.bigwig, 'chrM', 0, 16000)
+            self.assertEquals([reduction for reduction, _ in zooms],
+                              [100, 400, 1600, 6400, 25600])
+            self.assertEquals(zooms[0][1][:4],
+                              [(0, 0, 100, 100, 2.0, 2.0, 200.0, 400.0),
+                               (0, 100, 200, 100, 0.0, 2.0, 100.0, 200.0),
+                               (0, 200, 300, 100, 0.0, 4.0, 200.0, 800.0),
+                               (0, 300, 400, 100, 4.0, 4.0, 400.0, 1600.0)])
+            self.assertEquals(zooms[0][1][-1],
+                              (0, 15900, 16000, 90, 4.0, 4.0, 360.0, 1440.0))
+            for _, records in zooms:
+                self.assertEquals(sum([record[3] for record in records]),
+                                  15990)
+                self.assertEquals(sum([record[6] for record in records]),
+                                  300.0 + 15740 * 4.0)
+            self.assertEquals(zooms[-1][1],
+                              [(0, 0, 16000, 15990, 0.0, 4.0,
+                                300.0 + 15740 * 4.0, 600.0 + 15740 * 16.0)])
+            self.assertEquals(zooms[-2][1],
+                              [(0, 0, 6400, 6400, 0.0, 4.0,
+                                300.0 + 6150 * 4.0, 600.0 + 6150 * 16.0),
+                               (0, 6400, 12800, 6400, 4.0, 4.0,
+                                6400 * 4.0, 6400 * 16.0),
+                               (0, 12800, 16000, 3190, 4.0, 4.0,
+                                3190 * 4.0, 3190 * 16.0)])
+
+        def test_out_of_order(self):
+            """ Fails if out-of-order intervals are accepted. """
+            writer = BigWigThread(self.bigwig, self.chrom_sizes)
+            writer.add('chr1', 10, 20, 1.0)
+            writer.add('chr1', 5, 8, 1.0)
+            self.assertRaises(RuntimeError, writer.close)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
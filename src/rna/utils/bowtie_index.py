@@ -1,27 +1,158 @@
 import os
 import struct
 import mmap
-from operator import itemgetter
-from collections import defaultdict
+import tempfile
+from collections import defaultdict, OrderedDict, Mapping
 from bisect import bisect_right
 
+# Four characters encoded by each byte of .4.ebwt, low-order bits first
+_bases_from_byte = [''.join(['ACGT'[(byte >> shift) & 3]
+                                for shift in (0, 2, 4, 6)])
+                        for byte in xrange(256)]
+# Reference is decoded and cached in blocks of this many characters
+_block_bits = 12
+_block_size = 1 << _block_bits
+# Compiled reference written next to the index by compile_reference()
+_compiled_extension = '.rail.ref'
+_compiled_magic = 'RAILREF2'
+# nref, nrecs, total unambiguous chars, sequence length, size of names,
+# # of refs with records (length of each name order)
+_compiled_header = struct.Struct('<6Q')
+
+class _CompiledTable(Mapping):
+    """
+    Maps reference names to per-reference lists stored in the arrays of a
+    memory-mapped compiled reference. A reference's list is unpacked only
+    when it is first looked up, so loading a compiled reference costs
+    nothing per unambiguous stretch.
+    """
+
+    def __init__(self, mm, ref_index, rec_starts, columns):
+        """
+        @param mm: memory-mapped compiled reference
+        @param ref_index: dictionary mapping each reference name to its index
+        @param rec_starts: index of each reference's first record, followed
+            by total # of records
+        @param columns: list of tuples (position of array in mm, type code,
+            function applied to each element or None); if there is more than
+            one, each list element is a tuple with one item from each column
+        """
+        self._mm = mm
+        self._ref_index = ref_index
+        self._rec_starts = rec_starts
+        self._columns = columns
+        self._unpacked = {}
+
+    def _bounds(self, rname):
+        i = self._ref_index[rname]
+        return self._rec_starts[i], self._rec_starts[i + 1]
+
+    def __getitem__(self, rname):
+        try:
+            return self._unpacked[rname]
+        except KeyError:
+            pass
+        start, end = self._bounds(rname)
+        if start == end:
+            raise KeyError(rname)
+        columns = []
+        for pos, type_code, convert in self._columns:
+            column = struct.unpack_from(
+                    '<%d%s' % (end - start, type_code), self._mm,
+                    pos + start * struct.calcsize(type_code)
+                )
+            columns.append(map(convert, column) if convert else list(column))
+        value = zip(*columns) if len(columns) > 1 else columns[0]
+        self._unpacked[rname] = value
+        return value
+
+    def __contains__(self, rname):
+        try:
+            start, end = self._bounds(rname)
+        except KeyError:
+            return False
+        return start != end
+
+    def __iter__(self):
+        return (rname for rname in self._ref_index if rname in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
 class BowtieIndexReference(object):
     """
     Given prefix of a Bowtie index, parses the reference names, parses the
     extents of the unambiguous stretches, and memory-maps the file containing
     the unambiguous-stretch sequences.  get_stretch member function can
     retrieve stretches of characters from the reference, even if the stretch
-    contains ambiguous characters.
+    contains ambiguous characters. Recently decoded blocks of the reference
+    are kept in a bounded LRU cache.
     """
 
-    def __init__(self, idx_prefix):
+    def __init__(self, idx_prefix, cache_blocks=1024, use_compiled=True,
+                 with_sequence=True):
+        """
+        @param idx_prefix: prefix of Bowtie index
+        @param cache_blocks: max # of decoded blocks of _block_size
+            characters to cache; 0 disables the cache
+        @param use_compiled: load tables from a current compiled reference
+            written by compile_reference() instead of parsing the index
+        @param with_sequence: False if only reference names and lengths are
+            needed; the sequence is then never mapped, and get_stretch
+            raises RuntimeError
+        """
+        self._with_sequence = with_sequence
+        if use_compiled and compiled_reference_is_current(idx_prefix):
+            self._load_compiled(compiled_reference_path(idx_prefix))
+        else:
+            self._parse_index(idx_prefix)
+
+        # To facilitate sorting reference names in order of descending length
+        sorted_rnames = [self.refnames[i] for i in self.length_order]
+        '''A case-sensitive sort is also necessary here because new versions of
+        bedGraphToBigWig complain on encountering a nonlexicographic sort
+        order.'''
+        lexicographically_sorted_rnames = [self.refnames[i] for i
+                                            in self.lexicographic_order]
+        self.rname_to_string, self.l_rname_to_string = {}, {}
+        self.string_to_rname, self.l_string_to_rname = {}, {}
+        for i, rname in enumerate(sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.rname_to_string[rname] = rname_string
+            self.string_to_rname[rname_string] = rname
+        for i, rname in enumerate(lexicographically_sorted_rnames):
+            rname_string = ('%012d' % i)
+            self.l_rname_to_string[rname] = rname_string
+            self.l_string_to_rname[rname_string] = rname
+        # Handle unmapped reads
+        unmapped_string = ('%012d' % len(sorted_rnames))
+        self.rname_to_string['*'] = unmapped_string
+        self.string_to_rname[unmapped_string] = '*'
+
+        # For compatibility
+        self.rname_lengths = self.length
+
+        # LRU cache of decoded blocks keyed by (ref name, block index)
+        self._cache_blocks = cache_blocks
+        self._block_cache = OrderedDict()
+
+    def _parse_index(self, idx_prefix):
+        """
+        Parse the reference names and the extents of the unambiguous
+        stretches from the index, and memory-map the file containing the
+        unambiguous-stretch sequences.
+
+        @param idx_prefix: prefix of Bowtie index
+        """
 
         # Open file handles
         if os.path.exists(idx_prefix + '.3.ebwt'):
             # Small index (32-bit offsets)
             fh1 = open(idx_prefix + '.1.ebwt', 'rb')  # for ref names
             fh3 = open(idx_prefix + '.3.ebwt', 'rb')  # for stretch extents
-            fh4 = open(idx_prefix + '.4.ebwt', 'rb')  # for unambiguous sequence
+            if self._with_sequence:
+                # for unambiguous sequence
+                fh4 = open(idx_prefix + '.4.ebwt', 'rb')
             sz, struct_unsigned = 4, struct.Struct('I')
         else:
             raise RuntimeError('No Bowtie index files with prefix "%s"' % idx_prefix)
@@ -118,39 +249,184 @@ class BowtieIndexReference(object):
         #
         # Memory-map the .4.bt2 file
         #
-        ln_bytes = (running_unambig + 3) // 4
-        self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
+        if self._with_sequence:
+            ln_bytes = (running_unambig + 3) // 4
+            self.fh4mm = mmap.mmap(fh4.fileno(), ln_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ)
 
         # These are per-reference
         self.length = length
         self.refnames = refnames
+        self._total_unambig = running_unambig
+        self._sequence = None
+
+        # Indexes of ref names with records, by descending length and by name
+        with_records = [i for i, rname in enumerate(refnames)
+                            if rname in length]
+        self.length_order = sorted(with_records,
+                                   key=lambda i: -length[refnames[i]])
+        self.lexicographic_order = sorted(with_records,
+                                          key=lambda i: refnames[i])
+
+    def _load_compiled(self, compiled_path):
+        """
+        Memory-map a compiled reference written by compile_reference().
+        Only reference names and lengths are unpacked up front; each
+        reference's stretch extents are unpacked from the map on first use.
 
-        # To facilitate sorting reference names in order of descending length
-        sorted_rnames = sorted(self.length.items(),
-                               key=lambda x: itemgetter(1)(x), reverse=True)
-        '''A case-sensitive sort is also necessary here because new versions of
-        bedGraphToBigWig complain on encountering a nonlexicographic sort
-        order.'''
-        lexicographically_sorted_rnames = sorted(self.length.items(),
-                                                    key=lambda x:
-                                                    itemgetter(0)(x))
-        self.rname_to_string, self.l_rname_to_string = {}, {}
-        self.string_to_rname, self.l_string_to_rname = {}, {}
-        for i, (rname, _) in enumerate(sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.rname_to_string[rname] = rname_string
-            self.string_to_rname[rname_string] = rname
-        for i, (rname, _) in enumerate(lexicographically_sorted_rnames):
-            rname_string = ('%012d' % i)
-            self.l_rname_to_string[rname] = rname_string
-            self.l_string_to_rname[rname_string] = rname
-        # Handle unmapped reads
-        unmapped_string = ('%012d' % len(sorted_rnames))
-        self.rname_to_string['*'] = unmapped_string
-        self.string_to_rname[unmapped_string] = '*'
+        @param compiled_path: path to compiled reference
+        """
+        with open(compiled_path, 'rb') as compiled_stream:
+            self._compiled_mm = mmap.mmap(compiled_stream.fileno(), 0,
+                                          flags=mmap.MAP_SHARED,
+                                          prot=mmap.PROT_READ)
+        mm = self._compiled_mm
+        if mm[:len(_compiled_magic)] != _compiled_magic:
+            raise RuntimeError('"%s" is not a compiled reference'
+                                % compiled_path)
+        pos = len(_compiled_magic)
+        (nref, nrecs, total_unambig, sequence_length, names_size,
+            nordered) = _compiled_header.unpack_from(mm, pos)
+        pos += _compiled_header.size
+        def unpacked_array(type_code, count):
+            array_struct = struct.Struct('<%d%s' % (count, type_code))
+            return array_struct.unpack_from(mm, pos), array_struct.size
+        refnames = mm[pos:pos + names_size].split('\n') if nref else []
+        pos += names_size
+        lengths, size = unpacked_array('Q', nref); pos += size
+        rec_starts, size = unpacked_array('I', nref + 1); pos += size
+        # References without unambiguous stretches are left out of orders
+        self.length_order, size = unpacked_array('I', nordered); pos += size
+        self.lexicographic_order, size = unpacked_array('I', nordered)
+        pos += size
+        # Positions of per-record arrays, which are left in the map
+        array_pos = {}
+        for name, type_code in [('offs', 'I'), ('lns', 'I'),
+                                ('firsts', 'B'), ('offset_in_ref', 'Q'),
+                                ('unambig_preceding', 'Q')]:
+            array_pos[name] = (pos, type_code)
+            pos += nrecs * struct.calcsize(type_code)
+        ref_index = dict((rname, i) for i, rname in enumerate(refnames))
+        self.recs = _CompiledTable(
+                mm, ref_index, rec_starts,
+                [array_pos['offs'] + (None,), array_pos['lns'] + (None,),
+                 array_pos['firsts'] + (bool,)]
+            )
+        self.offset_in_ref = _CompiledTable(
+                mm, ref_index, rec_starts,
+                [array_pos['offset_in_ref'] + (None,)]
+            )
+        self.unambig_preceding = _CompiledTable(
+                mm, ref_index, rec_starts,
+                [array_pos['unambig_preceding'] + (None,)]
+            )
+        self.length = dict((rname, lengths[i])
+                            for i, rname in enumerate(refnames)
+                            if rec_starts[i] != rec_starts[i + 1])
+        self.refnames = refnames
+        self._total_unambig = total_unambig
+        if not self._with_sequence:
+            self._sequence = None
+        elif sequence_length:
+            # Sequence begins at next multiple of 8 bytes
+            self._sequence = buffer(mm, (pos + 7) & ~7, sequence_length)
+            self._sequence_start = {}
+            sequence_start = 0
+            for i, rname in enumerate(refnames):
+                self._sequence_start[rname] = sequence_start
+                sequence_start += lengths[i]
+        else:
+            self._sequence = None
+            fh4 = open(compiled_path[:-len(_compiled_extension)] + '.4.ebwt',
+                       'rb')
+            self.fh4mm = mmap.mmap(fh4.fileno(), (total_unambig + 3) // 4,
+                                   flags=mmap.MAP_SHARED,
+                                   prot=mmap.PROT_READ)
+
+    def _unpacked(self, buf_off, count):
+        """
+        Decode a run of unambiguous characters from the memory-mapped
+        .4.ebwt buffer a whole byte at a time.
 
-        # For compatibility
-        self.rname_lengths = self.length
+        @param buf_off: offset of first character into buffer of
+            unambiguous characters, 0-based
+        @param count: # of characters
+        @return: string of decoded characters
+        """
+        first_byte = buf_off >> 2
+        decoded = ''.join(map(_bases_from_byte.__getitem__,
+                              bytearray(self.fh4mm[
+                                    first_byte:(buf_off + count + 3) >> 2
+                                ])))
+        start = buf_off & 3
+        return decoded[start:start + count]
+
+    def _decoded(self, ref_id, ref_off, count):
+        """
+        Return a stretch of characters from the reference, bypassing the
+        cache.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param ref_off: offset into reference, 0-based and nonnegative
+        @param count: # of characters
+        @return: string extracted from reference
+        """
+        if self._sequence is not None:
+            # Compiled reference stores one character per byte
+            start = self._sequence_start[ref_id] + ref_off
+            stretch = self._sequence[
+                    start:start + min(count, self.length[ref_id] - ref_off)
+                ]
+            return stretch + 'N' * (count - len(stretch))
+        recs = self.recs[ref_id]
+        offset_in_ref = self.offset_in_ref[ref_id]
+        unambig_preceding = self.unambig_preceding[ref_id]
+        rec_count = len(recs)
+        rec = bisect_right(offset_in_ref, ref_off) - 1
+        assert rec >= 0
+        end = ref_off + count
+        stretch = []
+        while ref_off < end and rec < rec_count:
+            unambig_start = offset_in_ref[rec] + recs[rec][0]
+            unambig_end = unambig_start + recs[rec][1]
+            if ref_off < unambig_start:
+                # Ambiguous characters precede unambiguous stretch
+                to_add = min(unambig_start, end) - ref_off
+                stretch.append('N' * to_add)
+                ref_off += to_add
+            if ref_off < unambig_end and ref_off < end:
+                to_add = min(unambig_end, end) - ref_off
+                stretch.append(self._unpacked(
+                        unambig_preceding[rec] + ref_off - unambig_start,
+                        to_add
+                    ))
+                ref_off += to_add
+            rec += 1
+        # If the requested stretch went past the last unambiguous
+        # character in the chromosome, pad with Ns
+        stretch.append('N' * (end - ref_off))
+        return ''.join(stretch)
+
+    def _block(self, ref_id, block):
+        """
+        Return a block of characters from the reference, decoding it only if
+        it is not among the most recently used blocks.
+
+        @param ref_id: name of ref seq, up to & excluding whitespace
+        @param block: index of block of _block_size characters
+        @return: string with block's characters, truncated at end of ref seq
+        """
+        try:
+            decoded = self._block_cache.pop((ref_id, block))
+        except KeyError:
+            block_start = block << _block_bits
+            decoded = self._decoded(
+                    ref_id, block_start,
+                    min(self.length[ref_id] - block_start, _block_size)
+                )
+            if len(self._block_cache) >= self._cache_blocks:
+                self._block_cache.popitem(last=False)
+        self._block_cache[(ref_id, block)] = decoded
+        return decoded
 
     def get_stretch(self, ref_id, ref_off, count):
         """
@@ -162,50 +438,166 @@ class BowtieIndexReference(object):
         @param count: # of characters
         @return: string extracted from reference
         """
+        if not self._with_sequence:
+            raise RuntimeError('Reference was loaded without its sequence.')
         assert ref_id in self.recs
         # Account for negative reference offsets by padding with Ns
         N_count = min(abs(min(ref_off, 0)), count)
-        stretch = ['N'] * N_count
+        stretch = ['N' * N_count]
         count -= N_count
-        if not count: return ''.join(stretch)
+        if not count: return stretch[0]
         ref_off = max(ref_off, 0)
-        starting_rec = bisect_right(self.offset_in_ref[ref_id], ref_off) - 1
-        assert starting_rec >= 0
-        off = self.offset_in_ref[ref_id][starting_rec]
-        buf_off = self.unambig_preceding[ref_id][starting_rec]
-        # Naive to scan these records linearly; obvious speedup is binary search
-        for rec in self.recs[ref_id][starting_rec:]:
-            off += rec[0]
-            while ref_off < off and count > 0:
-                stretch.append('N')
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-            if ref_off < off + rec[1]:
-                # stretch extends through part of the unambiguous stretch
-                buf_off += (ref_off - off)
-            else:
-                buf_off += rec[1]
-            off += rec[1]
-            while ref_off < off and count > 0:
-                buf_elt = buf_off >> 2
-                shift_amt = (buf_off & 3) << 1
-                stretch.append(
-                    'ACGT'[(ord(self.fh4mm[buf_elt]) >> shift_amt) & 3]
-                )
-                buf_off += 1
-                count -= 1
-                ref_off += 1
-            if count == 0:
-                break
-        # If the requested stretch went past the last unambiguous
-        # character in the chromosome, pad with Ns
-        while count > 0:
-            count -= 1
-            stretch.append('N')
+        in_ref_count = min(ref_off + count, self.length[ref_id]) - ref_off
+        if (in_ref_count > 2 * _block_size or not self._cache_blocks
+                or self._sequence is not None):
+            # Long stretches are unlikely to be requested again, and
+            # stretches of a compiled sequence need no decoding
+            stretch.append(self._decoded(ref_id, ref_off, in_ref_count))
+        elif in_ref_count > 0:
+            end = ref_off + in_ref_count
+            for block in xrange(ref_off >> _block_bits,
+                                ((end - 1) >> _block_bits) + 1):
+                block_start = block << _block_bits
+                stretch.append(self._block(ref_id, block)[
+                        max(ref_off - block_start, 0):end - block_start
+                    ])
+        # Pad with Ns past the end of the ref seq
+        stretch.append('N' * (count - max(in_ref_count, 0)))
         return ''.join(stretch)
 
+    def get_stretches(self, requests):
+        """
+        Return many stretches of characters from the reference at once.
+
+        Requests are served in order of reference position so neighboring
+        stretches share decoded blocks.
+
+        @param requests: iterable of tuples (ref_id, ref_off, count), each
+            specifying a stretch as for get_stretch
+        @return: list of strings extracted from reference, one per request
+            and in the order of requests
+        """
+        requests = list(requests)
+        stretches = [None] * len(requests)
+        for i in sorted(xrange(len(requests)),
+                        key=lambda j: requests[j][:2]):
+            stretches[i] = self.get_stretch(*requests[i])
+        return stretches
+
+def compiled_reference_path(idx_prefix):
+    """ Returns path to compiled reference for Bowtie index
+
+        @param idx_prefix: prefix of Bowtie index
+        @return: path to compiled reference
+    """
+    return idx_prefix + _compiled_extension
+
+def compiled_reference_is_current(idx_prefix, with_sequence=False):
+    """ Checks whether compiled reference is at least as new as index
+
+        @param idx_prefix: prefix of Bowtie index
+        @param with_sequence: also require that compiled reference store
+            the full sequence
+        @return: True iff compiled reference can stand in for the index
+    """
+    compiled_path = compiled_reference_path(idx_prefix)
+    try:
+        compiled_mtime = os.path.getmtime(compiled_path)
+        if any(os.path.getmtime(idx_prefix + extension) > compiled_mtime
+                for extension in ['.1.ebwt', '.3.ebwt', '.4.ebwt']):
+            return False
+        with open(compiled_path, 'rb') as compiled_stream:
+            if compiled_stream.read(len(_compiled_magic)) != _compiled_magic:
+                return False
+            header = compiled_stream.read(_compiled_header.size)
+    except (IOError, OSError):
+        return False
+    if len(header) != _compiled_header.size:
+        return False
+    return not with_sequence or _compiled_header.unpack(header)[3] > 0
+
+def compile_reference(idx_prefix, with_sequence=False, force=False):
+    """ Writes compiled reference next to Bowtie index
+
+        The compiled reference holds the reference names, the extents of
+        the unambiguous stretches, and the name orders BowtieIndexReference
+        otherwise rebuilds on every load, so each task need only memory-map
+        it. If with_sequence is True, it also holds the decoded reference
+        at one character per byte, which costs about a byte per base of
+        disk but spares every get_stretch() the decoding. The file is
+        written to a temporary file and renamed into place so concurrent
+        tasks never see a partial compiled reference.
+
+        idx_prefix: prefix of Bowtie index
+        with_sequence: whether to store the decoded sequence
+        force: write compiled reference even if it is current
+
+        Return value: path to compiled reference
+    """
+    compiled_path = compiled_reference_path(idx_prefix)
+    if not force and compiled_reference_is_current(idx_prefix,
+                                                   with_sequence=with_sequence):
+        return compiled_path
+    ref = BowtieIndexReference(idx_prefix, use_compiled=False,
+                               with_sequence=with_sequence)
+    refnames = ref.refnames
+    nref = len(refnames)
+    lengths = [ref.length.get(rname, 0) for rname in refnames]
+    rec_starts = [0]
+    for rname in refnames:
+        rec_starts.append(rec_starts[-1] + len(ref.recs.get(rname, [])))
+    recs, offset_in_ref, unambig_preceding = [], [], []
+    for rname in refnames:
+        recs.extend(ref.recs.get(rname, []))
+        offset_in_ref.extend(ref.offset_in_ref.get(rname, []))
+        unambig_preceding.extend(ref.unambig_preceding.get(rname, []))
+    nrecs = len(recs)
+    names = '\n'.join(refnames)
+    sequence_length = sum(lengths) if with_sequence else 0
+    compiled_dir = os.path.dirname(os.path.abspath(compiled_path))
+    temp_fd, temp_path = tempfile.mkstemp(dir=compiled_dir,
+                                          prefix='.rail.ref.')
+    try:
+        with os.fdopen(temp_fd, 'wb') as compiled_stream:
+            compiled_stream.write(_compiled_magic)
+            compiled_stream.write(_compiled_header.pack(
+                    nref, nrecs, ref._total_unambig, sequence_length,
+                    len(names), len(ref.length_order)
+                ))
+            compiled_stream.write(names)
+            for type_code, values in [
+                    ('Q', lengths), ('I', rec_starts),
+                    ('I', ref.length_order), ('I', ref.lexicographic_order),
+                    ('I', [rec[0] for rec in recs]),
+                    ('I', [rec[1] for rec in recs]),
+                    ('B', [int(rec[2]) for rec in recs]),
+                    ('Q', offset_in_ref), ('Q', unambig_preceding)
+                ]:
+                compiled_stream.write(
+                        struct.pack('<%d%s' % (len(values), type_code),
+                                    *values)
+                    )
+            if with_sequence:
+                # Sequence begins at next multiple of 8 bytes
+                compiled_stream.write(
+                        '\x00' * (-compiled_stream.tell() & 7)
+                    )
+                chunk_size = _block_size << 8
+                for rname, length in zip(refnames, lengths):
+                    for ref_off in xrange(0, length, chunk_size):
+                        compiled_stream.write(ref._decoded(
+                                rname, ref_off,
+                                min(chunk_size, length - ref_off)
+                            ))
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, compiled_path)
+    except:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return compiled_path
 
 def which(program):
     def is_exe(fp):
@@ -234,9 +626,16 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--test', action='store_const', const=True, default=False, help='Do unit tests')
+    parser.add_argument('--compile', type=str, required=False, default=None, metavar='<idx>', help='Write compiled reference for Bowtie index with this prefix')
+    parser.add_argument('--with-sequence', action='store_const', const=True, default=False, help='Store decoded sequence in compiled reference')
 
     args = parser.parse_args()
 
+    if args.compile is not None:
+        print >>sys.stderr, 'Wrote %s' % compile_reference(
+                args.compile, with_sequence=args.with_sequence, force=True
+            )
+
     if args.test:
         import unittest
 
@@ -316,4 +715,88 @@ CA
                 self.assertEqual('NNNNNNNNN', ref.get_stretch('short_name1', 85, 9))
                 self.assertEqual('ANNNNNNNN', ref.get_stretch('short_name1', 80, 9))
 
+            def test_batch_and_cache(self):
+                # A one-block cache is evicted between most requests
+                ref = BowtieIndexReference(self.fa_fn_1, cache_blocks=1)
+                requests = [('short_name4', 240, 42), ('short_name1', -3, 6),
+                            ('short_name2', 1, 11), ('short_name4', 41, 4),
+                            ('short_name1', 72, 11)]
+                expected = ['NNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNTT',
+                            'NNNACG', 'AGTCAGTCAGT', 'AAAA', 'ACGTACGTANN']
+                self.assertEqual(expected, ref.get_stretches(requests))
+                self.assertEqual(expected, ref.get_stretches(requests))
+                uncached_ref = BowtieIndexReference(self.fa_fn_1, cache_blocks=0)
+                self.assertEqual(expected, uncached_ref.get_stretches(requests))
+
+            def test_compiled_reference(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                requests = [('short_name4', 240, 42), ('short_name1', -3, 6),
+                            ('short_name2', 1, 11), ('short_name3', 0, 10),
+                            ('short_name1', 85, 9)]
+                expected = ref.get_stretches(requests)
+                for with_sequence in [False, True]:
+                    compile_reference(self.fa_fn_1,
+                                      with_sequence=with_sequence)
+                    self.assertTrue(compiled_reference_is_current(
+                            self.fa_fn_1, with_sequence=with_sequence
+                        ))
+                    compiled_ref = BowtieIndexReference(self.fa_fn_1)
+                    self.assertEqual(expected,
+                                     compiled_ref.get_stretches(requests))
+                    self.assertEqual(ref.length, compiled_ref.length)
+                    self.assertEqual(ref.rname_to_string,
+                                     compiled_ref.rname_to_string)
+                    self.assertEqual(ref.l_string_to_rname,
+                                     compiled_ref.l_string_to_rname)
+                    # Tables unpacked on demand match parsed tables
+                    self.assertEqual(dict(ref.recs), dict(compiled_ref.recs))
+                    self.assertEqual(dict(ref.offset_in_ref),
+                                     dict(compiled_ref.offset_in_ref))
+                    self.assertEqual(dict(ref.unambig_preceding),
+                                     dict(compiled_ref.unambig_preceding))
+                    self.assertFalse('short_name5' in compiled_ref.recs)
+
+            def test_without_sequence(self):
+                ref = BowtieIndexReference(self.fa_fn_1)
+                for compile_first in [False, True]:
+                    if compile_first:
+                        compile_reference(self.fa_fn_1)
+                    names_ref = BowtieIndexReference(self.fa_fn_1,
+                                                     with_sequence=False)
+                    self.assertEqual(ref.length, names_ref.length)
+                    self.assertEqual(ref.rname_to_string,
+                                     names_ref.rname_to_string)
+                    self.assertRaises(RuntimeError, names_ref.get_stretch,
+                                      'short_name1', 0, 10)
+
+            def test_reference_of_only_ns(self):
+                fa_fn_2 = os.path.join(self.tmpdir, 'tmp2.fa')
+                with open(fa_fn_2, 'w') as fh:
+                    fh.write('''>short_name1
+ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT
+>short_name2
+NNNNNNNNNNCCCCCCCCCCGGGGGGGGGG
+>short_name3
+NNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNNN
+''')
+                os.system('bowtie-build %s %s >/dev/null' % (fa_fn_2, fa_fn_2))
+                ref = BowtieIndexReference(fa_fn_2, use_compiled=False)
+                requests = [('short_name1', 38, 4), ('short_name2', 5, 10),
+                            ('short_name2', 25, 10)]
+                expected = ref.get_stretches(requests)
+                for with_sequence in [False, True]:
+                    compile_reference(fa_fn_2, with_sequence=with_sequence,
+                                      force=True)
+                    compiled_ref = BowtieIndexReference(fa_fn_2)
+                    self.assertEqual(ref.length_order,
+                                     list(compiled_ref.length_order))
+                    self.assertEqual(ref.lexicographic_order,
+                                     list(compiled_ref.lexicographic_order))
+                    self.assertEqual(ref.length, compiled_ref.length)
+                    self.assertEqual(ref.rname_to_string,
+                                     compiled_ref.rname_to_string)
+                    self.assertEqual(dict(ref.recs), dict(compiled_ref.recs))
+                    self.assertEqual(expected,
+                                     compiled_ref.get_stretches(requests))
+
         unittest.main(argv=[sys.argv[0]])
@@ -0,0 +1,714 @@
+#!/usr/bin/env python
+"""
+bowtie_pool.py
+Part of Rail-RNA
+
+Node-local pool of long-lived Bowtie/Bowtie 2 processes. Starting an aligner
+loads its index and warms up its threads, which for many small tasks can
+take longer than aligning their reads. When Dooplicity's emr_simulator sets
+the environment variable DOOPLICITY_SERVICE_DIR, command() replaces an
+aligner command in a step's pipeline with a client that streams reads over a
+Unix socket to a server in that directory. The first task to need a given
+command starts its server; later tasks of all steps on the node reuse it.
+Each server keeps up to --workers aligner processes running the same command
+with --reorder and hands a connection to one idle worker at a time.
+
+Aligners read from a pipe in batches, so a worker can't tell where a task's
+reads end. The server follows a task's reads with a sentinel read and then
+keeps feeding all-N filler reads, which aligners reject immediately, until
+the sentinel's alignment comes back; alignments of the sentinel and fillers
+are never passed to clients. Commands with options that keep records of
+reads like the sentinel from being written, such as --no-unal, or that write
+reads to other files, such as --un, are never pooled. If a worker still
+writes nothing for --read-timeout seconds after a task's reads end, it is
+killed. A server exits when it has been idle for --idle-timeout seconds or
+when its socket is removed along with the service directory.
+
+A client keeps a copy of its reads and holds back alignments until its task
+is done. If no server can be reached or the server fails the task, the
+client runs the aligner command itself on the reads, as steps did before.
+
+Usage: bowtie_pool.py connect --service-dir DIR -- <aligner command>
+       bowtie_pool.py serve --socket PATH -- <aligner command>
+Alignments are written to stdout for reads in --12 format from stdin.
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import pipes
+import shlex
+import socket
+import hashlib
+import threading
+import subprocess
+import tempfile
+import shutil
+import Queue
+
+_service_dir_variable = 'DOOPLICITY_SERVICE_DIR'
+# Reads with names that start with \x1e never reach clients
+_internal_prefix = '\x1ebowtie_pool.'
+_filler_block = ('\t'.join([_internal_prefix + 'fill', 'N' * 32, 'I' * 32])
+                    + '\n') * 64
+_trailer = _internal_prefix + 'ok\n'
+'''Bowtie and Bowtie 2 options that keep an aligner from writing a record for
+every read, that write reads to other files, or that skip reads. A pooled
+aligner must write the sentinel's record, and it serves many tasks.'''
+_unpoolable_options = set(['--no-unal', '-u', '--upto', '--qupto', '-s',
+                            '--skip', '--max'] + [
+                                '--%s%s%s' % (prefix, conc, compression)
+                                for prefix in ['un', 'al']
+                                for conc in ['', '-conc']
+                                for compression in ['', '-gz', '-bz2',
+                                                        '-lz4']
+                            ])
+
+def add_args(parser):
+    """ Sets up arguments related to serving aligner commands. """
+    parser.add_argument(
+        '--service-dir', metavar='DIR', type=str, required=False,
+        default=os.environ.get(_service_dir_variable),
+        help='Directory with servers\' Unix sockets (def: $%s)'
+                % _service_dir_variable)
+    parser.add_argument(
+        '--workers', metavar='INT', type=int, required=False,
+        default=None,
+        help='Maximum number of aligner processes per command (def: number '
+             'of CPUs)')
+    parser.add_argument(
+        '--idle-timeout', metavar='SEC', type=float, required=False,
+        default=120,
+        help='Servers exit after being idle for this many seconds')
+    parser.add_argument(
+        '--read-timeout', metavar='SEC', type=float, required=False,
+        default=120,
+        help='Kill an aligner that writes nothing for this many seconds '
+             'after a task\'s reads end; the task then runs its own aligner')
+
+def poolable(command_list):
+    """ Checks whether an aligner command can be served by a pool.
+
+        command_list: aligner command as list of arguments
+
+        Return value: False iff command has an option in _unpoolable_options
+    """
+    for argument in command_list:
+        if argument.partition('=')[0] in _unpoolable_options:
+            return False
+        if (argument[:1] == '-' and argument[1:2] != '-'
+                and argument[:2] in _unpoolable_options):
+            # Short option with value attached, like -u100
+            return False
+    return True
+
+def command(aligner_command, service_dir=None):
+    """ Wraps aligner command so it's served by the node's pool if possible.
+
+        aligner_command: shell command that aligns reads in --12 format from
+            stdin and writes SAM to stdout
+        service_dir: directory in which servers' sockets are placed, or None
+            to use environment variable DOOPLICITY_SERVICE_DIR
+
+        Return value: shell command; aligner_command if no service dir is set
+            or the command can't be pooled
+    """
+    if service_dir is None:
+        service_dir = os.environ.get(_service_dir_variable)
+    if not service_dir or not poolable(shlex.split(aligner_command)):
+        return aligner_command
+    return ' '.join([pipes.quote(sys.executable),
+                     pipes.quote(os.path.splitext(
+                            os.path.realpath(__file__)
+                        )[0] + '.py'),
+                     'connect', '--service-dir', pipes.quote(service_dir),
+                     '--', aligner_command])
+
+def socket_path(service_dir, command_list):
+    """ Finds path to socket of server for aligner command.
+
+        Relative paths in a command are resolved against the directory of
+        the task that starts its server, so the working directory is part of
+        a server's identity.
+
+        service_dir: directory in which servers' sockets are placed
+        command_list: aligner command as list of arguments
+
+        Return value: path to Unix socket
+    """
+    return os.path.join(service_dir, 'bowtie.%s.sock' % hashlib.sha1(
+                '\x00'.join([os.getcwd()] + command_list)
+            ).hexdigest()[:16])
+
+class Worker(object):
+    """ Aligner process that aligns reads of one connection at a time. """
+    def __init__(self, command_list, log_stream=None, read_timeout=120):
+        """
+            command_list: aligner command as list of arguments
+            log_stream: where aligner writes stderr, or None to inherit
+            read_timeout: seconds without output after a client's reads end
+                after which aligner is killed
+        """
+        self.process = subprocess.Popen(command_list + ['--reorder'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=log_stream,
+                                        bufsize=-1)
+        self.read_timeout = read_timeout
+        self.batch = 0
+
+    def alive(self):
+        """ Return value: True iff aligner process hasn't exited. """
+        return self.process.poll() is None
+
+    def align(self, client):
+        """ Aligns reads from client and sends back alignments.
+
+            client: socket connected to a client, which shuts down its
+                writing end after sending all its reads
+
+            Return value: True iff worker can align another client's reads
+        """
+        self.batch += 1
+        sentinel = '%sdone.%d\t' % (_internal_prefix, self.batch)
+        done = threading.Event()
+        # Time of last line of output; updated by reader
+        last_output = [time.time()]
+        def feed():
+            """ Feeds client's reads, sentinel, and then filler to aligner.
+            """
+            try:
+                try:
+                    for line in client.makefile('rb'):
+                        if line[-1] != '\n': line += '\n'
+                        self.process.stdin.write(line)
+                except socket.error:
+                    # Client's gone; finish its batch anyway
+                    pass
+                self.process.stdin.write(
+                        sentinel + 'N' * 32 + '\t' + 'I' * 32 + '\n'
+                    )
+                fed_time = time.time()
+                while not done.is_set():
+                    if (time.time() - max(fed_time, last_output[0])
+                            > self.read_timeout):
+                        print >>sys.stderr, (
+                                'Aligner wrote nothing for %d s after a '
+                                'task\'s reads; killing it.'
+                            ) % self.read_timeout
+                        self.process.kill()
+                        break
+                    self.process.stdin.write(_filler_block)
+                    self.process.stdin.flush()
+                    done.wait(0.01)
+            except (IOError, OSError):
+                # Aligner died; handled when its output ends
+                pass
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        client_stream, client_gone = client.makefile('wb'), False
+        try:
+            for line in iter(self.process.stdout.readline, ''):
+                last_output[0] = time.time()
+                if line.startswith(_internal_prefix):
+                    if line.startswith(sentinel):
+                        done.set()
+                        break
+                    continue
+                if not client_gone:
+                    try:
+                        client_stream.write(line)
+                    except socket.error:
+                        client_gone = True
+            else:
+                return False
+            if not client_gone:
+                try:
+                    client_stream.write(_trailer)
+                    client_stream.flush()
+                except socket.error:
+                    pass
+        finally:
+            done.set()
+            feeder.join()
+            try:
+                client_stream.close()
+                client.close()
+            except socket.error:
+                pass
+        return True
+
+    def close(self):
+        """ Ends aligner process.
+
+            No return value.
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        self.process.stdout.read()
+        self.process.wait()
+
+class Server(object):
+    """ Serves one aligner command from a pool of workers. """
+    def __init__(self, socket_path, command_list, workers=None,
+                    idle_timeout=120, log_stream=None, read_timeout=120):
+        """
+            socket_path: path to Unix socket on which to listen
+            command_list: aligner command as list of arguments
+            workers: maximum number of aligner processes, or None to use
+                number of CPUs
+            idle_timeout: exit after this many seconds without clients
+            log_stream: where aligners write stderr, or None to inherit
+            read_timeout: seconds without output after a client's reads end
+                after which a worker's aligner is killed
+        """
+        if workers is None:
+            import multiprocessing
+            workers = multiprocessing.cpu_count()
+        self.socket_path = socket_path
+        self.command_list = command_list
+        self.max_workers = max(workers, 1)
+        self.idle_timeout = idle_timeout
+        self.log_stream = log_stream
+        self.read_timeout = read_timeout
+        self.idle_workers = Queue.Queue()
+        self.worker_count = 0
+        self.active_count = 0
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+
+    def handle(self, client):
+        """ Aligns a client's reads with an idle or new worker.
+
+            client: socket connected to a client
+
+            No return value.
+        """
+        try:
+            worker = None
+            while worker is None:
+                try:
+                    worker = self.idle_workers.get_nowait()
+                except Queue.Empty:
+                    with self.lock:
+                        start_worker = self.worker_count < self.max_workers
+                        if start_worker: self.worker_count += 1
+                    if start_worker:
+                        try:
+                            worker = Worker(self.command_list,
+                                            self.log_stream,
+                                            self.read_timeout)
+                        except Exception:
+                            with self.lock:
+                                self.worker_count -= 1
+                            raise
+                    else:
+                        try:
+                            worker = self.idle_workers.get(timeout=1)
+                        except Queue.Empty:
+                            # Check again in case a worker died
+                            continue
+                if not worker.alive():
+                    worker.close()
+                    with self.lock:
+                        self.worker_count -= 1
+                    worker = None
+            if worker.align(client):
+                self.idle_workers.put(worker)
+            else:
+                worker.close()
+                with self.lock:
+                    self.worker_count -= 1
+        finally:
+            client.close()
+            with self.lock:
+                self.active_count -= 1
+                self.last_active = time.time()
+
+    def serve(self):
+        """ Accepts connections until idle or socket is removed.
+
+            No return value.
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        listener.bind(self.socket_path)
+        socket_inode = os.stat(self.socket_path).st_ino
+        listener.listen(64)
+        listener.settimeout(1)
+        try:
+            while True:
+                try:
+                    client = listener.accept()[0]
+                except socket.timeout:
+                    try:
+                        if os.stat(self.socket_path).st_ino != socket_inode:
+                            # Replaced by another server
+                            break
+                    except OSError:
+                        # Service dir was removed
+                        break
+                    with self.lock:
+                        if (not self.active_count and time.time()
+                                - self.last_active > self.idle_timeout):
+                            break
+                    continue
+                client.settimeout(None)
+                with self.lock:
+                    self.active_count += 1
+                handler = threading.Thread(target=self.handle,
+                                           args=(client,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            try:
+                if os.stat(self.socket_path).st_ino == socket_inode:
+                    os.remove(self.socket_path)
+            except OSError:
+                pass
+            listener.close()
+            while True:
+                try:
+                    self.idle_workers.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+def connected(socket_path):
+    """ Connects to server.
+
+        socket_path: path to server's Unix socket
+
+        Return value: connected socket, or None if server isn't up
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        client.close()
+        return None
+    return client
+
+def connection(service_dir, command_list, workers=None, idle_timeout=120,
+                read_timeout=120, startup_timeout=60):
+    """ Connects to server for aligner command, starting it if necessary.
+
+        service_dir: directory in which servers' sockets are placed
+        command_list: aligner command as list of arguments
+        workers: maximum number of aligner processes for a new server, or
+            None to use number of CPUs
+        idle_timeout: new server exits after this many idle seconds
+        read_timeout: new server kills an aligner that writes nothing for
+            this many seconds after a task's reads end
+        startup_timeout: seconds to wait for a new server to listen
+
+        Return value: connected socket, or None if no server could be reached
+    """
+    path = socket_path(service_dir, command_list)
+    client = connected(path)
+    if client is not None:
+        return client
+    try:
+        os.makedirs(service_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            return None
+    try:
+        lock_stream = open(path + '.lock', 'w')
+    except IOError:
+        return None
+    try:
+        # Only one task starts a given server
+        fcntl.flock(lock_stream, fcntl.LOCK_EX)
+        client = connected(path)
+        if client is not None:
+            return client
+        server_command = [sys.executable,
+                            os.path.splitext(
+                                os.path.realpath(__file__)
+                            )[0] + '.py',
+                            'serve', '--socket', path,
+                            '--idle-timeout', str(idle_timeout),
+                            '--read-timeout', str(read_timeout)] + (
+                                ['--workers', str(workers)]
+                                if workers is not None else []
+                            ) + ['--'] + command_list
+        with open(os.devnull, 'r+') as null_stream, \
+            open(path[:-5] + '.log', 'a') as log_stream:
+            server_process = subprocess.Popen(server_command,
+                                              stdin=null_stream,
+                                              stdout=null_stream,
+                                              stderr=log_stream,
+                                              close_fds=True,
+                                              preexec_fn=os.setsid)
+        start_time = time.time()
+        while time.time() - start_time < startup_timeout:
+            client = connected(path)
+            if client is not None or server_process.poll() is not None:
+                break
+            time.sleep(0.05)
+        return client
+    finally:
+        fcntl.flock(lock_stream, fcntl.LOCK_UN)
+        lock_stream.close()
+
+def align(client, read_spool, input_stream=sys.stdin,
+            output_stream=sys.stdout):
+    """ Streams reads to server and alignments from it.
+
+        Alignments are held in a temporary file until the server reports
+        that all reads were aligned, so none are written if it fails.
+
+        client: socket connected to server
+        read_spool: file to which all reads are copied, even if server
+            fails, so they can be aligned again
+        input_stream: where to read reads in --12 format
+        output_stream: where to write alignments
+
+        Return value: True iff server aligned all reads
+    """
+    def feed():
+        """ Copies reads to spool and sends them to server. """
+        sending = True
+        try:
+            while True:
+                data = os.read(input_stream.fileno(), 65536)
+                if not data: break
+                read_spool.write(data)
+                if sending:
+                    try:
+                        client.sendall(data)
+                    except socket.error:
+                        # Keep spooling reads to align them in task
+                        sending = False
+        except OSError:
+            pass
+        try:
+            client.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+    succeeded = False
+    with tempfile.TemporaryFile() as alignment_spool:
+        try:
+            for line in client.makefile('rb'):
+                if line == _trailer:
+                    succeeded = True
+                    break
+                alignment_spool.write(line)
+        except socket.error:
+            pass
+        client.close()
+        feeder.join()
+        if succeeded:
+            alignment_spool.seek(0)
+            shutil.copyfileobj(alignment_spool, output_stream)
+            output_stream.flush()
+    read_spool.flush()
+    return succeeded
+
+if __name__ == '__main__':
+    import argparse
+    # Print file's docstring if -h is invoked
+    parser = argparse.ArgumentParser(description=__doc__,
+                formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', type=str, choices=['connect', 'serve', 'test'],
+        help='"connect" to align with a server, "serve" to run one, or '
+             '"test" to run unit tests')
+    parser.add_argument('--socket', metavar='PATH', type=str, required=False,
+        default=None,
+        help='Unix socket on which to serve')
+    add_args(parser)
+    # Aligner command follows --
+    try:
+        split_index = sys.argv.index('--')
+    except ValueError:
+        split_index = len(sys.argv)
+    args = parser.parse_args(sys.argv[1:split_index])
+    command_list = sys.argv[split_index+1:]
+    # A single argument may hold the whole command
+    if len(command_list) == 1: command_list = shlex.split(command_list[0])
+
+if __name__ == '__main__' and args.mode == 'serve':
+    Server(args.socket, command_list, workers=args.workers,
+            idle_timeout=args.idle_timeout,
+            read_timeout=args.read_timeout).serve()
+elif __name__ == '__main__' and args.mode == 'connect':
+    client = None
+    if args.service_dir and poolable(command_list):
+        try:
+            client = connection(args.service_dir, command_list,
+                                workers=args.workers,
+                                idle_timeout=args.idle_timeout,
+                                read_timeout=args.read_timeout)
+        except Exception as e:
+            print >>sys.stderr, 'Aligner pool unavailable: %s' % e
+    if client is None:
+        print >>sys.stderr, 'Running aligner in task: %s' % ' '.join(
+                command_list
+            )
+        sys.stderr.flush()
+        os.execvp(command_list[0], command_list)
+    print >>sys.stderr, 'Aligning with pooled aligner: %s' % ' '.join(
+            command_list
+        )
+    with tempfile.TemporaryFile() as read_spool:
+        if not align(client, read_spool):
+            print >>sys.stderr, ('Pooled aligner failed; see logs in %s. '
+                                 'Running aligner in task: %s') % (
+                                        args.service_dir,
+                                        ' '.join(command_list)
+                                    )
+            sys.stderr.flush()
+            read_spool.seek(0)
+            sys.exit(subprocess.call(command_list, stdin=read_spool))
+elif __name__ == '__main__':
+    # Test units
+    del sys.argv[1:] # Don't choke on extra command-line parameters
+    import unittest
+    import tempfile
+    import shutil
+
+    class TestBowtiePool(unittest.TestCase):
+        """ Tests pool with an aligner that buffers its output. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.service_dir = os.path.join(self.temp_dir_path, 'services')
+            self.aligner = os.path.join(self.temp_dir_path, 'aligner.sh')
+            self.log = os.path.join(self.temp_dir_path, 'starts')
+            with open(self.aligner, 'w') as aligner_stream:
+                # awk buffers output written to a pipe
+                print >>aligner_stream, (
+                        '#!/bin/sh\n'
+                        'echo $1 >>%s\n'
+                        'exec awk -F \'\\t\' \'{ print $1 "\\t4\\t" $2 }\''
+                    ) % self.log
+            os.chmod(self.aligner, 0755)
+
+        def run_client(self, reads, service_dir=None, aligner_args='idx',
+                        timeouts='--idle-timeout 1'):
+            """ Aligns reads with client; returns output lines. """
+            aligner_command = command(self.aligner + ' ' + aligner_args,
+                                      service_dir=service_dir)
+            client_process = subprocess.Popen(
+                    aligner_command.replace(' -- ', ' %s -- ' % timeouts),
+                    shell=True, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+            output = client_process.communicate(
+                    ''.join(['%s\t%s\tIIII\n' % read for read in reads])
+                )[0]
+            self.assertEquals(client_process.returncode, 0)
+            return output.splitlines()
+
+        def starts(self):
+            """ Returns number of times aligner was started. """
+            try:
+                with open(self.log) as log_stream:
+                    return len(log_stream.readlines())
+            except IOError:
+                return 0
+
+        def test_reuse(self):
+            """ Fails if tasks don't share one aligner or see others' reads.
+            """
+            for i in xrange(3):
+                reads = [('r%d.%d' % (i, j), 'ACGT') for j in xrange(500)]
+                self.assertEquals(
+                        self.run_client(reads, self.service_dir),
+                        ['r%d.%d\t4\tACGT' % (i, j) for j in xrange(500)]
+                    )
+            self.assertEquals(self.starts(), 1)
+
+        def test_concurrent(self):
+            """ Fails if concurrent tasks' alignments are mixed up. """
+            results = {}
+            def task(i):
+                results[i] = self.run_client(
+                        [('s%d.%d' % (i, j), 'A') for j in xrange(2000)],
+                        self.service_dir
+                    )
+            threads = [threading.Thread(target=task, args=(i,))
+                        for i in xrange(4)]
+            for thread in threads: thread.start()
+            for thread in threads: thread.join()
+            for i in xrange(4):
+                self.assertEquals(results[i], ['s%d.%d\t4\tA' % (i, j)
+                                                for j in xrange(2000)])
+
+        def test_idle_exit(self):
+            """ Fails if server doesn't exit after idle timeout. """
+            self.run_client([('a', 'C')], self.service_dir)
+            self.assertEquals(len([name for name
+                                    in os.listdir(self.service_dir)
+                                    if name.endswith('.sock')]), 1)
+            time.sleep(3)
+            self.assertEquals(len([name for name
+                                    in os.listdir(self.service_dir)
+                                    if name.endswith('.sock')]), 0)
+
+        def test_fallback(self):
+            """ Fails if client doesn't run aligner when pool's unusable. """
+            not_a_dir = os.path.join(self.temp_dir_path, 'file')
+            open(not_a_dir, 'w').close()
+            self.assertEquals(self.run_client([('b', 'G')], not_a_dir),
+                              ['b\t4\tG'])
+            self.assertEquals(self.run_client([('c', 'T')]), ['c\t4\tT'])
+
+        def test_unpoolable(self):
+            """ Fails if commands that suppress records are pooled. """
+            for aligner_args in ['idx --no-unal', 'idx --un=unaligned.fq',
+                                    'idx --al-conc-gz aligned', 'idx -u100',
+                                    'idx -s 5']:
+                self.assertEquals(
+                        command(self.aligner + ' ' + aligner_args,
+                                service_dir=self.service_dir),
+                        self.aligner + ' ' + aligner_args
+                    )
+            self.assertNotEquals(
+                    command(self.aligner + ' idx --local -p 4',
+                            service_dir=self.service_dir),
+                    self.aligner + ' idx --local -p 4'
+                )
+            self.assertEquals(self.run_client([('d', 'A')], self.service_dir,
+                                                aligner_args='idx --no-unal'),
+                              ['d\t4\tA'])
+            self.assertFalse(os.path.exists(self.service_dir))
+
+        def test_dropped_records(self):
+            """ Fails if task hangs or loses reads when records are dropped.
+            """
+            with open(self.aligner, 'w') as aligner_stream:
+                # Like --no-unal, doesn't write records of all-N reads
+                print >>aligner_stream, (
+                        '#!/bin/sh\n'
+                        'echo $1 >>%s\n'
+                        'exec awk -F \'\\t\' \'$2 !~ /^N+$/ '
+                        '{ print $1 "\\t4\\t" $2 }\''
+                    ) % self.log
+            reads = [('e%d' % i, 'N' if i % 3 else 'ACGT')
+                        for i in xrange(100)]
+            start_time = time.time()
+            self.assertEquals(
+                    self.run_client(reads, self.service_dir,
+                                    timeouts=('--idle-timeout 1 '
+                                              '--read-timeout 1')),
+                    ['e%d\t4\tACGT' % i for i in xrange(0, 100, 3)]
+                )
+            self.assertTrue(time.time() - start_time < 30)
+            # Pooled aligner was killed, and task ran its own
+            self.assertEquals(self.starts(), 2)
+
+        def tearDown(self):
+            # Servers see their sockets disappear and exit
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()
@@ -12,6 +12,11 @@ import subprocess
 import time
 import threading
 import pipes
+import select
+import hashlib
+import zlib
+import re
+import Queue
 
 def add_args(parser):
     """ Sets up arguments related to moving files around. """
@@ -38,6 +43,238 @@ class CommandThread(threading.Thread):
                                     stderr=sys.stderr)
         self.process_return = self.process.wait()
 
+def is_md5(md5):
+    """ Checks whether a manifest's optional MD5 field holds an MD5.
+
+        Manifests often hold a placeholder like 0 when no MD5 is available.
+
+        md5: contents of MD5 field
+
+        Return value: True iff md5 is 32 hex digits
+    """
+    return re.match('^[0-9a-fA-F]{32}$', md5 or '') is not None
+
+class DownloadStream(object):
+    """ File-like object for reading a remote file while it downloads.
+
+        A thread runs curl (for HTTP/FTP URLs) or s3cmd get (for S3 URLs)
+        with its output piped back, gunzips the data on the fly if it is
+        gzipped, and puts it on a queue of at most buffer_size chunks of at
+        most chunk_size bytes, so read-ahead is bounded. If no data arrives
+        for stall_timeout seconds or the download command fails, the command
+        is killed and restarted from the first byte not yet received: curl
+        is passed a range, while s3cmd cannot be, so bytes already received
+        from it are discarded. The MD5 of the raw (compressed) data is
+        computed as it arrives and checked at the end of the download if one
+        is provided.
+    """
+    def __init__(self, url, mover, md5=None, buffer_size=64,
+                    chunk_size=1048576, stall_timeout=120, tries=5):
+        self.url, self.mover = url, mover
+        self.name = url.to_url()
+        self.md5 = md5.lower() if is_md5(md5) else None
+        self.chunk_size, self.stall_timeout = chunk_size, stall_timeout
+        self.tries = tries
+        self.queue = Queue.Queue(maxsize=buffer_size)
+        self.buffer, self.position = '', 0
+        self.eof, self.closed = False, False
+        self.thread = threading.Thread(target=self._download)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _put(self, item):
+        """ Puts item on queue unless stream is closed while waiting. """
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def _command(self, offset):
+        """ Builds command that writes download to stdout.
+
+            offset: byte of file at which to start download
+
+            Return value: tuple (command list, True iff the command's output
+                begins with HTTP headers to be parsed, True iff the command
+                honors offset)
+        """
+        if self.url.is_s3:
+            command_list = [self.mover.s3cmd_exe]
+            if self.mover.s3cred is not None:
+                command_list.extend(['-c', self.mover.s3cred])
+            command_list.extend(['get', self.url.to_nonnative_url(), '-',
+                                    '--force'])
+            return command_list, False, False
+        assert self.url.is_curlable
+        command_list = ['curl', '-s', '-f', '-L', '--connect-timeout', '600']
+        with_headers = self.url.type in ['http', 'https']
+        if offset:
+            command_list.extend(['-r', '%d-' % offset])
+        if with_headers:
+            command_list.append('-i')
+        command_list.append(self.url.to_url())
+        return command_list, with_headers, True
+
+    def _download(self):
+        """ Runs download command(s), feeding queue; run by self.thread. """
+        offset, tries = 0, 0
+        raw_md5 = hashlib.md5()
+        head, decompressor = '', None
+        while True:
+            command_list, with_headers, honors_offset = self._command(offset)
+            process = subprocess.Popen(command_list, bufsize=-1,
+                                        stdout=subprocess.PIPE,
+                                        stderr=sys.stderr)
+            fileno = process.stdout.fileno()
+            to_discard = 0 if honors_offset else offset
+            headers = '' if with_headers else None
+            last_data_time, stalled = time.time(), False
+            while not self.closed:
+                if not select.select([fileno], [], [], 1)[0]:
+                    if time.time() - last_data_time > self.stall_timeout:
+                        stalled = True
+                        break
+                    continue
+                data = os.read(fileno, self.chunk_size)
+                if not data: break
+                last_data_time = time.time()
+                if headers is not None:
+                    # Skip header blocks of redirects and 100 Continues
+                    headers += data
+                    while headers is not None:
+                        header_end = headers.find('\r\n\r\n')
+                        if header_end == -1: break
+                        status = headers.split(None, 2)[1]
+                        data = headers[header_end+4:]
+                        if status[0] in '13':
+                            headers = data
+                        else:
+                            headers = None
+                            if offset and status != '206':
+                                # Server ignored range; start over
+                                to_discard = offset
+                    if headers is not None: continue
+                if to_discard:
+                    discarded = min(to_discard, len(data))
+                    to_discard -= discarded
+                    data = data[discarded:]
+                    if not data: continue
+                offset += len(data)
+                raw_md5.update(data)
+                if decompressor is None:
+                    head += data
+                    if len(head) < 2: continue
+                    if head[:2] == '\x1f\x8b':
+                        decompressor = zlib.decompressobj(31)
+                    else:
+                        decompressor = False
+                    data, head = head, ''
+                if decompressor:
+                    decompressed = []
+                    while data:
+                        decompressed.append(decompressor.decompress(data))
+                        data = decompressor.unused_data
+                        if data:
+                            # Concatenated gzip members
+                            decompressor = zlib.decompressobj(31)
+                    data = ''.join(decompressed)
+                if data: self._put(data)
+            if self.closed or stalled:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+            process.stdout.close()
+            return_code = process.wait()
+            if self.closed: return
+            if stalled or return_code:
+                tries += 1
+                if tries >= self.tries:
+                    self._put(RuntimeError(
+                            ('Could not download "%s" within %d tries; last '
+                             'command was "%s".') % (self.name, self.tries,
+                                                        ' '.join(command_list))
+                        ))
+                    return
+                print >>sys.stderr, (
+                        'Download %s on try %d; resuming at byte %d.'
+                    ) % ('stalled' if stalled else
+                            'failed with exit code %d' % return_code,
+                            tries, offset)
+                time.sleep(2)
+                continue
+            break
+        if head:
+            # File was shorter than two bytes
+            self._put(head)
+        if self.md5 is not None and raw_md5.hexdigest() != self.md5:
+            self._put(RuntimeError(
+                    'MD5 of "%s" is %s, but %s was expected.'
+                    % (self.name, raw_md5.hexdigest(), self.md5)
+                ))
+            return
+        self._put(None)
+
+    def _fill(self):
+        """ Appends next chunk from queue to buffer.
+
+            Return value: False iff download is complete
+        """
+        if self.eof: return False
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            self.eof = True
+            raise chunk
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def readline(self):
+        while True:
+            newline = self.buffer.find('\n', self.position)
+            if newline != -1:
+                line = self.buffer[self.position:newline+1]
+                self.position = newline + 1
+                return line
+            if not self._fill():
+                line = self.buffer[self.position:]
+                self.buffer, self.position = '', 0
+                return line
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            if not self._fill(): break
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position+size]
+        self.position += len(data)
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        """ Stops download and joins its thread. """
+        self.closed = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 class FileMover(object):
     """ Responsible for details on how to move files to and from URLs. """
     
@@ -130,6 +367,20 @@ class FileMover(object):
         else:
             return False
     
+    def stream(self, url, md5=None, stall_timeout=120):
+        """ Opens a remote file for reading while it downloads.
+
+            url: HTTP, FTP or S3 URL of file
+            md5: MD5 of file as stored, which is checked once the download
+                is complete, or None/a placeholder if it shouldn't be checked
+            stall_timeout: seconds without data after which download is
+                resumed
+
+            Return value: DownloadStream object
+        """
+        return DownloadStream(url, self, md5=md5,
+                                stall_timeout=stall_timeout)
+
     def get(self, url, dest="."):
         """ Get a file to local directory.
 
@@ -278,4 +529,152 @@ class FileMover(object):
             if exit_level > 0:
                 raise RuntimeError('Nonzero exitlevel %d from hadoop fs '
                                    '-get command "%s"' % (exit_level,
-                                        ' '.join(command_list)))
\ No newline at end of file
+                                        ' '.join(command_list)))
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', action='store_const', const=True,
+        default=False, help='Do unit tests')
+    args = parser.parse_args()
+
+    if args.test:
+        import unittest
+        import shutil
+        import tempfile
+        import gzip
+        import BaseHTTPServer
+        import SocketServer
+        site_path = os.path.dirname(os.path.dirname(os.path.dirname(
+                            os.path.realpath(__file__)
+                        )))
+        sys.path.insert(0, site_path)
+        from dooplicity.ansibles import Url
+
+        class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """ Serves server.files, honoring ranges unless told not to.
+
+                The first request for a path in server.stall_paths sends half
+                the file and then hangs.
+            """
+            def do_GET(self):
+                data = self.server.files[self.path]
+                start, status = 0, 200
+                range_header = self.headers.getheader('Range')
+                if range_header and self.path not in self.server.no_range:
+                    start = int(range_header.split('=')[1].split('-')[0])
+                    status = 206
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(data) - start))
+                self.end_headers()
+                if self.path in self.server.stall_paths:
+                    self.server.stall_paths.remove(self.path)
+                    self.wfile.write(data[start:start + len(data) / 2])
+                    self.wfile.flush()
+                    time.sleep(5)
+                    return
+                self.wfile.write(data[start:])
+
+            def log_message(self, *args):
+                pass
+
+        class QuietHTTPServer(SocketServer.ThreadingMixIn,
+                                BaseHTTPServer.HTTPServer):
+            """ Ignores clients that hang up early, as closed streams do. """
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                pass
+
+        class TestDownloadStream(unittest.TestCase):
+            """ Tests DownloadStream against local HTTP and S3 stand-ins. """
+            def setUp(self):
+                self.temp_dir_path = tempfile.mkdtemp()
+                self.lines = ['@r%d\nACGTACGT\n+\nIIIIIIII\n' % i
+                                for i in xrange(20000)]
+                self.raw = ''.join(self.lines)
+                gzipped_path = os.path.join(self.temp_dir_path, 'r.fq.gz')
+                gzipped = gzip.open(gzipped_path, 'wb')
+                gzipped.write(self.raw)
+                gzipped.close()
+                with open(gzipped_path, 'rb') as gzipped:
+                    self.gzipped = gzipped.read()
+                self.server = QuietHTTPServer(
+                        ('127.0.0.1', 0), RangeHandler
+                    )
+                self.server.files = {'/r.fq' : self.raw,
+                                     '/r.fq.gz' : self.gzipped}
+                self.server.no_range, self.server.stall_paths = set(), set()
+                self.server_thread = threading.Thread(
+                        target=self.server.serve_forever
+                    )
+                self.server_thread.daemon = True
+                self.server_thread.start()
+                self.mover = FileMover()
+
+            def url(self, path):
+                return Url('http://127.0.0.1:%d%s' % (
+                                            self.server.server_address[1], path
+                                        ))
+
+            def test_plain_and_gzipped(self):
+                """ Fails if streamed lines differ from file's lines. """
+                for path in ['/r.fq', '/r.fq.gz']:
+                    with self.mover.stream(self.url(path)) as stream:
+                        self.assertEqual(''.join(stream), self.raw)
+
+            def test_md5(self):
+                """ Fails if a bad MD5 goes unnoticed or a good one doesn't. """
+                good_md5 = hashlib.md5(self.gzipped).hexdigest()
+                with self.mover.stream(self.url('/r.fq.gz'),
+                                        md5=good_md5) as stream:
+                    self.assertEqual(stream.read(), self.raw)
+                with self.mover.stream(self.url('/r.fq.gz'),
+                                        md5='0' * 32) as stream:
+                    self.assertRaises(RuntimeError, stream.read)
+                with self.mover.stream(self.url('/r.fq.gz'),
+                                        md5='0') as stream:
+                    self.assertEqual(stream.read(), self.raw)
+
+            def test_resume_after_stall(self):
+                """ Fails if download isn't resumed with a range request. """
+                self.server.stall_paths.add('/r.fq.gz')
+                with self.mover.stream(self.url('/r.fq.gz'),
+                                        md5=hashlib.md5(
+                                                self.gzipped
+                                            ).hexdigest(),
+                                        stall_timeout=1) as stream:
+                    self.assertEqual(stream.read(), self.raw)
+
+            def test_resume_without_range_support(self):
+                """ Fails if server ignoring range corrupts download. """
+                self.server.stall_paths.add('/r.fq')
+                self.server.no_range.add('/r.fq')
+                with self.mover.stream(self.url('/r.fq'),
+                                        stall_timeout=1) as stream:
+                    self.assertEqual(stream.read(), self.raw)
+
+            def test_s3(self):
+                """ Fails if s3cmd get's output isn't streamed. """
+                gzipped_path = os.path.join(self.temp_dir_path, 'r.fq.gz')
+                s3cmd_path = os.path.join(self.temp_dir_path, 's3cmd')
+                with open(s3cmd_path, 'w') as s3cmd_stream:
+                    print >>s3cmd_stream, '#!/bin/sh\ncat %s' % gzipped_path
+                os.chmod(s3cmd_path, 0755)
+                self.mover.s3cmd_exe = s3cmd_path
+                with self.mover.stream(Url('s3://bucket/r.fq.gz')) as stream:
+                    self.assertEqual(stream.readline(), self.lines[0][:4])
+                    self.assertEqual(stream.read(), self.raw[4:])
+
+            def test_early_close(self):
+                """ Fails if closing a stream before it's read hangs. """
+                stream = self.mover.stream(self.url('/r.fq'))
+                stream.readline()
+                stream.close()
+                self.assertFalse(stream.thread.is_alive())
+
+            def tearDown(self):
+                self.server.shutdown()
+                self.server.server_close()
+                shutil.rmtree(self.temp_dir_path)
+
+        unittest.main(argv=[sys.argv[0]])
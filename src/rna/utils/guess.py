@@ -17,6 +17,28 @@ Phred64 : (64, 104) . Check out maxes and mins of ord(chars) in
 phred_converter functions below; they are written to guarantee that the ranges
 of quality chars fall within these ranges of valid chars.'''
 
+def phred_translation_table(phred_format):
+    """ Gets 256-character str.translate() table converting to Sanger format.
+
+        Each quality character is converted independently of the others, so
+        the conversion is computed once for every possible character here
+        rather than once for every character of every read.
+
+        phred_format: one of {Sanger, Solexa, Phred64}
+
+        Return value: 256-character translation table
+    """
+    if phred_format == 'Solexa':
+        return ''.join([
+                chr(int(round(
+                    10*math.log(1+10**((min(max(i, 59), 104)-64)/10.0),10)
+                )+33)) for i in xrange(256)
+            ])
+    elif phred_format == 'Sanger':
+        return ''.join([chr(min(max(i, 33), 93)) for i in xrange(256)])
+    assert phred_format == 'Phred64'
+    return ''.join([chr(min(max(i, 64), 104) - 31) for i in xrange(256)])
+
 def inferred_phred_format(fastq_stream, sample_size=10000, verbose=True):
     """ Studies a selection of reads from a sample to determine Phred format.
 
@@ -102,21 +124,64 @@ def phred_converter(fastq_stream=None, phred_format=None, sample_size=10000):
     if phred_format is None:
         phred_format = inferred_phred_format(fastq_stream,
                                                 sample_size=sample_size)[0]
-    if phred_format == 'Solexa':
-       def final_converter(qual):
-           return ''.join([
-                               chr(int(round(
-                           10*math.log(1+10**((min(max(ord(char), 59), 104)-64)
-                            /10.0),10)
-                   )+33)) for char in qual
-                ])
-    elif phred_format == 'Sanger':
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 33), 93)) for char in qual)
-    else:
-        assert phred_format == 'Phred64'
-        # It's Phred64
-        def final_converter(qual):
-            return ''.join(chr(min(max(ord(char), 64), 104) - 31)
-                                for char in qual)
-    return final_converter
\ No newline at end of file
+    conversion_table = phred_translation_table(phred_format)
+    def final_converter(qual):
+        return qual.translate(conversion_table)
+    return final_converter
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', action='store_const', const=True,
+        default=False, help='Do unit tests')
+    args = parser.parse_args()
+
+    if args.test:
+        import unittest
+
+        class TestPhredConverter(unittest.TestCase):
+            """ Checks translation tables against per-character formulas. """
+            def setUp(self):
+                self.all_chars = ''.join([chr(i) for i in xrange(256)])
+
+            def test_solexa(self):
+                self.assertEqual(
+                        phred_converter(phred_format='Solexa')(
+                                self.all_chars
+                            ),
+                        ''.join([chr(int(round(
+                            10*math.log(
+                                1+10**((min(max(ord(char), 59), 104)-64)
+                                    /10.0),10)
+                            )+33)) for char in self.all_chars])
+                    )
+
+            def test_sanger(self):
+                self.assertEqual(
+                        phred_converter(phred_format='Sanger')(
+                                self.all_chars
+                            ),
+                        ''.join([chr(min(max(ord(char), 33), 93))
+                                    for char in self.all_chars])
+                    )
+
+            def test_phred64(self):
+                self.assertEqual(
+                        phred_converter(phred_format='Phred64')(
+                                self.all_chars
+                            ),
+                        ''.join([chr(min(max(ord(char), 64), 104) - 31)
+                                    for char in self.all_chars])
+                    )
+
+            def test_inferred_format(self):
+                from cStringIO import StringIO
+                fastq_stream = StringIO(
+                        '@r1\nACGT\n+\nhhh;\n@r2\nACGT\n+\n@@^^\n'
+                    )
+                self.assertEqual(
+                        phred_converter(fastq_stream=fastq_stream)('h;'),
+                        phred_converter(phred_format='Solexa')('h;')
+                    )
+
+        unittest.main(argv=[sys.argv[0]])
@@ -0,0 +1,268 @@
+"""
+index_cache.py
+Part of Rail-RNA
+
+Content-addressed on-disk cache of Bowtie 2 indexes. An index is keyed by
+the SHA-1 digest of the FASTA it was built from, so identical FASTAs from
+different index groups, tasks and runs on the same node share one build.
+Entries are directories of index files; the least recently used are
+evicted when the cache grows past a size limit.
+"""
+import os
+import glob
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+def add_args(parser):
+    """ Sets up arguments related to caching indexes. """
+    parser.add_argument(
+        '--index-cache', metavar='DIR', type=str, required=False,
+        default=None,
+        help='Directory in which to cache Bowtie 2 indexes by FASTA content '
+             '(def: railrna-index-cache in --scratch or the default '
+             'temporary directory)')
+    parser.add_argument(
+        '--index-cache-size', metavar='MB', type=int, required=False,
+        default=2048,
+        help='Maximum size of index cache; least recently used indexes are '
+             'evicted past this. 0 disables the cache')
+
+def cache_from_args(args, salt=''):
+    """ Sets up index cache as specified by command-line arguments.
+
+        args: parsed arguments, including those from add_args() and
+            tempdel.add_args()
+        salt: string distinguishing indexes built from the same FASTA
+            with different builds, like path to bowtie2-build
+
+        Return value: IndexCache object, or None if cache is disabled
+    """
+    if args.index_cache_size <= 0:
+        return None
+    if args.index_cache is not None:
+        cache_dir = os.path.expandvars(args.index_cache)
+    else:
+        scratch = (os.path.expandvars(args.scratch)
+                    if args.scratch else tempfile.gettempdir())
+        cache_dir = os.path.join(scratch, 'railrna-index-cache')
+    return IndexCache(cache_dir, args.index_cache_size * 1048576, salt=salt)
+
+class IndexCache(object):
+    """ Caches index files in directories named for FASTA digests.
+
+        Entries are staged in a hidden directory and renamed into place, so
+        tasks sharing a cache never see partial entries. An entry's mtime
+        is updated when it is fetched, which orders entries for eviction.
+    """
+    def __init__(self, cache_dir, max_size, salt=''):
+        """
+            cache_dir: directory in which to cache indexes; created if it
+                doesn't exist
+            max_size: maximum size of cache in bytes
+            salt: string prepended to FASTA content when computing keys
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.salt = salt
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    def key(self, fasta_filename):
+        """ Computes key of index to build from FASTA.
+
+            fasta_filename: path to FASTA
+
+            Return value: hex digest of salt and FASTA content
+        """
+        digest = hashlib.sha1(self.salt)
+        with open(fasta_filename, 'rb') as fasta_stream:
+            while True:
+                data = fasta_stream.read(1048576)
+                if not data: break
+                digest.update(data)
+        return digest.hexdigest()
+
+    def fetch(self, key, index_basename):
+        """ Copies cached index files, if any, to index basename.
+
+            Files are hard-linked when possible.
+
+            key: key of index from key()
+            index_basename: path to basename of index to write
+
+            Return value: True iff index was found in cache
+        """
+        entry = os.path.join(self.cache_dir, key)
+        try:
+            index_files = os.listdir(entry)
+            for index_file in index_files:
+                destination = index_basename + index_file[5:]
+                try:
+                    os.link(os.path.join(entry, index_file), destination)
+                except OSError:
+                    shutil.copyfile(os.path.join(entry, index_file),
+                                    destination)
+            os.utime(entry, None)
+        except (OSError, IOError):
+            # Not cached, or evicted by another task while copying
+            return False
+        return bool(index_files)
+
+    def store(self, key, index_basename):
+        """ Adds index files to cache, then evicts old entries if necessary.
+
+            key: key of index from key()
+            index_basename: path to basename of index built
+
+            No return value.
+        """
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry): return
+        staging = tempfile.mkdtemp(dir=self.cache_dir, prefix='.staging.')
+        try:
+            for index_file in glob.glob(index_basename + '.*'):
+                shutil.copyfile(index_file, os.path.join(
+                        staging, 'index' + index_file[len(index_basename):]
+                    ))
+            os.rename(staging, entry)
+        except OSError:
+            # Another task cached the same index first
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """ Removes least recently used entries until cache fits max size.
+
+            No return value.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'): continue
+            entry = os.path.join(self.cache_dir, key)
+            try:
+                entries.append((os.path.getmtime(entry), sum(
+                        [os.path.getsize(os.path.join(entry, index_file))
+                            for index_file in os.listdir(entry)]
+                    ), entry))
+            except OSError:
+                continue
+        entries.sort()
+        total_size = sum([size for _, size, _ in entries])
+        for _, size, entry in entries:
+            if total_size <= self.max_size: break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+
+def build(bowtie2_build_exe, fasta_file, index_basename, cache=None,
+            output_stream=None):
+    """ Builds Bowtie 2 index from FASTA unless it's in the cache.
+
+        bowtie2_build_exe: path to bowtie2-build executable
+        fasta_file: path to FASTA to index
+        index_basename: path to basename of index to write
+        cache: IndexCache object, or None if not caching
+        output_stream: where to send bowtie2-build's stdout and stderr, or
+            None to discard them
+
+        Return value: return value of bowtie2-build process, or 0 if index
+            was cached
+    """
+    if cache is not None:
+        key = cache.key(fasta_file)
+        if cache.fetch(key, index_basename):
+            return 0
+    if output_stream is None:
+        with open(os.devnull, 'w') as null_stream:
+            return_code = subprocess.call(
+                    [bowtie2_build_exe, fasta_file, index_basename],
+                    stdout=null_stream, stderr=null_stream
+                )
+    else:
+        return_code = subprocess.call(
+                [bowtie2_build_exe, fasta_file, index_basename],
+                stdout=output_stream, stderr=output_stream
+            )
+    if not return_code and cache is not None:
+        cache.store(key, index_basename)
+    return return_code
+
+if __name__ == '__main__':
+    import unittest
+    import time
+
+    class TestIndexCache(unittest.TestCase):
+        """ Tests IndexCache and build() with a fake bowtie2-build. """
+        def setUp(self):
+            self.temp_dir_path = tempfile.mkdtemp()
+            self.cache = IndexCache(
+                    os.path.join(self.temp_dir_path, 'cache'), 300
+                )
+            self.build_log = os.path.join(self.temp_dir_path, 'builds')
+            self.build_exe = os.path.join(self.temp_dir_path, 'build.sh')
+            with open(self.build_exe, 'w') as build_stream:
+                # Index files are each 100 bytes
+                print >>build_stream, (
+                        '#!/bin/sh\n'
+                        'echo $1 >>%s\n'
+                        'head -c 100 /dev/zero >$2.1.bt2\n'
+                        'head -c 100 /dev/zero >$2.rev.1.bt2'
+                    ) % self.build_log
+            os.chmod(self.build_exe, 0755)
+
+        def fasta(self, name, seq):
+            """ Writes FASTA; returns its path. """
+            fasta_file = os.path.join(self.temp_dir_path, name + '.fa')
+            with open(fasta_file, 'w') as fasta_stream:
+                print >>fasta_stream, '>%s\n%s' % (name, seq)
+            return fasta_file
+
+        def builds(self):
+            """ Returns number of times bowtie2-build was run. """
+            try:
+                with open(self.build_log) as build_stream:
+                    return len(build_stream.readlines())
+            except IOError:
+                return 0
+
+        def test_hit(self):
+            """ Fails if identical FASTA is rebuilt. """
+            first = os.path.join(self.temp_dir_path, 'first')
+            second = os.path.join(self.temp_dir_path, 'second')
+            # Large enough to hold both indexes
+            self.cache.max_size = 1000
+            self.assertEquals(build(self.build_exe, self.fasta('a', 'ACGT'),
+                                    first, cache=self.cache), 0)
+            self.assertEquals(build(self.build_exe, self.fasta('b', 'ACGT'),
+                                    second, cache=self.cache), 0)
+            self.assertEquals(build(self.build_exe, self.fasta('a', 'ACGT'),
+                                    second, cache=self.cache), 0)
+            self.assertEquals(self.builds(), 2)
+            self.assertEquals(sorted(os.listdir(self.temp_dir_path)),
+                              ['a.fa', 'b.fa', 'build.sh', 'builds', 'cache',
+                               'first.1.bt2', 'first.rev.1.bt2',
+                               'second.1.bt2', 'second.rev.1.bt2'])
+
+        def test_eviction(self):
+            """ Fails if least recently used index isn't evicted. """
+            basename = os.path.join(self.temp_dir_path, 'index')
+            for name in 'abc':
+                build(self.build_exe, self.fasta(name, 'A'), basename,
+                        cache=self.cache)
+                for index_file in glob.glob(basename + '.*'):
+                    os.remove(index_file)
+                time.sleep(0.01)
+            self.assertEquals(len(os.listdir(self.cache.cache_dir)), 1)
+            build(self.build_exe, self.fasta('c', 'A'), basename,
+                    cache=self.cache)
+            self.assertEquals(self.builds(), 3)
+
+        def tearDown(self):
+            shutil.rmtree(self.temp_dir_path)
+
+    unittest.main()